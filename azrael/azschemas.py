@@ -146,6 +146,7 @@ Template = {
     'properties': {
         'aid': {'type': 'string'},
         'custom': {'type': 'string'},
+        'quality': {'type': 'string'},
         'rbs': {'$ref': '#/definitions/RigidBodyState'},
         'fragments': {
             'type': 'object',
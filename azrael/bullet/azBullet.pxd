@@ -13,19 +13,23 @@ cdef extern from "broadphase_callback.cpp":
 
 
 # Custom callbacks functions for narrowphase solver.
-cdef extern from "narrowphase_callback.cpp":
-    cdef void installNarrowphaseCallback(btDiscreteDynamicsWorld *world)
-    cdef void resetNarrowphasePairCache();
-    cdef vector[AzraelCollisionData] narrowphasePairCache
+cdef extern from "narrowphase_callback.cpp" nogil:
+    cdef void installNarrowphaseCallback(
+        btDiscreteDynamicsWorld *world, vector[AzraelCollisionData] *cache)
+    cdef void resetNarrowphasePairCache(vector[AzraelCollisionData] *cache);
+    cdef void azCompileContacts(
+        btDiscreteDynamicsWorld *world, vector[AzraelCollisionData] *cache,
+        bint touchingOnly)
     cdef struct AzraelCollisionData:
         int aid_a
         int aid_b
         btVector3 point_a
         btVector3 point_b
         btVector3 normal_on_b
+        btScalar impulse
 
 
-cdef extern from "btBulletDynamicsCommon.h":
+cdef extern from "btBulletDynamicsCommon.h" nogil:
     cdef cppclass btDefaultCollisionConfiguration:
         btDefaultCollisionConfiguration()
 
@@ -70,6 +74,13 @@ cdef extern from "btBulletDynamicsCommon.h":
         btOverlappingPairCache()
         void setOverlapFilterCallback(btOverlapFilterCallback *callback)
 
+    cdef cppclass btContactSolverInfo:
+        int m_numIterations
+        int m_splitImpulse
+        btScalar m_warmstartingFactor
+        btScalar m_erp
+        btScalar m_globalCfm
+
     cdef cppclass btDiscreteDynamicsWorld:
         btDiscreteDynamicsWorld(
                 btCollisionDispatcher *dispatcher,
@@ -90,3 +101,14 @@ cdef extern from "btBulletDynamicsCommon.h":
         btDispatcher *getDispatcher()
         void performDiscreteCollisionDetection()
         btOverlappingPairCache *getPairCache()
+        btContactSolverInfo &getSolverInfo()
+
+
+# Dynamics world with continuous collision detection for compound shapes.
+cdef extern from "ccd_world.cpp" nogil:
+    cdef cppclass AzraelDynamicsWorld(btDiscreteDynamicsWorld):
+        AzraelDynamicsWorld(
+                btCollisionDispatcher *dispatcher,
+                btBroadphaseInterface *pairCache,
+                btSequentialImpulseConstraintSolver *constraintSolver,
+                btDefaultCollisionConfiguration *collisionConfiguration)
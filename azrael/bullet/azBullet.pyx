@@ -23,6 +23,7 @@ To compile and test:
 Python version of Bullet's Hello World program:
   >> python hello.py
 """
+import numpy as np
 from cpython.object cimport Py_EQ, Py_NE
 
 from basic cimport *
@@ -44,6 +45,41 @@ include 'rigid_body.pyx'
 include 'typed_constraint.pyx'
 
 
+cdef list _contactsToPython(vector[AzraelCollisionData] *pc):
+    """
+    Convert the collision contacts in ``pc`` to a list of dictionaries.
+
+    See ``BulletBase.azGetNarrowphaseContacts`` for the format.
+    """
+    # Compile the collision information from bullet into a Python
+    # dictionary and pass it to the (Python)caller.
+    out = []
+    for ii in range(pc[0].size()):
+        tmp = {
+            'aid_a': pc[0][ii].aid_a,
+            'aid_b': pc[0][ii].aid_b,
+            'point_a': (
+                <double>(pc[0][ii].point_a.x()),
+                <double>(pc[0][ii].point_a.y()),
+                <double>(pc[0][ii].point_a.z())
+            ),
+            'point_b': (
+                <double>(pc[0][ii].point_b.x()),
+                <double>(pc[0][ii].point_b.y()),
+                <double>(pc[0][ii].point_b.z())
+            ),
+        }
+
+        # Swap the information if aid_a < aid_b.
+        if tmp['aid_a'] > tmp['aid_b']:
+            tmp['aid_a'], tmp['aid_b'] = tmp['aid_b'], tmp['aid_a']
+            tmp['point_a'], tmp['point_b'] = tmp['point_b'], tmp['point_a']
+
+        # Add the current collision info to the buffer.
+        out.append(tmp)
+    return out
+
+
 cdef class BulletBase:
     """
     Framework class that sets up a complete simulation environment.
@@ -54,6 +90,7 @@ cdef class BulletBase:
     cdef btSequentialImpulseConstraintSolver *solver
     cdef btDiscreteDynamicsWorld *dynamicsWorld
     cdef BroadphasePaircacheBuilder *cb_broadphase
+    cdef vector[AzraelCollisionData] *narrowphasePairCache
     cdef list _list_constraints
 
     def __cinit__(self):
@@ -70,8 +107,9 @@ cdef class BulletBase:
         self.solver = new btSequentialImpulseConstraintSolver()
         assert self.solver != NULL
 
-        # Create the simulation.
-        self.dynamicsWorld = new btDiscreteDynamicsWorld(
+        # Create the simulation. Unlike the default Bullet world, this one
+        # supports continuous collision detection for compound shapes.
+        self.dynamicsWorld = new AzraelDynamicsWorld(
             self.dispatcher,
             # Downcast to the base class.
             <btBroadphaseInterface*>self.pairCache,
@@ -81,8 +119,13 @@ cdef class BulletBase:
 
         # Install a custom handler that Bullet calls after each tick. The
         # handler is a pure C++ function and compiles all the collision
-        # contacts that have occurred during that tick.
-        installNarrowphaseCallback(self.dynamicsWorld)
+        # contacts that have occurred during that tick into the pair cache of
+        # this world (every world has its own cache to ensure different worlds
+        # can be stepped concurrently in different threads).
+        self.narrowphasePairCache = new vector[AzraelCollisionData]()
+        assert self.narrowphasePairCache != NULL
+        installNarrowphaseCallback(
+            self.dynamicsWorld, self.narrowphasePairCache)
 
         # Container to keep track of all constraints.
         self._list_constraints = []
@@ -99,6 +142,7 @@ cdef class BulletBase:
         del self.pairCache
         del self.dispatcher
         del self.collisionConfiguration
+        del self.narrowphasePairCache
 
     def setGravity(self, Vec3 v):
         self.dynamicsWorld.setGravity(v.ptr_Vector3[0])
@@ -107,6 +151,33 @@ cdef class BulletBase:
         cdef btVector3 tmp = self.dynamicsWorld.getGravity()
         return Vec3(<double>tmp.x(), <double>tmp.y(), <double>tmp.z())
 
+    def setSolverInfo(self, int numIterations, bint splitImpulse,
+                      double warmstartingFactor, double erp, double globalCfm):
+        """
+        Specify the parameters of the constraint solver.
+
+        The ``erp`` value applies to joints and to contacts without split
+        impulses. The (separate) ERP for split impulses remains unchanged.
+        """
+        cdef btContactSolverInfo *info = &self.dynamicsWorld.getSolverInfo()
+        info.m_numIterations = numIterations
+        info.m_splitImpulse = splitImpulse
+        info.m_warmstartingFactor = btScalar(warmstartingFactor)
+        info.m_erp = btScalar(erp)
+        info.m_globalCfm = btScalar(globalCfm)
+
+    def getSolverInfo(self):
+        """
+        Return the parameters of the constraint solver.
+
+        The return value is the tuple (numIterations, splitImpulse,
+        warmstartingFactor, erp, globalCfm).
+        """
+        cdef btContactSolverInfo *info = &self.dynamicsWorld.getSolverInfo()
+        return (info.m_numIterations, bool(info.m_splitImpulse),
+                <double>info.m_warmstartingFactor, <double>info.m_erp,
+                <double>info.m_globalCfm)
+
     def installBroadphaseCallback(self):
         # Install the broadphase callback. This is only necessary if Bullet
         # should do the broadphase instead of Azrael, but that did not work out
@@ -118,8 +189,9 @@ cdef class BulletBase:
 
     def azResetPairCache(self):
         # Clear the pair cache that has built up in the Broadphase callback.
-        self.cb_broadphase.azResetPairCache()
-        resetNarrowphasePairCache()
+        if self.cb_broadphase != NULL:
+            self.cb_broadphase.azResetPairCache()
+        resetNarrowphasePairCache(self.narrowphasePairCache)
 
     def azReturnPairCache(self):
         # Return latest set of broadphase collision pairs.
@@ -130,79 +202,27 @@ cdef class BulletBase:
         return set(zip(ret[0::2], ret[1::2]))
 
     def updateAabbs(self):
-        self.dynamicsWorld.updateAabbs()
+        with nogil:
+            self.dynamicsWorld.updateAabbs()
 
     def performDiscreteCollisionDetection(self):
-        self.dynamicsWorld.performDiscreteCollisionDetection()
+        with nogil:
+            self.dynamicsWorld.performDiscreteCollisionDetection()
 
     def azGetLastContacts(self):
-        # Convenience.
-        cdef btDispatcher *dispatcher = self.dynamicsWorld.getDispatcher()
-
-        # Allocate auxiliary variables needed later on.
-        cdef btManifoldPoint ptr_mp
-        cdef btPersistentManifold* contactManifold
-
-        # This list will contain the contact information returned to the
-        # caller.
-        pairData = []
-
-        # Auxiliary Python objects to gain access to the 'azGetBodyID'
-        # convenience methods.
-        rb_a, rb_b = CollisionObject(), CollisionObject()
-
-        for ii in range(dispatcher.getNumManifolds()):
-            contactManifold = dispatcher.getManifoldByIndexInternal(ii)
-
-            # Skip the current pair of bodies because they are only close but
-            # do not touch each other.
-            if contactManifold.getNumContacts() == 0:
-                continue
-
-            # Get the two objects.
-            rb_a.ptr_CollisionObject = <btCollisionObject*>(contactManifold.getBody0())
-            rb_b.ptr_CollisionObject = <btCollisionObject*>(contactManifold.getBody1())
-
-            # Query the bodyIDs of both objects. Skip the rest of this loop if
-            # one (or both) objects have no ID.
-            bodyIDs = rb_a.azGetBodyID(), rb_b.azGetBodyID()
-            if None in bodyIDs:
-                continue
-            aid_a, aid_b = bodyIDs
-
-            # Compile the list of all contact positions for the current pair.
-            for jj in range(contactManifold.getNumContacts()):
-                # Query the contact point structure.
-                ptr_mp = contactManifold.getContactPoint(jj)
-
-                # Add the contact point locations to our pairData dictionary.
-                tmp = {
-                    'aid_a': aid_a,
-                    'aid_b': aid_b,
-                    'point_a': (
-                        <double>(ptr_mp.getPositionWorldOnA().x()),
-                        <double>(ptr_mp.getPositionWorldOnA().y()),
-                        <double>(ptr_mp.getPositionWorldOnA().z())
-                    ),
-                    'point_b': (
-                        <double>(ptr_mp.getPositionWorldOnB().x()),
-                        <double>(ptr_mp.getPositionWorldOnB().y()),
-                        <double>(ptr_mp.getPositionWorldOnB().z())
-                    ),
-                }
-
-                # Ensure aid_a < aid_b.
-                if tmp['aid_a'] > tmp['aid_b']:
-                    tmp['aid_a'], tmp['aid_b'] = tmp['aid_b'], tmp['aid_a']
-                    tmp['point_a'], tmp['point_b'] = tmp['point_b'], tmp['point_a']
-                pairData.append(tmp)
-
-        # Explicitly set the internal pointers to NULL as the destructor of rb_a
-        # and rb_b would otherwise deallocate the user pointers where the
-        # bodyID is stored.
-        rb_a.ptr_CollisionObject = NULL
-        rb_b.ptr_CollisionObject = NULL
-        return pairData
+        """
+        Return all contact points currently known to the dispatcher.
+
+        The format is the same as in ``azGetNarrowphaseContacts`` but, unlike
+        there, the contact points of bodies that are merely close are
+        included as well.
+        """
+        cdef vector[AzraelCollisionData] contacts
+
+        # Compile the contacts without holding the GIL.
+        with nogil:
+            azCompileContacts(self.dynamicsWorld, &contacts, False)
+        return _contactsToPython(&contacts)
 
     def azGetNarrowphaseContacts(self):
         """
@@ -218,41 +238,71 @@ cdef class BulletBase:
         Returns:
             list(dict): 
         """
+        return _contactsToPython(self.narrowphasePairCache)
+
+    def azGetNarrowphaseContactsArray(self):
+        """
+        Return the collision contacts gathered during the narrowphase as
+        NumPy arrays.
+
+        The return value is an (aid, point_a, point_b, normal, impulse) tuple.
+        The (N, 2) array 'aid' contains the body IDs of the N contacts,
+        'point_a', 'point_b' and 'normal' are (N, 3) arrays, and 'impulse' is
+        an (N,) array with the impulse Bullet applied to resolve the contact.
+        The normal points from the second to the first body.
+
+        This method guarantees that aid[:, 0] <= aid[:, 1].
+
+        Returns:
+            tuple(ndarray):
+        """
         # Shorthand for readability.
-        cdef vector[AzraelCollisionData] *pc = &narrowphasePairCache
-
-        # Compile the collision information from bullet into a Python
-        # dictionary and pass it to the (Python)caller.
-        out = []
-        for ii in range(pc[0].size()):
-            tmp = {
-                'aid_a': pc[0][ii].aid_a,
-                'aid_b': pc[0][ii].aid_b,
-                'point_a': (
-                    <double>(pc[0][ii].point_a.x()),
-                    <double>(pc[0][ii].point_a.y()),
-                    <double>(pc[0][ii].point_a.z())
-                ),
-                'point_b': (
-                    <double>(pc[0][ii].point_b.x()),
-                    <double>(pc[0][ii].point_b.y()),
-                    <double>(pc[0][ii].point_b.z())
-                ),
-                # 'normal_on_b': (
-                #     <double>(pc[0][ii].normal_on_b.x()),
-                #     <double>(pc[0][ii].normal_on_b.y()),
-                #     <double>(pc[0][ii].normal_on_b.z())
-                # ),
-            }
-
-            # Swap the information if aid_a < aid_b.
-            if tmp['aid_a'] > tmp['aid_b']:
-                tmp['aid_a'], tmp['aid_b'] = tmp['aid_b'], tmp['aid_a']
-                tmp['point_a'], tmp['point_b'] = tmp['point_b'], tmp['point_a']
-
-            # Add the current collision info to the buffer.
-            out.append(tmp)
-        return out
+        cdef vector[AzraelCollisionData] *pc = self.narrowphasePairCache
+        cdef Py_ssize_t ii, num = pc[0].size()
+        cdef double sign
+
+        # Allocate the output arrays.
+        aid = np.zeros((num, 2), np.intc)
+        point_a = np.zeros((num, 3), np.float64)
+        point_b = np.zeros((num, 3), np.float64)
+        normal = np.zeros((num, 3), np.float64)
+        impulse = np.zeros(num, np.float64)
+
+        cdef int[:, ::1] v_aid = aid
+        cdef double[:, ::1] v_pa = point_a
+        cdef double[:, ::1] v_pb = point_b
+        cdef double[:, ::1] v_normal = normal
+        cdef double[::1] v_impulse = impulse
+
+        # Copy the contacts into the arrays. Swap the bodies (and flip the
+        # normal) if aid_a > aid_b.
+        cdef const btVector3 *pa
+        cdef const btVector3 *pb
+        with nogil:
+            for ii in range(num):
+                if pc[0][ii].aid_a <= pc[0][ii].aid_b:
+                    v_aid[ii, 0] = pc[0][ii].aid_a
+                    v_aid[ii, 1] = pc[0][ii].aid_b
+                    pa = &pc[0][ii].point_a
+                    pb = &pc[0][ii].point_b
+                    sign = 1
+                else:
+                    v_aid[ii, 0] = pc[0][ii].aid_b
+                    v_aid[ii, 1] = pc[0][ii].aid_a
+                    pa = &pc[0][ii].point_b
+                    pb = &pc[0][ii].point_a
+                    sign = -1
+                v_pa[ii, 0] = <double>pa.x()
+                v_pa[ii, 1] = <double>pa.y()
+                v_pa[ii, 2] = <double>pa.z()
+                v_pb[ii, 0] = <double>pb.x()
+                v_pb[ii, 1] = <double>pb.y()
+                v_pb[ii, 2] = <double>pb.z()
+                v_normal[ii, 0] = sign * <double>pc[0][ii].normal_on_b.x()
+                v_normal[ii, 1] = sign * <double>pc[0][ii].normal_on_b.y()
+                v_normal[ii, 2] = sign * <double>pc[0][ii].normal_on_b.z()
+                v_impulse[ii] = <double>pc[0][ii].impulse
+        return aid, point_a, point_b, normal, impulse
 
     def addRigidBody(self, RigidBody body, short group=-1, short mask=-1):
         if (group < 0) or (mask < 0):
@@ -280,7 +330,7 @@ cdef class BulletBase:
 
     def removeConstraint(self, TypedConstraint constraint):
         tmp = [_ for _ in self._list_constraints if _ != constraint]
-        if len(tmp) == self._list_constraints:
+        if len(tmp) == len(self._list_constraints):
             # `shape` was not in the list.
             return None
         else:
@@ -309,9 +359,12 @@ cdef class BulletBase:
         # Clear the narrowphase pair cache.
         self.azResetPairCache()
 
+        # Release the GIL while Bullet steps the world. This includes the
+        # narrowphase callback that compiles the collision contacts.
         cdef double fixedTimeStep = (timeStep / maxSubSteps)
-        self.dynamicsWorld.stepSimulation(
-            btScalar(timeStep), maxSubSteps, btScalar(fixedTimeStep))
+        with nogil:
+            self.dynamicsWorld.stepSimulation(
+                btScalar(timeStep), maxSubSteps, btScalar(fixedTimeStep))
 
     def removeRigidBody(self, RigidBody body):
         self.dynamicsWorld.removeRigidBody(body.ptr_RigidBody)
@@ -1,4 +1,4 @@
-cdef extern from "btBulletDynamicsCommon.h":
+cdef extern from "btBulletDynamicsCommon.h" nogil:
     cdef cppclass btScalar:
         btScalar(double s)
 
@@ -0,0 +1,103 @@
+#include "btBulletDynamicsCommon.h"
+
+/*
+  Sweep callback for the continuous collision detection (CCD).
+
+  This is the same filter Bullet uses internally: ignore the body
+  itself, bodies without contact response, and contacts where the body
+  moves away from the other one.
+*/
+struct AzraelCcdCallback : public btCollisionWorld::ClosestConvexResultCallback
+{
+  btCollisionObject *m_me;
+  btScalar m_allowedPenetration;
+  btDispatcher *m_dispatcher;
+
+  AzraelCcdCallback(btCollisionObject *me, const btVector3 &fromA,
+                    const btVector3 &toA, btDispatcher *dispatcher)
+    : btCollisionWorld::ClosestConvexResultCallback(fromA, toA),
+      m_me(me), m_allowedPenetration(0), m_dispatcher(dispatcher) {}
+
+  virtual btScalar addSingleResult(btCollisionWorld::LocalConvexResult &convexResult,
+                                   bool normalInWorldSpace) {
+    if (convexResult.m_hitCollisionObject == m_me) return 1;
+    if (!convexResult.m_hitCollisionObject->hasContactResponse()) return 1;
+
+    // Do not report a time of impact if the body moves away from the
+    // contact normal.
+    btVector3 relativeVelocity = m_convexToWorld - m_convexFromWorld;
+    if (convexResult.m_hitNormalLocal.dot(relativeVelocity) >= -m_allowedPenetration)
+      return 1;
+
+    return ClosestConvexResultCallback::addSingleResult(convexResult, normalInWorldSpace);
+  }
+
+  virtual bool needsCollision(btBroadphaseProxy *proxy0) const {
+    if (proxy0->m_clientObject == m_me) return false;
+    if (!ClosestConvexResultCallback::needsCollision(proxy0)) return false;
+
+    btCollisionObject *other = (btCollisionObject*)proxy0->m_clientObject;
+    if (!m_dispatcher->needsCollision(m_me, other)) return false;
+    return m_dispatcher->needsResponse(m_me, other);
+  }
+};
+
+
+/*
+  Dynamics world with CCD for compound shapes.
+
+  Bullet only clamps the motion of bodies with convex collision shapes.
+  Azrael, however, wraps all collision shapes into a compound shape (see
+  ``PyBulletDynamicsWorld._compileCollisionShape``). This class therefore
+  replaces the integration step of ``btDiscreteDynamicsWorld`` with an
+  otherwise identical one that clamps the motion of all bodies. Like in
+  Bullet, the sweep uses a sphere with the CCD swept sphere radius of the
+  body, irrespective of its actual shape.
+*/
+class AzraelDynamicsWorld : public btDiscreteDynamicsWorld
+{
+public:
+  AzraelDynamicsWorld(btDispatcher *dispatcher,
+                      btBroadphaseInterface *pairCache,
+                      btConstraintSolver *constraintSolver,
+                      btCollisionConfiguration *collisionConfiguration)
+    : btDiscreteDynamicsWorld(dispatcher, pairCache, constraintSolver,
+                              collisionConfiguration) {}
+
+protected:
+  virtual void integrateTransforms(btScalar timeStep) {
+    btTransform predictedTrans;
+    for (int i = 0; i < m_nonStaticRigidBodies.size(); i++) {
+      btRigidBody *body = m_nonStaticRigidBodies[i];
+      body->setHitFraction(1);
+      if (!body->isActive() || body->isStaticOrKinematicObject()) continue;
+
+      body->predictIntegratedTransform(timeStep, predictedTrans);
+      const btTransform &current = body->getWorldTransform();
+      btScalar squareMotion = (predictedTrans.getOrigin() - current.getOrigin()).length2();
+      btScalar threshold = body->getCcdSquareMotionThreshold();
+
+      if (getDispatchInfo().m_useContinuous && threshold && (threshold < squareMotion)) {
+        // Sweep a sphere along the path of the body (without rotation).
+        AzraelCcdCallback sweepResults(
+            body, current.getOrigin(), predictedTrans.getOrigin(), getDispatcher());
+        btSphereShape tmpSphere(body->getCcdSweptSphereRadius());
+        sweepResults.m_allowedPenetration = getDispatchInfo().m_allowedCcdPenetration;
+        sweepResults.m_collisionFilterGroup = body->getBroadphaseProxy()->m_collisionFilterGroup;
+        sweepResults.m_collisionFilterMask = body->getBroadphaseProxy()->m_collisionFilterMask;
+        btTransform modifiedPredictedTrans = predictedTrans;
+        modifiedPredictedTrans.setBasis(current.getBasis());
+
+        convexSweepTest(&tmpSphere, current, modifiedPredictedTrans, sweepResults);
+        if (sweepResults.hasHit() && (sweepResults.m_closestHitFraction < 1)) {
+          // Move the body only up to the time of impact. The collision
+          // response happens in the next sub-step.
+          body->setHitFraction(sweepResults.m_closestHitFraction);
+          body->predictIntegratedTransform(timeStep * body->getHitFraction(), predictedTrans);
+          body->setHitFraction(0);
+        }
+      }
+      body->proceedToTransform(predictedTrans);
+    }
+  }
+};
@@ -7,6 +7,16 @@ cdef extern from "btBulletDynamicsCommon.h":
         btCollisionShape *getCollisionShape()
         void setCollisionShape(btCollisionShape *collisionShape)
 
+        # {get,set}ContactProcessingThreshold
+        btScalar getContactProcessingThreshold()
+        void setContactProcessingThreshold(btScalar threshold)
+
+        # {get,set}Ccd{MotionThreshold,SweptSphereRadius}
+        btScalar getCcdMotionThreshold()
+        void setCcdMotionThreshold(btScalar ccdMotionThreshold)
+        btScalar getCcdSweptSphereRadius()
+        void setCcdSweptSphereRadius(btScalar radius)
+
         # {get,set}UserPointer
         void *getUserPointer()
         void setUserPointer(void *userPointer)
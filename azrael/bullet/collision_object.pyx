@@ -24,6 +24,25 @@ cdef class CollisionObject:
         self._ref_cs = collisionShape
         self.ptr_CollisionObject.setCollisionShape(collisionShape.ptr_CollisionShape)
 
+    def getContactProcessingThreshold(self):
+        return <double>self.ptr_CollisionObject.getContactProcessingThreshold()
+
+    def setContactProcessingThreshold(self, double threshold):
+        self.ptr_CollisionObject.setContactProcessingThreshold(
+            btScalar(threshold))
+
+    def getCcdMotionThreshold(self):
+        return <double>self.ptr_CollisionObject.getCcdMotionThreshold()
+
+    def setCcdMotionThreshold(self, double threshold):
+        self.ptr_CollisionObject.setCcdMotionThreshold(btScalar(threshold))
+
+    def getCcdSweptSphereRadius(self):
+        return <double>self.ptr_CollisionObject.getCcdSweptSphereRadius()
+
+    def setCcdSweptSphereRadius(self, double radius):
+        self.ptr_CollisionObject.setCcdSweptSphereRadius(btScalar(radius))
+
     def azSetBodyID(self, int bodyID):
         cdef int *tmp
 
@@ -9,22 +9,29 @@ struct AzraelCollisionData {
   const btVector3 point_a;
   const btVector3 point_b;
   const btVector3 normal_on_b;
+  const btScalar impulse;
 };
-std::vector<AzraelCollisionData> narrowphasePairCache;
+
+/*
+  Every dynamics world has its own pair cache. It is stored in the
+  'worldUserInfo' pointer of the world to ensure several worlds can be
+  stepped concurrently from different threads.
+*/
+typedef std::vector<AzraelCollisionData> AzraelPairCache;
 
 
 /*
-  Bullet will call this function for every pair that has a collision.
+  Compile the contacts of all collision pairs in the dispatcher of
+  ``world`` and append them to ``cache``.
 
-  We are adding some minor logic here to compile collision contacts
-  into the global `narrowphasePairCache` variable.
+  If ``touchingOnly`` is true then contact points that are merely
+  close but neither touching nor interpenetrating are skipped.
 
-  This function is a modified version of the demo provided at
-  http://www.bulletphysics.org/mediawiki-1.5.8/index.php/Simulation_Tick_Callbacks
-  as explained at
-  http://www.bulletphysics.org/mediawiki-1.5.8/index.php?title=Collision_Callbacks_and_Triggers
+  This function does not touch any Python objects and is safe to call
+  without the GIL.
  */
-void azNarrowphaseCallback(btDynamicsWorld *world, btScalar timeStep) {
+void azCompileContacts(btDynamicsWorld *world, AzraelPairCache *cache,
+                       bool touchingOnly) {
   // Handle to all contacts.
   int numManifolds = world->getDispatcher()->getNumManifolds();
 
@@ -45,10 +52,10 @@ void azNarrowphaseCallback(btDynamicsWorld *world, btScalar timeStep) {
 
     // If there is no data then this is a bug; continue to the next
     // collision pair.
-    if ((upa == NULL) || (upa == NULL)) continue;
+    if ((upa == NULL) || (upb == NULL)) continue;
 
     // Each collision pair may have multiple contacts. Loop over them
-    // all and add them to the global 'narrowphasePairCache' vector.
+    // all and add them to the cache.
     int numContacts = contactManifold->getNumContacts();
     for (int j=0;j<numContacts;j++) {
       // Get the next contact point.
@@ -57,29 +64,53 @@ void azNarrowphaseCallback(btDynamicsWorld *world, btScalar timeStep) {
       // Skip to the next contact point if the collision points for
       // this object are merely close but not touching or
       // interpenetrating.
-      if (pt.getDistance() > 0.f) continue;
+      if (touchingOnly && (pt.getDistance() > 0.f)) continue;
 
-      // Compile the collision data and add it to the global buffer.
-      narrowphasePairCache.push_back(
+      // Compile the collision data and add it to the cache.
+      cache->push_back(
         AzraelCollisionData {
           *reinterpret_cast<int*>(upa),
           *reinterpret_cast<int*>(upb),
           pt.getPositionWorldOnA(),
           pt.getPositionWorldOnB(),
-          pt.m_normalWorldOnB
+          pt.m_normalWorldOnB,
+          pt.getAppliedImpulse()
         }
       );
     }
   }
 }
 
-/* Reset the global collision pair buffer */
-void resetNarrowphasePairCache() {
-  narrowphasePairCache.clear();
-  narrowphasePairCache.reserve(1000000);
+
+/*
+  Bullet will call this function after every tick.
+
+  We are adding some minor logic here to compile collision contacts
+  into the pair cache of the world.
+
+  This function is a modified version of the demo provided at
+  http://www.bulletphysics.org/mediawiki-1.5.8/index.php/Simulation_Tick_Callbacks
+  as explained at
+  http://www.bulletphysics.org/mediawiki-1.5.8/index.php?title=Collision_Callbacks_and_Triggers
+ */
+void azNarrowphaseCallback(btDynamicsWorld *world, btScalar timeStep) {
+  // The pair cache of this world.
+  AzraelPairCache *cache = static_cast<AzraelPairCache*>(world->getWorldUserInfo());
+  if (cache == NULL) return;
+  azCompileContacts(world, cache, true);
+}
+
+/* Reset the collision pair buffer of a world */
+void resetNarrowphasePairCache(AzraelPairCache *cache) {
+  cache->clear();
 }
 
-/* Register the callback handler with the narrowphase dispatcher */
-void installNarrowphaseCallback(btDiscreteDynamicsWorld *world) {
-  world->setInternalTickCallback(azNarrowphaseCallback);
+/*
+  Register the callback handler with the narrowphase dispatcher and
+  attach the pair cache (owned by the caller) to the world.
+*/
+void installNarrowphaseCallback(btDiscreteDynamicsWorld *world,
+                                AzraelPairCache *cache) {
+  cache->reserve(1000);
+  world->setInternalTickCallback(azNarrowphaseCallback, static_cast<void*>(cache));
 }
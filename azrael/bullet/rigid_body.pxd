@@ -5,6 +5,7 @@ from transform cimport *
 from motion_state cimport *
 from collision_object cimport *
 from rigid_body cimport *
+from libcpp.vector cimport vector
 
 
 cdef extern from "btBulletDynamicsCommon.h" namespace "btRigidBody":
@@ -33,7 +34,7 @@ cdef extern from "btBulletDynamicsCommon.h" namespace "btRigidBody":
         btScalar          m_additionalAngularDampingFactor
 
 
-cdef extern from "btBulletDynamicsCommon.h":
+cdef extern from "btBulletDynamicsCommon.h" nogil:
     cdef cppclass btRigidBody:
         btRigidBody (btRigidBodyConstructionInfo &constructionInfo)
 
@@ -371,3 +371,234 @@ cdef class RigidBody(CollisionObject):
 
     def setCenterOfMassTransform(self, Transform t):
         self.ptr_RigidBody.setCenterOfMassTransform(t.ptr_Transform[0])
+
+
+# ----------------------------------------------------------------------
+# Batch functions to transfer the state of many bodies with a single call.
+# They copy the C++ pointers of all bodies into a vector first and then
+# release the GIL for the actual work.
+# ----------------------------------------------------------------------
+cdef vector[btRigidBody*] _bodyPointers(bodies, Py_ssize_t num) except *:
+    """
+    Return the C++ pointers of all ``bodies``.
+
+    Raise a ValueError if the number of ``bodies`` does not match ``num``.
+    """
+    if len(bodies) != num:
+        msg = 'Expected {} bodies but got {}'
+        raise ValueError(msg.format(num, len(bodies)))
+
+    cdef vector[btRigidBody*] out
+    cdef RigidBody body
+    out.reserve(num)
+    for body in bodies:
+        out.push_back(body.ptr_RigidBody)
+    return out
+
+
+def setRigidBodiesBatch(bodies, double[:, ::1] pose, double[:, ::1] vel,
+                        double[:, ::1] props):
+    """
+    Set the state and properties of all ``bodies``.
+
+    The i-th row of each array belongs to the i-th body:
+
+    * pose: (N, 7) centre of mass transform as (x, y, z, qx, qy, qz, qw),
+    * vel: (N, 6) linear- and angular velocity,
+    * props: (N, 16) mass, inertia (3), linear factor (3), angular factor
+      (3), restitution, friction, linear- and angular damping, and linear-
+      and angular sleeping thresholds.
+    """
+    if pose.shape[1] != 7 or vel.shape[1] != 6 or props.shape[1] != 16:
+        raise ValueError('Invalid number of columns')
+    if not (pose.shape[0] == vel.shape[0] == props.shape[0]):
+        raise ValueError('Arrays must have the same number of rows')
+
+    cdef vector[btRigidBody*] ptr = _bodyPointers(bodies, pose.shape[0])
+    cdef btRigidBody *body
+    cdef btTransform t
+    cdef btVector3 v
+    cdef size_t ii
+
+    with nogil:
+        for ii in range(ptr.size()):
+            body = ptr[ii]
+
+            # Factors, velocities and transform.
+            v = btVector3(props[ii, 7], props[ii, 8], props[ii, 9])
+            body.setAngularFactor(v)
+            v = btVector3(vel[ii, 3], vel[ii, 4], vel[ii, 5])
+            body.setAngularVelocity(v)
+            t.setIdentity()
+            t.setRotation(btQuaternion(pose[ii, 3], pose[ii, 4],
+                                       pose[ii, 5], pose[ii, 6]))
+            v = btVector3(pose[ii, 0], pose[ii, 1], pose[ii, 2])
+            t.setOrigin(v)
+            body.setCenterOfMassTransform(t)
+            body.setDamping(btScalar(props[ii, 12]), btScalar(props[ii, 13]))
+            body.setFriction(btScalar(props[ii, 11]))
+            v = btVector3(props[ii, 4], props[ii, 5], props[ii, 6])
+            body.setLinearFactor(v)
+            v = btVector3(vel[ii, 0], vel[ii, 1], vel[ii, 2])
+            body.setLinearVelocity(v)
+
+            # Mass properties.
+            v = btVector3(props[ii, 1], props[ii, 2], props[ii, 3])
+            body.setMassProps(btScalar(props[ii, 0]), v)
+            body.setRestitution(btScalar(props[ii, 10]))
+            body.setSleepingThresholds(btScalar(props[ii, 14]),
+                                       btScalar(props[ii, 15]))
+            body.updateInertiaTensor()
+
+
+def applyForcesBatch(bodies, double[:, ::1] forces):
+    """
+    Replace the central force and torque of all ``bodies``.
+
+    The i-th row of the (N, 6) ``forces`` array contains the force and
+    torque of the i-th body.
+    """
+    if forces.shape[1] != 6:
+        raise ValueError('Invalid number of columns')
+
+    cdef vector[btRigidBody*] ptr = _bodyPointers(bodies, forces.shape[0])
+    cdef btRigidBody *body
+    cdef btVector3 v
+    cdef size_t ii
+
+    with nogil:
+        for ii in range(ptr.size()):
+            body = ptr[ii]
+            body.clearForces()
+            v = btVector3(forces[ii, 0], forces[ii, 1], forces[ii, 2])
+            body.applyCentralForce(v)
+            v = btVector3(forces[ii, 3], forces[ii, 4], forces[ii, 5])
+            body.applyTorque(v)
+
+
+def getRigidBodiesBatch(bodies, double[:, ::1] pose, double[:, ::1] vel):
+    """
+    Copy the state of all ``bodies`` into ``pose`` and ``vel``.
+
+    The arrays have the same layout as in ``setRigidBodiesBatch`` and must
+    have one row per body.
+    """
+    if pose.shape[1] != 7 or vel.shape[1] != 6:
+        raise ValueError('Invalid number of columns')
+    if pose.shape[0] != vel.shape[0]:
+        raise ValueError('Arrays must have the same number of rows')
+
+    cdef vector[btRigidBody*] ptr = _bodyPointers(bodies, pose.shape[0])
+    cdef btRigidBody *body
+    cdef btTransform t
+    cdef btQuaternion q
+    cdef btVector3 v
+    cdef size_t ii
+
+    with nogil:
+        for ii in range(ptr.size()):
+            body = ptr[ii]
+            t = body.getCenterOfMassTransform()
+            v = t.getOrigin()
+            q = t.getRotation()
+            pose[ii, 0] = <double>v.x()
+            pose[ii, 1] = <double>v.y()
+            pose[ii, 2] = <double>v.z()
+            pose[ii, 3] = <double>q.x()
+            pose[ii, 4] = <double>q.y()
+            pose[ii, 5] = <double>q.z()
+            pose[ii, 6] = <double>q.w()
+
+            v = body.getLinearVelocity()
+            vel[ii, 0] = <double>v.x()
+            vel[ii, 1] = <double>v.y()
+            vel[ii, 2] = <double>v.z()
+            v = body.getAngularVelocity()
+            vel[ii, 3] = <double>v.x()
+            vel[ii, 4] = <double>v.y()
+            vel[ii, 5] = <double>v.z()
+
+
+def getRigidBodiesStateBatch(bodies, double[:, ::1] state):
+    """
+    Copy the exact kinematic state of all ``bodies`` into ``state``.
+
+    Unlike ``getRigidBodiesBatch`` this function returns the rotation matrix
+    of the centre of mass transform instead of a quaternion. This avoids the
+    round off error of the conversion and ``setRigidBodiesStateBatch`` can
+    thus restore the bodies bit for bit.
+
+    The i-th row of the (N, 18) ``state`` array contains the position (3),
+    the rotation matrix (9, row major), and the linear- and angular velocity
+    of the i-th body.
+    """
+    if state.shape[1] != 18:
+        raise ValueError('Invalid number of columns')
+
+    cdef vector[btRigidBody*] ptr = _bodyPointers(bodies, state.shape[0])
+    cdef btRigidBody *body
+    cdef btTransform t
+    cdef btVector3 v
+    cdef size_t ii
+    cdef int row
+
+    with nogil:
+        for ii in range(ptr.size()):
+            body = ptr[ii]
+            t = body.getCenterOfMassTransform()
+            v = t.getOrigin()
+            state[ii, 0] = <double>v.x()
+            state[ii, 1] = <double>v.y()
+            state[ii, 2] = <double>v.z()
+            for row in range(3):
+                v = t.getBasis().getRow(row)
+                state[ii, 3 + 3 * row] = <double>v.x()
+                state[ii, 4 + 3 * row] = <double>v.y()
+                state[ii, 5 + 3 * row] = <double>v.z()
+
+            v = body.getLinearVelocity()
+            state[ii, 12] = <double>v.x()
+            state[ii, 13] = <double>v.y()
+            state[ii, 14] = <double>v.z()
+            v = body.getAngularVelocity()
+            state[ii, 15] = <double>v.x()
+            state[ii, 16] = <double>v.y()
+            state[ii, 17] = <double>v.z()
+
+
+def setRigidBodiesStateBatch(bodies, double[:, ::1] state):
+    """
+    Restore the kinematic ``state`` of all ``bodies``.
+
+    The ``state`` array has the same layout as in
+    ``getRigidBodiesStateBatch``. The mass properties of the bodies must
+    already be set.
+    """
+    if state.shape[1] != 18:
+        raise ValueError('Invalid number of columns')
+
+    cdef vector[btRigidBody*] ptr = _bodyPointers(bodies, state.shape[0])
+    cdef btRigidBody *body
+    cdef btTransform t
+    cdef btMatrix3x3 m
+    cdef btVector3 v
+    cdef size_t ii
+
+    with nogil:
+        for ii in range(ptr.size()):
+            body = ptr[ii]
+            v = btVector3(state[ii, 12], state[ii, 13], state[ii, 14])
+            body.setLinearVelocity(v)
+            v = btVector3(state[ii, 15], state[ii, 16], state[ii, 17])
+            body.setAngularVelocity(v)
+
+            m.setValue(btScalar(state[ii, 3]), btScalar(state[ii, 4]),
+                       btScalar(state[ii, 5]), btScalar(state[ii, 6]),
+                       btScalar(state[ii, 7]), btScalar(state[ii, 8]),
+                       btScalar(state[ii, 9]), btScalar(state[ii, 10]),
+                       btScalar(state[ii, 11]))
+            t.setBasis(m)
+            v = btVector3(state[ii, 0], state[ii, 1], state[ii, 2])
+            t.setOrigin(v)
+            body.setCenterOfMassTransform(t)
+            body.updateInertiaTensor()
@@ -90,6 +90,11 @@ def compileBullet(tarball: str, libdir: str, double_precision: bool):
             '-DUSE_GRAPHICAL_BENCHMARK:BOOL=0',
         ]
 
+        # Disable the built-in profiler. It is a global singleton that is not
+        # thread safe and would prevent us from stepping several worlds in
+        # different threads.
+        cmd.append('-DCMAKE_CXX_FLAGS=-DBT_NO_PROFILE')
+
         # Specify the precision flag.
         if double_precision:
             cmd.append('-DUSE_DOUBLE_PRECISION:BOOL=1')
@@ -207,6 +212,7 @@ def main():
         macros = [('BT_USE_DOUBLE_PRECISION', None)]
     else:
         macros = []
+    macros.append(('BT_NO_PROFILE', None))
 
     # Let distutils' Extension function take care of the compiler options.
     ext = Extension(
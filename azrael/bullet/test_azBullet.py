@@ -373,6 +373,88 @@ class TestRigidBody:
         body.applyTorque(inc)
         assert body.getTotalForce() == force + inc
 
+    def test_batch(self):
+        """
+        Set and query the state and properties of several bodies with a single
+        call.
+        """
+        bodies = [getRB(bodyID=_) for _ in range(3)]
+
+        # Pose: position and (normalised) rotation of the centre of mass.
+        pose = np.zeros((3, 7), np.float64)
+        pose[:, :3] = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        pose[:, 3:] = [[0, 0, 0, 1], [0, 1, 0, 0], [0.6, 0, 0, 0.8]]
+
+        # Linear and angular velocities.
+        vel = np.arange(18, dtype=np.float64).reshape(3, 6)
+
+        # Mass, inertia, linear/angular factor, restitution, friction,
+        # damping, sleeping thresholds.
+        props = np.zeros((3, 16), np.float64)
+        props[:, 0] = [1, 2, 4]
+        props[:, 1:4] = [1, 2, 3]
+        props[:, 4:7] = [1, 0.5, 1]
+        props[:, 7:10] = [0, 1, 1]
+        props[:, 10:] = [0.9, 0.1, 0.2, 0.3, 0.4, 0.5]
+        azBullet.setRigidBodiesBatch(bodies, pose, vel, props)
+
+        for idx, body in enumerate(bodies):
+            assert body.getLinearVelocity() == Vec3(*vel[idx, :3])
+            assert body.getAngularVelocity() == Vec3(*vel[idx, 3:])
+            assert body.getLinearFactor() == Vec3(1, 0.5, 1)
+            assert body.getAngularFactor() == Vec3(0, 1, 1)
+            assert np.isclose(body.getInvMass(), 1 / props[idx, 0])
+            assert np.isclose(body.getRestitution(), 0.9)
+            assert np.isclose(body.getFriction(), 0.1)
+            assert np.isclose(body.getLinearDamping(), 0.2)
+            assert np.isclose(body.getAngularDamping(), 0.3)
+            assert np.isclose(body.getLinearSleepingThreshold(), 0.4)
+            assert np.isclose(body.getAngularSleepingThreshold(), 0.5)
+            t = body.getCenterOfMassTransform()
+            assert t.getOrigin() == Vec3(*pose[idx, :3])
+
+        # Query the state again.
+        pose_out = np.zeros_like(pose)
+        vel_out = np.zeros_like(vel)
+        azBullet.getRigidBodiesBatch(bodies, pose_out, vel_out)
+        assert np.allclose(pose, pose_out)
+        assert np.array_equal(vel, vel_out)
+
+        # Apply forces and torques. Bullet scales them with the linear- and
+        # angular factors.
+        forces = np.arange(18, dtype=np.float64).reshape(3, 6)
+        azBullet.applyForcesBatch(bodies, forces)
+        for idx, body in enumerate(bodies):
+            ref_f = forces[idx, :3] * [1, 0.5, 1]
+            ref_t = forces[idx, 3:] * [0, 1, 1]
+            assert body.getTotalForce() == Vec3(*ref_f)
+            assert body.getTotalTorque() == Vec3(*ref_t)
+
+        # The number of bodies and the array shapes must match.
+        with pytest.raises(ValueError):
+            azBullet.applyForcesBatch(bodies[:2], forces)
+        with pytest.raises(ValueError):
+            azBullet.applyForcesBatch(bodies, forces[:, :3].copy())
+        with pytest.raises(TypeError):
+            azBullet.applyForcesBatch([1, 2, 3], forces)
+
+        # The exact state (rotation matrix instead of quaternion) must survive
+        # the round trip to other bodies bit for bit.
+        state = np.zeros((3, 18), np.float64)
+        azBullet.getRigidBodiesStateBatch(bodies, state)
+        assert np.array_equal(state[:, :3], pose[:, :3])
+        assert np.array_equal(state[:, 12:], vel)
+        rotation = [1, 0, 0, 0, 0.28, -0.96, 0, 0.96, 0.28]
+        assert np.allclose(state[2, 3:12], rotation)
+
+        others = [getRB(bodyID=_) for _ in range(3)]
+        azBullet.setRigidBodiesStateBatch(others, state)
+        state_out = np.zeros_like(state)
+        azBullet.getRigidBodiesStateBatch(others, state_out)
+        assert np.array_equal(state, state_out)
+        with pytest.raises(ValueError):
+            azBullet.setRigidBodiesStateBatch(others, state[:, :13].copy())
+
     def test_damping(self):
         """
         Set/get damping factors.
@@ -418,6 +500,46 @@ class TestRigidBody:
         body.setFriction(friction)
         assert body.getFriction() == friction
 
+    def test_ccd(self):
+        """
+        Set/get the CCD parameters and verify that CCD prevents a fast body
+        from tunnelling through a thin wall.
+        """
+        # CCD is disabled by default.
+        body = getRB()
+        assert body.getCcdMotionThreshold() == 0
+        assert body.getCcdSweptSphereRadius() == 0
+
+        body.setCcdMotionThreshold(0.5)
+        body.setCcdSweptSphereRadius(0.25)
+        assert body.getCcdMotionThreshold() == 0.5
+        assert body.getCcdSweptSphereRadius() == 0.25
+
+        # Fire a small sphere at a thin static wall and advance the
+        # simulation with a single (large) step.
+        for ccd in (False, True):
+            wall = getRB(pos=Vec3(0, 0, 0), mass=0, inertia=(0, 0, 0),
+                         cshape=BoxShape(Vec3(0.05, 5, 5)), bodyID=1)
+            ball = getRB(pos=Vec3(-2, 0, 0), cshape=SphereShape(0.1),
+                         bodyID=2)
+            ball.setLinearVelocity(Vec3(40, 0, 0))
+            if ccd:
+                ball.setCcdMotionThreshold(0.1)
+                ball.setCcdSweptSphereRadius(0.05)
+
+            bb = BulletBase()
+            bb.setGravity(Vec3(0, 0, 0))
+            bb.addRigidBody(wall)
+            bb.addRigidBody(ball)
+            bb.stepSimulation(0.1, 1)
+
+            # Without CCD the ball passes through the wall.
+            pos = ball.getCenterOfMassTransform().getOrigin().topy()
+            if ccd:
+                assert pos[0] < 0
+            else:
+                assert pos[0] > 1
+
     def test_mass_inertia(self):
         """
         Set/get mass- and inertia.
@@ -1,6 +1,13 @@
 from basic cimport *
 
-cdef extern from "btBulletDynamicsCommon.h":
+cdef extern from "btBulletDynamicsCommon.h" nogil:
+    cdef cppclass btMatrix3x3:
+        btMatrix3x3()
+        const btVector3 &getRow(int i) const
+        void setValue(const btScalar &xx, const btScalar &xy, const btScalar &xz,
+                      const btScalar &yx, const btScalar &yy, const btScalar &yz,
+                      const btScalar &zx, const btScalar &zy, const btScalar &zz)
+
     cdef cppclass btTransform:
         btTransform()
         btTransform(btQuaternion &q, btVector3 &c)
@@ -11,5 +18,7 @@ cdef extern from "btBulletDynamicsCommon.h":
         btVector3 &getOrigin()
         btQuaternion getRotation()
         void setRotation(const btQuaternion &q)
+        btMatrix3x3 &getBasis()
+        void setBasis(const btMatrix3x3 &basis)
         btTransform inverse()
         void mult (const btTransform &t1, const btTransform &t2)
@@ -22,8 +22,13 @@ This module is the *one and only* module that actually imports the Bullet
 engine (ie the wrapper called `azBullet`). This will make it easier to swap out
 Bullet for another engine at some point, should the need arise.
 """
+import json
+import struct
+import hashlib
 import logging
 import numpy as np
+import azrael.integrator
+import azrael.config as config
 
 # Attempt to import the locally compiled version of azBullet first. If it does
 # not exist (typically the case inside a Docker container) then import the
@@ -35,6 +40,7 @@ except ImportError:
 
 from IPython import embed as ipshell
 from azrael.aztypes import typecheck, RetVal, _RigidBodyData, RbStateUpdate
+from azrael.aztypes import ContactData, QualityProfile, RigidBodyData
 from azrael.aztypes import ConstraintMeta, ConstraintP2P, Constraint6DofSpring2
 from azrael.aztypes import CollShapeMeta, CollShapeSphere, CollShapeBox, CollShapePlane
 
@@ -43,6 +49,143 @@ Vec3 = azBullet.Vec3
 Quaternion = azBullet.Quaternion
 Transform = azBullet.Transform
 
+# Every snapshot starts with this tag, followed by the length of its JSON
+# header (see `PyBulletDynamicsWorld.getSnapshot`).
+SNAPSHOT_MAGIC = b'AZBWSNP1'
+
+
+@typecheck
+def computeCcdRadius(rbState: _RigidBodyData):
+    """
+    Return the size of the smallest collision feature of ``rbState``.
+
+    This is the smallest half-length of the (local) AABBs of all spheres and
+    boxes in the body. Other shapes do not count. The return value is zero if
+    the body has no such shapes.
+
+    :param _RigidBodyData rbState: body description.
+    :return: smallest half-length.
+    :rtype: float
+    """
+    sizes = []
+    for cs in rbState.cshapes.values():
+        cs = CollShapeMeta(*cs)
+        cstype = cs.cstype.upper()
+        if cstype == 'SPHERE':
+            sizes.append(CollShapeSphere(*cs.csdata).radius)
+        elif cstype == 'BOX':
+            sizes.append(min(CollShapeBox(*cs.csdata)))
+    sizes = [_ for _ in sizes if _ > 0]
+    return rbState.scale * min(sizes) if len(sizes) > 0 else 0.0
+
+
+@typecheck
+def reduceContacts(contacts: ContactData, maxPoints: int, aggregate: bool):
+    """
+    Return the reduced ``contacts``.
+
+    If ``aggregate`` is True then all contact points of a body pair are
+    reduced to a single point. Its position and normal are the impulse
+    weighted average of the individual contacts (the plain average if the
+    impulses are all zero), and its impulse is the sum of the individual
+    impulses.
+
+    Otherwise, keep at most ``maxPoints`` contacts for each pair, namely the
+    ones with the largest impulses. A ``maxPoints`` value of zero keeps all
+    contacts.
+
+    In both cases the output is sorted by body pair.
+
+    :param ContactData contacts: contacts with NumPy arrays.
+    :param int maxPoints: maximum number of contacts per body pair.
+    :param bool aggregate: reduce every pair to a single contact.
+    :return: reduced contacts.
+    :rtype: ContactData
+    """
+    num = len(contacts.impulse)
+    if num == 0 or (maxPoints <= 0 and not aggregate):
+        return contacts
+
+    # Sort the contacts by pair, and by decreasing impulse within each pair.
+    order = np.lexsort((-contacts.impulse, contacts.aid_b, contacts.aid_a))
+    c = ContactData(*[_[order] for _ in contacts])
+
+    # Find the index of the first contact of every pair and assign every
+    # contact the index of its pair.
+    new_pair = np.ones(num, bool)
+    new_pair[1:] = ((c.aid_a[1:] != c.aid_a[:-1]) |
+                    (c.aid_b[1:] != c.aid_b[:-1]))
+    start = np.flatnonzero(new_pair)
+    pairIdx = np.cumsum(new_pair) - 1
+
+    if not aggregate:
+        # Keep the first `maxPoints` contacts of every pair.
+        rank = np.arange(num) - start[pairIdx]
+        keep = rank < maxPoints
+        return ContactData(*[_[keep] for _ in c])
+
+    # Impulse weights for the average. Use equal weights for pairs without
+    # any impulse.
+    impulse = np.bincount(pairIdx, weights=c.impulse)
+    weight = c.impulse.copy()
+    no_impulse = (impulse <= 0)[pairIdx]
+    weight[no_impulse] = 1
+    weight /= np.bincount(pairIdx, weights=weight)[pairIdx]
+
+    def average(val):
+        out = np.zeros((len(start), 3), np.float64)
+        np.add.at(out, pairIdx, val * weight[:, None])
+        return out
+
+    # Average the normals and normalise them again (unless they are zero).
+    normal = average(c.normal)
+    length = np.linalg.norm(normal, axis=1)
+    length[length == 0] = 1
+    normal /= length[:, None]
+    return ContactData(c.aid_a[start], c.aid_b[start],
+                       average(c.point_a), average(c.point_b), normal, impulse)
+
+
+@typecheck
+def encodeContacts(contacts: (tuple, list)):
+    """
+    Return all ``contacts`` as a list of (aidA, aidB, points) tuples.
+
+    This is the JSON compatible format of ``getLastContacts`` (see there
+    for details), and the order of the body pairs is the same.
+
+    :param list[ContactData] contacts: contacts (eg from several engines).
+    :return: list of collision info for each body pair that collided.
+    """
+    if len(contacts) == 0:
+        return []
+
+    # Concatenate all contacts and skip the rest if there are none.
+    c = ContactData(*[np.concatenate(_) for _ in zip(*contacts)])
+    if len(c.impulse) == 0:
+        return []
+
+    # Sort the contacts by pair (stable to preserve their order).
+    order = np.lexsort((c.aid_b, c.aid_a))
+    aid_a, aid_b = c.aid_a[order], c.aid_b[order]
+
+    # Interleave the contact points of the two objects.
+    points = np.empty((2 * len(order), 3), np.float64)
+    points[0::2] = c.point_a[order]
+    points[1::2] = c.point_b[order]
+    points = [tuple(_) for _ in points.tolist()]
+
+    # Group the contact positions for each object pair. Also convert the
+    # object IDs from Integers(Bullet format) to strings (Azrael format).
+    start = np.ones(len(order), bool)
+    start[1:] = (aid_a[1:] != aid_a[:-1]) | (aid_b[1:] != aid_b[:-1])
+    start = np.flatnonzero(start).tolist() + [len(order)]
+    unpacked = [
+        (str(aid_a[i0]), str(aid_b[i0]), points[2 * i0:2 * i1])
+        for i0, i1 in zip(start[:-1], start[1:])
+    ]
+    return unpacked
+
 
 class PyRigidBody(azBullet.RigidBody):
     """
@@ -65,7 +208,8 @@ class PyBulletDynamicsWorld():
     """
     High level wrapper around the low level Bullet bindings.
     """
-    def __init__(self, engineID: int):
+    def __init__(self, engineID: int, contactsMaxPoints: int=None,
+                 contactsAggregate: bool=None):
         # Create a Class-specific logger.
         name = '.'.join([__name__, self.__class__.__name__])
         self.logit = logging.getLogger(name)
@@ -73,6 +217,19 @@ class PyBulletDynamicsWorld():
         # To distinguish engines.
         self.engineID = engineID
 
+        # Reduction of the collision contacts (see `reduceContacts`). Use the
+        # values from the config module unless specified explicitly.
+        if contactsMaxPoints is None:
+            contactsMaxPoints = config.contacts_max_points
+        if contactsAggregate is None:
+            contactsAggregate = config.contacts_aggregate
+        self.contactsMaxPoints = contactsMaxPoints
+        self.contactsAggregate = contactsAggregate
+
+        # The physics quality profile. The default profile corresponds to the
+        # Bullet defaults.
+        self.quality = QualityProfile()
+
         # Create a standard Bullet Dynamics World.
         self.dynamicsWorld = azBullet.BulletBase()
 
@@ -82,6 +239,22 @@ class PyBulletDynamicsWorld():
         # Dictionary of all bodies.
         self.rigidBodies = {}
 
+        # Library of compound shapes. Bodies with identical collision shapes,
+        # scale, centre of mass, and principal axes share the same compound
+        # shape. Each entry is a {'cs': compound, 'refs': int, 'ccd': float}
+        # dictionary and the keys are computed by `shapeKey`. The 'ccd' value
+        # is the size of the smallest collision feature (see
+        # `computeCcdRadius`). Shapes without references are evicted
+        # immediately.
+        self.shapeLibrary = {}
+        self.shapeStats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        # Cache of Bullet constraints: {aid: (ConstraintMeta, constraint)}.
+        # The IDs of the constraints currently in the world are in
+        # `activeConstraints`.
+        self.constraintCache = {}
+        self.activeConstraints = set()
+
     def setGravity(self, gravity: (tuple, list)):
         """
         Set the ``gravity`` in the simulation.
@@ -105,6 +278,12 @@ class PyBulletDynamicsWorld():
         :return: number of actually removed bodies.
         :rtype: int
         """
+        # Drop all constraints attached to any of the bodies.
+        removed = set(bodyIDs)
+        self._dropConstraints([
+            aid for aid, (c, _) in self.constraintCache.items()
+            if (c.rb_a in removed) or (c.rb_b in removed)])
+
         cnt = 0
         # Remove every body, skipping non-existing ones.
         for bodyID in bodyIDs:
@@ -112,13 +291,55 @@ class PyBulletDynamicsWorld():
             if bodyID not in self.rigidBodies:
                 continue
 
-            # Delete the body from all caches.
-            del self.rigidBodies[bodyID]
+            # Delete the body from all caches and release its shape.
+            body = self.rigidBodies.pop(bodyID)
+            self._releaseCollisionShape(body.azrael['shapeKey'])
             cnt += 1
 
         # Return the total number of removed bodies.
         return RetVal(True, None, cnt)
 
+    @typecheck
+    def setQualityProfile(self, profile: QualityProfile):
+        """
+        Apply the quality ``profile`` to all subsequent ``compute`` calls.
+
+        The solver parameters apply to the entire world, the contact threshold
+        to every body that takes part in ``compute``, and the sub-step scale
+        to the ``max_substeps`` argument of ``compute``.
+
+        :param QualityProfile profile: the new profile.
+        :return: Success
+        """
+        if profile != self.quality:
+            self.dynamicsWorld.setSolverInfo(
+                profile.solverIterations, profile.splitImpulse,
+                profile.warmstarting, profile.erp, profile.cfm)
+            self.quality = profile
+        return RetVal(True, None, None)
+
+    def getContactData(self):
+        """
+        Return the collisions created during the last simulation step.
+
+        The return value is a ``ContactData`` tuple of NumPy arrays. The
+        contacts are reduced according to the ``contactsMaxPoints`` and
+        ``contactsAggregate`` settings (see ``reduceContacts``).
+
+        The body IDs in ``aid_a`` and ``aid_b`` are integers (the Bullet
+        format) and ``aid_a`` <= ``aid_b`` for every contact. The normal
+        points from the second to the first body. All positions are in
+        *world* coordinates.
+
+        :return: ``ContactData`` with the contacts.
+        """
+        aid, pa, pb, normal, impulse = (
+            self.dynamicsWorld.azGetNarrowphaseContactsArray())
+        contacts = ContactData(aid[:, 0], aid[:, 1], pa, pb, normal, impulse)
+        contacts = reduceContacts(
+            contacts, self.contactsMaxPoints, self.contactsAggregate)
+        return RetVal(True, None, contacts)
+
     def getLastContacts(self):
         """
         Return the collisions created during the last simulation step.
@@ -137,34 +358,13 @@ class PyBulletDynamicsWorld():
         1.5) for the second objects. These values are in *world* coordinates
         and *not* in  body local coordinates.
 
+        This is a convenience wrapper around ``getContactData`` and
+        ``encodeContacts``.
+
         :return: list of collision info for each body pair that collided.
         """
-        # Fetch the list of collision contacts from Bullet. Each element in the
-        # list is a dictionary to describe which objects were involved in a
-        # collision and where they touched.
-        contacts = self.dynamicsWorld.azGetNarrowphaseContacts()
-
-        # At the moment, the contacts list contains one dictionary for every
-        # collision. However, the same pair of objects may have collided
-        # several times. The following loop groups all collision positions for
-        # each object pair.
-        unpacked = {}
-        for contact in contacts:
-            # Unpack for convenience.
-            key = contact['aid_a'], contact['aid_b']
-            pos_a, pos_b = contact['point_a'], contact['point_b']
-
-            # The key will the collision pair.
-            if key in unpacked:
-                unpacked[key].extend([pos_a, pos_b])
-            else:
-                unpacked[key] = [pos_a, pos_b]
-
-        # Flatten the dictionary into the list described in the doc string.
-        # Also convert the object IDs from Integers(Bullet format) to strings
-        # (Azrael format).
-        unpacked = [(str(k[0]), str(k[1]), v) for k, v in unpacked.items()]
-        return RetVal(True, None, unpacked)
+        contacts = self.getContactData().data
+        return RetVal(True, None, encodeContacts([contacts]))
 
     def compute(self, bodyIDs: (tuple, list), dt: float, max_substeps: int):
         """
@@ -190,10 +390,17 @@ class PyBulletDynamicsWorld():
 
         # Add the body to the world and make sure it is activated, as
         # Bullet may otherwise decide to simply set its velocity to zero
-        # and ignore the body.
+        # and ignore the body. Also apply the contact threshold of the
+        # current quality profile.
+        threshold = self.quality.contactThreshold
         for body in rigidBodies:
             self.dynamicsWorld.addRigidBody(body)
             body.forceActivationState(4)
+            body.setContactProcessingThreshold(threshold)
+
+        # Scale the number of sub-steps according to the quality profile.
+        scale = self.quality.substepScale
+        max_substeps = max(1, int(round(max_substeps * scale)))
 
         # The max_substeps parameter instructs Bullet to subdivide the
         # specified timestep (dt) into at most max_substeps. For example, with
@@ -262,10 +469,150 @@ class PyBulletDynamicsWorld():
         body.applyForce(b_force, b_relpos)
         return RetVal(True, None, None)
 
+    def _buildConstraint(self, c: ConstraintMeta):
+        """
+        Compile the constraint ``c`` into the proper C-level Bullet body.
+
+        Raise a KeyError unless both bodies exist and an AssertionError if
+        the constraint type is unknown.
+
+        :param ConstraintMeta c: the constraint.
+        :return: Bullet constraint.
+        """
+        # Get handles to the two bodies. This will raise a KeyError unless
+        # both bodies exist.
+        rb_a = self.rigidBodies[c.rb_a]
+        rb_b = self.rigidBodies[c.rb_b]
+
+        # Construct the specified constraint type. Raise an error if the
+        # constraint could not be constructed (eg the constraint name is
+        # unknown).
+        if c.contype.upper() == 'P2P':
+            tmp = ConstraintP2P(*c.condata)
+            out = azBullet.Point2PointConstraint(
+                rb_a, rb_b,
+                Vec3(*tmp.pivot_a),
+                Vec3(*tmp.pivot_b)
+            )
+        elif c.contype.upper() == '6DOFSPRING2':
+            t = Constraint6DofSpring2(*c.condata)
+            fa, fb = t.frameInA, t.frameInB
+            frameInA = Transform(Quaternion(*fa[3:]), Vec3(*fa[:3]))
+            frameInB = Transform(Quaternion(*fb[3:]), Vec3(*fb[:3]))
+            out = azBullet.Generic6DofSpring2Constraint(
+                rb_a, rb_b, frameInA, frameInB
+            )
+            self._updateConstraint(out, c)
+        else:
+            assert False
+
+        # Return the Bullet constraint body.
+        return out
+
+    def _updateConstraint(self, con, c: ConstraintMeta):
+        """
+        Update the parameters of the existing Bullet constraint ``con``.
+
+        Only the parameters that Bullet can modify in place are updated,
+        ie. the pivots of a P2P constraint, and the limits, springs and
+        bounce of a 6DOF constraint. The caller must ensure that ``con``
+        has the same type, bodies and (for 6DOF constraints) frames as ``c``.
+
+        :param con: Bullet constraint.
+        :param ConstraintMeta c: the new constraint parameters.
+        """
+        if c.contype.upper() == 'P2P':
+            tmp = ConstraintP2P(*c.condata)
+            con.setPivotA(Vec3(*tmp.pivot_a))
+            con.setPivotB(Vec3(*tmp.pivot_b))
+            return
+
+        t = Constraint6DofSpring2(*c.condata)
+        con.setLinearLowerLimit(Vec3(*t.linLimitLo))
+        con.setLinearUpperLimit(Vec3(*t.linLimitHi))
+        con.setAngularLowerLimit(Vec3(*t.rotLimitLo))
+        con.setAngularUpperLimit(Vec3(*t.rotLimitHi))
+        for ii in range(6):
+            if not t.enableSpring[ii]:
+                con.enableSpring(ii, False)
+                continue
+            con.enableSpring(ii, True)
+            con.setStiffness(ii, t.stiffness[ii])
+            con.setDamping(ii, t.damping[ii])
+            con.setEquilibriumPoint(ii, t.equilibrium[ii])
+
+        for ii in range(3):
+            con.setBounce(ii, t.bounce[ii])
+
+    def _getOrBuildConstraint(self, c: ConstraintMeta):
+        """
+        Return the cached Bullet constraint for ``c``.
+
+        Build the constraint if it is not in the cache yet. Update the cached
+        constraint in place if only its parameters have changed, and rebuild
+        it if its type, bodies or (6DOF) frames have changed.
+
+        :param ConstraintMeta c: the constraint.
+        :return: Bullet constraint.
+        """
+        entry = self.constraintCache.get(c.aid, None)
+        if entry is not None:
+            old, con = entry
+
+            # Nothing to do if the constraint has not changed. However, the
+            # bodies must be the same instances that the constraint was
+            # built with (they may have been removed and created anew).
+            rb_a = self.rigidBodies[c.rb_a]
+            rb_b = self.rigidBodies[c.rb_b]
+            same_bodies = ((con.getRigidBodyA() is rb_a) and
+                           (con.getRigidBodyB() is rb_b))
+            if same_bodies and (old == c):
+                return con
+
+            # Modify the constraint in place if possible.
+            same_type = (old.contype.upper() == c.contype.upper())
+            if same_type and same_bodies:
+                if c.contype.upper() == 'P2P':
+                    same_frames = True
+                else:
+                    frames_old = old.condata.frameInA, old.condata.frameInB
+                    frames_new = c.condata.frameInA, c.condata.frameInB
+                    same_frames = (frames_old == frames_new)
+                if same_frames:
+                    self._updateConstraint(con, c)
+                    self.constraintCache[c.aid] = (c, con)
+                    return con
+
+            # The constraint must be rebuilt.
+            self._dropConstraints([c.aid])
+
+        con = self._buildConstraint(c)
+        self.constraintCache[c.aid] = (c, con)
+        return con
+
+    def _dropConstraints(self, aids):
+        """
+        Remove the constraints ``aids`` from the world and the cache.
+
+        :param list aids: constraint IDs.
+        """
+        for aid in aids:
+            entry = self.constraintCache.pop(aid, None)
+            if entry is None:
+                continue
+            if aid in self.activeConstraints:
+                self.dynamicsWorld.removeConstraint(entry[1])
+                self.activeConstraints.discard(aid)
+
     def setConstraints(self, constraints: (tuple, list)):
         """
         Apply the ``constraints`` to the specified bodies in the world.
 
+        The ``constraints`` replace all the constraints from previous calls.
+        The Bullet constraints are cached by constraint ID and only rebuilt
+        if their type, bodies, or frames change. Constraints that are
+        already in the world remain there.
+
         If one or more of the rigid bodies specified in any of the constraints
         do not exist then this method will abort. Similarly, it will also abort
         if one or more constraints could not be constructed for whatever
@@ -277,65 +624,24 @@ class PyBulletDynamicsWorld():
         :param list constraints: list of `ConstraintMeta` instances.
         :return: Success
         """
-        def _buildConstraint(c):
-            """
-            Compile the constraint `c` into the proper C-level Bullet body.
-            """
-            # Get handles to the two bodies. This will raise a KeyError unless
-            # both bodies exist.
-            rb_a = self.rigidBodies[c.rb_a]
-            rb_b = self.rigidBodies[c.rb_b]
-
-            # Construct the specified constraint type. Raise an error if the
-            # constraint could not be constructed (eg the constraint name is
-            # unknown).
-            if c.contype.upper() == 'P2P':
-                tmp = ConstraintP2P(*c.condata)
-                out = azBullet.Point2PointConstraint(
-                    rb_a, rb_b,
-                    Vec3(*tmp.pivot_a),
-                    Vec3(*tmp.pivot_b)
-                )
-            elif c.contype.upper() == '6DOFSPRING2':
-                t = Constraint6DofSpring2(*c.condata)
-                fa, fb = t.frameInA, t.frameInB
-                frameInA = Transform(Quaternion(*fa[3:]), Vec3(*fa[:3]))
-                frameInB = Transform(Quaternion(*fb[3:]), Vec3(*fb[:3]))
-                out = azBullet.Generic6DofSpring2Constraint(
-                    rb_a, rb_b, frameInA, frameInB
-                )
-                out.setLinearLowerLimit(Vec3(*t.linLimitLo))
-                out.setLinearUpperLimit(Vec3(*t.linLimitHi))
-                out.setAngularLowerLimit(Vec3(*t.rotLimitLo))
-                out.setAngularUpperLimit(Vec3(*t.rotLimitHi))
-                for ii in range(6):
-                    if not t.enableSpring[ii]:
-                        out.enableSpring(ii, False)
-                        continue
-                    out.enableSpring(ii, True)
-                    out.setStiffness(ii, t.stiffness[ii])
-                    out.setDamping(ii, t.damping[ii])
-                    out.setEquilibriumPoint(ii, t.equilibrium[ii])
-
-                for ii in range(3):
-                    out.setBounce(ii, t.bounce[ii])
-            else:
-                assert False
-
-            # Return the Bullet constraint body.
-            return out
-
-        # Compile a list of all Bullet constraints.
+        # Compile a dictionary of all Bullet constraints.
         try:
             constraints = [ConstraintMeta(*_) for _ in constraints]
-            out = [_buildConstraint(_) for _ in constraints]
+            out = {_.aid: self._getOrBuildConstraint(_) for _ in constraints}
         except (TypeError, AttributeError, KeyError, AssertionError):
+            self.clearAllConstraints()
             return RetVal(False, 'Could not compile all Constraints.', None)
 
-        # Apply the constraints.
-        fun = self.dynamicsWorld.addConstraint
-        for c in out:
-            fun(c)
+        # Remove the constraints that are no longer needed and add the new
+        # ones. The constraints in both sets remain in the world.
+        world = self.dynamicsWorld
+        active = self.activeConstraints
+        for aid in active - set(out):
+            world.removeConstraint(self.constraintCache[aid][1])
+        for aid, con in out.items():
+            if aid not in active:
+                world.addConstraint(con)
+        self.activeConstraints = set(out)
 
         # All went well.
         return RetVal(True, None, None)
@@ -344,17 +650,21 @@ class PyBulletDynamicsWorld():
         """
         Remove all constraints from the simulation.
 
+        The constraints remain in the cache and subsequent calls to
+        ``setConstraints`` can re-use them.
+
         :return: success
         """
         # Convenience.
         world = self.dynamicsWorld
+        self.activeConstraints = set()
 
         # Return immediately if the world has no constraints to remove.
         if world.getNumConstraints() == 0:
             return RetVal(True, None, None)
 
         # Iterate over all constraints and remove them.
-        for c in world.iterateConstraints():
+        for c in list(world.iterateConstraints()):
             world.removeConstraint(c)
 
         # Verify that the number of constraints is now zero.
@@ -391,6 +701,90 @@ class PyBulletDynamicsWorld():
             return True
         return False
 
+    @typecheck
+    def shapeKey(self, rbState: _RigidBodyData):
+        """
+        Return the key of the compound shape for ``rbState`` in the library.
+
+        The key is a hash over the canonical form of all properties that
+        affect the compound shape (see ``needNewCollisionShape``). The names
+        and order of the collision shapes are irrelevant.
+
+        :param _RigidBodyData rbState: body description.
+        :return: hex digest.
+        :rtype: str
+        """
+        def canonical(val):
+            # Convert all numbers to floats and all sequences to tuples.
+            if isinstance(val, str):
+                return val.upper()
+            if isinstance(val, (tuple, list, np.ndarray)):
+                return tuple(canonical(_) for _ in val)
+            return float(val)
+
+        cshapes = [CollShapeMeta(*_) for _ in rbState.cshapes.values()]
+        cshapes = sorted(repr(canonical(_)) for _ in cshapes)
+        key = (cshapes, canonical(rbState.scale),
+               canonical(rbState.com), canonical(rbState.paxis))
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+    @typecheck
+    def _acquireCollisionShape(self, rbState: _RigidBodyData):
+        """
+        Return the key and compound shape for ``rbState`` from the library.
+
+        Compile a new compound shape if the library does not yet contain a
+        matching one. Either way, increment its reference count.
+
+        :param _RigidBodyData rbState: body description.
+        :return: (key, compound shape)
+        """
+        key = self.shapeKey(rbState)
+        if key in self.shapeLibrary:
+            self.shapeStats['hits'] += 1
+        else:
+            self.shapeStats['misses'] += 1
+            cs = self._compileCollisionShape(rbState)
+            ccd = computeCcdRadius(rbState)
+            self.shapeLibrary[key] = {'cs': cs, 'refs': 0, 'ccd': ccd}
+
+        entry = self.shapeLibrary[key]
+        entry['refs'] += 1
+        return key, entry['cs']
+
+    def _releaseCollisionShape(self, key: str):
+        """
+        Decrement the reference count of compound shape ``key``.
+
+        Evict the shape from the library once nobody uses it anymore.
+
+        :param str key: shape key (see ``shapeKey``).
+        """
+        entry = self.shapeLibrary[key]
+        entry['refs'] -= 1
+        if entry['refs'] <= 0:
+            del self.shapeLibrary[key]
+            self.shapeStats['evictions'] += 1
+
+    def getShapeLibraryStats(self):
+        """
+        Return statistics about the compound shape library.
+
+        The returned dictionary contains the number of cache 'hits', 'misses'
+        and 'evictions', the number of compound 'shapes' and 'children' in the
+        library, and the number of 'references' to them. The number of
+        references is the number of compound shapes that would exist without
+        the library.
+
+        :return: dictionary with statistics.
+        """
+        out = dict(self.shapeStats)
+        out['shapes'] = len(self.shapeLibrary)
+        out['children'] = sum(_['cs'].getNumChildShapes()
+                              for _ in self.shapeLibrary.values())
+        out['references'] = sum(_['refs'] for _ in self.shapeLibrary.values())
+        return RetVal(True, None, out)
+
     @typecheck
     def _compileCollisionShape(self, rbState: _RigidBodyData):
         """
@@ -541,29 +935,27 @@ class PyBulletDynamicsWorld():
         out = RbStateUpdate(pos, rot, vLin, vRot)
         return RetVal(True, None, out)
 
-    @typecheck
-    def setRigidBodyData(self, bodyID: str, rbState: _RigidBodyData):
+    def _getOrCreateRigidBody(self, bodyID: str, rbState: _RigidBodyData):
         """
-        Update State Variables of ``bodyID`` to ``rbState``.
+        Return the rigid body for ``bodyID`` with the collision shape for
+        ``rbState``.
 
-        Create a new body with ``bodyID`` if it does not yet exist.
+        Create the body if it does not yet exist and fetch a new collision
+        shape from the library if ``rbState`` requires one. The caller must
+        set all other body properties and update ``body.azrael`` afterwards.
 
-        :param str bodyID: the IDs of all bodies to retrieve.
+        :param str bodyID: the ID of the body.
         :param ``_RigidBodyData`` rbState: body description.
-        :return: Success
+        :return: (body, shapeKey)
         """
-        paxis = Quaternion(*rbState.paxis).normalized()
-        paComT = Transform(paxis, Vec3(*rbState.com))
-        del paxis
-
         # Create the rigid body if it does not yet exist.
         if bodyID not in self.rigidBodies:
             # Get the collision shape (always a compund shape)
-            compound = self._compileCollisionShape(rbState)
+            shapeKey, compound = self._acquireCollisionShape(rbState)
 
             # Create a rigid body for the collision shape. Use default values
-            # for mass, inertia, position and orientation. We will overwrite
-            # them later in this method.
+            # for mass, inertia, position and orientation. The caller will
+            # overwrite them.
             body = PyRigidBody(
                 azBullet.RigidBodyConstructionInfo(
                     mass=1,
@@ -575,16 +967,60 @@ class PyBulletDynamicsWorld():
             )
 
             # Attach Azrael's info and add the body to our cache.
-            body.azrael = {'rbState': rbState}
+            body.azrael = {'rbState': rbState, 'shapeKey': shapeKey}
             self.rigidBodies[bodyID] = body
+            self._setCcd(body, shapeKey)
 
         # Convenience.
         body = self.rigidBodies[bodyID]
+        shapeKey = body.azrael['shapeKey']
 
-        # Build a new collision shape, if necessary, and replace the old one
-        # with it.
+        # Fetch a new collision shape from the library, if necessary, and
+        # replace the old one with it.
         if self.needNewCollisionShape(bodyID, rbState):
-            body.setCollisionShape(self._compileCollisionShape(rbState))
+            newKey, compound = self._acquireCollisionShape(rbState)
+            if newKey == shapeKey:
+                # Nothing has changed after all.
+                self._releaseCollisionShape(newKey)
+            else:
+                body.setCollisionShape(compound)
+                self._releaseCollisionShape(shapeKey)
+                shapeKey = newKey
+                self._setCcd(body, shapeKey)
+
+        return body, shapeKey
+
+    def _setCcd(self, body, shapeKey: str):
+        """
+        Configure the continuous collision detection for ``body``.
+
+        The parameters derive from the smallest collision feature of the
+        compound shape ``shapeKey``. A size of zero disables CCD.
+
+        :param body: the Bullet rigid body.
+        :param str shapeKey: key of its compound shape in the library.
+        """
+        size = self.shapeLibrary[shapeKey]['ccd'] if config.ccd_enabled else 0
+        body.setCcdMotionThreshold(size)
+        body.setCcdSweptSphereRadius(config.ccd_radius_scale * size)
+
+    @typecheck
+    def setRigidBodyData(self, bodyID: str, rbState: _RigidBodyData):
+        """
+        Update State Variables of ``bodyID`` to ``rbState``.
+
+        Create a new body with ``bodyID`` if it does not yet exist.
+
+        :param str bodyID: the IDs of all bodies to retrieve.
+        :param ``_RigidBodyData`` rbState: body description.
+        :return: Success
+        """
+        paxis = Quaternion(*rbState.paxis).normalized()
+        paComT = Transform(paxis, Vec3(*rbState.com))
+        del paxis
+
+        # Fetch (or create) the body with the correct collision shape.
+        body, shapeKey = self._getOrCreateRigidBody(bodyID, rbState)
 
         # Convert rotation and position to Bullet types.
         pos, rot = Vec3(*rbState.position), Quaternion(*rbState.rotation)
@@ -617,5 +1053,277 @@ class PyBulletDynamicsWorld():
         body.updateInertiaTensor()
 
         # Overwrite the rbState structure with the latest version.
-        body.azrael = {'rbState': rbState}
+        body.azrael = {'rbState': rbState, 'shapeKey': shapeKey}
+        return RetVal(True, None, None)
+
+    @typecheck
+    def setRigidBodyDataBatch(self, bodyIDs: (tuple, list),
+                              rbStates: (tuple, list)):
+        """
+        Same as ``setRigidBodyData`` but for many bodies at once.
+
+        Only the creation of new bodies and the replacement of collision
+        shapes happens per body. All other properties are compiled into
+        arrays and passed to Bullet with a single call.
+
+        :param list bodyIDs: the IDs of the bodies to update.
+        :param list rbStates: the corresponding ``_RigidBodyData`` tuples.
+        :return: Success
+        """
+        if len(bodyIDs) != len(rbStates):
+            return RetVal(False, 'Length mismatch', None)
+        if len(bodyIDs) == 0:
+            return RetVal(True, None, None)
+
+        # Fetch (or create) the bodies with the correct collision shapes.
+        bodies = []
+        for bodyID, rbState in zip(bodyIDs, rbStates):
+            body, shapeKey = self._getOrCreateRigidBody(bodyID, rbState)
+            body.azrael = {'rbState': rbState, 'shapeKey': shapeKey}
+            bodies.append(body)
+
+        def arr(name):
+            return np.array([getattr(_, name) for _ in rbStates], np.float64)
+        integ = azrael.integrator
+
+        # Compute the centre of mass transform of all bodies (see
+        # `setRigidBodyData` for details).
+        rot = integ.quatNormalise(arr('rotation'))
+        paxis = integ.quatNormalise(arr('paxis'))
+        pose = np.zeros((len(bodies), 7), np.float64)
+        pose[:, :3] = arr('position') + integ.quatRotate(rot, arr('com'))
+        pose[:, 3:] = integ.quatMult(rot, paxis)
+        vel = np.hstack([arr('velocityLin'), arr('velocityRot')])
+
+        # Mass and inertia are zero for static bodies.
+        imass, inertia = arr('imass'), arr('inertia')
+        static = (imass < 1E-4) | (np.sum(inertia, axis=1) < 1E-4)
+        mass = np.zeros_like(imass)
+        mass[~static] = 1 / imass[~static]
+        inertia[static] = 0
+
+        # Compile the body properties in the order 'setRigidBodiesBatch'
+        # expects them. Friction, damping and sleeping thresholds are the
+        # same as in `setRigidBodyData`.
+        num = len(bodies)
+        props = np.hstack([
+            mass[:, None], inertia, arr('linFactor'), arr('rotFactor'),
+            arr('restitution')[:, None],
+            np.tile([0.1, 0.02, 0.02, 0.1, 0.1], (num, 1)),
+        ])
+        azBullet.setRigidBodiesBatch(bodies, pose, vel, props)
+        return RetVal(True, None, None)
+
+    @typecheck
+    def getRigidBodyDataBatch(self, bodyIDs: (tuple, list)):
+        """
+        Same as ``getRigidBodyData`` but for many bodies at once.
+
+        The returned position, rotation, linear- and angular velocity are
+        (N, 3) and (N, 4) NumPy arrays where the i-th row belongs to the i-th
+        body in ``bodyIDs``.
+
+        Return with an error if at least one body does not exist.
+
+        :param list bodyIDs: the IDs of the bodies to query.
+        :return: (position, rotation, velocityLin, velocityRot)
+        """
+        try:
+            bodies = [self.rigidBodies[_] for _ in bodyIDs]
+        except KeyError as err:
+            msg = 'Cannot find body with ID <{}>'.format(err.args[0])
+            return RetVal(False, msg, None)
+
+        # Query the centre of mass transform and velocities of all bodies.
+        num = len(bodies)
+        pose = np.zeros((num, 7), np.float64)
+        vel = np.zeros((num, 6), np.float64)
+        azBullet.getRigidBodiesBatch(bodies, pose, vel)
+
+        # Undo the centre-of-mass and principal-axis correction.
+        integ = azrael.integrator
+        rbStates = [_.azrael['rbState'] for _ in bodies]
+        com = np.array([_.com for _ in rbStates], np.float64).reshape(num, 3)
+        paxis = np.array([_.paxis for _ in rbStates], np.float64)
+        paxis = integ.quatNormalise(paxis.reshape(num, 4))
+        rot = integ.quatMult(pose[:, 3:], integ.quatConj(paxis))
+        pos = pose[:, :3] - integ.quatRotate(rot, com)
+        return RetVal(True, None, (pos, rot, vel[:, :3], vel[:, 3:]))
+
+    @typecheck
+    def applyForceAndTorqueBatch(self, bodyIDs: (tuple, list), force, torque):
+        """
+        Same as ``applyForceAndTorque`` but for many bodies at once.
+
+        :param list bodyIDs: the IDs of the bodies to update.
+        :param ndarray force: (N, 3) array of central forces.
+        :param ndarray torque: (N, 3) array of torques.
+        :return: Success
+        """
+        try:
+            bodies = [self.rigidBodies[_] for _ in bodyIDs]
+        except KeyError as err:
+            msg = 'Cannot set force of unknown body <{}>'.format(err.args[0])
+            self.logit.warning(msg)
+            return RetVal(False, msg, None)
+
+        num = len(bodies)
+        try:
+            forces = np.zeros((num, 6), np.float64)
+            forces[:, :3] = np.reshape(force, (num, 3))
+            forces[:, 3:] = np.reshape(torque, (num, 3))
+        except ValueError:
+            return RetVal(False, 'Invalid force or torque array', None)
+        azBullet.applyForcesBatch(bodies, forces)
+        return RetVal(True, None, None)
+
+    def getSnapshot(self):
+        """
+        Return the complete state of the world as a compact binary blob.
+
+        The blob starts with ``SNAPSHOT_MAGIC`` and the length of a JSON
+        header, followed by the header itself and an (N, 18) float64 array
+        with the centre of mass transform and the velocities of all bodies
+        (see ``azBullet.getRigidBodiesStateBatch``).
+        The header contains the body descriptions, all cached constraints
+        (and which of them are active), the quality profile and the gravity.
+        The transforms are stored verbatim (ie. not in Azrael's position and
+        rotation format) to ensure ``restoreSnapshot`` reproduces the
+        simulation bit for bit.
+
+        Collision contacts are not part of the snapshot because ``compute``
+        removes all bodies from the world again, which also discards their
+        contact manifolds.
+
+        :return: snapshot as bytes.
+        """
+        bodyIDs = list(self.rigidBodies.keys())
+        bodies = [self.rigidBodies[_] for _ in bodyIDs]
+
+        # Query the exact transforms and velocities of all bodies.
+        state = np.zeros((len(bodies), 18), np.float64)
+        azBullet.getRigidBodiesStateBatch(bodies, state)
+
+        # Compile the header.
+        header = {
+            'bodies': [
+                (bodyID, RigidBodyData(*body.azrael['rbState'])._asdict())
+                for bodyID, body in zip(bodyIDs, bodies)
+            ],
+            'constraints': [
+                c._asdict() for c, _ in self.constraintCache.values()],
+            'active': sorted(self.activeConstraints),
+            'quality': self.quality._asdict(),
+            'gravity': self.dynamicsWorld.getGravity().topy(),
+        }
+        header = json.dumps(header).encode('utf8')
+
+        # Pad the header to keep the state array 8 Byte aligned.
+        header += b' ' * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 8)
+        out = SNAPSHOT_MAGIC + struct.pack('<I', len(header)) + header
+        return RetVal(True, None, out + state.tobytes())
+
+    def restoreSnapshot(self, blob: bytes):
+        """
+        Replace the entire state of the world with the snapshot in ``blob``.
+
+        The ``blob`` must have been created by ``getSnapshot``, possibly by
+        another instance. The world remains unmodified if the blob is
+        invalid. Should the restoration fail nevertheless then the world
+        reverts to its previous state.
+
+        :param bytes blob: snapshot created by ``getSnapshot``.
+        :return: Success
+        """
+        # Decode and verify the entire snapshot before touching the world.
+        try:
+            snapshot = self._decodeSnapshot(blob)
+        except (AssertionError, KeyError, IndexError, TypeError,
+                ValueError, struct.error):
+            return RetVal(False, 'Invalid snapshot', None)
+
+        # Keep the current state to roll back if the restoration fails.
+        backup = self._decodeSnapshot(self.getSnapshot().data)
+        ret = self._applySnapshot(*snapshot)
+        if not ret.ok:
+            self._applySnapshot(*backup)
+        return ret
+
+    def _decodeSnapshot(self, blob: bytes):
+        """
+        Return the decoded and verified content of the snapshot ``blob``.
+
+        The return value is a (bodyIDs, rbStates, state, constraints, active,
+        quality, gravity) tuple for ``_applySnapshot``. Raise an exception
+        if the snapshot is invalid.
+
+        :param bytes blob: snapshot created by ``getSnapshot``.
+        :return: tuple
+        """
+        ofs = len(SNAPSHOT_MAGIC)
+        assert blob[:ofs] == SNAPSHOT_MAGIC
+        hlen = struct.unpack('<I', blob[ofs:ofs + 4])[0]
+        ofs += 4
+        header = json.loads(blob[ofs:ofs + hlen].decode('utf8'))
+        ofs += hlen
+
+        bodyIDs = [_[0] for _ in header['bodies']]
+        rbStates = [RigidBodyData(**_[1]) for _ in header['bodies']]
+        constraints = [ConstraintMeta(**_) for _ in header['constraints']]
+        active = set(header['active'])
+        quality = QualityProfile(**header['quality'])
+        gravity = header['gravity']
+        assert len(gravity) == 3
+
+        state = np.frombuffer(blob[ofs:], np.float64)
+        state = state.reshape(len(bodyIDs), 18)
+        assert active.issubset({_.aid for _ in constraints})
+
+        # Every constraint must link two bodies of the snapshot and have a
+        # valid type and parameters (see ``_buildConstraint``).
+        for c in constraints:
+            assert {c.rb_a, c.rb_b}.issubset(bodyIDs)
+            if c.contype.upper() == 'P2P':
+                ConstraintP2P(*c.condata)
+            else:
+                assert c.contype.upper() == '6DOFSPRING2'
+                Constraint6DofSpring2(*c.condata)
+        return bodyIDs, rbStates, state, constraints, active, quality, gravity
+
+    def _applySnapshot(self, bodyIDs, rbStates, state, constraints, active,
+                       quality, gravity):
+        """
+        Replace the state of the world with the decoded snapshot.
+
+        See ``_decodeSnapshot`` for the arguments.
+
+        :return: Success
+        """
+        # Remove all bodies and constraints.
+        self.removeRigidBody(list(self.rigidBodies.keys()))
+        self.clearAllConstraints()
+        self.constraintCache = {}
+
+        # Create all bodies (this also restores the collision shapes) and
+        # overwrite their transforms and velocities with the stored ones.
+        if len(bodyIDs) > 0:
+            ret = self.setRigidBodyDataBatch(bodyIDs, rbStates)
+            if not ret.ok:
+                return ret
+            bodies = [self.rigidBodies[_] for _ in bodyIDs]
+            azBullet.setRigidBodiesStateBatch(bodies, state.copy())
+
+        # Re-populate the constraint cache and activate the constraints.
+        try:
+            for c in constraints:
+                self.constraintCache[c.aid] = (c, self._buildConstraint(c))
+        except (KeyError, AssertionError, TypeError):
+            self.constraintCache = {}
+            return RetVal(False, 'Could not compile all Constraints.', None)
+        ret = self.setConstraints([_ for _ in constraints if _.aid in active])
+        if not ret.ok:
+            return ret
+
+        self.setQualityProfile(quality)
+        self.dynamicsWorld.setGravity(Vec3(*gravity))
         return RetVal(True, None, None)
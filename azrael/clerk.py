@@ -147,6 +147,18 @@ class Clerk(config.AzraelProcess):
                 protocol.ToClerk_ControlParts_Decode,
                 self.controlParts,
                 protocol.FromClerk_ControlParts_Encode),
+            'set_schedule': (
+                protocol.ToClerk_SetSchedule_Decode,
+                self.setSchedule,
+                protocol.FromClerk_SetSchedule_Encode),
+            'get_schedule_status': (
+                protocol.ToClerk_GetScheduleStatus_Decode,
+                self.getScheduleStatus,
+                protocol.FromClerk_GetScheduleStatus_Encode),
+            'set_force_profiles': (
+                protocol.ToClerk_SetForceProfiles_Decode,
+                self.setForceProfiles,
+                protocol.FromClerk_SetForceProfiles_Encode),
             'add_constraints': (
                 protocol.ToClerk_AddConstraints_Decode,
                 self.addConstraints,
@@ -405,6 +417,12 @@ class Clerk(config.AzraelProcess):
             except TypeError:
                 return RetVal(False, 'Invalid template data', None)
 
+            # Verify that all templates request a known quality tier.
+            for template in templates:
+                if not self._isValidQuality(template.quality):
+                    msg = 'Unknown quality tier <{}>'.format(template.quality)
+                    return RetVal(False, msg, None)
+
             # Handle to data store.
             db = datastore.getDSHandle('Templates')
 
@@ -529,6 +547,15 @@ class Clerk(config.AzraelProcess):
         # Return the templates.
         return RetVal(True, None, out)
 
+    def _isValidQuality(self, quality: str):
+        """
+        Return True if ``quality`` names a physics quality tier.
+
+        The empty string is also valid and selects the default tier (see
+        ``config.quality_tiers``).
+        """
+        return (quality == '') or (quality in config.quality_tiers)
+
     def _mangleFileName(self, fname: str, unmangle: bool):
         """
         Return the (un)mangled version of ``fname``.
@@ -568,14 +595,16 @@ class Clerk(config.AzraelProcess):
             structure.
         :return: dict
         """
-        # Iterate over all fragments in the template and mangle the geometry
-        # file names.
+        # Iterate over all fragments in the template and unmangle the geometry
+        # file names. Copy the dictionaries instead of modifying them because
+        # the datastore documents may be read-only.
+        frags = {}
         for fragname, metafrag in template_json['fragments'].items():
             fnames = metafrag['files']
             tmp = {self._mangleFileName(fname, unmangle=True): None
                    for fname in fnames}
-            metafrag['files'] = tmp
-        return template_json
+            frags[fragname] = dict(metafrag, files=tmp)
+        return dict(template_json, fragments=frags)
 
     @typecheck
     def spawn(self, newObjects: (tuple, list)):
@@ -600,7 +629,8 @@ class Clerk(config.AzraelProcess):
         `foo`. The second object will also be a `foo` instance but with an
         `imass` of 5. The third object is a `bar` instance spawned at the
         position (1, 2, 3). The fourth object is a verbatim `bar` instance with
-        its 'custom' data initialised to 'blah'.
+        its 'custom' data initialised to 'blah'. The optional 'quality' key
+        overrides the physics quality tier of the template.
 
         This method will either spawn all objects, or return with an error
         without spawning a single one.
@@ -622,9 +652,18 @@ class Clerk(config.AzraelProcess):
                     aztypes.DefaultRigidBody(**tmp['rbs'])
                 if 'custom' in tmp:
                     assert isinstance(tmp['custom'], str)
+                if 'quality' in tmp:
+                    assert isinstance(tmp['quality'], str)
         except (AssertionError, KeyError, TypeError):
             return RetVal(False, '<spawn> received invalid arguments', None)
 
+        # Reject unknown quality tiers.
+        for tmp in newObjects:
+            quality = tmp.get('quality', '')
+            if not self._isValidQuality(quality):
+                msg = 'Unknown quality tier <{}>'.format(quality)
+                return RetVal(False, msg, None)
+
         # Fetch the specified templates so that we can duplicate them in
         # the instance database afterwards. Return with an error unless all
         # requested templates were found.
@@ -656,7 +695,7 @@ class Clerk(config.AzraelProcess):
             # Copy every template, endow it with the meta information for an
             # instance object, and add it to the list of objects to spawn.
             ds_ops, dib_files = {}, {}
-            bodyStates = {}
+            bodyStates, qualities = {}, {}
             for newObj, objID in zip(newObjects, newObjectIDs):
                 # Unpack the template name and its data (convenience).
                 templateID = newObj['templateID']
@@ -682,9 +721,14 @@ class Clerk(config.AzraelProcess):
                 if 'custom' in newObj:
                     template = template._replace(custom=newObj['custom'])
 
+                # Update the physics quality tier.
+                if 'quality' in newObj:
+                    template = template._replace(quality=newObj['quality'])
+
                 # The new bodies will be announced (eg to Leonard) once they
                 # exist in the database. Until we just hold on to their data.
                 bodyStates[objID] = template.rbs
+                qualities[objID] = template.quality
 
                 # ------------------------------------------------------------
                 # Compile the copy operations for Dibbler. This means
@@ -761,7 +805,8 @@ class Clerk(config.AzraelProcess):
         # Publish the existence of the new objects.
         with util.Timeit('spawn:3 addCmds'):
             # Queue the spawn commands. Leonard will fetch them at its leisure.
-            objs = tuple(bodyStates.items())
+            objs = tuple((objID, body, qualities[objID])
+                         for objID, body in bodyStates.items())
             ret = leoAPI.addCmdSpawn(objs)
             if not ret.ok:
                 return ret
@@ -1061,7 +1106,8 @@ class Clerk(config.AzraelProcess):
         """
         # Retrieve the geometry. Return an error if the ID does not exist.
         db = datastore.getDSHandle('ObjInstances')
-        ret = db.getMulti(objIDs)
+        prj = [['template', 'fragments'], ['url_frag']]
+        ret = db.getMulti(objIDs, prj)
         if not ret.ok:
             return ret
 
@@ -1538,9 +1584,9 @@ class Clerk(config.AzraelProcess):
                       'rotation': v['rotation']}
                   for (k, v) in frags.items()}
 
-            # Add the current version to the rigid body data.
-            rbs = doc['template']['rbs']
-            rbs['version'] = doc['version']
+            # Add the current version to (a copy of) the rigid body data
+            # because the datastore documents may be read-only.
+            rbs = dict(doc['template']['rbs'], version=doc['version'])
 
             # Construct the return value.
             out[aid] = {'frag': fs, 'rbs': rbs}
@@ -1556,7 +1602,7 @@ class Clerk(config.AzraelProcess):
         """
         # Get handle to datastore and query for the specified ``objID``.
         db = datastore.getDSHandle('ObjInstances')
-        ret = db.getOne(objID)
+        ret = db.getOne(objID, [['templateID']])
 
         # Return the template (or an error).
         if ret.ok and ret.data is not None:
@@ -1600,6 +1646,143 @@ class Clerk(config.AzraelProcess):
                           np.array(force, np.float64)).tolist()
         return leoAPI.addCmdDirectForce(objID, force, torque)
 
+    @typecheck
+    def setSchedule(self, objID: str, schedule: (tuple, list)):
+        """
+        Install a ``schedule`` of booster- and force commands for ``objID``.
+
+        Each element in ``schedule`` must be a ``CmdSchedule`` instance.
+        Leonard will apply the commands at the simulation steps that match
+        their time stamps (relative to the moment it receives the schedule).
+        Booster commands are converted to the net force and torque of all
+        boosters here, in chronological order, just like ``controlParts``
+        would compute them at that time.
+
+        A new schedule replaces the current one, and an empty schedule
+        cancels it. Note that scheduled booster commands do not update the
+        booster values in the object's template.
+
+        :param str objID: object ID.
+        :param list[CmdSchedule] schedule: the scheduled commands.
+        :return: Success
+        """
+        # Query the object's booster information.
+        db = datastore.getDSHandle('ObjInstances')
+        ret = db.getOne(objID, [['template', 'boosters']])
+        if not ret.ok:
+            return ret
+
+        # Return with an error if `objID` does not exists.
+        if ret.data is None:
+            msg = 'Object <{}> does not exist'.format(objID)
+            return RetVal(False, msg, None)
+
+        # Put the Booster entries from the database into Booster tuples and
+        # sanity check the schedule.
+        try:
+            b = aztypes.Booster
+            boosters = ret.data['template']['boosters']
+            boosters = {k: b(**v) for (k, v) in boosters.items()}
+            schedule = [aztypes.CmdSchedule(*_) for _ in schedule]
+            del b
+        except TypeError:
+            msg = 'Invalid schedule or inconsistent Template data'
+            self.logit.warning(msg)
+            return RetVal(False, msg, None)
+
+        # Compile the schedule for Leonard. To this end replay the booster
+        # commands in chronological order and compute the net force and
+        # torque they produce at each step.
+        entries = []
+        for cmd in sorted(schedule, key=lambda _: _.time):
+            if len(cmd.cmd_boosters) > 0:
+                # Update the Booster values.
+                for partID, cmd_b in cmd.cmd_boosters.items():
+                    if partID not in boosters:
+                        msg = 'Object <{}> has no Booster with AID <{}>'
+                        msg = msg.format(objID, partID)
+                        self.logit.warning(msg)
+                        return RetVal(False, msg, None)
+                    boosters[partID] = boosters[partID]._replace(
+                        force=cmd_b.force)
+
+                # Tally up the forces exerted by all Boosters on the object.
+                force, torque = np.zeros(3), np.zeros(3)
+                for booster in boosters.values():
+                    b_pos = np.array(booster.position)
+                    b_dir = np.array(booster.direction)
+                    force += booster.force * b_dir
+                    torque += booster.force * np.cross(b_pos, b_dir)
+                entries.append((cmd.time, 'booster_force',
+                                force.tolist(), torque.tolist()))
+
+            if cmd.force is not None:
+                # Compute the torque of the direct force.
+                force = np.array(cmd.force, np.float64)
+                torque = np.cross(np.array(cmd.rpos, np.float64), force)
+                entries.append((cmd.time, 'direct_force',
+                                force.tolist(), torque.tolist()))
+
+        # Record the initial status of the schedule. This must happen before
+        # queuing the command or it could overwrite Leonard's status update.
+        num = len(entries)
+        status = {
+            'state': 'queued' if num > 0 else 'cancelled',
+            'applied': 0,
+            'remaining': num,
+        }
+        ops = {
+            objID: {
+                'inc': {},
+                'set': {('schedule', ): status},
+                'unset': [],
+                'exists': {},
+            }
+        }
+        ret = db.modify(ops)
+        if not ret.ok:
+            return ret
+
+        # Hand the schedule to Leonard.
+        return leoAPI.addCmdSchedule(objID, entries)
+
+    @typecheck
+    def setForceProfiles(self, objID: str, profiles: (tuple, list)):
+        """
+        Replace the analytic force- and torque profiles of ``objID``.
+
+        Leonard evaluates the profiles in every physics step, which makes
+        them the preferred way to apply smooth, time varying forces (eg.
+        sinusoidal excitations) to objects. An empty list removes all
+        profiles. See ``aztypes.ForceProfile`` for the available profiles.
+
+        :param str objID: object ID.
+        :param list[ForceProfile] profiles: the new profiles.
+        :return: Success
+        """
+        return leoAPI.addCmdForceProfiles(objID, profiles)
+
+    @typecheck
+    def getScheduleStatus(self, objIDs: (tuple, list)):
+        """
+        Return the status of the command schedules for all ``objIDs``.
+
+        The status is a dictionary with the keys 'state' (one of 'queued',
+        'active', 'done', 'cancelled'), 'applied', and 'remaining'. The
+        status is *None* if the object does not exist or has no schedule.
+
+        :param list[str] objIDs: object IDs.
+        :return: dictionary of schedule status.
+        """
+        db = datastore.getDSHandle('ObjInstances')
+        ret = db.getMulti(objIDs, [['schedule']])
+        if not ret.ok:
+            return ret
+
+        out = {k: v.get('schedule', None) if v is not None else None
+               for k, v in ret.data.items()}
+        return RetVal(True, None, out)
+
     @typecheck
     def addConstraints(self, constraints: (tuple, list)):
         """
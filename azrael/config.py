@@ -29,9 +29,11 @@ Global configuration parameters.
 import os
 import sys
 import psutil
+import tempfile
 import azutils
 import pymongo
 import logging
+import threading
 import setproctitle
 import multiprocessing
 
@@ -85,6 +87,167 @@ url_templates = '/templates'
 url_instances = '/instances'
 assert not url_templates.endswith('/') and not url_templates.endswith('/')
 
+# Datastore backend: 'mongo', or 'shared' for the in-memory datastore that all
+# processes on this host share (see `memstore.DatastoreServer`). The shared
+# datastore listens on the Unix domain socket `datastore_socket`. If
+# `datastore_journal` is not None then it logs all write operations to that
+# file, and replays them after a restart. The journal is only guaranteed to be
+# on disk before the server replies if `datastore_journal_sync` is True. The
+# server compacts the journal after `datastore_journal_compact` write requests
+# (zero means only at start up).
+datastore_backend = 'mongo'
+datastore_socket = os.path.join(tempfile.gettempdir(), 'azrael_datastore.sock')
+datastore_journal = None
+datastore_journal_sync = False
+datastore_journal_compact = 100000
+
+# The Mongo datastores send their write operations in unordered bulk writes of
+# at most `datastore_batch_size` operations each, with the specified write
+# concern (see `pymongo.WriteConcern` for the supported keys).
+datastore_batch_size = 1000
+datastore_write_concern = {'w': 1}
+
+# Read-through caches for the datastores (see `datastore.DatastoreCached`).
+# The keys of `datastore_cache` name the cached datastores and the values list
+# the volatile key hierarchies that change too often to be worth caching. Each
+# cache holds at most `datastore_cache_size` (document, projection) entries.
+# The caches learn about the writes of other processes from the change feed
+# of the datastore, which requires Mongo to run as a replica set; they
+# disable themselves otherwise. 'ObjInstances' is not cached by default
+# because every process would then receive the rigid body updates of Leonard.
+datastore_cache = {'Templates': []}
+datastore_cache_size = 10000
+
+# Store the position, rotation and velocities of the object instances in a
+# single binary blob instead of separate arrays (see
+# `datastore.DatastorePacked`). This reduces the size of the documents Leonard
+# rewrites in every step.
+datastore_pack_rbs = False
+
+# Number of partitions (collections) for each datastore (see
+# `datastore.DatastorePartitioned`). Datastores that are not listed use a
+# single collection.
+datastore_partitions = {}
+
+# Every process leases blocks of `objid_block_size` object IDs at once and
+# hands them out locally (see `datastore.getUniqueObjectIDs`).
+objid_block_size = 10000
+
+# Secondary indexes of the datastores (see `datastore.DatastoreBase.query`).
+# The keys name the datastores and the values list the indexed key
+# hierarchies.
+datastore_indexes = {
+    'ObjInstances': [('templateID', )],
+    'Constraints': [('rb_a', ), ('rb_b', )],
+}
+
+# Reduction of the collision contacts returned by the physics engines (and
+# published by Leonard). Keep at most `contacts_max_points` contact points per
+# pair of bodies (zero means all of them). If `contacts_aggregate` is True
+# then all contacts of a pair are reduced to a single, impulse weighted,
+# contact point instead.
+contacts_max_points = 0
+contacts_aggregate = False
+
+# Physics quality tiers in ascending order of quality (and cost). Templates
+# can request a tier by name, and Leonard simulates every collision set with
+# the best tier of its members. Objects without a tier use `quality_default`.
+# See `aztypes.QualityProfile` for the meaning of the parameters; the
+# 'default' tier corresponds to the Bullet defaults.
+quality_tiers = ('low', 'default', 'high')
+quality_default = 'default'
+
+# Isolated bodies bypass Bullet unless their tier is in `quality_bullet`. The
+# solver settings of a profile only affect contacts and constraints, which
+# isolated bodies do not have, and Leonard scales their number of sub-steps
+# by the `substepScale` of the tier (see `LeonardBase.splitCollisionSets`).
+quality_bullet = ()
+quality_profiles = {
+    'low': {
+        'solverIterations': 4, 'splitImpulse': False, 'warmstarting': 0.85,
+        'erp': 0.2, 'cfm': 0, 'contactThreshold': 1E30, 'substepScale': 0.5,
+    },
+    'default': {
+        'solverIterations': 10, 'splitImpulse': True, 'warmstarting': 0.85,
+        'erp': 0.2, 'cfm': 0, 'contactThreshold': 1E30, 'substepScale': 1,
+    },
+    'high': {
+        'solverIterations': 30, 'splitImpulse': True, 'warmstarting': 0.85,
+        'erp': 0.2, 'cfm': 0, 'contactThreshold': 1E30, 'substepScale': 2,
+    },
+}
+
+# Continuous collision detection (CCD) for fast bodies. The physics engine
+# derives the CCD parameters of every body from the smallest half-length of
+# its collision shapes; CCD kicks in once a body moves further than that
+# within a single sub-step. The swept sphere is `ccd_radius_scale` times that
+# size. Leonard uses the same size to select the number of sub-steps for each
+# collision set (see `LeonardBase.getSubsteps`).
+ccd_enabled = True
+ccd_radius_scale = 0.5
+
+# Adaptive sub-steps (see `LeonardBase.getSubsteps`). During one sub-step no
+# point on a body may travel further than `substeps_travel` times the
+# smallest AABB half-length in its collision set, and no body may rotate by
+# more than `substeps_angle` (in radians). Springs must complete at most
+# `1 / substeps_spring` radians of their natural oscillation per sub-step.
+# Leonard uses at most `leonard_maxsteps` sub-steps per step (see
+# `LeonardBase.run`).
+substeps_travel = 1.0
+substeps_angle = 0.25
+substeps_spring = 4.0
+leonard_maxsteps = 10
+
+# Leonard snapshots its state, including that of its Bullet engines, every
+# `snapshot_interval` steps (zero, the default, disables the snapshots). It
+# keeps the last `snapshot_history` snapshots in memory to roll back the
+# simulation, and writes the latest one to the file `<snapshot_name>.snapshot`
+# in `snapshot_dir`. Only the current user may access that directory. If
+# `snapshot_resume` is True then Leonard resumes from that file at start up
+# (see `LeonardBase.run`).
+snapshot_interval = 0
+snapshot_history = 10
+snapshot_dir = os.path.join(
+    tempfile.gettempdir(), 'azrael-{}'.format(os.getuid()))
+snapshot_name = 'leonard'
+snapshot_resume = False
+
+# Every Leonard Worker keeps at most `worker_max_bodies` bodies in its Bullet
+# engine and evicts the least recently used ones beyond that (see
+# `LeonardWorkerZeroMQ.updateBodyCache`). The budget is a number of bodies,
+# not bytes, because Bullet does not report its memory usage. The memory of a
+# body is roughly constant though, since identical bodies share their
+# collision shapes (see `PyBulletDynamicsWorld.getShapeLibraryStats`), so the
+# memory of a worker grows proportionally to this value.
+worker_max_bodies = 10000
+
+
+# MongoDB connection pools. Every process shares one client (and thus one
+# connection pool) per timeout value (see `getMongoClient`). Each pool holds at
+# most `mongo_pool_max` sockets and keeps at least `mongo_pool_min` of them
+# open. Idle sockets are closed after `mongo_pool_idle` seconds (zero keeps
+# them open indefinitely).
+mongo_pool_max = 20
+mongo_pool_min = 0
+mongo_pool_idle = 60
+
+# Registry of the shared Mongo clients of this process (see `getMongoClient`).
+_mongoClients = {}
+_mongoClientsPID = os.getpid()
+_mongoClientStats = {'created': 0, 'reused': 0}
+
+# Guards the registry. A forked child gets a fresh lock because another thread
+# of the parent may have held it during the fork.
+_mongoClientsLock = threading.RLock()
+
+
+def _newMongoClientsLock():
+    global _mongoClientsLock
+    _mongoClientsLock = threading.RLock()
+
+
+os.register_at_fork(after_in_child=_newMongoClientsLock)
+
 
 def getMongoClient(timeout: float=10):
     """
@@ -93,6 +256,12 @@ def getMongoClient(timeout: float=10):
     This is a convenience method that automatically connects to the correct
     host on the correct address.
 
+    All callers in the same process share the same client for the same
+    `timeout`, and therefore also its connection pool. The registry resets
+    itself when it detects a new PID (ie the process was forked), because
+    clients must not be shared across a fork (see `resetMongoClients`). It is
+    thread safe.
+
     This function does *not* intercept any errors. It is the responsibility of
     the caller to use the correct try/except statement.
 
@@ -102,13 +271,71 @@ def getMongoClient(timeout: float=10):
     :raises: pymongo.errors.*
     """
     timeout_milliseconds = int(1000 * timeout)
-    return pymongo.MongoClient(
-        host=azService['database'].ip,
-        port=azService['database'].port,
-        serverSelectionTimeoutMS=timeout_milliseconds,
-        socketTimeoutMS=timeout_milliseconds,
-        connectTimeoutMS=timeout_milliseconds,
-    )
+    key = (azService['database'].ip, azService['database'].port,
+           timeout_milliseconds)
+
+    with _mongoClientsLock:
+        # Discard the clients inherited from the parent process.
+        if os.getpid() != _mongoClientsPID:
+            resetMongoClients()
+
+        # Return the shared client if there already is one.
+        if key in _mongoClients:
+            _mongoClientStats['reused'] += 1
+            return _mongoClients[key]
+
+        # Create a new client with its own connection pool.
+        idle = int(1000 * mongo_pool_idle) if mongo_pool_idle > 0 else None
+        client = pymongo.MongoClient(
+            host=key[0],
+            port=key[1],
+            serverSelectionTimeoutMS=timeout_milliseconds,
+            socketTimeoutMS=timeout_milliseconds,
+            connectTimeoutMS=timeout_milliseconds,
+            maxPoolSize=mongo_pool_max,
+            minPoolSize=mongo_pool_min,
+            maxIdleTimeMS=idle,
+        )
+        _mongoClients[key] = client
+        _mongoClientStats['created'] += 1
+        return client
+
+
+def resetMongoClients():
+    """
+    Discard all shared Mongo clients of this process.
+
+    The clients are only closed if they were created by this process. Clients
+    inherited from a parent process are merely dropped since closing them
+    would also shut down the sockets the parent still uses.
+    """
+    global _mongoClientsPID
+    with _mongoClientsLock:
+        if os.getpid() == _mongoClientsPID:
+            for client in _mongoClients.values():
+                client.close()
+        _mongoClients.clear()
+        _mongoClientStats['created'] = _mongoClientStats['reused'] = 0
+        _mongoClientsPID = os.getpid()
+
+
+def getMongoClientStats():
+    """
+    Return the connection reuse statistics of the shared Mongo clients.
+
+    The statistics contain the number of shared clients (`clients`), how often
+    `getMongoClient` had to create one (`created`), and how often it returned
+    an existing one instead (`reused`). All counters refer to the current
+    process only.
+
+    :return: statistics
+    :rtype: dict
+    """
+    with _mongoClientsLock:
+        stats = dict(_mongoClientStats)
+        stats['clients'] = len(_mongoClients)
+        stats['pid'] = _mongoClientsPID
+    return stats
 
 
 class AzraelProcess(multiprocessing.Process):
@@ -141,6 +368,9 @@ class AzraelProcess(multiprocessing.Process):
             setproctitle.setproctitle(procname)
             del procname
 
+            # Do not share the Mongo clients of the parent process.
+            resetMongoClients()
+
     def terminate(self):
         """
         Kill this process and *all* its descendants.
@@ -18,10 +18,17 @@
 """
 Database abstractions.
 """
+import os
 import copy
 import time
+import zlib
+import uuid
+import struct
 import pymongo
 import logging
+import threading
+import collections
+import concurrent.futures
 
 import azrael.config as config
 from IPython import embed as ipshell
@@ -32,6 +39,12 @@ logit = logging.getLogger('azrael.' + __name__)
 
 dbHandles = {}
 
+# The rigid body fields that `DatastorePacked` stores in a single blob if
+# `config.datastore_pack_rbs` is set. These are the fields that Leonard updates
+# in every step.
+PACKED_RBS_LAYOUT = (
+    ('position', 3), ('rotation', 4), ('velocityLin', 3), ('velocityRot', 3))
+
 
 def init(flush):
     """
@@ -42,20 +55,66 @@ def init(flush):
     """
     global dbHandles
 
+    # Close the change feeds of the current caches.
+    for db in dbHandles.values():
+        if isinstance(db, DatastoreCached):
+            db.close()
+
     # Create all the data stores.
     names = ('Commands', 'Constraints', 'Counters', 'ObjInstances', 'Templates')
+    if config.datastore_backend == 'shared':
+        import azrael.memstore
+        clsDatastore = azrael.memstore.DatastoreShared
+    else:
+        clsDatastore = DatastoreMongo
     try:
-        dbHandles = {name: DatastoreMongo(('azrael', name)) for name in names}
+        dbHandles = {name: _createHandle(clsDatastore, name) for name in names}
     except IOError:
         return RetVal(False, 'Could not initialise Datastore', None)
 
-    # Reset each data store.
+    # Pack the hot rigid body fields of the object instances, if so
+    # configured.
+    if config.datastore_pack_rbs:
+        dbHandles['ObjInstances'] = DatastorePacked(
+            dbHandles['ObjInstances'], ('template', 'rbs'), PACKED_RBS_LAYOUT)
+
+    # Wrap the datastores in read-through caches, if so configured.
+    for name, volatile in config.datastore_cache.items():
+        dbHandles[name] = DatastoreCached(
+            dbHandles[name], volatile=volatile, watch=True)
+
+    # Reset each data store, and discard the object IDs leased from the old
+    # counter.
     if flush:
         for name in names:
             dbHandles[name].reset()
+        with _objIDs.lock:
+            _objIDs.reset()
     return RetVal(True, None, None)
 
 
+def _createHandle(clsDatastore, name: str):
+    """
+    Return the ``clsDatastore`` instance for the datastore ``name``.
+
+    Distribute the documents over several collections if
+    `config.datastore_partitions` says so (see `DatastorePartitioned`).
+
+    Raises IOError if the datastore is unavailable.
+    """
+    indexes = config.datastore_indexes.get(name, ())
+    num = config.datastore_partitions.get(name, 1)
+    if num <= 1:
+        return clsDatastore(('azrael', name), indexes=indexes)
+
+    # The partitions are the collections 'name_0', 'name_1', ...
+    backends = [
+        clsDatastore(('azrael', '{}_{}'.format(name, ii)), indexes=indexes)
+        for ii in range(num)
+    ]
+    return DatastorePartitioned(backends)
+
+
 @typecheck
 def getDSHandle(name: str):
     """
@@ -81,11 +140,109 @@ def getDSHandle(name: str):
     return dbHandles[name]
 
 
+class _ObjectIDLeases:
+    """
+    Hand out object IDs from blocks this process leased from the 'objcnt'
+    counter in the 'Counters' datastore.
+
+    Every lease increments the counter by `config.objid_block_size` and thus
+    reserves the IDs in between for this process, even if other processes
+    lease their own blocks concurrently. The next block is leased in a
+    background thread once fewer than a quarter of the current one remain.
+    Unused IDs are lost when the process terminates.
+
+    A forked process discards the leases of its parent.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all leases (eg. after the counter was reset).
+        """
+        self.pid = os.getpid()
+        self.blocks = collections.deque()
+        self.refilling = False
+        self.generation += 1
+
+    def _lease(self, numIDs: int):
+        """
+        Lease a block of ``numIDs`` IDs and return it as a [start, stop) range.
+        """
+        ret = dbHandles['Counters'].incrementCounter('objcnt', numIDs)
+        if not ret.ok:
+            return ret
+        return RetVal(True, None, (ret.data - numIDs + 1, ret.data + 1))
+
+    def _refill(self, generation: int):
+        """
+        Lease another block in the background.
+        """
+        ret = self._lease(config.objid_block_size)
+        with self.lock:
+            # Discard the block if the leases were reset in the meantime.
+            if ret.ok and generation == self.generation:
+                self.blocks.append(ret.data)
+            self.refilling = False
+
+    def get(self, numIDs: int):
+        """
+        Return ``numIDs`` unique IDs.
+
+        :param int numIDs: positive integer.
+        :return: list[int]
+        """
+        blockSize = config.objid_block_size
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+
+            # Hand out the leased IDs and lease new ones synchronously if they
+            # do not suffice.
+            out = []
+            while len(out) < numIDs:
+                if len(self.blocks) == 0:
+                    ret = self._lease(max(blockSize, numIDs - len(out)))
+                    if not ret.ok:
+                        return ret
+                    self.blocks.append(ret.data)
+                start, stop = self.blocks[0]
+                num = min(stop - start, numIDs - len(out))
+                out.extend(range(start, start + num))
+                if start + num == stop:
+                    self.blocks.popleft()
+                else:
+                    self.blocks[0] = (start + num, stop)
+
+            # Lease the next block in the background if necessary.
+            remaining = sum(stop - start for start, stop in self.blocks)
+            low = remaining < blockSize / 4
+            if low and blockSize > 1 and not self.refilling:
+                self.refilling = True
+                self.thread = threading.Thread(
+                    target=self._refill, args=(self.generation, ), daemon=True)
+                self.thread.start()
+        return RetVal(True, None, out)
+
+
+# The object ID leases of this process.
+_objIDs = _ObjectIDLeases()
+
+
 @typecheck
 def getUniqueObjectIDs(numIDs: int):
     """
     Return a list of ``numIDs`` unique strings.
 
+    The IDs come from the blocks this process has leased (see
+    `_ObjectIDLeases`). They are unique across all processes but not
+    necessarily consecutive.
+
+    If ``numIDs`` is zero then return the current value of the counter.
+
     :param int numIDs: non-negative integer.
     :return list[str]: for instance ['1', '2']
     """
@@ -93,26 +250,18 @@ def getUniqueObjectIDs(numIDs: int):
     if numIDs < 0:
         return RetVal(False, 'numIDs must be non-negative', None)
 
-    # Increment the counter by ``numIDs``.
-    db = dbHandles['Counters']
-    ret = db.incrementCounter('objcnt', numIDs)
-    if not ret.ok:
-        return ret
-    value = ret.data
-
-    # The a range of values with length numIDs.
+    # Return the current counter value.
     if numIDs == 0:
-        newIDs = range(1)
-    else:
-        newIDs = range(numIDs)
-
-    # Convert [0, 1, ..., N] to [value, value-1, ..., value-N+1]. For instance,
-    # if value=10 and N=3 then this will produce [10, 9, 8]
-    newIDs = [value - ii for ii in newIDs]
+        ret = dbHandles['Counters'].incrementCounter('objcnt', 0)
+        if not ret.ok:
+            return ret
+        return RetVal(True, None, [str(ret.data)])
 
-    # Reverse the list and convert the integers to strings.
-    newIDs = [str(_) for _ in newIDs[::-1]]
-    return RetVal(True, None, newIDs)
+    # Fetch the IDs from the leased blocks and convert them to strings.
+    ret = _objIDs.get(numIDs)
+    if not ret.ok:
+        return ret
+    return RetVal(True, None, [str(_) for _ in ret.data])
 
 
 def _checkGet(aids: (tuple, list), prj: list):
@@ -163,6 +312,30 @@ def _checkGetAll(prj: list):
     return True
 
 
+def _checkQuery(filter: dict, prj: list):
+    """
+    Return True if ``filter`` and ``prj`` are valid inputs to `query`.
+
+    The keys of ``filter`` must be valid JSON keys and its values strings or
+    numbers.
+
+    Example:: _checkQuery({('a', 'b'): 'foo'}, [('a', )])
+
+    :param dict filter: {key_hierarchy: value}
+    :param list prj: list of projection keys.
+    :return: bool
+    """
+    try:
+        assert isinstance(filter, dict)
+        for jsonkey, value in filter.items():
+            assert _validJsonKey(jsonkey)
+            assert isinstance(value, (str, int, float))
+            assert not isinstance(value, bool)
+    except (AssertionError, TypeError):
+        return False
+    return _checkGetAll(prj)
+
+
 def _checkPut(ops: dict):
     """
     Return True if ``ops`` is valid input for {'put', 'replace'}.
@@ -231,19 +404,27 @@ def _checkMod(ops):
     return True
 
 
-def _checkRemove(aids):
+def _checkRemove(aids, match=None):
     """
-    Return True if all ``aids`` are strings.
+    Return True if all ``aids`` are strings and ``match`` is valid.
 
-    Example:: _checkRemove(['foo', 'bar'])
+    Example:: _checkRemove(['foo', 'bar'], {'foo': {('a', 'b'): 1}})
 
     :param list aids: The AIDS to remove.
+    :param dict match: {aid: {key_hierarchy: value}} conditions (or None).
     :return: bool
     """
     try:
         for aid in aids:
             assert isinstance(aid, str)
-    except AssertionError:
+        if match is not None:
+            assert isinstance(match, dict)
+            for aid, cond in match.items():
+                assert isinstance(aid, str)
+                assert isinstance(cond, dict)
+                for key in cond:
+                    assert _validJsonKey(key)
+    except (AssertionError, TypeError):
         return False
     return True
 
@@ -275,6 +456,337 @@ def _validJsonKey(name: (list, tuple)):
     return True
 
 
+def _readOnly(self, *args, **kwargs):
+    raise TypeError('Datastore documents are read-only')
+
+
+class _FrozenDict(dict):
+    """
+    Read-only dictionary for the documents in ``DatastoreInMemory``.
+
+    Frozen documents can be shared between the data store and all callers
+    because nobody can modify them. Pickling or (deep) copying them produces
+    ordinary dictionaries again.
+    """
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+
+    def __reduce__(self):
+        return (dict, (dict(self), ))
+
+    def __copy__(self):
+        return dict(self)
+
+
+class _FrozenList(list):
+    """
+    Read-only list for the documents in ``DatastoreInMemory``.
+
+    See ``_FrozenDict``.
+    """
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readOnly
+    append = extend = insert = pop = remove = clear = _readOnly
+    sort = reverse = _readOnly
+
+    def __reduce__(self):
+        return (list, (list(self), ))
+
+    def __copy__(self):
+        return list(self)
+
+
+def _freeze(obj):
+    """
+    Return a read-only version of ``obj``.
+
+    Frozen containers are returned as is, which means that freezing a
+    document whose sub-documents are already frozen only copies the
+    containers along the modified paths.
+
+    :param obj: arbitrary JSON compatible data structure.
+    :return: frozen version of ``obj``.
+    """
+    if isinstance(obj, (_FrozenDict, _FrozenList)):
+        return obj
+    elif isinstance(obj, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return _FrozenList(_freeze(_) for _ in obj)
+    else:
+        return obj
+
+
+def _thawPaths(doc, key_hierarchies):
+    """
+    Return a shallow copy of ``doc`` whose dictionaries along all
+    ``key_hierarchies`` are mutable again.
+
+    All other sub-documents are shared with ``doc``.
+
+    :param _FrozenDict doc: frozen document.
+    :param list key_hierarchies: the key hierarchies to thaw.
+    :return: dict
+    """
+    out = dict(doc)
+    for key_hierarchy in key_hierarchies:
+        tmp = out
+        for key in key_hierarchy[:-1]:
+            child = tmp.get(key)
+            if not isinstance(child, dict):
+                break
+            if isinstance(child, _FrozenDict):
+                child = tmp[key] = dict(child)
+            tmp = child
+    return out
+
+
+# A single change to a datastore document (see `DatastoreBase.subscribe`).
+# The 'op' is one of 'insert', 'modify', 'remove' or 'reset' (the 'aid' is
+# None for the latter). The 'keys' list the modified key hierarchies, or are
+# None if the entire document changed. The 'version' increases monotonically
+# with every change to the datastore.
+ChangeEvent = collections.namedtuple('ChangeEvent', 'op aid keys version')
+
+
+class ChangeFeed:
+    """
+    Queue of `ChangeEvent` tuples for a single subscriber.
+
+    The datastore pushes the events into the queue and the subscriber either
+    fetches them with `poll`, or iterates over the feed to wait for them.
+
+    :param callable onClose: called with the feed as argument once it closes.
+    """
+    def __init__(self, onClose=None):
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self._onClose = onClose
+
+    def push(self, events: (tuple, list)):
+        """
+        Add the ``events`` to the queue and wake up the subscriber.
+        """
+        with self.cond:
+            if not self.closed:
+                self.events.extend(events)
+                self.cond.notify_all()
+
+    def poll(self, timeout: float=0):
+        """
+        Return all pending events and remove them from the queue.
+
+        Wait up to ``timeout`` seconds for an event if none is pending. Wait
+        indefinitely if ``timeout`` is None.
+
+        :param float timeout: timeout in seconds.
+        :return: list of ``ChangeEvent`` tuples.
+        """
+        with self.cond:
+            if len(self.events) == 0 and timeout != 0 and not self.closed:
+                self.cond.wait(timeout)
+            out = list(self.events)
+            self.events.clear()
+        return out
+
+    def __iter__(self):
+        while not self.closed:
+            yield from self.poll(timeout=None)
+
+    def close(self):
+        """
+        Stop the feed (subsequent events will be dropped).
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        if self._onClose is not None:
+            self._onClose(self)
+
+
+def _isCounter(doc: dict):
+    """
+    Return True if the Mongo document ``doc`` is a counter.
+
+    Counters only have an AID (their name) and a value (see
+    `DatastoreMongo.setCounter`).
+    """
+    return set(doc.keys()) == {'_id', 'aid', 'value'}
+
+
+class ChangeFeedMongo(ChangeFeed):
+    """
+    Change feed for a Mongo collection.
+
+    A background thread tails the change stream of the collection and pushes
+    the events into the queue. Change streams require Mongo to run as a
+    replica set (one member suffices); the constructor raises a
+    `pymongo.errors.PyMongoError` otherwise.
+
+    Only documents with an AID produce events. The counters in the same
+    collection do not.
+
+    The '_id' of every document is its AID, except for the counters and the
+    documents created before `DatastoreMongo.put` adopted that convention;
+    they have an ObjectId. The feed resolves the AIDs of the latter from
+    the ``legacy`` map (see `compileEvent`).
+
+    :param collection: pymongo collection.
+    """
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.token = None
+        self.stream = collection.watch(max_await_time_ms=100)
+
+        # Create a Class-specific logger.
+        name = '.'.join([__name__, self.__class__.__name__])
+        self.logit = logging.getLogger(name)
+
+        # Map the ObjectIds of all existing documents to their AID (None for
+        # counters). Read them after opening the stream to not miss any.
+        self.legacy = {}
+        query = {'_id': {'$not': {'$type': 'string'}}}
+        for doc in collection.find(query):
+            self.legacy[doc['_id']] = None if _isCounter(doc) else doc['aid']
+
+        self.thread = threading.Thread(target=self._tail, daemon=True)
+        self.thread.start()
+
+    def _tail(self):
+        """
+        Relay the change stream to the queue until the feed closes.
+        """
+        while not self.closed:
+            try:
+                # Open a new stream if the old one was invalidated (eg.
+                # because the collection was dropped). Resume right after
+                # the last event to not miss any changes.
+                if not self.stream.alive:
+                    self.stream = self.collection.watch(
+                        max_await_time_ms=100, start_after=self.token)
+                doc = self.stream.try_next()
+            except pymongo.errors.PyMongoError as err:
+                self.logit.warning('Change stream error: {}'.format(err))
+                time.sleep(0.1)
+                continue
+            if doc is None:
+                continue
+
+            self.token = doc['_id']
+            event = self.compileEvent(doc, self.legacy)
+            if event is not None:
+                self.push([event])
+        self.stream.close()
+
+    @staticmethod
+    def compileEvent(doc: dict, legacy: dict=None):
+        """
+        Return the ``ChangeEvent`` for the change stream document ``doc``.
+
+        Return None if ``doc`` does not pertain to a document with an AID.
+
+        The ``legacy`` map translates ObjectIds into AIDs (None for
+        counters). This method adds the documents it learns about from
+        inserts and replacements, and removes the deleted ones. It returns a
+        'reset' event for unknown ObjectIds to make the subscribers reload
+        everything.
+
+        :param dict doc: change stream document.
+        :param dict legacy: {ObjectId: AID} map.
+        :return: ``ChangeEvent`` or None.
+        """
+        ts = doc['clusterTime']
+        version = (ts.time << 32) + ts.inc
+        optype = doc['operationType']
+        legacy = {} if legacy is None else legacy
+
+        # Dropping the collection invalidates all documents.
+        if optype in ('drop', 'dropDatabase', 'rename', 'invalidate'):
+            legacy.clear()
+            return ChangeEvent('reset', None, None, version)
+
+        # The '_id' of every document is its AID, unless it is a counter or
+        # an old document (see `DatastoreMongo`). Resolve the AID of the
+        # latter from the full document or the legacy map.
+        aid = doc.get('documentKey', {}).get('_id', None)
+        if not isinstance(aid, str):
+            key, full = aid, doc.get('fullDocument', None)
+            if full is not None:
+                legacy[key] = None if _isCounter(full) else full.get('aid')
+            elif key not in legacy:
+                return ChangeEvent('reset', None, None, version)
+            aid = legacy[key]
+            if optype == 'delete':
+                del legacy[key]
+            if aid is None:
+                return None
+
+        if optype == 'insert':
+            return ChangeEvent('insert', aid, None, version)
+        elif optype == 'replace':
+            return ChangeEvent('modify', aid, None, version)
+        elif optype == 'update':
+            desc = doc['updateDescription']
+            keys = list(desc['updatedFields']) + list(desc['removedFields'])
+            keys = [tuple(_.split('.')) for _ in keys]
+            keys = [_ for _ in keys if _[0] != '_batch']
+            return ChangeEvent('modify', aid, keys, version)
+        elif optype == 'delete':
+            return ChangeEvent('remove', aid, None, version)
+        return None
+
+
+class ChangeFeedMerged(ChangeFeed):
+    """
+    Relay the events of several change feeds.
+
+    One background thread per feed moves its events into this queue until
+    that feed closes. This feed closes once all of them have. The event
+    versions are only comparable if they stem from the same feed.
+
+    :param list feeds: the ``ChangeFeed`` instances to merge.
+    """
+    def __init__(self, feeds: (tuple, list)):
+        super().__init__()
+        self.feeds = feeds
+        self.threads = [
+            threading.Thread(target=self._relay, args=(feed, ), daemon=True)
+            for feed in feeds
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _relay(self, feed):
+        """
+        Relay the events of ``feed`` until either feed closes.
+        """
+        while not (self.closed or feed.closed):
+            events = feed.poll(timeout=0.1)
+            if len(events) > 0:
+                self.push(events)
+
+        # Relay the events that arrived before the feed closed, and close
+        # this feed once all others have closed as well.
+        events = feed.poll()
+        if len(events) > 0:
+            self.push(events)
+        if all(_.closed for _ in self.feeds):
+            self.close()
+
+    def close(self):
+        """
+        See docu in ``ChangeFeed``.
+        """
+        super().close()
+        for feed in self.feeds:
+            feed.close()
+
+
 class DatastoreBase:
     """
     Base class for all Datastores.
@@ -293,6 +805,9 @@ class DatastoreBase:
         # database uses).
         self.dbname = name
 
+        # The key hierarchies with a secondary index (see `createIndex`).
+        self.indexes = []
+
         # Create a Class-specific logger.
         name = '.'.join([__name__, self.__class__.__name__])
         self.logit = logging.getLogger(name)
@@ -358,6 +873,38 @@ class DatastoreBase:
         """
         raise NotImplementedError
 
+    def query(self, filter: dict, prj=None):
+        """
+        Return all documents that match ``filter`` in a dictionary.
+
+        The ``filter`` maps key hierarchies to values, for instance
+        {('templateID', ): 'foo'}. A document matches if it contains all these
+        key hierarchies, and if they hold exactly the specified values. The
+        values must be strings or numbers. An empty ``filter`` matches all
+        documents.
+
+        The query uses the secondary indexes on the key hierarchies (see
+        `createIndex`) if there are any, and scans all documents otherwise.
+
+        :param dict filter: {key_hierarchy: value}
+        :param list prj: only return the fields specified in ``prj``.
+        :return: document dictionary.
+        """
+        raise NotImplementedError
+
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        Create a secondary index for ``key_hierarchy``.
+
+        The data store maintains the index on every write operation, and
+        `query` uses it to find the matching documents. This method does
+        nothing if the index already exists. Indexes survive a ``reset``.
+
+        :param tuple key_hierarchy: the key hierarchy to index, eg ('a', 'b').
+        :return: None
+        """
+        raise NotImplementedError
+
     def put(self, ops: dict):
         """
         Insert a not yet existing document into the data store.
@@ -422,13 +969,24 @@ class DatastoreBase:
         """
         raise NotImplementedError
 
-    def remove(self, aids: (tuple, list)):
+    def remove(self, aids: (tuple, list), match=None):
         """
         Remove the documents with the specified ``aids``.
 
+        The optional ``match`` dictionary makes the removal conditional. Its
+        keys are AIDs and its values specify which (nested) keys must have
+        which value for the document to be removed. This makes it possible to
+        only remove a document if it has not changed since it was read. AIDs
+        that are not in ``match`` are removed unconditionally.
+
         Return the number of actually removed documents.
 
+        Example::
+
+            db.remove(['1', '2'], {'1': {('foo', 'a'): 1}})
+
         :param list aids: list of AID strings.
+        :param dict match: {aid: {key_hierarchy: value}} conditions.
         :return: int number of actually removed objects.
         """
         raise NotImplementedError
@@ -480,6 +1038,20 @@ class DatastoreBase:
         """
         raise NotImplementedError
 
+    def subscribe(self):
+        """
+        Return a new ``ChangeFeed`` for this data store.
+
+        The feed receives a ``ChangeEvent`` for every document that is
+        inserted, modified or removed from now on, and a 'reset' event when
+        the entire data store was flushed. Counters do not produce events.
+
+        Call ``close`` on the feed once it is no longer needed.
+
+        :return: ``ChangeFeed``
+        """
+        raise NotImplementedError
+
 
 class DatastoreInMemory(DatastoreBase):
     """
@@ -488,15 +1060,33 @@ class DatastoreInMemory(DatastoreBase):
     This class is currently only useful for testing because different instances
     operate on their own copy of the database.
 
+    All documents are read-only (see ``_freeze``). This allows the query
+    methods to return them without copying them first. Modifications copy only
+    the sub-documents along the modified keys and share the rest with the
+    previous version of the document.
+
     The main purpose of this class is to (eventually) speed up the unit tests,
     and have a reference implementation for the ideal Datastore for Azrael.
+
+    The secondary indexes map the values of the indexed key hierarchies to
+    the AIDs of the documents that contain them. They only cover string and
+    numeric values because `query` cannot match any others.
+
+    :param tuple[str, str] name: (db_name, collection_name)
+    :param list indexes: key hierarchies to index (see `createIndex`).
     """
     @typecheck
-    def __init__(self, name: tuple):
+    def __init__(self, name: tuple, indexes: (tuple, list)=()):
         super().__init__(name)
 
-        # Setup the database dictionary.
+        # Change feeds of all subscribers and the current version.
+        self.feeds = []
+        self.version = 0
+
+        # Setup the database dictionary and the secondary indexes.
         self.reset()
+        for key in indexes:
+            assert self.createIndex(key).ok
 
     # -------------------------------------------------------------------------
     #                             API methods.
@@ -507,6 +1097,8 @@ class DatastoreInMemory(DatastoreBase):
         """
         self.content = {}
         self.counters = {}
+        self.index = {key: {} for key in self.indexes}
+        self._publish([('reset', None, None)])
         return RetVal(True, None, None)
 
     def count(self):
@@ -563,7 +1155,8 @@ class DatastoreInMemory(DatastoreBase):
         # Apply the projection operator.
         if prj is not None:
             project = self.project
-            docs = {aid: project(doc, prj) for aid, doc in docs.items()}
+            docs = {aid: None if doc is None else project(doc, prj)
+                    for aid, doc in docs.items()}
 
         return RetVal(True, None, docs)
 
@@ -577,16 +1170,64 @@ class DatastoreInMemory(DatastoreBase):
             self.logit.warning('Invalid GETALL argument')
             return RetVal(False, 'Argument error', None)
 
-        # Copy the requested documents into an output dictionary. If a key does
-        # not exist then the output dictionary will contain None for the
-        # respective values.
-        docs = copy.deepcopy(self.content)
+        # Copy the references to all (read-only) documents into an output
+        # dictionary and apply the projection operator.
+        docs = dict(self.content)
         if prj is not None:
             for doc in docs:
                 docs[doc] = self.project(docs[doc], prj)
 
         return RetVal(True, None, docs)
 
+    @typecheck
+    def query(self, filter: dict, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkQuery(filter, prj) is False:
+            self.logit.warning('Invalid QUERY argument')
+            return RetVal(False, 'Argument error', None)
+        filter = {tuple(k): v for k, v in filter.items()}
+
+        # Intersect the AIDs of all indexed filter values, starting with the
+        # smallest set. Scan all documents if none of the keys is indexed.
+        candidates = [self.index[k].get(v, set())
+                      for k, v in filter.items() if k in self.index]
+        if len(candidates) == 0:
+            aids = self.content.keys()
+        else:
+            candidates.sort(key=len)
+            aids = candidates[0].intersection(*candidates[1:])
+
+        # Verify the remaining filter conditions for every candidate.
+        rest = [(k, v) for k, v in filter.items() if k not in self.index]
+        docs = {}
+        for aid in aids:
+            doc = self.content[aid]
+            if all(self._indexValue(doc, k) == v for k, v in rest):
+                docs[aid] = doc if prj is None else self.project(doc, prj)
+        return RetVal(True, None, docs)
+
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if not _validJsonKey(key_hierarchy):
+            self.logit.warning('Invalid CREATEINDEX argument')
+            return RetVal(False, 'Argument error', None)
+        key = tuple(key_hierarchy)
+        if key in self.index:
+            return RetVal(True, None, None)
+
+        # Index the current documents.
+        self.indexes.append(key)
+        self.index[key] = {}
+        for aid, doc in self.content.items():
+            self._updateIndex(aid, None, doc, [key])
+        return RetVal(True, None, None)
+
     @typecheck
     def put(self, ops: dict):
         """
@@ -606,10 +1247,12 @@ class DatastoreInMemory(DatastoreBase):
 
             # Create the document. Log an error if it already exists.
             if aid not in self.content:
-                self.content[aid] = data
+                self.content[aid] = _freeze(data)
+                self._updateIndex(aid, None, self.content[aid])
                 ret[aid] = True
             else:
                 ret[aid] = False
+        self._publish([('insert', aid, None) for aid, ok in ret.items() if ok])
         return RetVal(True, None, ret)
 
     @typecheck
@@ -632,10 +1275,13 @@ class DatastoreInMemory(DatastoreBase):
             # Replace the document. Log an error if the document to
             # replace does not exist.
             if aid in self.content:
-                self.content[aid] = data
+                old = self.content[aid]
+                self.content[aid] = _freeze(data)
+                self._updateIndex(aid, old, self.content[aid])
                 ret[aid] = True
             else:
                 ret[aid] = False
+        self._publish([('modify', aid, None) for aid, ok in ret.items() if ok])
         return RetVal(True, None, ret)
 
     @typecheck
@@ -683,43 +1329,127 @@ class DatastoreInMemory(DatastoreBase):
                 ret[aid] = False
                 continue
 
+            # Copy the dictionaries along the modified keys. The new document
+            # shares all other sub-documents with the current one.
+            keys = list(op['inc']) + list(op['unset']) + list(op['set'])
+            c = _thawPaths(c, keys)
+
             # Increment the specified keys.
             for key, val in op['inc'].items():
-                self.incKey(self.content[aid], key, val)
+                self.incKey(c, key, val)
 
             # Delete the specified keys.
             for key in op['unset']:
-                self.delKey(self.content[aid], key)
+                self.delKey(c, key)
 
             # Create/overwrite the specified keys/value pairs.
             for key, val in op['set'].items():
-                self.setKey(self.content[aid], key, val)
+                self.setKey(c, key, val)
+
+            # Freeze the new document. This only affects the copied
+            # dictionaries and the new values.
+            old = self.content[aid]
+            self.content[aid] = _freeze(c)
+            self._updateIndex(aid, old, self.content[aid])
+
+        # Publish the modified keys of all modified documents.
+        events = []
+        for aid, ok in ret.items():
+            if ok:
+                op = ops[aid]
+                keys = list(op['inc']) + list(op['set']) + list(op['unset'])
+                events.append(('modify', aid, [tuple(_) for _ in keys]))
+        self._publish(events)
 
         # Return the success status (True or False) for each AID.
         return RetVal(True, None, ret)
 
     @typecheck
-    def remove(self, aids: (tuple, list)):
+    def remove(self, aids: (tuple, list), match=None):
         """
         See docu in ``DatastoreBase``.
         """
         # Sanity check all arguments.
-        if _checkRemove(aids) is False:
+        if _checkRemove(aids, match) is False:
             return RetVal(False, 'Argument error', None)
+        match = {} if match is None else match
 
-        # Delete every key. Ignore those that do not exist, but don't count
-        # them.
-        num_deleted = 0
+        # Delete every key. Ignore those that do not exist or do not satisfy
+        # their match conditions, but don't count them.
+        num_deleted, events = 0, []
         for aid in aids:
             try:
-                del self.content[aid]
-                num_deleted += 1
-            except KeyError:
-                pass
+                doc = self.content[aid]
+                for key, val in match.get(aid, {}).items():
+                    assert self.getKey(doc, key) == val
+            except (AssertionError, KeyError, TypeError):
+                continue
+            self._updateIndex(aid, self.content.pop(aid), None)
+            num_deleted += 1
+            events.append(('remove', aid, None))
+        self._publish(events)
 
         # Return the total number of deleted keys.
         return RetVal(True, None, num_deleted)
 
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+
+        The feed receives the events synchronously, ie. they are available
+        as soon as the write operation returns.
+        """
+        feed = ChangeFeed(onClose=self.feeds.remove)
+        self.feeds.append(feed)
+        return RetVal(True, None, feed)
+
+    def _publish(self, changes: list):
+        """
+        Push the (op, aid, keys) ``changes`` to all change feeds.
+        """
+        if len(self.feeds) == 0 or len(changes) == 0:
+            return
+        events = []
+        for op, aid, keys in changes:
+            self.version += 1
+            events.append(ChangeEvent(op, aid, keys, self.version))
+        for feed in self.feeds:
+            feed.push(events)
+
+    def _indexValue(self, doc: dict, key_hierarchy: tuple):
+        """
+        Return the value of ``key_hierarchy`` in ``doc`` if it is a string or
+        number, or None otherwise.
+        """
+        try:
+            value = self.getKey(doc, key_hierarchy)
+        except (KeyError, TypeError):
+            return None
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            return None
+        return value
+
+    def _updateIndex(self, aid: str, old: dict, new: dict, keys=None):
+        """
+        Replace the ``old`` document of ``aid`` with the ``new`` one in the
+        secondary indexes for ``keys`` (defaults to all).
+
+        Either document may be None to insert or remove ``aid``.
+        """
+        keys = self.indexes if keys is None else keys
+        for key in keys:
+            index = self.index[key]
+            v_old = None if old is None else self._indexValue(old, key)
+            v_new = None if new is None else self._indexValue(new, key)
+            if v_old == v_new:
+                continue
+            if v_old is not None:
+                index[v_old].discard(aid)
+                if len(index[v_old]) == 0:
+                    del index[v_old]
+            if v_new is not None:
+                index.setdefault(v_new, set()).add(aid)
+
     # -------------------------------------------------------------------------
     #                         Counter Functionality
     # -------------------------------------------------------------------------
@@ -873,42 +1603,74 @@ class DatastoreInMemory(DatastoreBase):
         """
         Return ``doc`` but with only those fields specified in ``prj``.
 
-        This method returns a copy of the original ``doc``. It does *not*
-        modify the original ``doc`` in any way.
+        This method does *not* modify the original ``doc`` in any way. The
+        returned document is read-only and shares the projected values with
+        ``doc``.
 
         :param dict doc: possibly nested dictionary.
         :param tuple prj: list of key_hierarchies.
         """
-        # Create a genuine copy that is independent from all the dictionaries
-        # in the original.
-        doc = copy.deepcopy(doc)
-
         # Iterate over all key hierarchies specified in ``prj``. Copy the
         # respective values from the original `doc`.
         out = {}
         for p in prj:
             try:
                 self.setKey(out, p, self.getKey(doc, p))
-            except KeyError:
+            except (KeyError, TypeError):
                 continue
-        return out
+        return _freeze(out)
 
 
 class DatastoreMongo(DatastoreBase):
     """
     MongoDB backed datastore.
+
+    The ``put``, ``replace``, ``modify`` and ``remove`` methods send their
+    operations as unordered bulk writes of at most ``batchSize`` operations,
+    with the ``writeConcern`` (a dictionary of ``pymongo.WriteConcern``
+    arguments). Both default to the values in the config module.
+
+    The secondary ``indexes`` are ordinary Mongo indexes (see `createIndex`).
+
+    Every ``replace`` and ``modify`` stamps the documents it writes with a
+    unique token, and each document keeps the last ``numTokens`` of them in
+    its private '_batch' field (see `_matchedAIDs`). The field is never
+    returned.
+
+    The '_id' of every document that ``put`` inserts is its AID. Documents
+    from older versions have an ObjectId instead, and need no migration:
+    all queries use the 'aid' field, ``put`` never upserts an existing
+    document, and `ChangeFeedMongo` resolves their AIDs.
     """
-    def __init__(self, name: tuple):
+    numTokens = 16
+
+    def __init__(self, name: tuple, batchSize: int=None,
+                 writeConcern: dict=None, indexes: (tuple, list)=()):
         super().__init__(name)
 
         # Record the database/collection name.
         self.name_db, self.name_col = name
 
+        # Batch size and write concern for the bulk writes.
+        if batchSize is None:
+            batchSize = config.datastore_batch_size
+        if writeConcern is None:
+            writeConcern = config.datastore_write_concern
+        assert batchSize > 0
+        self.batchSize = batchSize
+        self.writeConcern = pymongo.WriteConcern(**writeConcern)
+
         # Get client handle (may raise IOError to relay errors to the caller).
         client = self.connect()
 
         # Store the MongoDB handle as an instance variable.
         self.db = client[self.name_db][self.name_col]
+        self.db = self.db.with_options(write_concern=self.writeConcern)
+
+        # Create the secondary indexes.
+        for key in indexes:
+            if not self.createIndex(key).ok:
+                raise IOError('Could not create index <{}>'.format(key))
 
     def connect(self):
         """
@@ -945,6 +1707,10 @@ class DatastoreMongo(DatastoreBase):
                     background=False,
                     unique=True
                 )
+
+                # Restore the secondary indexes.
+                for key in self.indexes:
+                    self.db.create_index([('.'.join(key), pymongo.ASCENDING)])
                 break
             except pymongo.errors.AutoReconnect as err:
                 # An error occurred. According to the pymongo docu this means
@@ -1044,39 +1810,71 @@ class DatastoreMongo(DatastoreBase):
         return RetVal(True, None, docs)
 
     @typecheck
-    def put(self, ops: dict):
+    def query(self, filter: dict, prj=None):
         """
         See docu in ``DatastoreBase``.
         """
         # Sanity check all arguments.
-        if _checkPut(ops) is False:
-            self.logit.warning('Invalid PUT argument')
+        if _checkQuery(filter, prj) is False:
+            self.logit.warning('Invalid QUERY argument')
             return RetVal(False, 'Argument error', None)
 
-        ret = {}
-        for aid, op in ops.items():
-            # Unpack the data and make a genuine copy of it (jsut to avoid bad
-            # surprised because dictionaries are mutable).
-            data = op['data']
-            data = copy.deepcopy(data)
+        # Fetch the matching documents. Mongo picks the index itself.
+        query = {'.'.join(k): v for k, v in filter.items()}
+        prj = self._compileProjectionOperator(prj)
+        docs = self._removeAID(self.db.find(query, prj))
+        return RetVal(True, None, docs)
 
-            # Insert the AID field. This field is the primary key in the
-            # Datastore.
-            data['aid'] = aid
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if not _validJsonKey(key_hierarchy):
+            self.logit.warning('Invalid CREATEINDEX argument')
+            return RetVal(False, 'Argument error', None)
+        key = tuple(key_hierarchy)
+        if key in self.indexes:
+            return RetVal(True, None, None)
 
-            # Insert the document only if it does not yet exist.
-            r = self.db.update_one(
-                {'aid': aid},
-                {'$setOnInsert': data},
-                upsert=True
-            )
+        try:
+            self.db.create_index([('.'.join(key), pymongo.ASCENDING)])
+        except pymongo.errors.PyMongoError as err:
+            msg = 'Could not create index <{}>: {}'.format(key, err)
+            self.logit.error(msg)
+            return RetVal(False, msg, None)
+        self.indexes.append(key)
+        return RetVal(True, None, None)
 
-            # Specify the success value for this document depending on whether
-            # it already existed in the database or not.
-            if r.upserted_id is None:
-                ret[aid] = False
-            else:
-                ret[aid] = True
+    @typecheck
+    def put(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkPut(ops) is False:
+            self.logit.warning('Invalid PUT argument')
+            return RetVal(False, 'Argument error', None)
+
+        # Insert every document only if it does not yet exist. The '_id' of
+        # every document is its AID. This identifies the upserted documents
+        # afterwards, and the documents in the change stream (see
+        # `ChangeFeedMongo`). The shallow copy suffices because only the top
+        # level gets new keys.
+        aids, requests = list(ops.keys()), []
+        for aid in aids:
+            data = dict(ops[aid]['data'], aid=aid, _id=aid)
+            requests.append(pymongo.UpdateOne(
+                {'aid': aid}, {'$setOnInsert': data}, upsert=True))
+
+        # A document was inserted if and only if it was upserted.
+        ret_bulk = self._bulkWrite(requests)
+        if not ret_bulk.ok:
+            return ret_bulk
+        ret = {aid: False for aid in aids}
+        for _, _, result in ret_bulk.data:
+            for doc in result['upserted']:
+                ret[doc['_id']] = True
         return RetVal(True, None, ret)
 
     @typecheck
@@ -1089,20 +1887,24 @@ class DatastoreMongo(DatastoreBase):
             self.logit.warning('Invalid REPLACE argument')
             return RetVal(False, 'Argument error', None)
 
+        # Replace the documents if they exist, do nothing if they do not.
+        # Every replacement carries the token of this call.
+        token, aids = uuid.uuid4().hex, list(ops.keys())
+        requests = [
+            pymongo.ReplaceOne(
+                {'aid': aid},
+                dict(ops[aid]['data'], aid=aid, _batch=[token]),
+                upsert=False)
+            for aid in aids
+        ]
+
+        # The replaced documents are those that matched (see `_matchedAIDs`).
+        ret_bulk = self._bulkWrite(requests)
+        if not ret_bulk.ok:
+            return ret_bulk
         ret = {}
-        for aid, op in ops.items():
-            # Unpack the data and make a genuine copy of it (jsut to avoid bad
-            # surprised because dictionaries are mutable).
-            data = op['data']
-            data = copy.deepcopy(data)
-
-            # Insert the AID field. This field is the primary key in the
-            # Datastore.
-            data['aid'] = aid
-
-            # Replace the document if it exist, do nothing if it does not.
-            r = self.db.replace_one({'aid': aid}, data, upsert=False)
-            ret[aid] = (r.matched_count > 0)
+        for start, stop, result in ret_bulk.data:
+            ret.update(self._matchedAIDs(aids[start:stop], result, token))
         return RetVal(True, None, ret)
 
     @typecheck
@@ -1115,8 +1917,9 @@ class DatastoreMongo(DatastoreBase):
             self.logit.warning('Invalid MOD argument')
             return RetVal(False, 'Argument error', None)
 
-        # Issue the operations one-by-one.
-        ret = {}
+        # Compile the query and update operator for every document.
+        token = uuid.uuid4().hex
+        queries, updates, single = [], [], []
         for aid, op_tmp in ops.items():
             # Compile the first part of the query that specifies which (nested)
             # keys must exist.
@@ -1140,29 +1943,85 @@ class DatastoreMongo(DatastoreBase):
             if len(op) == 0:
                 continue
 
-            # Issue the database query.
-            r = self.db.update_one(query, op, upsert=False)
+            # Updates that may change the outcome of their own query must be
+            # issued one-by-one (see `_isQueryInvariant`). All others are
+            # stamped with the token of this call.
+            if self._isQueryInvariant(op_tmp):
+                op['$push'] = {'_batch': {
+                    '$each': [token], '$slice': -self.numTokens}}
+                queries.append(query)
+                updates.append(op)
+            else:
+                single.append((aid, query, op))
+
+        # Issue the bulk updates. The update was a success if Mongo could find
+        # a document that matched our query. Since AID has a unique index it
+        # is impossible to match more than one.
+        aids = [_['aid'] for _ in queries]
+        requests = [pymongo.UpdateOne(q, u, upsert=False)
+                    for q, u in zip(queries, updates)]
+        ret_bulk = self._bulkWrite(requests)
+        if not ret_bulk.ok:
+            return ret_bulk
+        ret = {}
+        for start, stop, result in ret_bulk.data:
+            ret.update(self._matchedAIDs(aids[start:stop], result, token))
 
-            # The update was a success if Mongo could find a document that
-            # matched our query. Since AID has a unique index it is impossible
-            # to match more than one.
+        # Issue the remaining updates one-by-one.
+        for aid, query, op in single:
+            r = self.db.update_one(query, op, upsert=False)
             ret[aid] = (r.matched_count == 1)
         return RetVal(True, None, ret)
 
     @typecheck
-    def remove(self, aids: (tuple, list)):
+    def remove(self, aids: (tuple, list), match=None):
         """
         See docu in ``DatastoreBase``.
         """
         # Sanity check all arguments.
-        if _checkRemove(aids) is False:
+        if _checkRemove(aids, match) is False:
             self.logit.warning('Invalid REMOVE argument')
             return RetVal(False, 'Argument error', None)
+        match = {} if match is None else match
+
+        # Delete the unconditional AIDs (in batches).
+        cnt = 0
+        aids_all = [_ for _ in aids if _ not in match]
+        for start in range(0, len(aids_all), self.batchSize):
+            tmp = aids_all[start:start + self.batchSize]
+            cnt += self.db.delete_many({'aid': {'$in': tmp}}).deleted_count
+
+        # Delete the conditional AIDs with one query each.
+        requests = []
+        for aid in aids:
+            if aid not in match:
+                continue
+            query = {'.'.join(k): v for k, v in match[aid].items()}
+            query['aid'] = aid
+            requests.append(pymongo.DeleteOne(query))
+        ret_bulk = self._bulkWrite(requests)
+        if not ret_bulk.ok:
+            return ret_bulk
+        for _, _, result in ret_bulk.data:
+            cnt += result['nRemoved']
 
-        # Delete the specified AIDs and return the number of actually deleted
-        # documents.
-        ret = self.db.delete_many({'aid': {'$in': aids}})
-        return RetVal(True, None, ret.deleted_count)
+        # Return the number of actually deleted documents.
+        return RetVal(True, None, cnt)
+
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+
+        The feed tails the change stream of the collection (see
+        ``ChangeFeedMongo``). The events therefore arrive asynchronously.
+        """
+        try:
+            feed = ChangeFeedMongo(self.db)
+        except pymongo.errors.PyMongoError as err:
+            msg = 'Change feed not supported: {}'.format(err)
+            self.logit.warning(msg)
+            return RetVal(False, msg, None)
+        return RetVal(True, None, feed)
 
     # -------------------------------------------------------------------------
     #                         Counter Functionality
@@ -1236,6 +2095,90 @@ class DatastoreMongo(DatastoreBase):
     # -------------------------------------------------------------------------
     #                           Utility methods.
     # -------------------------------------------------------------------------
+    def _bulkWrite(self, requests: list):
+        """
+        Issue the ``requests`` as unordered bulk writes of at most
+        ``batchSize`` operations each.
+
+        Return a list of (start, stop, result) tuples, one for each batch.
+        The batch comprised ``requests[start:stop]`` and ``result`` is the
+        raw Mongo result (ie. the ``bulk_api_result`` dictionary). Failed
+        operations are listed in its 'writeErrors' field.
+
+        Return an error if Mongo could not satisfy the write concern for any
+        batch, because then it is unknown which writes will persist.
+
+        :param list requests: pymongo write operations.
+        :return: list of (int, int, dict) tuples.
+        :rtype: RetVal
+        """
+        out = []
+        for start in range(0, len(requests), self.batchSize):
+            stop = min(start + self.batchSize, len(requests))
+            try:
+                ret = self.db.bulk_write(requests[start:stop], ordered=False)
+                ret = ret.bulk_api_result
+            except pymongo.errors.BulkWriteError as err:
+                ret = err.details
+            if len(ret.get('writeConcernErrors', [])) > 0:
+                msg = 'Write concern error: {}'
+                msg = msg.format(ret['writeConcernErrors'])
+                self.logit.error(msg)
+                return RetVal(False, msg, None)
+            out.append((start, stop, ret))
+        return RetVal(True, None, out)
+
+    def _matchedAIDs(self, aids: list, result: dict, token: str):
+        """
+        Return {aid: bool} to specify which updates matched a document.
+
+        The ``aids`` must belong to the updates of one bulk write, which
+        returned ``result``. Mongo only reports the total number of matches.
+        If it is zero, or equals the number of updates, then it already
+        determines the outcome of every update. Otherwise, or if some updates
+        failed, the updated documents are those that carry the ``token`` all
+        these updates wrote.
+
+        :param list aids: the AIDs of all updates in a bulk write.
+        :param dict result: the ``bulk_api_result`` of that bulk write.
+        :param str token: the token written by these updates.
+        :return: dict
+        """
+        failed = {_['index'] for _ in result['writeErrors']}
+        if len(failed) == 0 and result['nMatched'] in (0, len(aids)):
+            return {aid: result['nMatched'] > 0 for aid in aids}
+
+        # Only the successful updates stamped their document with the token.
+        query = {'aid': {'$in': aids}, '_batch': token}
+        cursor = self.db.find(query, {'aid': True, '_id': False})
+        matched = {_['aid'] for _ in cursor}
+        return {aid: aid in matched for aid in aids}
+
+    @staticmethod
+    def _isQueryInvariant(op: dict):
+        """
+        Return True if the ``modify`` operation ``op`` cannot change whether
+        its own 'exists' conditions hold.
+
+        This is the case unless ``op`` unsets a key (or a parent/child of it)
+        that must exist, or sets/increments a key (or a parent/child of it)
+        that must not exist.
+
+        :param dict op: modify operation (see ``DatastoreBase.modify``).
+        :return: bool
+        """
+        def related(a, b):
+            n = min(len(a), len(b))
+            return tuple(a[:n]) == tuple(b[:n])
+
+        written = list(op['inc'].keys()) + list(op['set'].keys())
+        for key, yes in op['exists'].items():
+            if yes and any(related(key, _) for _ in op['unset']):
+                return False
+            if not yes and any(related(key, _) for _ in written):
+                return False
+        return True
+
     def _removeAID(self, docs: list):
         """
         Compile the list of docs into a dictionary with the 'aid' field as
@@ -1252,8 +2195,9 @@ class DatastoreMongo(DatastoreBase):
         operator.
         """
         if prj is None:
-            # No projection specified.
-            prj = {}
+            # No projection specified. Only hide the private tokens (see
+            # `_matchedAIDs`).
+            prj = {'_batch': False}
         else:
             # Join the key hierarchies with dots. Also, we _always_ need the
             # aid because this is the primary key as far as Azrael is
@@ -1264,3 +2208,1012 @@ class DatastoreMongo(DatastoreBase):
         # Never return the _id field.
         prj['_id'] = False
         return prj
+
+
+class DatastoreCached(DatastoreBase):
+    """
+    Read-through cache for another datastore.
+
+    The cache stores the documents returned by `getOne` and `getMulti` under
+    their AID *and* projection, and evicts the least recently used entries
+    once it holds more than ``maxEntries`` of them. All other queries go
+    straight to the ``backend``.
+
+    Every write through this instance invalidates exactly those entries whose
+    projection overlaps the modified keys (eg. setting ('template', 'rbs')
+    does not invalidate an entry with projection [('template', 'boosters')]).
+    If ``watch`` is True then the cache also subscribes to the change feed of
+    the backend to learn about the writes of other processes, and applies
+    them before every query. Otherwise, writes from elsewhere must be relayed
+    to `invalidate`. If the backend does not support change feeds then the
+    cache disables itself. Queries that overlap the ``volatile`` key
+    hierarchies always bypass the cache; use them for keys that change too
+    often to be worth caching.
+
+    A version counter increments with every invalidation. Documents are only
+    cached if the version did not change while the backend fetched them, which
+    prevents a concurrent write from leaving a stale entry behind.
+
+    :param DatastoreBase backend: the datastore to cache.
+    :param int maxEntries: maximum number of (AID, projection) entries.
+    :param list volatile: key hierarchies that must never be cached.
+    :param bool watch: subscribe to the change feed of ``backend``.
+    """
+    @typecheck
+    def __init__(self, backend: DatastoreBase, maxEntries: int=None,
+                 volatile: (tuple, list)=(), watch: bool=False):
+        super().__init__(backend.dbname)
+        self.indexes = backend.indexes
+        if maxEntries is None:
+            maxEntries = config.datastore_cache_size
+        assert maxEntries >= 0
+        assert _checkGetAll(volatile)
+
+        self.backend = backend
+        self.maxEntries = maxEntries
+        self.volatile = [tuple(_) for _ in volatile]
+
+        # The LRU cache: {(aid, prj): doc} and the projections cached for
+        # every AID: {aid: {prj_1, prj_2, ...}}.
+        self.cache = collections.OrderedDict()
+        self.prjs = {}
+        self.version = 0
+        self.resetStats()
+
+        # Subscribe to the changes of the backend.
+        self.watch = watch
+        self.feed = self.feedPID = None
+        if watch:
+            self._subscribe()
+
+    def _subscribe(self):
+        """
+        Subscribe to the change feed of the backend.
+
+        Do not cache anything if that is impossible because the cache could
+        become stale.
+        """
+        ret = self.backend.subscribe()
+        if ret.ok:
+            self.feed, self.feedPID = ret.data, os.getpid()
+        else:
+            self.logit.warning('Cache disabled: {}'.format(ret.msg))
+            self.feed, self.maxEntries = None, 0
+
+    def close(self):
+        """
+        Close the change feed (if there is one).
+        """
+        if self.feed is not None:
+            self.feed.close()
+            self.feed = None
+
+    def resetStats(self):
+        """
+        Reset the hit/miss statistics (see `getStats`).
+        """
+        self.stats = dict.fromkeys(
+            ('hits', 'misses', 'bypassed', 'invalidated', 'evicted'), 0)
+
+    def getStats(self):
+        """
+        Return the cache statistics.
+
+        The statistics count the cache hits and misses of the AIDs requested
+        via `getOne` and `getMulti`, the requests that bypassed the cache
+        (volatile projections), and the number of invalidated and evicted
+        entries. The 'hitrate' is the fraction of cache hits among all hits
+        and misses.
+
+        :return: dict
+        """
+        stats = dict(self.stats)
+        total = stats['hits'] + stats['misses']
+        stats['hitrate'] = stats['hits'] / total if total > 0 else 0.0
+        stats['entries'] = len(self.cache)
+        stats['version'] = self.version
+        return stats
+
+    def invalidate(self, aids: (tuple, list), keys: (tuple, list)=None):
+        """
+        Invalidate the cached entries for ``aids``.
+
+        Only invalidate the entries whose projection overlaps at least one of
+        the key hierarchies in ``keys``. If ``keys`` is None then invalidate
+        all entries for ``aids``.
+
+        :param list aids: AIDs of the modified documents.
+        :param list keys: modified key hierarchies (or None).
+        """
+        self.version += 1
+        if keys is not None:
+            keys = [tuple(_) for _ in keys]
+
+        for aid in aids:
+            prjs = self.prjs.get(aid, None)
+            if prjs is None:
+                continue
+
+            # Find all projections for this AID that overlap any of the
+            # modified keys (the full document overlaps all of them).
+            if keys is None:
+                stale = list(prjs)
+            else:
+                stale = [prj for prj in prjs if self._overlaps(prj, keys)]
+
+            for prj in stale:
+                del self.cache[(aid, prj)]
+                prjs.discard(prj)
+            if len(prjs) == 0:
+                del self.prjs[aid]
+            self.stats['invalidated'] += len(stale)
+
+    def _applyChanges(self):
+        """
+        Invalidate all entries affected by the pending events of the feed.
+        """
+        if self.feed is None:
+            return
+
+        # The change feed does not survive a fork. Start from scratch with a
+        # new one.
+        if self.feedPID != os.getpid():
+            self.version += 1
+            self.cache.clear()
+            self.prjs.clear()
+            self._subscribe()
+            return
+
+        for event in self.feed.poll():
+            if event.op == 'reset':
+                self.version += 1
+                self.cache.clear()
+                self.prjs.clear()
+            else:
+                self.invalidate([event.aid], event.keys)
+
+    def _overlaps(self, prj: tuple, keys: list):
+        """
+        Return True if the projection ``prj`` overlaps any of the ``keys``.
+
+        Two key hierarchies overlap if one is a prefix of the other. The full
+        document (``prj`` is None) overlaps everything.
+        """
+        if prj is None:
+            return True
+        for p in prj:
+            for key in keys:
+                n = min(len(p), len(key))
+                if p[:n] == key[:n]:
+                    return True
+        return False
+
+    def _compileCacheKey(self, prj):
+        """
+        Return the normalised (hashable) version of the projection ``prj``.
+        """
+        return None if prj is None else tuple(sorted({tuple(_) for _ in prj}))
+
+    def _insert(self, aid: str, prj: tuple, doc: dict):
+        """
+        Add ``doc`` to the cache and evict the oldest entries if necessary.
+        """
+        key = (aid, prj)
+        self.cache[key] = copy.deepcopy(doc)
+        self.cache.move_to_end(key)
+        self.prjs.setdefault(aid, set()).add(prj)
+
+        while len(self.cache) > self.maxEntries:
+            (old_aid, old_prj), _ = self.cache.popitem(last=False)
+            self.prjs[old_aid].discard(old_prj)
+            if len(self.prjs[old_aid]) == 0:
+                del self.prjs[old_aid]
+            self.stats['evicted'] += 1
+
+    # -------------------------------------------------------------------------
+    #                             API methods.
+    # -------------------------------------------------------------------------
+    def reset(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        self.version += 1
+        self.cache.clear()
+        self.prjs.clear()
+        return self.backend.reset()
+
+    def count(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.count()
+
+    def allKeys(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.allKeys()
+
+    @typecheck
+    def getOne(self, aid: str, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.getMulti([aid], prj)
+        if not ret.ok:
+            return ret
+
+        # Mimic the behaviour of the backends for missing documents.
+        doc = ret.data[aid]
+        if doc is None:
+            return RetVal(False, None, None)
+        return RetVal(True, None, doc)
+
+    @typecheck
+    def getMulti(self, aids: (list, tuple), prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Let the backend deal with invalid arguments.
+        if _checkGet(aids, prj) is False:
+            return self.backend.getMulti(aids, prj)
+        self._applyChanges()
+
+        # Query the backend directly if the projection overlaps a volatile
+        # key.
+        key = self._compileCacheKey(prj)
+        if self.maxEntries == 0 or (
+                len(self.volatile) > 0 and self._overlaps(key, self.volatile)):
+            self.stats['bypassed'] += 1
+            return self.backend.getMulti(aids, prj)
+
+        # Serve all documents we have from the cache.
+        out, missing = {}, []
+        for aid in aids:
+            try:
+                out[aid] = copy.deepcopy(self.cache[(aid, key)])
+                self.cache.move_to_end((aid, key))
+                self.stats['hits'] += 1
+            except KeyError:
+                missing.append(aid)
+        if len(missing) == 0:
+            return RetVal(True, None, out)
+
+        # Fetch the remaining documents from the backend. Only cache them if
+        # no write has happened in the meantime.
+        version = self.version
+        missing = list(set(missing))
+        ret = self.backend.getMulti(missing, prj)
+        if not ret.ok:
+            return ret
+        self.stats['misses'] += len(missing)
+        for aid, doc in ret.data.items():
+            if doc is not None and self.version == version:
+                self._insert(aid, key, doc)
+            out[aid] = doc
+        return RetVal(True, None, out)
+
+    @typecheck
+    def getAll(self, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.getAll(prj)
+
+    @typecheck
+    def query(self, filter: dict, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.query(filter, prj)
+
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.createIndex(key_hierarchy)
+
+    @typecheck
+    def put(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.backend.put(ops)
+        if _checkPut(ops):
+            self.invalidate(list(ops.keys()))
+        return ret
+
+    @typecheck
+    def replace(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.backend.replace(ops)
+        if _checkPut(ops):
+            self.invalidate(list(ops.keys()))
+        return ret
+
+    @typecheck
+    def modify(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.backend.modify(ops)
+        if not _checkMod(ops):
+            return ret
+
+        # Invalidate only the entries that overlap the modified keys.
+        self.version += 1
+        for aid, op in ops.items():
+            if aid not in self.prjs:
+                continue
+            keys = list(op['inc']) + list(op['set']) + list(op['unset'])
+            self.invalidate([aid], keys)
+        return ret
+
+    @typecheck
+    def remove(self, aids: (tuple, list), match=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self.backend.remove(aids, match)
+        if _checkRemove(aids, match):
+            self.invalidate(aids)
+        return ret
+
+    @typecheck
+    def setCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.setCounter(counter_name, value)
+
+    @typecheck
+    def getCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.getCounter(counter_name)
+
+    @typecheck
+    def incrementCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.incrementCounter(counter_name, value)
+
+    @typecheck
+    def removeCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.removeCounter(counter_name)
+
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.subscribe()
+
+
+class DatastorePacked(DatastoreBase):
+    """
+    Store the hot numeric fields of a sub-document in a single binary blob.
+
+    The ``layout`` is a list of (name, length) tuples. It specifies the fields
+    of the sub-document at ``key_hierarchy`` that this wrapper packs into one
+    contiguous array of little endian float64 values. The array is stored
+    under the 'packed' key of the sub-document, next to its other fields. For
+    instance, with key_hierarchy=('rbs', ) and layout=[('position', 3)] the
+    document {'rbs': {'position': [1, 2, 3], 'imass': 2}} is stored as
+    {'rbs': {'packed': b'...', 'imass': 2}}. This reduces the document size,
+    and the cost to encode and decode it.
+
+    The wrapper packs and unpacks the fields transparently: callers always see
+    the original document structure (with floats), and projections may
+    reference the packed fields as usual.
+
+    A sub-document is only packed if it contains all fields of the layout,
+    and if they are numeric vectors of the correct length. Otherwise it is
+    stored as is. Setting an individual packed field stores it next to the
+    blob, where it supersedes the value in the blob until the entire
+    sub-document is written again. Packed fields cannot be incremented,
+    unset, queried, or indexed, and 'exists' conditions for them refer to
+    the blob.
+
+    :param DatastoreBase backend: the datastore that holds the documents.
+    :param tuple key_hierarchy: location of the sub-document to pack.
+    :param list layout: list of (name, length) tuples.
+    """
+    @typecheck
+    def __init__(self, backend: DatastoreBase, key_hierarchy: (tuple, list),
+                 layout: (tuple, list)):
+        super().__init__(backend.dbname)
+        assert _validJsonKey(key_hierarchy)
+        assert len(layout) > 0
+        for name, length in layout:
+            assert _validJsonKey([name]) and name != 'packed'
+            assert isinstance(length, int) and length > 0
+
+        self.backend = backend
+        self.indexes = backend.indexes
+        self.key = tuple(key_hierarchy)
+        self.layout = [tuple(_) for _ in layout]
+        self.fields = {name for name, _ in self.layout}
+
+        # Binary format of the packed fields.
+        self.struct = struct.Struct(
+            '<{}d'.format(sum(length for _, length in self.layout)))
+
+    def _isPackedField(self, key_hierarchy: (tuple, list)):
+        """
+        Return True if ``key_hierarchy`` points to (or into) a packed field.
+        """
+        n = len(self.key)
+        return ((len(key_hierarchy) > n) and
+                (tuple(key_hierarchy[:n]) == self.key) and
+                (key_hierarchy[n] in self.fields))
+
+    def _pack(self, prefix: tuple, value):
+        """
+        Return ``value``, which is stored at ``prefix``, with its packed
+        sub-document.
+
+        Return ``value`` itself if it does not contain the sub-document, or if
+        the sub-document cannot be packed. Otherwise, only copy the
+        dictionaries along the way to the sub-document.
+        """
+        if not isinstance(value, dict) or self.key[:len(prefix)] != prefix:
+            return value
+
+        # Descend to the sub-document.
+        if len(prefix) < len(self.key):
+            key = self.key[len(prefix)]
+            if key not in value:
+                return value
+            new = self._pack(prefix + (key, ), value[key])
+            return value if new is value else dict(value, **{key: new})
+
+        # Pack the fields, unless they are incomplete or not numeric.
+        try:
+            values = []
+            for name, length in self.layout:
+                assert len(value[name]) == length
+                values.extend(value[name])
+            blob = self.struct.pack(*values)
+        except (AssertionError, KeyError, TypeError, struct.error):
+            return value
+        out = {k: v for k, v in value.items() if k not in self.fields}
+        out['packed'] = blob
+        return out
+
+    def _unpack(self, doc: dict, wanted: set):
+        """
+        Return ``doc`` with the ``wanted`` fields restored from the blob.
+
+        The returned document shares all other values with ``doc``.
+        """
+        if doc is None or len(wanted) == 0:
+            return doc
+
+        # Find the sub-document and return immediately if it has no blob.
+        path, sub = [], doc
+        for key in self.key:
+            if not isinstance(sub, dict) or key not in sub:
+                return doc
+            path.append(sub)
+            sub = sub[key]
+        if not isinstance(sub, dict) or 'packed' not in sub:
+            return doc
+
+        # Unpack the wanted fields. Fields stored next to the blob take
+        # precedence.
+        values, start, new = self.struct.unpack(sub['packed']), 0, {}
+        for name, length in self.layout:
+            if name in wanted:
+                new[name] = list(values[start:start + length])
+            start += length
+        new.update({k: v for k, v in sub.items() if k != 'packed'})
+
+        # Copy the dictionaries along the way to the sub-document.
+        for parent, key in zip(path[::-1], self.key[::-1]):
+            new = dict(parent, **{key: new})
+        return new
+
+    def _compileProjection(self, prj):
+        """
+        Return the projection for the backend and the packed fields it must
+        unpack.
+
+        The projection for the backend fetches the blob in lieu of the packed
+        fields. An invalid ``prj`` is returned as is (the backend will reject
+        it).
+
+        :param list prj: projection as specified by the caller.
+        :return: (projection, set of field names).
+        """
+        if prj is None:
+            return None, self.fields
+        if not _checkGetAll(prj):
+            return prj, set()
+
+        keys, wanted = set(), set()
+        for key in prj:
+            key = tuple(key)
+            if self._isPackedField(key):
+                name = key[len(self.key)]
+                wanted.add(name)
+                keys.add(self.key + (name, ))
+                keys.add(self.key + ('packed', ))
+            else:
+                keys.add(key)
+                if self.key[:len(key)] == key:
+                    wanted = set(self.fields)
+
+        # Remove all keys that are covered by another one to not confuse Mongo
+        # with colliding paths.
+        keys = [k for k in keys if not any(
+            len(o) < len(k) and k[:len(o)] == o for o in keys)]
+        return sorted(keys), wanted
+
+    # -------------------------------------------------------------------------
+    #                             API methods.
+    # -------------------------------------------------------------------------
+    def reset(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.reset()
+
+    def count(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.count()
+
+    def allKeys(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.allKeys()
+
+    @typecheck
+    def getOne(self, aid: str, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        prj, wanted = self._compileProjection(prj)
+        ret = self.backend.getOne(aid, prj)
+        if not ret.ok:
+            return ret
+        return ret._replace(data=self._unpack(ret.data, wanted))
+
+    @typecheck
+    def getMulti(self, aids: (list, tuple), prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        prj, wanted = self._compileProjection(prj)
+        ret = self.backend.getMulti(aids, prj)
+        if not ret.ok:
+            return ret
+        docs = {k: self._unpack(v, wanted) for k, v in ret.data.items()}
+        return RetVal(True, None, docs)
+
+    @typecheck
+    def getAll(self, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        prj, wanted = self._compileProjection(prj)
+        ret = self.backend.getAll(prj)
+        if not ret.ok:
+            return ret
+        docs = {k: self._unpack(v, wanted) for k, v in ret.data.items()}
+        return RetVal(True, None, docs)
+
+    @typecheck
+    def query(self, filter: dict, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if _checkQuery(filter, prj):
+            if any(self._isPackedField(_) for _ in filter):
+                return RetVal(False, 'Cannot query packed fields', None)
+        prj, wanted = self._compileProjection(prj)
+        ret = self.backend.query(filter, prj)
+        if not ret.ok:
+            return ret
+        docs = {k: self._unpack(v, wanted) for k, v in ret.data.items()}
+        return RetVal(True, None, docs)
+
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if self._isPackedField(key_hierarchy):
+            return RetVal(False, 'Cannot index packed fields', None)
+        return self.backend.createIndex(key_hierarchy)
+
+    @typecheck
+    def put(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if _checkPut(ops):
+            ops = {aid: dict(op, data=self._pack((), op['data']))
+                   for aid, op in ops.items()}
+        return self.backend.put(ops)
+
+    @typecheck
+    def replace(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if _checkPut(ops):
+            ops = {aid: dict(op, data=self._pack((), op['data']))
+                   for aid, op in ops.items()}
+        return self.backend.replace(ops)
+
+    @typecheck
+    def modify(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        if not _checkMod(ops):
+            return self.backend.modify(ops)
+
+        # Pack the sub-documents in the 'set' values, and redirect the
+        # 'exists' conditions for packed fields to the blob.
+        blob = self.key + ('packed', )
+        out = {}
+        for aid, op in ops.items():
+            keys = list(op['inc']) + list(op['unset'])
+            if any(self._isPackedField(_) for _ in keys):
+                msg = 'Cannot increment or unset packed fields'
+                return RetVal(False, msg, None)
+
+            out[aid] = {
+                'inc': op['inc'],
+                'set': {k: self._pack(tuple(k), v)
+                        for k, v in op['set'].items()},
+                'unset': op['unset'],
+                'exists': {blob if self._isPackedField(k) else k: v
+                           for k, v in op['exists'].items()},
+            }
+        return self.backend.modify(out)
+
+    @typecheck
+    def remove(self, aids: (tuple, list), match=None):
+        """
+        See docu in ``DatastoreBase``.
+
+        The ``match`` conditions cannot reference the packed fields.
+        """
+        return self.backend.remove(aids, match)
+
+    @typecheck
+    def setCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.setCounter(counter_name, value)
+
+    @typecheck
+    def getCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.getCounter(counter_name)
+
+    @typecheck
+    def incrementCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.incrementCounter(counter_name, value)
+
+    @typecheck
+    def removeCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.removeCounter(counter_name)
+
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backend.subscribe()
+
+
+class DatastorePartitioned(DatastoreBase):
+    """
+    Distribute the documents over several datastores (partitions).
+
+    Every document lives in the partition ``crc32(aid) % len(backends)``.
+    The partitions may be arbitrary datastores, for instance Mongo
+    collections in different databases or on different hosts. Queries and
+    write operations that involve several partitions run in parallel in a
+    pool of ``numThreads`` threads (defaults to one per partition), and the
+    wrapper merges their results.
+
+    All counters live in the first partition.
+
+    :param list backends: the datastores of all partitions.
+    :param int numThreads: number of threads in the pool.
+    """
+    @typecheck
+    def __init__(self, backends: (tuple, list), numThreads: int=None):
+        assert len(backends) > 0
+        super().__init__(backends[0].dbname)
+        if numThreads is None:
+            numThreads = len(backends)
+        assert numThreads > 0
+
+        self.backends = list(backends)
+        self.indexes = self.backends[0].indexes
+        self.numThreads = numThreads
+        self.lock = threading.Lock()
+        self.pool = self.poolPID = None
+
+    def _getPool(self):
+        """
+        Return the thread pool.
+
+        Create a new pool in a forked process because the threads of the
+        parent do not exist there.
+        """
+        with self.lock:
+            if self.poolPID != os.getpid():
+                self.pool = concurrent.futures.ThreadPoolExecutor(
+                    self.numThreads)
+                self.poolPID = os.getpid()
+            return self.pool
+
+    def _partition(self, aid: str):
+        """
+        Return the index of the partition for ``aid``.
+        """
+        return zlib.crc32(aid.encode('utf8')) % len(self.backends)
+
+    def _split(self, aids):
+        """
+        Return {partition: [aid, ...]} for all ``aids``.
+        """
+        out = {}
+        for aid in aids:
+            out.setdefault(self._partition(aid), []).append(aid)
+        return out
+
+    def _run(self, calls: (tuple, list)):
+        """
+        Run all (partition, method, args) ``calls`` in parallel and return
+        their results in the same order.
+
+        :param list calls: list of (int, str, tuple) tuples.
+        :return: list of ``RetVal`` tuples.
+        """
+        if len(calls) == 1:
+            idx, method, args = calls[0]
+            return [getattr(self.backends[idx], method)(*args)]
+
+        pool = self._getPool()
+        futures = [pool.submit(getattr(self.backends[idx], method), *args)
+                   for idx, method, args in calls]
+        return [_.result() for _ in futures]
+
+    def _runAll(self, method: str, *args):
+        """
+        Run ``method`` on all partitions and return their results.
+        """
+        return self._run([(idx, method, args)
+                          for idx in range(len(self.backends))])
+
+    def _merge(self, results: (tuple, list)):
+        """
+        Merge the dictionaries in the ``results`` of several partitions.
+
+        Return the first failed result, if any.
+        """
+        out = {}
+        for ret in results:
+            if not ret.ok:
+                return ret
+            out.update(ret.data)
+        return RetVal(True, None, out)
+
+    # -------------------------------------------------------------------------
+    #                             API methods.
+    # -------------------------------------------------------------------------
+    def reset(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        for ret in self._runAll('reset'):
+            if not ret.ok:
+                return ret
+        return RetVal(True, None, None)
+
+    def count(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        num = 0
+        for ret in self._runAll('count'):
+            if not ret.ok:
+                return ret
+            num += ret.data
+        return RetVal(True, None, num)
+
+    def allKeys(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        keys = []
+        for ret in self._runAll('allKeys'):
+            if not ret.ok:
+                return ret
+            keys.extend(ret.data)
+        return RetVal(True, None, keys)
+
+    @typecheck
+    def getOne(self, aid: str, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backends[self._partition(aid)].getOne(aid, prj)
+
+    @typecheck
+    def getMulti(self, aids: (list, tuple), prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkGet(aids, prj) is False:
+            self.logit.warning('Invalid GETMULTI argument')
+            return RetVal(False, 'Argument error', None)
+
+        parts = self._split(aids)
+        ret = self._merge(self._run(
+            [(idx, 'getMulti', (part, prj)) for idx, part in parts.items()]))
+        if not ret.ok:
+            return ret
+        return RetVal(True, None, {aid: ret.data[aid] for aid in aids})
+
+    @typecheck
+    def getAll(self, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._merge(self._runAll('getAll', prj))
+
+    @typecheck
+    def query(self, filter: dict, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._merge(self._runAll('query', filter, prj))
+
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        for ret in self._runAll('createIndex', key_hierarchy):
+            if not ret.ok:
+                return ret
+        return RetVal(True, None, None)
+
+    def _writeOps(self, method: str, ops: dict):
+        """
+        Split the write ``ops`` by partition, run ``method`` on all affected
+        partitions and merge the results.
+        """
+        parts = self._split(ops)
+        calls = [(idx, method, ({aid: ops[aid] for aid in part}, ))
+                 for idx, part in parts.items()]
+        return self._merge(self._run(calls))
+
+    @typecheck
+    def put(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkPut(ops) is False:
+            self.logit.warning('Invalid PUT argument')
+            return RetVal(False, 'Argument error', None)
+        return self._writeOps('put', ops)
+
+    @typecheck
+    def replace(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkPut(ops) is False:
+            self.logit.warning('Invalid REPLACE argument')
+            return RetVal(False, 'Argument error', None)
+        return self._writeOps('replace', ops)
+
+    @typecheck
+    def modify(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkMod(ops) is False:
+            self.logit.warning('Invalid MODIFY argument')
+            return RetVal(False, 'Argument error', None)
+        return self._writeOps('modify', ops)
+
+    @typecheck
+    def remove(self, aids: (tuple, list), match=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        # Sanity check all arguments.
+        if _checkRemove(aids, match) is False:
+            return RetVal(False, 'Argument error', None)
+        match = {} if match is None else match
+
+        # Pass each partition only the match conditions for its own AIDs.
+        parts = self._split(aids)
+        calls = []
+        for idx, part in parts.items():
+            cond = {_: match[_] for _ in part if _ in match}
+            calls.append((idx, 'remove', (part, cond)))
+
+        num = 0
+        for ret in self._run(calls):
+            if not ret.ok:
+                return ret
+            num += ret.data
+        return RetVal(True, None, num)
+
+    @typecheck
+    def setCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backends[0].setCounter(counter_name, value)
+
+    @typecheck
+    def getCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backends[0].getCounter(counter_name)
+
+    @typecheck
+    def incrementCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backends[0].incrementCounter(counter_name, value)
+
+    @typecheck
+    def removeCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self.backends[0].removeCounter(counter_name)
+
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+
+        The returned ``ChangeFeedMerged`` relays the events of all partitions.
+        """
+        feeds = []
+        for backend in self.backends:
+            ret = backend.subscribe()
+            if not ret.ok:
+                for feed in feeds:
+                    feed.close()
+                return ret
+            feeds.append(ret.data)
+        return RetVal(True, None, ChangeFeedMerged(feeds))
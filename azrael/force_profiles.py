@@ -0,0 +1,204 @@
+# Copyright 2015, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+"""
+Analytic force- and torque profiles.
+
+Leonard evaluates the profiles of all objects once per physics step. To make
+this cheap the profiles are compiled into NumPy arrays (one set of arrays per
+profile type) whenever they change, and all profiles of the same type are then
+evaluated with a handful of array operations.
+
+See ``aztypes.ForceProfile`` for the supported profile types.
+"""
+import logging
+import numpy as np
+
+from IPython import embed as ipshell
+from azrael.aztypes import typecheck, RetVal, ForceProfile
+
+# Create module logger.
+logit = logging.getLogger('azrael.' + __name__)
+
+
+class ForceProfiles:
+    """
+    Store the force profiles of all objects and evaluate them.
+
+    Every object can have an arbitrary number of profiles. Their time
+    argument is relative to the simulation time at which they were installed.
+    """
+    def __init__(self):
+        # {objID: (t_start, [ForceProfile, ...])}
+        self.profiles = {}
+
+        # Compiled profile arrays (None if they need re-compiling).
+        self.compiled = None
+
+    @typecheck
+    def setProfiles(self, objID: str, t_start: (int, float),
+                    profiles: (tuple, list)):
+        """
+        Replace the profiles of ``objID`` with ``profiles``.
+
+        An empty list removes all profiles of ``objID``.
+
+        :param str objID: object ID.
+        :param float t_start: simulation time when the profiles start.
+        :param list profiles: ``ForceProfile`` instances (or their dicts).
+        :return: Success
+        """
+        try:
+            profiles = [ForceProfile(**_) if isinstance(_, dict)
+                        else ForceProfile(*_) for _ in profiles]
+        except TypeError:
+            return RetVal(False, 'Invalid force profile', None)
+
+        if len(profiles) == 0:
+            self.profiles.pop(objID, None)
+        else:
+            self.profiles[objID] = (t_start, profiles)
+        self.compiled = None
+        return RetVal(True, None, None)
+
+    @typecheck
+    def removeProfiles(self, objID: str):
+        """
+        Remove all profiles of ``objID``.
+
+        :param str objID: object ID.
+        :return: Success
+        """
+        if self.profiles.pop(objID, None) is not None:
+            self.compiled = None
+        return RetVal(True, None, None)
+
+    def compile(self):
+        """
+        Compile the profile parameters into NumPy arrays.
+
+        All profiles of the same type end up in the same arrays. The 'idx' and
+        'torque' arrays map every profile to its object (an index into
+        'objIDs') and specify whether it applies to the force or the torque.
+        """
+        objIDs = list(self.profiles.keys())
+
+        # Sort the profiles by type.
+        rows = {'sine': [], 'ramp': [], 'piecewise': [], 'spring': []}
+        for idx, objID in enumerate(objIDs):
+            t_start, profiles = self.profiles[objID]
+            for prof in profiles:
+                rows[prof.ptype].append((idx, t_start, prof))
+
+        def common(rows):
+            # Object index, start time, and target flag of every profile.
+            return {
+                'idx': np.array([_[0] for _ in rows], np.int64),
+                't_start': np.array([_[1] for _ in rows], np.float64),
+                'torque': np.array([_[2].target == 'torque' for _ in rows]),
+            }
+
+        def column(rows, key):
+            return np.array([_[2].params[key] for _ in rows], np.float64)
+
+        out = {'objIDs': objIDs}
+        if len(rows['sine']) > 0:
+            tmp = rows['sine']
+            out['sine'] = common(tmp)
+            for key in ('amplitude', 'frequency', 'phase', 'offset'):
+                out['sine'][key] = column(tmp, key)
+        if len(rows['ramp']) > 0:
+            tmp = rows['ramp']
+            out['ramp'] = common(tmp)
+            for key in ('start', 'stop', 't0', 't1'):
+                out['ramp'][key] = column(tmp, key)
+        if len(rows['spring']) > 0:
+            tmp = rows['spring']
+            out['spring'] = common(tmp)
+            for key in ('position', 'stiffness', 'damping'):
+                out['spring'][key] = column(tmp, key)
+        if len(rows['piecewise']) > 0:
+            # The tables have different lengths and cannot be stacked.
+            tmp = rows['piecewise']
+            out['piecewise'] = common(tmp)
+            out['piecewise']['tables'] = [
+                (np.array(_[2].params['times'], np.float64),
+                 np.array(_[2].params['values'], np.float64))
+                for _ in tmp]
+        self.compiled = out
+
+    @typecheck
+    def evaluate(self, t: (int, float), bodies: dict):
+        """
+        Return the force and torque of all profiles at simulation time ``t``.
+
+        The ``bodies`` dictionary must contain the ``RigidBodyData`` of all
+        objects with a profile (only spring profiles need it). The return
+        value is a dictionary {objID: (force, torque)} where force and torque
+        are NumPy arrays. Objects without profiles are not in the output.
+
+        :param float t: simulation time.
+        :param dict bodies: {objID: RigidBodyData}
+        :return: dictionary with force and torque of every object.
+        """
+        if len(self.profiles) == 0:
+            return {}
+        if self.compiled is None:
+            self.compile()
+        cp = self.compiled
+        objIDs = cp['objIDs']
+
+        # Accumulate the contributions of all profiles in these arrays.
+        num = len(objIDs)
+        force = np.zeros((num, 3), np.float64)
+        torque = np.zeros((num, 3), np.float64)
+
+        def add(p, val):
+            # Add the profile values to the force- or torque of their object.
+            np.add.at(force, p['idx'][~p['torque']], val[~p['torque']])
+            np.add.at(torque, p['idx'][p['torque']], val[p['torque']])
+
+        if 'sine' in cp:
+            p = cp['sine']
+            arg = 2 * np.pi * p['frequency'] * (t - p['t_start']) + p['phase']
+            add(p, p['offset'] + p['amplitude'] * np.sin(arg)[:, None])
+
+        if 'ramp' in cp:
+            p = cp['ramp']
+            s = (t - p['t_start'] - p['t0']) / (p['t1'] - p['t0'])
+            s = np.clip(s, 0, 1)[:, None]
+            add(p, (1 - s) * p['start'] + s * p['stop'])
+
+        if 'spring' in cp:
+            p = cp['spring']
+            body = [bodies[objIDs[_]] for _ in p['idx']]
+            pos = np.array([_.position for _ in body], np.float64)
+            vel = np.array([_.velocityLin for _ in body], np.float64)
+            val = p['stiffness'][:, None] * (p['position'] - pos)
+            val -= p['damping'][:, None] * vel
+            add(p, val)
+
+        if 'piecewise' in cp:
+            p = cp['piecewise']
+            val = np.zeros((len(p['tables']), 3), np.float64)
+            for row, (times, values) in enumerate(p['tables']):
+                dt = t - p['t_start'][row]
+                for dim in range(3):
+                    val[row, dim] = np.interp(dt, times, values[:, dim])
+            add(p, val)
+
+        return {objID: (force[idx], torque[idx])
+                for idx, objID in enumerate(objIDs)}
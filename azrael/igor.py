@@ -17,6 +17,7 @@
 """
 Igor is a stateless class to manage rigid body constraints.
 """
+import os
 import logging
 import azrael.datastore as datastore
 
@@ -36,6 +37,13 @@ class Igor:
         self.db = datastore.getDSHandle('Constraints')
         self._cache = {}
 
+        # The change feed of the constraint database (see `updateLocalCache`),
+        # the datastore keys of all cached constraints, and the keys this
+        # instance modified itself.
+        self._feed = self._feedPID = None
+        self._keys = {}
+        self._dirty = set()
+
     def reset(self):
         """
         Flush the constraint database.
@@ -44,45 +52,97 @@ class Igor:
         """
         self.db.reset()
         self._cache = {}
+        self._keys = {}
+        self._closeFeed()
         return RetVal(True, None, None)
 
+    def _closeFeed(self):
+        """
+        Close the change feed. The next cache update will download all
+        constraints again.
+        """
+        if self._feed is not None and self._feedPID == os.getpid():
+            self._feed.close()
+        self._feed = self._feedPID = None
+
     def updateLocalCache(self):
         """
-        Download *all* constraints from the database into the local cache.
+        Update the local cache with the constraints in the database.
+
+        The first call downloads *all* constraints and subscribes to the
+        change feed of the database. Subsequent calls only fetch the
+        constraints that have changed since. If the database does not support
+        change feeds then every call downloads all constraints.
 
         :return: Number of unique constraints in local cache after operation.
         """
-        # Flush the cache and create a convenience handle.
+        # The change feed does not survive a fork.
+        if self._feedPID != os.getpid():
+            self._feed = self._feedPID = None
+
+        # Fetch only the changed constraints if we have a change feed.
+        if self._feed is not None:
+            events = self._feed.poll()
+            if 'reset' not in {_.op for _ in events}:
+                keys = list({_.aid for _ in events} | self._dirty)
+                self._dirty.clear()
+                if len(keys) == 0:
+                    return RetVal(True, None, len(self._cache))
+                ret = self.db.getMulti(keys)
+                if not ret.ok:
+                    return ret
+
+                # Remove the old versions of the changed constraints and add
+                # the ones that still exist.
+                for key in keys:
+                    con = self._keys.pop(key, None)
+                    if con is not None:
+                        del self._cache[con]
+                self._addToCache(ret.data)
+                return RetVal(True, None, len(self._cache))
+
+        # Subscribe to the change feed before downloading the constraints to
+        # not miss any changes in between.
+        self._closeFeed()
+        ret = self.db.subscribe()
+        if ret.ok:
+            self._feed, self._feedPID = ret.data, os.getpid()
+
+        # Flush the cache and fetch all constraints.
         self._cache = {}
-        cache = self._cache
-
-        # Fetch all constraints.
+        self._keys = {}
+        self._dirty.clear()
         ret = self.db.getAll()
         if not ret.ok:
             return ret
-        docs = ret.data
+        self._addToCache(ret.data)
+
+        # Return the number of valid constraints currently in the cache.
+        return RetVal(True, None, len(self._cache))
+
+    def _addToCache(self, docs: dict):
+        """
+        Add the constraint documents ``docs`` to the local cache.
+
+        :param dict docs: {datastore_key: doc}. None values are skipped.
+        """
+        cache = self._cache
 
         # Extract the AID from the compound key value. A compound key is a
         # colon (':') separated string in the form of 'aid:contype:rb_a:rb_b'.
         for k, v in docs.items():
-            v['aid'] = k.split(':')[0]
-
-        # Convert the documents into ConstraintMeta instances.
-        constraints = (ConstraintMeta(**_) for _ in docs.values())
+            if v is None:
+                continue
 
-        # Iterate over all constraints and  build a dictionary. The keys are
-        # `ConstraintMeta` tuples with a value of *None* for the data field.
-        # The values contain the same `ConstraintMeta` data but with a valid
-        # 'condata' attribute.
-        for con in constraints:
-            # Replace the 'condata' field in the constraint. This will become
-            # the key for the self._cache dictionary.
+            # Convert the document into a ConstraintMeta instance and add it
+            # to the dictionary. The keys are `ConstraintMeta` tuples with a
+            # value of *None* for the data field. The values contain the same
+            # `ConstraintMeta` data but with a valid 'condata' attribute.
+            # Note: the datastore documents may be read-only.
+            con = ConstraintMeta(**dict(v, aid=k.split(':')[0]))
             key = con._replace(condata=None)
             cache[key] = con
-            del con, key
-
-        # Return the number of valid constraints currently in the cache.
-        return RetVal(True, None, len(self._cache))
+            self._keys[k] = key
 
     def addConstraints(self, constraints: (tuple, list)):
         """
@@ -155,6 +215,7 @@ class Igor:
             return RetVal(False, 'Not all constraints are unique', None)
         else:
             ret = self.db.put(ops)
+            self._dirty.update(ops.keys())
 
         # Return the number of newly created constraints.
         success = [ret.data[idx2key[_]] for _ in range(len(constraints_sane))]
@@ -216,6 +277,7 @@ class Igor:
             key = ':'.join([con.aid, con.contype, con.rb_a, con.rb_b])
             ops.append(key)
         ret = self.db.remove(ops)
+        self._dirty.update(ops)
 
         # Return the number of deleted constraints.
         return RetVal(True, None, ret.data)
@@ -0,0 +1,315 @@
+# Copyright 2015, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+"""
+Vectorised rigid body integrator for bodies that do not interact.
+
+Leonard uses this integrator instead of Bullet for isolated bodies (ie
+singleton collision sets without constraints). The integrator processes all
+bodies at once with NumPy array operations and reproduces what Bullet does
+to such bodies in every sub-step:
+
+1. apply the (hard coded) linear and angular damping,
+2. update the velocities from the force and torque (after scaling them with
+   the linear- and angular factors),
+3. apply the implicit gyroscopic correction (one Newton step in body
+   coordinates, see ``btRigidBody::computeGyroscopicImpulseImplicit_Body``),
+4. move the centre of mass and rotate the principal axes with the exponential
+   map of the angular velocity.
+
+All quaternions use the (x, y, z, w) convention.
+"""
+import numpy as np
+
+from IPython import embed as ipshell
+from azrael.aztypes import typecheck
+
+# Same as in 'PyBulletDynamicsWorld.setRigidBodyData'.
+DAMPING_LIN = 0.02
+DAMPING_ROT = 0.02
+
+# Bullet limits the rotation per sub-step to this angle.
+ANGULAR_MOTION_THRESHOLD = 0.25 * np.pi
+
+
+def quatMult(q1, q2):
+    """
+    Return the products of the quaternions in ``q1`` and ``q2``.
+
+    :param ndarray q1: (N, 4) array of quaternions.
+    :param ndarray q2: (N, 4) array of quaternions.
+    :return: (N, 4) array with the products q1 * q2.
+    """
+    v1, w1 = q1[:, :3], q1[:, 3:]
+    v2, w2 = q2[:, :3], q2[:, 3:]
+    out = np.empty_like(q1)
+    out[:, :3] = w1 * v2 + w2 * v1 + np.cross(v1, v2)
+    out[:, 3:] = w1 * w2 - np.sum(v1 * v2, axis=1, keepdims=True)
+    return out
+
+
+def quatRotate(q, vec):
+    """
+    Rotate the vectors in ``vec`` with the (unit) quaternions in ``q``.
+
+    :param ndarray q: (N, 4) array of unit quaternions.
+    :param ndarray vec: (N, 3) array of vectors.
+    :return: (N, 3) array of rotated vectors.
+    """
+    u, w = q[:, :3], q[:, 3:]
+    t = 2 * np.cross(u, vec)
+    return vec + w * t + np.cross(u, t)
+
+
+def quatConj(q):
+    """
+    Return the conjugate of the quaternions in ``q``.
+
+    :param ndarray q: (N, 4) array of quaternions.
+    :return: (N, 4) array of conjugated quaternions.
+    """
+    out = -q
+    out[:, 3] = q[:, 3]
+    return out
+
+
+def quatNormalise(q):
+    """
+    Return the unit quaternions of ``q``.
+
+    :param ndarray q: (N, 4) array of quaternions.
+    :return: (N, 4) array of unit quaternions.
+    """
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def integrateRotation(q, vRot, dt: (int, float)):
+    """
+    Rotate the quaternions ``q`` by the angular velocity ``vRot`` for ``dt``.
+
+    This is the exponential map Bullet uses in
+    ``btTransformUtil::integrateTransform``, including the limit on the
+    maximum rotation per step and the Taylor expansion for small angles.
+
+    :param ndarray q: (N, 4) array of unit quaternions.
+    :param ndarray vRot: (N, 3) array of angular velocities.
+    :param float dt: time step.
+    :return: (N, 4) array of unit quaternions.
+    """
+    # Rotation angle (per unit time); clamped like in Bullet.
+    angle = np.linalg.norm(vRot, axis=1)
+    angle = np.minimum(angle, ANGULAR_MOTION_THRESHOLD / dt)
+
+    # Compute the axis scaling. Use the Taylor expansion of sin(x)/x for small
+    # angles to avoid the division by zero.
+    small = angle < 0.001
+    scale = np.empty_like(angle)
+    scale[small] = 0.5 * dt - (dt ** 3) * 0.020833333333 * angle[small] ** 2
+    tmp = angle[~small]
+    scale[~small] = np.sin(0.5 * tmp * dt) / tmp
+
+    # Compile the rotation quaternions and apply them.
+    dq = np.empty_like(q)
+    dq[:, :3] = vRot * scale[:, None]
+    dq[:, 3] = np.cos(0.5 * angle * dt)
+    return quatNormalise(quatMult(dq, q))
+
+
+def skew(vec):
+    """
+    Return the skew symmetric (cross product) matrices of ``vec``.
+
+    :param ndarray vec: (N, 3) array of vectors.
+    :return: (N, 3, 3) array of matrices.
+    """
+    out = np.zeros(vec.shape + (3, ))
+    x, y, z = vec[:, 0], vec[:, 1], vec[:, 2]
+    out[:, 0, 1], out[:, 0, 2] = -z, y
+    out[:, 1, 0], out[:, 1, 2] = z, -x
+    out[:, 2, 0], out[:, 2, 1] = -y, x
+    return out
+
+
+def gyroscopicImpulse(q, vRot, inertia, dt: (int, float)):
+    """
+    Return the change of angular velocity due to the gyroscopic torque.
+
+    This is a vectorised version of Bullet's implicit gyroscopic correction
+    in body coordinates, which is enabled by default for all rigid bodies.
+
+    :param ndarray q: (N, 4) array with orientation of principal axes.
+    :param ndarray vRot: (N, 3) array of angular velocities.
+    :param ndarray inertia: (N, 3) principal moments of inertia.
+    :param float dt: time step.
+    :return: (N, 3) array with change of angular velocity.
+    """
+    # Angular velocity in body coordinates.
+    omega = quatRotate(quatConj(q), vRot)
+    Ib = np.zeros(omega.shape + (3, ))
+    Ib[:, [0, 1, 2], [0, 1, 2]] = inertia
+    ibo = inertia * omega
+
+    # Residual vector and Jacobian.
+    f = dt * np.cross(omega, ibo)
+    J = Ib + (np.matmul(skew(omega), Ib) - skew(ibo)) * dt
+
+    # Single Newton-Raphson update and conversion back to world coordinates.
+    omega = omega - np.linalg.solve(J, f[:, :, None])[:, :, 0]
+    return quatRotate(q, omega) - vRot
+
+
+def compileBodies(bodies: (tuple, list)):
+    """
+    Compile the attributes of ``bodies`` into NumPy arrays.
+
+    Each element of ``bodies`` must be a ``RigidBodyData`` instance. The
+    returned dictionary holds the state of all bodies in the frame of their
+    centre of mass and principal axes (this is the frame Bullet integrates
+    in). Use ``integrateState`` to advance it and ``extractState`` to convert
+    it back to positions and rotations of the bodies.
+
+    :param list bodies: list of ``RigidBodyData`` instances.
+    :return: dictionary of (N, 3) and (N, 4) arrays.
+    :rtype: dict
+    """
+    def arr(name):
+        return np.array([getattr(_, name) for _ in bodies], np.float64)
+    pos, rot, com = arr('position'), arr('rotation'), arr('com')
+    inertia = arr('inertia')
+    paxis = quatNormalise(arr('paxis'))
+
+    # Inverse inertia in the principal axis frame (zero for zero inertia,
+    # just like ``btRigidBody.setMassProps``).
+    nonzero = inertia != 0
+    invInertia = np.zeros_like(inertia)
+    invInertia[nonzero] = 1 / inertia[nonzero]
+
+    # Bullet integrates the transform of the centre of mass and principal
+    # axes (see ``PyBulletDynamicsWorld.setRigidBodyData``).
+    return {
+        'p_com': pos + quatRotate(quatNormalise(rot), com),
+        'q_com': quatNormalise(quatMult(rot, paxis)),
+        'vLin': arr('velocityLin'),
+        'vRot': arr('velocityRot'),
+        'imass': arr('imass'),
+        'inertia': inertia,
+        'invInertia': invInertia,
+        'linFactor': arr('linFactor'),
+        'rotFactor': arr('rotFactor'),
+        'com': com,
+        'paxis': paxis,
+    }
+
+
+def extractState(state: dict):
+    """
+    Return position, rotation, linear- and angular velocity of all bodies.
+
+    This undoes the centre-of-mass and principal-axis transformation of
+    ``compileBodies``.
+
+    :param dict state: the state returned by ``compileBodies``.
+    :return: (position, rotation, velocityLin, velocityRot)
+    :rtype: tuple(ndarray, ndarray, ndarray, ndarray)
+    """
+    rot = quatMult(state['q_com'], quatConj(state['paxis']))
+    pos = state['p_com'] - quatRotate(rot, state['com'])
+    return pos, rot, state['vLin'].copy(), state['vRot'].copy()
+
+
+def integrateState(state: dict, force, torque,
+                   dt: (int, float), substeps: int):
+    """
+    Advance the compiled ``state`` by ``dt`` seconds (in place).
+
+    The ``force`` and ``torque`` are (N, 3) arrays in world coordinates and
+    apply at the centre of mass for the entire duration. The time step ``dt``
+    is split into ``substeps`` equal sub-steps.
+
+    :param dict state: the state returned by ``compileBodies``.
+    :param ndarray force: (N, 3) array of central forces.
+    :param ndarray torque: (N, 3) array of torques.
+    :param float dt: time step in seconds.
+    :param int substeps: number of sub-steps.
+    """
+    assert substeps > 0
+
+    # Bullet applies the linear- and angular factors when the force/torque
+    # is applied.
+    force = np.asarray(force, np.float64) * state['linFactor']
+    torque = np.asarray(torque, np.float64) * state['rotFactor']
+
+    # Convenience.
+    p_com, q_com = state['p_com'], state['q_com']
+    vLin, vRot = state['vLin'], state['vRot']
+    inertia, invInertia = state['inertia'], state['invInertia']
+
+    # Damping factor per sub-step.
+    h = dt / substeps
+    decay_lin = (1 - DAMPING_LIN) ** h
+    decay_rot = (1 - DAMPING_ROT) ** h
+
+    # The linear acceleration is constant.
+    dvLin = force * (state['imass'][:, None] * h)
+
+    for ii in range(substeps):
+        # Damping.
+        vLin *= decay_lin
+        vRot *= decay_rot
+
+        # Update the velocities. The torque acts via the inverse inertia
+        # tensor in world coordinates, ie R * diag(invInertia) * R^T.
+        vLin += dvLin
+        tmp = quatRotate(quatConj(q_com), torque) * invInertia
+        dvRot = quatRotate(q_com, tmp) * h
+        vRot += dvRot + gyroscopicImpulse(q_com, vRot, inertia, h)
+
+        # Update position and orientation of the centre of mass.
+        p_com += vLin * h
+        q_com = integrateRotation(q_com, vRot, h)
+
+    # The rotation was not updated in place.
+    state['q_com'] = q_com
+
+
+@typecheck
+def integrateBodies(bodies: (tuple, list), force, torque,
+                    dt: (int, float), substeps: int):
+    """
+    Integrate the motion of ``bodies`` for ``dt`` seconds.
+
+    Each element of ``bodies`` must be a ``RigidBodyData`` instance. The
+    ``force`` and ``torque`` are (N, 3) arrays in world coordinates and apply
+    at the centre of mass for the entire duration. The time step ``dt`` is
+    split into ``substeps`` equal sub-steps, which is what Bullet does in
+    ``PyBulletDynamicsWorld.compute``.
+
+    Static bodies are not supported and must not be passed to this function.
+
+    The return value contains the new position, rotation, linear- and angular
+    velocity of all bodies as (N, 3) and (N, 4) NumPy arrays.
+
+    :param list bodies: list of ``RigidBodyData`` instances.
+    :param ndarray force: (N, 3) array of central forces.
+    :param ndarray torque: (N, 3) array of torques.
+    :param float dt: time step in seconds.
+    :param int substeps: number of sub-steps.
+    :return: (position, rotation, velocityLin, velocityRot)
+    :rtype: tuple(ndarray, ndarray, ndarray, ndarray)
+    """
+    state = compileBodies(bodies)
+    integrateState(state, force, torque, dt, substeps)
+    return extractState(state)
@@ -20,6 +20,7 @@ Specify and implement the necessary functions to create, access and manipulate
 state variables.
 """
 
+import uuid
 import logging
 import numpy as np
 import azutils as util
@@ -112,53 +113,158 @@ def computeAABBs(cshapes: dict):
 
 
 @typecheck
-def dequeueCommands():
+def dequeueCommands(keep: bool=False, skip: dict=None):
     """
     Return and de-queue all commands currently in the command queue.
 
+    If ``keep`` is True then the commands remain in the queue until
+    ``removeCommands`` removes them. In that case, the caller can pass the
+    versions of the commands it has already received in ``skip``. This is a
+    {key: stamp} dictionary, where the key is '<cmd>:<objID>' and the stamp
+    is the 'stamp' field of the returned command.
+
+    :param bool keep: do not remove the commands from the queue.
+    :param dict skip: the versions of the commands to skip.
     :return QueuedCommands: a tuple with lists for each command.
     """
     # Convenience.
     db = datastore.getDSHandle('Commands')
+    skip = {} if skip is None else skip
 
     # Fetch all pending commands.
     ret = db.getAll()
     if not ret.ok:
         return ret
-    docs = ret.data
-
-    # Delete all the commands we have just fetched.
-    db.remove(list(docs.keys()))
-
-    # Decompose the command:objID key into its constituents and add them to the
-    # document. This will allow us to compile all spawn/remove/etc commands
-    # easily below.
-    for key in docs:
+    fetched, docs = ret.data, {}
+
+    if keep:
+        # Only return the commands the caller has not received yet.
+        docs = {k: v for k, v in fetched.items()
+                if (k not in skip) or (skip[k] != v.get('stamp', None))}
+
+    # Delete all the commands we have just fetched, but only if they have not
+    # been superseded or updated since (see ``_stamp``). Fetch the latest
+    # version of those and repeat. The latest version of a command always
+    # supersedes, or includes, the older ones.
+    while (not keep) and len(fetched) > 0:
+        docs.update(fetched)
+        match = {k: {('stamp', ): v['stamp']}
+                 for k, v in fetched.items() if 'stamp' in v}
+        ret = db.remove(list(fetched.keys()), match)
+        if not ret.ok:
+            return ret
+        if ret.data == len(fetched):
+            break
+
+        ret = db.getMulti(list(fetched.keys()))
+        if not ret.ok:
+            return ret
+        fetched = {k: v for k, v in ret.data.items()
+                   if v is not None and v.get('stamp') != docs[k].get('stamp')}
+
+    # Decompose the command:objID key into its constituents and add them to
+    # (a copy of) the document. This will allow us to compile all
+    # spawn/remove/etc commands easily below. Note: the datastore documents
+    # may be read-only.
+    tmp = []
+    for key, doc in docs.items():
         cmd, objID = key.split(':')
-        docs[key]['cmd'] = cmd
-        docs[key]['objID'] = objID
+        tmp.append(dict(doc, cmd=cmd, objID=objID))
         del cmd, objID
-    docs = docs.values()
+    docs = tmp
+    del tmp
 
-    # Split the commands into categories.
+    # Split the commands into categories. Sort the spawn commands by object
+    # ID since IDs are allocated in ascending order; this ensures Leonard
+    # spawns the objects in the same order in which they were created.
     spawn = [_ for _ in docs if _['cmd'] == 'spawn']
+    spawn.sort(key=lambda _: (len(_['objID']), _['objID']))
     remove = [_ for _ in docs if _['cmd'] == 'remove']
     modify = [_ for _ in docs if _['cmd'] == 'modify']
     direct_force = [_ for _ in docs if _['cmd'] == 'direct_force']
     booster_force = [_ for _ in docs if _['cmd'] == 'booster_force']
+    schedule = [_ for _ in docs if _['cmd'] == 'schedule']
+    force_profile = [_ for _ in docs if _['cmd'] == 'force_profile']
 
     # Compile the output dictionary.
     out = {'spawn': spawn, 'remove': remove, 'modify': modify,
-           'direct_force': direct_force, 'booster_force': booster_force}
+           'direct_force': direct_force, 'booster_force': booster_force,
+           'schedule': schedule, 'force_profile': force_profile}
     return RetVal(True, None, out)
 
 
+@typecheck
+def removeCommands(stamps: dict):
+    """
+    Remove the specified versions of the commands from the command queue.
+
+    The ``stamps`` dictionary has the same form as the ``skip`` argument of
+    ``dequeueCommands``. Commands with a different version remain in the
+    queue, and commands without a version (ie. a stamp of *None*) are
+    removed unconditionally.
+
+    :param dict stamps: {key: stamp} versions of the commands to remove.
+    :return: Success
+    """
+    db = datastore.getDSHandle('Commands')
+    match = {k: {('stamp', ): v} for k, v in stamps.items() if v is not None}
+    ret = db.remove(list(stamps.keys()), match)
+    if not ret.ok:
+        return ret
+    return RetVal(True, None, None)
+
+
+def _stamp():
+    """
+    Return a new unique version stamp for a command document.
+
+    Every write to the command queue stamps the document with a new value.
+    This allows ``dequeueCommands`` to only delete those versions of the
+    commands it has actually read.
+
+    :return: str
+    """
+    return uuid.uuid4().hex
+
+
+def _putOrReplace(db, ops: dict):
+    """
+    Write all ``ops`` to ``db`` and overwrite already existing documents.
+
+    This gives the command queue last-writer-wins semantics: a new command
+    supersedes a still pending command with the same key instead of being
+    silently dropped.
+
+    :param DatastoreBase db: command datastore.
+    :param dict ops: datastore ops (see ``DatastoreBase.put``).
+    :return: success.
+    """
+    # Stamp every command with a new version.
+    ops = {k: {'data': dict(v['data'], stamp=_stamp())}
+           for (k, v) in ops.items()}
+
+    # Overwrite the pending commands first...
+    ret = db.replace(ops)
+    if not ret.ok:
+        return ret
+
+    # ... and insert those that did not exist yet.
+    ops = {k: v for (k, v) in ops.items() if not ret.data[k]}
+    if len(ops) > 0:
+        ret = db.put(ops)
+        if not ret.ok:
+            return ret
+    return RetVal(True, None, None)
+
+
 @typecheck
 def addCmdSpawn(objData: (tuple, list)):
     """
     Announce that the elements in ``objData`` were created.
 
-    The ``objData`` variables comprises a list of (objID, body) tuples.
+    The ``objData`` variables comprises a list of (objID, body) tuples. Each
+    tuple may contain an optional third element with the name of the physics
+    quality tier for that object (see ``config.quality_tiers``).
 
     Returns **False** if ``objID`` already exists, is already scheduled to
     spawn, or if any of the parameters are invalid.
@@ -170,11 +276,15 @@ def addCmdSpawn(objData: (tuple, list)):
     :return: success.
     """
     # Sanity check all bodies.
-    for objID, body in objData:
+    for obj in objData:
         try:
+            assert 2 <= len(obj) <= 3
+            objID, body = obj[:2]
             assert isinstance(objID, str)
             assert isinstance(body, _RigidBodyData)
-        except AssertionError:
+            if len(obj) == 3:
+                assert isinstance(obj[2], str)
+        except (AssertionError, TypeError):
             msg = '<addCmdQueue> received invalid argument type'
             return RetVal(False, msg, None)
 
@@ -185,14 +295,18 @@ def addCmdSpawn(objData: (tuple, list)):
 
     # Compile the datastore ops.
     ops = {}
-    for objID, body in objData:
+    for obj in objData:
+        objID, body = obj[:2]
+        quality = obj[2] if len(obj) == 3 else ''
+
         # Compile the AABBs. Return immediately if an error occurs.
         aabbs = computeAABBs(body.cshapes)
         if not aabbs.ok:
             return RetVal(False, 'Could not compile all AABBs', None)
 
         # Insert this document.
-        data = {'rbs': body._asdict(), 'AABBs': aabbs.data}
+        data = {'rbs': body._asdict(), 'AABBs': aabbs.data, 'quality': quality,
+                'stamp': _stamp()}
         key = 'spawn:{}'.format(objID)
         ops[key] = {'data': data}
 
@@ -230,7 +344,7 @@ def addCmdRemoveObject(objID: str):
     """
     db = datastore.getDSHandle('Commands')
     key = 'remove:{}'.format(objID)
-    ops = {key: {'data': {}}}
+    ops = {key: {'data': {'stamp': _stamp()}}}
     db.put(ops)
 
     return RetVal(True, None, None)
@@ -274,16 +388,26 @@ def addCmdModifyBodyState(objID: str, body: dict):
     del body_sane
 
     # Add the new body state and AABBs to the 'command' database from where
-    # clients can read it at their leisure. Note that this will overwrite
-    # already pending update commands for the same object - tough luck.
+    # clients can read it at their leisure. If an update command for the same
+    # object is still pending then merge the new values into it (newer
+    # values win) so that Leonard only has to apply one command per object.
     db = datastore.getDSHandle('Commands')
-
-    data = {'rbs': body, 'AABBs': aabbs}
     key = 'modify:{}'.format(objID)
+
+    # Attempt to merge the update into an already pending command.
+    fields = {('rbs', k): v for (k, v) in body.items()}
+    fields[('stamp', )] = _stamp()
+    if aabbs is not None:
+        fields[('AABBs', )] = aabbs
+    op = {'inc': {}, 'set': fields, 'unset': [], 'exists': {('rbs', ): True}}
+    ret = db.modify({key: op})
+    if ret.ok and ret.data.get(key, False):
+        return RetVal(True, None, None)
+
+    # No command was pending yet --> create it.
+    data = {'rbs': body, 'AABBs': aabbs, 'stamp': _stamp()}
     ops = {key: {'data': data}}
     db.put(ops)
-
-    # This function was successful if exactly one document was updated.
     return RetVal(True, None, None)
 
 
@@ -313,9 +437,9 @@ def addCmdDirectForce(objID: str, force: list, torque: list):
     data = {'force': force, 'torque': torque}
     key = 'direct_force:{}'.format(objID)
     ops = {key: {'data': data}}
-    db.put(ops)
 
-    return RetVal(True, None, None)
+    # The latest force supersedes any still pending one.
+    return _putOrReplace(db, ops)
 
 
 @typecheck
@@ -350,6 +474,85 @@ def addCmdBoosterForce(objID: str, force: list, torque: list):
     data = {'force': force, 'torque': torque}
     key = 'booster_force:{}'.format(objID)
     ops = {key: {'data': data}}
-    db.put(ops)
 
-    return RetVal(True, None, None)
+    # The latest force supersedes any still pending one.
+    return _putOrReplace(db, ops)
+
+
+@typecheck
+def addCmdSchedule(objID: str, entries: (tuple, list)):
+    """
+    Install a schedule of force commands for ``objID``.
+
+    Each entry in ``entries`` is a (time, cmd, force, torque) tuple. The
+    ``time`` is in seconds relative to the moment Leonard installs the
+    schedule, and ``cmd`` must be either 'direct_force' or 'booster_force'.
+    Leonard will apply each entry in the physics step that covers its time
+    exactly as if the corresponding ``addCmdDirectForce`` or
+    ``addCmdBoosterForce`` command had arrived at that moment.
+
+    A new schedule replaces any existing schedule for the same object. An
+    empty schedule therefore cancels the current one.
+
+    :param str objID: the object
+    :param list entries: the scheduled (time, cmd, force, torque) commands.
+    :return bool: Success
+    """
+    # Sanity check.
+    if objID == '':
+        msg = 'Invalid Object ID'
+        logit.warning(msg)
+        return RetVal(False, msg, None)
+    try:
+        out = []
+        for t, cmd, force, torque in entries:
+            assert isinstance(t, (int, float)) and t >= 0
+            assert cmd in ('direct_force', 'booster_force')
+            assert len(force) == len(torque) == 3
+            out.append((float(t), cmd, list(force), list(torque)))
+    except (TypeError, ValueError, AssertionError):
+        return RetVal(False, 'Invalid schedule entries', None)
+
+    # Compile datastore ops.
+    db = datastore.getDSHandle('Commands')
+    data = {'entries': out}
+    key = 'schedule:{}'.format(objID)
+    ops = {key: {'data': data}}
+
+    # The latest schedule supersedes any still pending one.
+    return _putOrReplace(db, ops)
+
+
+@typecheck
+def addCmdForceProfiles(objID: str, profiles: (tuple, list)):
+    """
+    Replace the analytic force- and torque profiles of ``objID``.
+
+    Leonard evaluates the ``profiles`` in every physics step and adds the
+    result to the other forces on the object. An empty list removes all
+    profiles. See ``aztypes.ForceProfile`` for details.
+
+    :param str objID: the object
+    :param list[ForceProfile] profiles: the new profiles.
+    :return bool: Success
+    """
+    # Sanity check.
+    if objID == '':
+        msg = 'Invalid Object ID'
+        logit.warning(msg)
+        return RetVal(False, msg, None)
+    try:
+        P = aztypes.ForceProfile
+        profiles = [P(**_) if isinstance(_, dict) else P(*_) for _ in profiles]
+        profiles = [_._asdict() for _ in profiles]
+    except TypeError:
+        return RetVal(False, 'Invalid force profile', None)
+
+    # Compile datastore ops.
+    db = datastore.getDSHandle('Commands')
+    data = {'profiles': profiles}
+    key = 'force_profile:{}'.format(objID)
+    ops = {key: {'data': data}}
+
+    # The latest profiles supersede any still pending ones.
+    return _putOrReplace(db, ops)
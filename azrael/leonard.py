@@ -21,12 +21,18 @@ Physics manager.
 import os
 import sys
 import zmq
+import mmap
+import stat
 import time
 import json
+import heapq
 import signal
+import struct
 import pickle
 import logging
+import collections
 import networkx
+import concurrent.futures
 import numpy as np
 
 import azrael.igor
@@ -34,6 +40,8 @@ import azrael.datastore
 import azrael.eventstore
 import azrael.vectorgrid
 import azrael.bullet_api
+import azrael.integrator
+import azrael.force_profiles
 import azutils as util
 import azrael.config as config
 import azrael.leo_api as leoAPI
@@ -41,10 +49,15 @@ import azrael.leo_api as leoAPI
 from IPython import embed as ipshell
 from azrael.aztypes import _RigidBodyData, RigidBodyData
 from azrael.aztypes import typecheck, RetVal, WPMeta, WPDataOut, WPDataRet, Forces
+from azrael.aztypes import QualityProfile, Constraint6DofSpring2
 
 # Create module logger.
 logit = logging.getLogger('azrael.' + __name__)
 
+# Every snapshot file starts with this tag, followed by the length of the
+# snapshot (see `writeSnapshotFile`).
+SNAPSHOT_FILE_MAGIC = b'AZLEOSNP'
+
 
 @typecheck
 def sweeping(data: dict, dim: str):
@@ -398,6 +411,111 @@ def getFinalCollisionSets(constraintPairs: list,
     return ret
 
 
+def _isPrivate(st: os.stat_result):
+    """
+    Return True if the file with the status ``st`` belongs to the current
+    user and nobody else can modify it.
+    """
+    return (st.st_uid == os.getuid()) and (st.st_mode & 0o022 == 0)
+
+
+@typecheck
+def getSnapshotFile(name: str=None):
+    """
+    Return the name of the snapshot file for the Leonard instance ``name``.
+
+    The file resides in the directory `config.snapshot_dir`. Create that
+    directory if it does not exist yet, and return an error if it is not
+    private to the current user. The default ``name`` is
+    `config.snapshot_name`.
+
+    :param str name: name of Leonard instance.
+    :return: file name.
+    """
+    name = config.snapshot_name if name is None else name
+    dirname = config.snapshot_dir
+    try:
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        st = os.lstat(dirname)
+    except OSError as err:
+        msg = 'Cannot create snapshot directory <{}>: {}'.format(dirname, err)
+        return RetVal(False, msg, None)
+
+    if not (stat.S_ISDIR(st.st_mode) and _isPrivate(st)
+            and (st.st_mode & 0o077 == 0)):
+        msg = 'Snapshot directory <{}> is not private'.format(dirname)
+        return RetVal(False, msg, None)
+    return RetVal(True, None, os.path.join(dirname, name + '.snapshot'))
+
+
+@typecheck
+def writeSnapshotFile(fname: str, blob: bytes):
+    """
+    Write the snapshot ``blob`` to the local file ``fname``.
+
+    The snapshot goes into a temporary file first (via a memory map), which
+    then atomically replaces ``fname``. The file thus always contains a
+    complete snapshot, even if Leonard dies half way through. Only the
+    current user can read or write the file.
+
+    :param str fname: file name.
+    :param bytes blob: the snapshot.
+    :return: Success
+    """
+    ofs = len(SNAPSHOT_FILE_MAGIC) + 8
+    tmp_name = '{}.{}.tmp'.format(fname, os.getpid())
+    flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+    try:
+        with open(os.open(tmp_name, flags, 0o600), 'w+b') as fd:
+            fd.truncate(ofs + len(blob))
+            with mmap.mmap(fd.fileno(), ofs + len(blob)) as mm:
+                mm[:ofs] = SNAPSHOT_FILE_MAGIC + struct.pack('<Q', len(blob))
+                mm[ofs:] = blob
+                mm.flush()
+        os.replace(tmp_name, fname)
+    except OSError as err:
+        msg = 'Cannot write snapshot file <{}>: {}'.format(fname, err)
+        return RetVal(False, msg, None)
+    return RetVal(True, None, None)
+
+
+@typecheck
+def readSnapshotFile(fname: str):
+    """
+    Return the snapshot stored in ``fname`` by ``writeSnapshotFile``.
+
+    The snapshots are pickled. This function therefore refuses to read
+    files, or files in directories, that someone other than the current
+    user could have written.
+
+    :param str fname: file name.
+    :return: the snapshot.
+    :rtype: bytes
+    """
+    ofs = len(SNAPSHOT_FILE_MAGIC) + 8
+    try:
+        st = os.lstat(os.path.dirname(os.path.abspath(fname)))
+        fd = os.open(fname, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        msg = 'Cannot read snapshot file <{}>'.format(fname)
+        return RetVal(False, msg, None)
+
+    try:
+        with open(fd, 'rb') as fin:
+            if not (_isPrivate(st) and _isPrivate(os.fstat(fin.fileno()))):
+                msg = 'Snapshot file <{}> is not private'.format(fname)
+                return RetVal(False, msg, None)
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                assert mm[:len(SNAPSHOT_FILE_MAGIC)] == SNAPSHOT_FILE_MAGIC
+                size = struct.unpack('<Q', mm[ofs - 8:ofs])[0]
+                blob = mm[ofs:ofs + size]
+                assert len(blob) == size
+    except (OSError, ValueError, AssertionError, struct.error):
+        msg = 'Cannot read snapshot file <{}>'.format(fname)
+        return RetVal(False, msg, None)
+    return RetVal(True, None, blob)
+
+
 class LeonardBase(config.AzraelProcess):
     """
     Base class for Physics manager.
@@ -406,7 +524,9 @@ class LeonardBase(config.AzraelProcess):
     interface for the actual Leonard implementations, as well as a test
     framework.
     """
-    def __init__(self):
+    def __init__(self, maxIngest: int=5000, fastPath: bool=True,
+                 batchSteps: int=1, adaptiveSubsteps: bool=True,
+                 resume: bool=None, maxsteps: int=None):
         super().__init__()
 
         # Create an Igor instance.
@@ -417,6 +537,88 @@ class LeonardBase(config.AzraelProcess):
         self.allForces = {}
         self.events = azrael.eventstore.EventStore(topics=['phys'])
 
+        # Leonard spawns at most `maxIngest` objects per step. Spawn commands
+        # beyond that limit remain in the (ordered) backlog until the next
+        # step. Body- and force updates are coalesced per object (last writer
+        # wins) until they can be applied.
+        assert maxIngest > 0
+        self.maxIngest = maxIngest
+        self.cmdBacklog = collections.OrderedDict()
+        self.cmdPending = {'modify': {}, 'direct_force': {},
+                           'booster_force': {}, 'schedule': {},
+                           'force_profile': {}}
+
+        # Simulation time and the priority queue of scheduled force commands.
+        # Every heap entry is a (time, seq, objID, gen, cmd, force, torque)
+        # tuple; entries whose `gen` does not match the current schedule
+        # generation of their object are stale and will be skipped.
+        self.simTime = 0.0
+        self.schedHeap = []
+        self.schedGen = {}
+        self.schedStatus = {}
+        self.schedDirty = set()
+        self.schedSeq = 0
+
+        # Analytic force profiles and their most recent values.
+        self.forceProfiles = azrael.force_profiles.ForceProfiles()
+        self.profileForces = {}
+
+        # Physics quality profiles and the quality tier of all objects that
+        # requested one; all other objects use the default tier.
+        self.qualityProfiles = {
+            k: QualityProfile(**v) for k, v in config.quality_profiles.items()}
+        self.allQuality = {}
+
+        # IDs of the objects removed by the last few `processCommandQueue`
+        # calls (one list per call). The physics engines use it to purge
+        # the objects from their own caches.
+        self.removedLog = collections.deque(maxlen=10)
+
+        # Integrate isolated bodies (singleton collision sets without
+        # constraints) directly instead of passing them to Bullet.
+        self.fastPath = fastPath
+
+        # Select the number of sub-steps for every collision set from the
+        # speed of its bodies instead of always using `maxsteps`.
+        self.adaptiveSubsteps = adaptiveSubsteps
+
+        # Number of collision sets, and the sub-steps they used and saved,
+        # since the last `logSubsteps` call (and in total).
+        self.substepsStep = {'sets': 0, 'substeps': 0, 'saved': 0}
+        self.substepStats = dict(self.substepsStep)
+
+        # In batch mode `run` advances the simulation by `batchSteps` steps
+        # at a time, as fast as possible, and only synchronises the bodies
+        # with the datastore after each batch. Only the integrator of this
+        # class supports it.
+        if batchSteps < 1:
+            raise ValueError('batchSteps must be positive')
+        if batchSteps > 1 and type(self).step is not LeonardBase.step:
+            msg = '{} does not support batch mode'
+            raise ValueError(msg.format(type(self).__name__))
+        self.batchSteps = batchSteps
+
+        # Maximum number of sub-steps per step in `run`.
+        if maxsteps is None:
+            maxsteps = config.leonard_maxsteps
+        if maxsteps < 1:
+            raise ValueError('maxsteps must be positive')
+        self.maxsteps = maxsteps
+
+        # The most recent snapshots as (simTime, snapshot) tuples (see
+        # `takeSnapshot`). If `resume` is True then `run` restores the
+        # snapshot file (see `getSnapshotFile`) before the first step. The
+        # default is `config.snapshot_resume`.
+        self.snapshots = collections.deque(maxlen=config.snapshot_history)
+        self.resume = config.snapshot_resume if resume is None else resume
+
+        # If `keepCommands` is True then the applied commands remain in the
+        # command queue until a snapshot file covers them. The `cmdAcks`
+        # dictionary specifies the versions of those commands, ie. it has
+        # the form {key: stamp} (see `leoAPI.dequeueCommands`).
+        self.keepCommands = False
+        self.cmdAcks = {}
+
     def setup(self):
         """
         Stub for initialisation code that cannot go into the constructor.
@@ -469,8 +671,8 @@ class LeonardBase(config.AzraelProcess):
         Return the total force- and torque on the object.
 
         The returned values are the sum of all booster forces (correctly
-        oriented relative to the object) and the force a user may have specifed
-        directly.
+        oriented relative to the object), the force a user may have specifed
+        directly, and the current value of the force profiles.
 
         Note that this function does not account for the forces from the 'force
         grid'.
@@ -497,62 +699,404 @@ class LeonardBase(config.AzraelProcess):
         force += quat * f.forceBoost
         torque += quat * f.torqueBoost
 
+        # Add the contribution from the force profiles (if any).
+        if objID in self.profileForces:
+            force += self.profileForces[objID][0]
+            torque += self.profileForces[objID][1]
+
         # Convert to Python lists.
         return force.tolist(), torque.tolist()
 
+    def compileForces(self, objIDs: (tuple, list), pos, rot):
+        """
+        Return the total force and torque on all ``objIDs`` as NumPy arrays.
+
+        This is the vectorised version of ``totalForceAndTorque`` but it
+        includes the forces from the 'force grid' as well. The ``pos`` and
+        ``rot`` arrays specify the current position and rotation of the
+        objects since they may differ from those in the local body cache.
+
+        :param list objIDs: object IDs.
+        :param ndarray pos: (N, 3) array of object positions.
+        :param ndarray rot: (N, 4) array of object rotations.
+        :return: (force, torque) as two (N, 3) arrays.
+        """
+        # Compile the direct- and booster forces.
+        forces = [self.allForces[_] for _ in objIDs]
+        force = np.array([_.forceDirect for _ in forces], np.float64)
+        torque = np.array([_.torqueDirect for _ in forces], np.float64)
+        boost_f = np.array([_.forceBoost for _ in forces], np.float64)
+        boost_t = np.array([_.torqueBoost for _ in forces], np.float64)
+        del forces
+
+        # Rotate the booster forces into world coordinates.
+        force += azrael.integrator.quatRotate(rot, boost_f)
+        torque += azrael.integrator.quatRotate(rot, boost_t)
+
+        # Add the contribution from the force profiles (usually only few
+        # objects have one).
+        if len(self.profileForces) > 0:
+            index = {objID: idx for idx, objID in enumerate(objIDs)}
+            for objID, (f, t) in self.profileForces.items():
+                if objID in index:
+                    force[index[objID]] += f
+                    torque[index[objID]] += t
+
+        # Add the forces from the force grid.
+        ret = self.getGridForces(dict(zip(objIDs, pos)))
+        if not ret.ok:
+            self.logit.info(ret.msg)
+        else:
+            force += np.array([ret.data[_] for _ in objIDs], np.float64)
+        return force, torque
+
+    def splitCollisionSets(self, collSets: list, constraintPairs: list):
+        """
+        Separate the isolated bodies from the other ``collSets``.
+
+        A body is isolated if it is the only member of its collision set, is
+        not static, has no constraints, and its quality tier is not listed in
+        ``config.quality_bullet``. Nothing can interact with these bodies and
+        ``integrateIsolated`` can update them without Bullet.
+
+        Return the IDs of all isolated bodies and the remaining collision
+        sets. All collision sets remain unchanged if ``fastPath`` is False.
+
+        :param list collSets: the collision sets.
+        :param list constraintPairs: list of 2-tuples eg [(1, 2), (1, 5), ...].
+        :return: (isolated body IDs, remaining collision sets)
+        :rtype: (list, list)
+        """
+        if not self.fastPath:
+            return [], collSets
+
+        # Objects connected to a constraint must always go through Bullet,
+        # and so must those whose quality tier demands it.
+        constrained = {_ for pair in constraintPairs for _ in pair}
+        bullet = set(config.quality_bullet)
+
+        isolated, remaining = [], []
+        for subset in collSets:
+            if len(subset) == 1:
+                objID = next(iter(subset))
+                body = self.allBodies[objID]
+                static = (body.imass < 1E-4) or (sum(body.inertia) < 1E-4)
+                special = ((objID in constrained) or
+                           (self.allQuality.get(objID, None) in bullet))
+                if not static and not special:
+                    isolated.append(objID)
+                    continue
+            remaining.append(subset)
+
+        # Log the number of bodies that bypass Bullet.
+        util.logMetricQty('#FastPath', len(isolated))
+        return isolated, remaining
+
+    def getQualityProfile(self, objIDs: (tuple, list)):
+        """
+        Return the ``QualityProfile`` for the collision set ``objIDs``.
+
+        A collision set is only as accurate as its most demanding member.
+        This method therefore returns the profile of the highest tier (see
+        ``config.quality_tiers``) among the members of ``objIDs``. Objects
+        without a tier, or with an unknown one, count as the default tier.
+
+        :param list objIDs: the objects in the collision set.
+        :return: the profile for the collision set.
+        :rtype: QualityProfile
+        """
+        tiers = config.quality_tiers
+        default = tiers.index(config.quality_default)
+        best = None
+        for objID in objIDs:
+            name = self.allQuality.get(objID, config.quality_default)
+            try:
+                idx = tiers.index(name)
+            except ValueError:
+                msg = 'Object <{}> uses the unknown quality tier <{}>'
+                self.logit.warning(msg.format(objID, name))
+                idx = default
+            best = idx if best is None else max(best, idx)
+        best = default if best is None else best
+        return self.qualityProfiles[tiers[best]]
+
+    def getSubsteps(self, objIDs: (tuple, list), dt: (int, float),
+                    maxsteps: int, constraints: (tuple, list)=(),
+                    forced: bool=False, count: bool=True):
+        """
+        Return the number of sub-steps for the collision set ``objIDs``.
+
+        The number of sub-steps is the smallest one that satisfies all of the
+        following (see the 'substeps_*' values in ``config``):
+
+          * no point on any body travels further than (a fraction of) the
+            smallest AABB half-length in the set; the speed of a point is the
+            linear speed of its body plus the angular speed times its
+            distance from the body,
+          * no body rotates by more than a fixed angle,
+          * every spring in ``constraints`` resolves its natural frequency.
+
+        The physics engine uses CCD to stop fast bodies from tunnelling, which
+        is why these criteria are merely a matter of accuracy.
+
+        Rigid constraints (eg. P2P and locked axes) and forces (``forced``)
+        make the integration error depend on the step size, which is why these
+        sets always use ``maxsteps``.
+
+        Unless ``count`` is False, this method also tallies the number of
+        used and saved sub-steps for the metrics (see ``countSubsteps``).
+
+        :param list objIDs: the objects in the collision set.
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps.
+        :param list constraints: the ``ConstraintMeta`` of the set.
+        :param bool forced: whether any body in the set is subject to a force.
+        :param bool count: tally the sub-steps for the metrics.
+        :return: number of sub-steps in [1, maxsteps].
+        :rtype: int
+        """
+        if forced or not self.adaptiveSubsteps:
+            num = maxsteps
+        else:
+            num = self._computeSubsteps(objIDs, dt, maxsteps, constraints)
+
+        if count:
+            self.countSubsteps(num, maxsteps)
+        return num
+
+    def countSubsteps(self, substeps: int, maxsteps: int):
+        """
+        Tally the ``substeps`` Bullet used to step one collision set.
+
+        :param int substeps: number of sub-steps used for the set.
+        :param int maxsteps: maximum number of sub-steps.
+        """
+        self.substepsStep['sets'] += 1
+        self.substepsStep['substeps'] += substeps
+        self.substepsStep['saved'] += maxsteps - substeps
+
+    def _computeSubsteps(self, objIDs, dt, maxsteps, constraints):
+        """
+        Return the adaptive number of sub-steps (see ``getSubsteps``).
+        """
+        num = 1
+        for con in constraints:
+            if con.contype.upper() != '6DOFSPRING2':
+                return maxsteps
+            dof = Constraint6DofSpring2(*con.condata)
+
+            # Locked axes are rigid constraints.
+            lo = tuple(dof.linLimitLo) + tuple(dof.rotLimitLo)
+            hi = tuple(dof.linLimitHi) + tuple(dof.rotLimitHi)
+            if any(l == h for l, h in zip(lo, hi)):
+                return maxsteps
+
+            # Stiffest linear- and angular spring, and the largest inverse
+            # mass and inverse inertia of the two bodies.
+            k = [v if on else 0 for v, on in
+                 zip(dof.stiffness, dof.enableSpring)]
+            bodies = [self.allBodies[_] for _ in (con.rb_a, con.rb_b)
+                      if _ in self.allBodies]
+            imass = max([_.imass for _ in bodies], default=0)
+            iinertia = max([1 / min(_.inertia) for _ in bodies
+                            if min(_.inertia) > 0], default=0)
+            omega = max(np.sqrt(max(k[:3]) * imass),
+                        np.sqrt(max(k[3:]) * iinertia))
+            num = max(num, np.ceil(config.substeps_spring * omega * dt))
+
+        # Determine the fastest point, the fastest rotation, and the smallest
+        # (non-zero) AABB half-length in the set.
+        speed, spin, size = 0, 0, None
+        for objID in objIDs:
+            body = self.allBodies[objID]
+            vLin = np.sqrt(np.dot(body.velocityLin, body.velocityLin))
+            vRot = np.sqrt(np.dot(body.velocityRot, body.velocityRot))
+            reach = 0
+            for aabb in self.allAABBs[objID].values():
+                reach = max(reach, np.sqrt(np.dot(aabb[:3], aabb[:3])) +
+                            max(aabb[3:]))
+                for hl in aabb[3:]:
+                    if hl > 0 and (size is None or hl < size):
+                        size = hl
+            speed = max(speed, vLin + vRot * reach)
+            spin = max(spin, vRot)
+        num = max(num, np.ceil(spin * dt / config.substeps_angle))
+
+        # Sets without collision shapes cannot collide with anything.
+        if size is not None:
+            travel = config.substeps_travel * size
+            num = max(num, np.ceil(speed * dt / travel))
+        return int(min(maxsteps, max(1, num)))
+
+    def logSubsteps(self):
+        """
+        Log the number of sub-steps used and saved since the last call.
+
+        The saved sub-steps are those that the collision sets did not need
+        compared to always using ``maxsteps``. Only collision sets stepped
+        with Bullet count (see ``countSubsteps``). The totals are in
+        ``substepStats``.
+        """
+        for key, val in self.substepsStep.items():
+            self.substepStats[key] += val
+        util.logMetricQty('#Substeps', int(self.substepsStep['substeps']))
+        util.logMetricQty('#SubstepsSaved', int(self.substepsStep['saved']))
+        self.substepsStep = dict.fromkeys(self.substepsStep, 0)
+
+    def integrateIsolated(self, objIDs: (tuple, list),
+                          dt: (int, float), maxsteps: int):
+        """
+        Advance the isolated bodies ``objIDs`` by ``dt``.
+
+        This uses the vectorised integrator in ``azrael.integrator`` to update
+        all bodies with the same number of sub-steps (see ``getSubsteps``) at
+        once. Like Bullet, it scales the sub-steps of every body by the
+        ``substepScale`` of its quality profile. The result is the same as if
+        each body had been passed to Bullet on its own. These sub-steps do
+        not count towards the metrics (see ``logSubsteps``).
+
+        :param list objIDs: IDs of isolated bodies (see
+            ``splitCollisionSets``).
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps.
+        """
+        if len(objIDs) == 0:
+            return
+
+        # Compile the forces of all bodies into arrays.
+        bodies = [self.allBodies[_] for _ in objIDs]
+        pos = np.array([_.position for _ in bodies], np.float64)
+        rot = np.array([_.rotation for _ in bodies], np.float64)
+        force, torque = self.compileForces(objIDs, pos, rot)
+        forced = np.any(force != 0, axis=1) | np.any(torque != 0, axis=1)
+        del pos, rot
+
+        # Group the bodies by their number of sub-steps.
+        groups = {}
+        for idx, objID in enumerate(objIDs):
+            num = self.getSubsteps(
+                [objID], dt, maxsteps, forced=forced[idx], count=False)
+            scale = self.getQualityProfile([objID]).substepScale
+            num = max(1, int(round(num * scale)))
+            groups.setdefault(num, []).append(idx)
+
+        integ = azrael.integrator
+        for substeps, idx in groups.items():
+            # Integrate all bodies in the group at once and update the local
+            # body cache.
+            group = [objIDs[_] for _ in idx]
+            state = integ.compileBodies([bodies[_] for _ in idx])
+            integ.integrateState(state, force[idx], torque[idx], dt, substeps)
+            self._updateBodies(group, state)
+
     @typecheck
     def step(self, dt: (int, float), maxsteps: int):
         """
         Advance the simulation by ``dt`` using at most ``maxsteps``.
 
-        This method will use a primitive Euler step to update the state
-        variables. This suffices as a proof of concept.
+        This method integrates all bodies at once with the same semi-implicit
+        integrator Bullet uses (see ``azrael.integrator``) but ignores
+        collisions and constraints altogether.
 
         :param float dt: time step in seconds.
         :param int maxsteps: maximum number of sub-steps to simulate for one
                              ``dt`` update.
         """
+        self.stepBatch(dt, maxsteps, 1)
+
+    @typecheck
+    def stepBatch(self, dt: (int, float), maxsteps: int, numSteps: int):
+        """
+        Advance the simulation ``numSteps`` times by ``dt``.
+
+        This is equivalent to calling ``step`` ``numSteps`` times, except that
+        the command queue is only processed before the first step and the
+        bodies are only synchronised with the datastore after the last one.
+        The bodies remain in NumPy arrays in between. This makes it possible
+        to simulate scenes without collisions (eg orbital mechanics) much
+        faster than real time.
+
+        Static bodies never move.
+
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps to simulate for one
+                             ``dt`` update.
+        :param int numSteps: number of steps.
+        """
+        assert numSteps > 0
+        integ = azrael.integrator
         self.processCommandQueue()
 
-        # Fetch the forces for all object positions.
-        idPos = {k: v.position for (k, v) in self.allBodies.items()}
-        ret = self.getGridForces(idPos)
-        if not ret.ok:
-            self.logit.info(ret.msg)
-            z = np.float64(0)
-            gridForces = {_: z for _ in idPos}
-        else:
-            gridForces = ret.data
-        del ret, idPos
+        # Compile the state of all non-static bodies into NumPy arrays.
+        objIDs = [
+            objID for objID, body in self.allBodies.items()
+            if (body.imass >= 1E-4) and (sum(body.inertia) >= 1E-4)
+        ]
+        if len(objIDs) > 0:
+            state = integ.compileBodies([self.allBodies[_] for _ in objIDs])
+
+        for ii in range(numSteps):
+            self.processSchedules(dt)
+            if len(objIDs) == 0:
+                continue
 
-        # Iterate over all objects and update their body information in Bullet.
-        for objID, body in self.allBodies.items():
-            # Compute direct- and booster forces on object.
-            force, torque = self.totalForceAndTorque(objID)
+            # Compute the forces for the current positions and rotations.
+            pos, rot, _, _ = integ.extractState(state)
+            force, torque = self.compileForces(objIDs, pos, rot)
+            integ.integrateState(state, force, torque, dt, maxsteps)
 
-            # Add the force defined on the 'force' grid.
-            force += gridForces[objID]
+            # Spring profiles depend on the body state. Update the cache for
+            # all objects with profiles so that the next step uses the
+            # current state.
+            if (ii < numSteps - 1) and (len(self.forceProfiles.profiles) > 0):
+                tmp = set(self.forceProfiles.profiles)
+                self._updateBodies(objIDs, state, subset=tmp)
 
-            # Update velocity and position.
-            vel = np.array(body.velocityLin, np.float64) + 0.5 * force
-            pos = np.array(body.position, np.float64)
-            pos += dt * vel
-            vel, pos = tuple(vel), tuple(pos)
-            self.allBodies[objID] = body._replace(position=pos, velocityLin=vel)
+        # Copy the final state back to the local body cache.
+        if len(objIDs) > 0:
+            self._updateBodies(objIDs, state)
 
         # Synchronise the local object cache back to the database.
         self.syncObjects(collisions=None)
 
+    def _updateBodies(self, objIDs: (tuple, list), state: dict, subset=None):
+        """
+        Copy the integrator ``state`` of ``objIDs`` to the local body cache.
+
+        Only update the objects in ``subset`` unless it is None.
+
+        :param list objIDs: object IDs in the same order as in ``state``.
+        :param dict state: integrator state (see ``azrael.integrator``).
+        :param set subset: only update these objects (optional).
+        """
+        pos, rot, vLin, vRot = azrael.integrator.extractState(state)
+        for idx, objID in enumerate(objIDs):
+            if (subset is not None) and (objID not in subset):
+                continue
+            self.allBodies[objID] = self.allBodies[objID]._replace(
+                position=tuple(pos[idx].tolist()),
+                rotation=tuple(rot[idx].tolist()),
+                velocityLin=tuple(vLin[idx].tolist()),
+                velocityRot=tuple(vRot[idx].tolist()),
+            )
+
     def processCommandQueue(self):
         """
         Apply commands from queue to objects in local cache.
 
         Applied commands are automatically removed.
 
+        Spawn and remove commands are applied in the order they were issued,
+        but at most ``maxIngest`` objects will be spawned per call; the
+        remaining ones stay in the backlog for the next call. All other
+        commands are coalesced per object and command type (the latest one
+        wins) and applied as soon as the object exists.
+
         :return bool: Success.
         """
-        # Fetch (and de-queue) all pending commands.
-        ret = leoAPI.dequeueCommands()
+        # Fetch (and de-queue) all pending commands. Skip the commands that
+        # were already applied but remain in the queue (see `keepCommands`).
+        ret = leoAPI.dequeueCommands(keep=self.keepCommands, skip=self.cmdAcks)
         if not ret.ok:
             msg = 'Cannot fetch commands'
             self.logit.error(msg)
@@ -560,22 +1104,67 @@ class LeonardBase(config.AzraelProcess):
 
         # Convenience.
         cmds = ret.data
+        backlog, pending = self.cmdBacklog, self.cmdPending
 
-        # Remove objects.
+        # Remember the versions of the commands that remain in the queue.
+        if self.keepCommands:
+            for docs in cmds.values():
+                for doc in docs:
+                    key = '{}:{}'.format(doc['cmd'], doc['objID'])
+                    self.cmdAcks[key] = doc.get('stamp', None)
+
+        # Queue the new spawn commands behind those still in the backlog.
+        for doc in cmds['spawn']:
+            objID = doc['objID']
+            if (objID in self.allBodies) or (objID in backlog):
+                msg = 'Cannot spawn object since objID={} already exists'
+                self.logit.warning(msg.format(objID))
+                continue
+            backlog[objID] = doc
+
+        # Coalesce the update commands with those that are still pending.
+        # Partial body state updates for the same object are merged (into a
+        # copy because the datastore documents may be read-only).
+        for doc in cmds['modify']:
+            objID = doc['objID']
+            if objID in pending['modify']:
+                old = pending['modify'][objID]
+                old['rbs'] = dict(old['rbs'], **doc['rbs'])
+                if doc['AABBs'] is not None:
+                    old['AABBs'] = doc['AABBs']
+            else:
+                pending['modify'][objID] = doc
+        for cmd in ('direct_force', 'booster_force', 'schedule',
+                    'force_profile'):
+            for doc in cmds[cmd]:
+                pending[cmd][doc['objID']] = doc
+
+        # Remove objects. Object IDs are never re-used, which means a remove
+        # command always refers to an earlier spawn command. If that spawn
+        # command is still in the backlog then cancel it. Either way, drop all
+        # pending commands for the object.
+        removed = []
         for doc in cmds['remove']:
             objID = doc['objID']
+            backlog.pop(objID, None)
+            for val in pending.values():
+                val.pop(objID, None)
+            self.schedGen.pop(objID, None)
+            self.schedStatus.pop(objID, None)
+            self.schedDirty.discard(objID)
+            self.forceProfiles.removeProfiles(objID)
+            self.profileForces.pop(objID, None)
+            self.allQuality.pop(objID, None)
             if objID in self.allBodies:
                 del self.allBodies[objID]
                 del self.allForces[objID]
                 del self.allAABBs[objID]
+                removed.append(objID)
+        self.removedLog.append(removed)
 
-        # Spawn objects.
-        for doc in cmds['spawn']:
-            objID = doc['objID']
-            if objID in self.allBodies:
-                msg = 'Cannot spawn object since objID={} already exists'
-                self.logit.warning(msg.format(objID))
-                continue
+        # Spawn (at most `maxIngest`) objects in the order they were created.
+        for _ in range(min(len(backlog), self.maxIngest)):
+            objID, doc = backlog.popitem(last=False)
 
             # Add the body and its AABB to Leonard's cache. Furthermore, add
             # (and initialise) the entry for the forces on this body.
@@ -583,68 +1172,141 @@ class LeonardBase(config.AzraelProcess):
             self.allBodies[objID] = RigidBodyData(**body_old)
             self.allForces[objID] = Forces(*(([0, 0, 0], ) * 4))
             self.allAABBs[objID] = doc['AABBs']
+            if doc.get('quality', '') not in ('', config.quality_default):
+                self.allQuality[objID] = doc['quality']
+        util.logMetricQty('#CmdBacklog', len(backlog))
+
+        # Apply the pending updates to all objects that exist. Keep the
+        # updates for objects that are still waiting to spawn and discard all
+        # others.
+        for cmd, val in pending.items():
+            for objID in list(val.keys()):
+                if objID in self.allBodies:
+                    self._applyUpdateCommand(cmd, val.pop(objID))
+                elif objID not in backlog:
+                    del val[objID]
 
-        # Update Body States.
-        for doc in cmds['modify']:
-            objID, new, aabbs_new = doc['objID'], doc['rbs'], doc['AABBs']
-            if objID in self.allBodies:
-                # Convert the original body state into a dictionary and update
-                # it with the new values.
-                old = self.allBodies[objID]._asdict()
-                old.update(new)
-
-                # Attempt to construct a new RigidBody with the new body that
-                # now includes the updated values. If it fails skip this body
-                # altogether.
-                try:
-                    self.allBodies[objID] = RigidBodyData(**old)
-                except TypeError:
-                    self.logit.warning('Could not update body state in Leonard.')
-                    continue
+        return RetVal(True, None, None)
 
-                # Assign the new AABB if it is not None (note: a value of
-                # *None* explicitly means that there is no AABB update,
-                # whereas the AABBs for eg an empty shape would be []).
-                if aabbs_new is not None:
-                    self.allAABBs[objID] = aabbs_new
+    def _applyUpdateCommand(self, cmd: str, doc: dict):
+        """
+        Apply the modify/force command ``doc`` to its (existing) object.
 
-        # Update direct force- and torque values.
-        for doc in cmds['direct_force']:
-            objID, force, torque = doc['objID'], doc['force'], doc['torque']
+        :param str cmd: command type ('modify', 'direct_force', ...)
+        :param dict doc: the command as returned by ``dequeueCommands``.
+        """
+        objID = doc['objID']
+        if cmd == 'modify':
+            new, aabbs_new = doc['rbs'], doc['AABBs']
+
+            # Convert the original body state into a dictionary and update
+            # it with the new values.
+            old = self.allBodies[objID]._asdict()
+            old.update(new)
+
+            # Attempt to construct a new RigidBody with the new body that
+            # now includes the updated values. If it fails skip this body
+            # altogether.
             try:
-                self.allForces[objID] = self.allForces[objID]._replace(
-                    forceDirect=force, torqueDirect=torque)
-            except KeyError:
-                pass
+                self.allBodies[objID] = RigidBodyData(**old)
+            except TypeError:
+                self.logit.warning('Could not update body state in Leonard.')
+                return
 
-        # Update booster force- and torque values.
-        for doc in cmds['booster_force']:
-            objID, force, torque = doc['objID'], doc['force'], doc['torque']
-            try:
-                self.allForces[objID] = self.allForces[objID]._replace(
-                    forceBoost=force, torqueBoost=torque)
-            except KeyError:
-                pass
+            # Assign the new AABB if it is not None (note: a value of
+            # *None* explicitly means that there is no AABB update,
+            # whereas the AABBs for eg an empty shape would be []).
+            if aabbs_new is not None:
+                self.allAABBs[objID] = aabbs_new
+        elif cmd == 'direct_force':
+            # Update direct force- and torque values.
+            self.allForces[objID] = self.allForces[objID]._replace(
+                forceDirect=doc['force'], torqueDirect=doc['torque'])
+        elif cmd == 'booster_force':
+            # Update booster force- and torque values.
+            self.allForces[objID] = self.allForces[objID]._replace(
+                forceBoost=doc['force'], torqueBoost=doc['torque'])
+        elif cmd == 'schedule':
+            # Invalidate the entries of the current schedule (if any) and
+            # queue the new ones relative to the current simulation time.
+            gen = self.schedGen.get(objID, 0) + 1
+            self.schedGen[objID] = gen
+            for t, sched_cmd, force, torque in doc['entries']:
+                self.schedSeq += 1
+                entry = (self.simTime + t, self.schedSeq, objID, gen,
+                         sched_cmd, force, torque)
+                heapq.heappush(self.schedHeap, entry)
+
+            # Update the status of the schedule.
+            num = len(doc['entries'])
+            state = 'active' if num > 0 else 'cancelled'
+            self.schedStatus[objID] = {
+                'state': state, 'applied': 0, 'remaining': num}
+            self.schedDirty.add(objID)
+
+        elif cmd == 'force_profile':
+            ret = self.forceProfiles.setProfiles(
+                objID, self.simTime, doc['profiles'])
+            if not ret.ok:
+                self.logit.warning(ret.msg)
+            self.profileForces.pop(objID, None)
 
-        return RetVal(True, None, None)
+    def processSchedules(self, dt: (int, float)):
+        """
+        Apply all scheduled commands that fall into the next ``dt`` seconds.
+
+        This method also evaluates the force profiles, advances the
+        simulation time, and must thus be called exactly once per physics
+        step (after the command queue was processed).
+
+        :param float dt: time step in seconds.
+        """
+        heap, t_end = self.schedHeap, self.simTime + dt
+        while len(heap) > 0 and heap[0][0] < t_end:
+            _, _, objID, gen, cmd, force, torque = heapq.heappop(heap)
+
+            # Skip the entry if its schedule was replaced or cancelled, or if
+            # the object does not exist anymore.
+            if self.schedGen.get(objID, None) != gen:
+                continue
+
+            # Apply the command exactly as if it had just arrived.
+            doc = {'objID': objID, 'force': force, 'torque': torque}
+            self._applyUpdateCommand(cmd, doc)
+
+            # Update the status of the schedule.
+            status = self.schedStatus[objID]
+            status['applied'] += 1
+            status['remaining'] -= 1
+            if status['remaining'] == 0:
+                status['state'] = 'done'
+            self.schedDirty.add(objID)
+
+        # Evaluate all force profiles at the start of this step.
+        self.profileForces = self.forceProfiles.evaluate(
+            self.simTime, self.allBodies)
+        self.simTime = t_end
 
     def syncObjects(self, collisions: list):
         """
         Sync the bodies from Leonard's local cache to the datastore.
 
-        This method will also publish the `collisions`, the format of which is
-        determined entirely by `PyBulletDynamicsWorld.getLastContacts`.
+        This method will also publish the `collisions`, namely a list of
+        ``ContactData`` arrays (see `PyBulletDynamicsWorld.getContactData`).
+        The message format is determined by `bullet_api.encodeContacts`.
 
-        :param list collisions: collisions to publish.
+        :param list[ContactData] collisions: collisions to publish.
         """
         # Return immediately if we have no objects to begin with.
         if len(self.allBodies) == 0:
             return
 
         # Publish the collision contacts (if there are any).
-        if (collisions is not None) and (len(collisions) > 0):
-            msg = json.dumps(collisions).encode('utf8')
-            self.events.publish(topic='phys.collisions', msg=msg)
+        if collisions is not None:
+            collisions = azrael.bullet_api.encodeContacts(collisions)
+            if len(collisions) > 0:
+                msg = json.dumps(collisions).encode('utf8')
+                self.events.publish(topic='phys.collisions', msg=msg)
 
         # Update the RBS data in the master record.
         db = azrael.datastore.getDSHandle('ObjInstances')
@@ -656,6 +1318,12 @@ class LeonardBase(config.AzraelProcess):
                 'unset': [],
                 'exists': {('template', 'rbs'): True},
             }
+
+        # Include the status of all schedules that have changed.
+        for aid in self.schedDirty:
+            if aid in ops:
+                ops[aid]['set'][('schedule', )] = dict(self.schedStatus[aid])
+        self.schedDirty.clear()
         db.modify(ops)
 
     def processCommandsAndSync(self):
@@ -671,6 +1339,141 @@ class LeonardBase(config.AzraelProcess):
         self.processCommandQueue()
         self.syncObjects(collisions=None)
 
+    def getEngines(self):
+        """
+        Return the physics engines whose state is part of the snapshots.
+
+        :return: list of ``PyBulletDynamicsWorld`` instances.
+        """
+        return []
+
+    def takeSnapshot(self, fname: str=None):
+        """
+        Take a snapshot of Leonard and its physics engines.
+
+        The snapshot covers the local object cache, the pending commands,
+        the schedules and force profiles, the simulation time, and the
+        complete state of all physics engines. Leonard keeps the most recent
+        snapshots in memory (see ``rollback``). If ``fname`` is not None then
+        the snapshot also goes to that file (see ``resumeSnapshot``).
+
+        Commands Leonard fetches after the snapshot are not part of it. If
+        ``keepCommands`` is True then those commands remain in the command
+        queue until the next snapshot file covers them. Leonard thus applies
+        them again after it resumed from an older snapshot file.
+
+        :param str fname: name of snapshot file (optional).
+        :return: Success
+        """
+        state = {k: getattr(self, k) for k in self._snapshotAttributes()}
+        state['forceProfiles'] = self.forceProfiles.profiles
+        state['engines'] = [_.getSnapshot().data for _ in self.getEngines()]
+        blob = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        self.snapshots.append((self.simTime, blob))
+
+        if fname is None:
+            return RetVal(True, None, None)
+        ret = writeSnapshotFile(fname, blob)
+        if not ret.ok:
+            return ret
+
+        # The snapshot file now covers all applied commands --> remove them
+        # from the command queue.
+        if len(self.cmdAcks) > 0:
+            ret = leoAPI.removeCommands(self.cmdAcks)
+            if not ret.ok:
+                return ret
+            self.cmdAcks = {}
+        return RetVal(True, None, None)
+
+    @staticmethod
+    def _snapshotAttributes():
+        """
+        Return the names of the attributes that ``takeSnapshot`` stores.
+
+        :return: tuple of attribute names.
+        """
+        return (
+            'simTime', 'allBodies', 'allAABBs', 'allForces', 'allQuality',
+            'cmdBacklog', 'cmdPending', 'schedHeap', 'schedGen',
+            'schedStatus', 'schedDirty', 'schedSeq', 'profileForces',
+            'removedLog', 'cmdAcks',
+        )
+
+    def restoreSnapshot(self, blob: bytes):
+        """
+        Restore the snapshot ``blob`` created by ``takeSnapshot``.
+
+        The physics engines are only restored if their number matches that
+        in the snapshot. Otherwise they rebuild their state from the object
+        cache, like they always do for new objects.
+
+        :param bytes blob: the snapshot.
+        :return: Success
+        """
+        try:
+            state = pickle.loads(blob)
+            engines = state.pop('engines')
+            profiles = state.pop('forceProfiles')
+            assert set(state.keys()) == set(self._snapshotAttributes())
+        except (pickle.UnpicklingError, EOFError, AttributeError, KeyError,
+                IndexError, TypeError, ValueError, AssertionError):
+            return RetVal(False, 'Invalid snapshot', None)
+
+        # Restore the physics engines. Revert those that were already
+        # restored should one of them fail.
+        if len(engines) == len(self.getEngines()):
+            backup = [_.getSnapshot().data for _ in self.getEngines()]
+            for idx, engine in enumerate(self.getEngines()):
+                ret = engine.restoreSnapshot(engines[idx])
+                if not ret.ok:
+                    for engine, engine_blob in zip(self.getEngines(), backup):
+                        engine.restoreSnapshot(engine_blob)
+                    return ret
+        else:
+            self.logit.info('Cannot restore physics engines')
+
+        # Restore Leonard's own state.
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.forceProfiles.profiles = profiles
+        self.forceProfiles.compiled = None
+        return RetVal(True, None, None)
+
+    def resumeSnapshot(self, fname: str):
+        """
+        Restore the snapshot in ``fname`` (see ``takeSnapshot``).
+
+        :param str fname: name of snapshot file.
+        :return: Success
+        """
+        ret = readSnapshotFile(fname)
+        if not ret.ok:
+            return ret
+        return self.restoreSnapshot(ret.data)
+
+    @typecheck
+    def rollback(self, simTime: (int, float)):
+        """
+        Roll the simulation back to the latest snapshot taken at ``simTime``
+        or earlier.
+
+        All newer snapshots are discarded. Return the simulation time of the
+        restored snapshot.
+
+        :param float simTime: simulation time.
+        :return: simulation time after the rollback.
+        """
+        while (len(self.snapshots) > 0) and (self.snapshots[-1][0] > simTime):
+            self.snapshots.pop()
+        if len(self.snapshots) == 0:
+            return RetVal(False, 'No snapshot available', None)
+
+        ret = self.restoreSnapshot(self.snapshots[-1][1])
+        if not ret.ok:
+            return ret
+        return RetVal(True, None, self.simTime)
+
     def run(self):
         """
         Drive the periodic physics updates.
@@ -682,12 +1485,48 @@ class LeonardBase(config.AzraelProcess):
         self.setup()
         self.logit.debug('Setup complete.')
 
+        # Determine the snapshot file. Only keep the snapshots in memory if
+        # it is unavailable.
+        fname, interval = None, config.snapshot_interval
+        if (interval > 0) or self.resume:
+            ret = getSnapshotFile()
+            if ret.ok:
+                fname = ret.data
+            else:
+                self.logit.warning(ret.msg)
+
+        # Keep the commands in the queue until a snapshot file covers them.
+        self.keepCommands = (fname is not None) and (interval > 0)
+
+        # Resume from the latest snapshot, if requested.
+        if self.resume and (fname is not None):
+            ret = self.resumeSnapshot(fname)
+            if ret.ok:
+                self.logit.info('Resumed at t={:.3f}s'.format(self.simTime))
+            else:
+                self.logit.warning(ret.msg)
+
         # Trigger the `step` method every `stepinterval` seconds, if possible.
         t0 = time.time()
         stepinterval = 0.050
+        numSteps = 0
 
         try:
             while True:
+                # Snapshot the simulation every `interval` steps.
+                if (interval > 0) and (numSteps % interval == 0):
+                    ret = self.takeSnapshot(fname)
+                    if not ret.ok:
+                        self.logit.warning(ret.msg)
+                numSteps += 1
+
+                # Batch mode: simulate as fast as possible.
+                if self.batchSteps > 1:
+                    with util.Timeit('Leonard:1.0 StepBatch'):
+                        self.stepBatch(
+                            stepinterval, self.maxsteps, self.batchSteps)
+                    continue
+
                 # Wait if <10ms have passed. Proceed immediately otherwise.
                 sleep_time = stepinterval - (time.time() - t0)
                 if sleep_time > 0:
@@ -703,7 +1542,7 @@ class LeonardBase(config.AzraelProcess):
                 # during the sub-steps, but we can only query them after the
                 # last update.
                 with util.Timeit('Leonard:1.0 Step'):
-                    self.step(stepinterval, maxsteps=10)
+                    self.step(stepinterval, maxsteps=self.maxsteps)
         except KeyboardInterrupt:
             self.logit.warning('Leonard was aborted')
 
@@ -714,14 +1553,17 @@ class LeonardBullet(LeonardBase):
 
     Unlike ``LeonardBase`` this class actually *does* update the physics.
     """
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.bullet = None
 
     def setup(self):
         # Instantiate the Bullet engine with ID=1.
         self.bullet = azrael.bullet_api.PyBulletDynamicsWorld(1)
 
+    def getEngines(self):
+        return [] if self.bullet is None else [self.bullet]
+
     @typecheck
     def step(self, dt, maxsteps):
         """
@@ -738,6 +1580,11 @@ class LeonardBullet(LeonardBase):
         """
         # Process pending commands.
         self.processCommandQueue()
+        self.processSchedules(dt)
+
+        # Purge the removed objects from Bullet.
+        if len(self.removedLog) > 0:
+            self.bullet.removeRigidBody(self.removedLog[-1])
 
         # Update the constraint cache in our local Igor instance.
         self.igor.updateLocalCache()
@@ -755,6 +1602,7 @@ class LeonardBullet(LeonardBase):
         del ret, idPos
 
         # Iterate over all objects and update them.
+        forced = False
         for objID, body in self.allBodies.items():
             # Copy the body from the DB to Bullet.
             self.bullet.setRigidBodyData(objID, body)
@@ -764,6 +1612,7 @@ class LeonardBullet(LeonardBase):
 
             # Add the force defined on the 'force' grid.
             force += gridForces[objID]
+            forced = forced or bool(np.any(force) or np.any(torque))
 
             # Apply the force to the object.
             self.bullet.applyForceAndTorque(objID, force, torque)
@@ -774,15 +1623,17 @@ class LeonardBullet(LeonardBase):
         if not ret.ok:
             self.logit.warning(ret.msg)
 
-        # Advance the simulation by one time step.
+        # Advance the simulation by one time step. All bodies share the same
+        # world and therefore the same quality profile and sub-steps.
+        objIDs = list(self.allBodies.keys())
+        self.bullet.setQualityProfile(self.getQualityProfile(objIDs))
+        substeps = self.getSubsteps(
+            objIDs, dt, maxsteps, allConstraints, forced)
         with util.Timeit('compute'):
-            self.bullet.compute(list(self.allBodies.keys()), dt, maxsteps)
-
-            # Remove all constraints.
-            self.bullet.clearAllConstraints()
+            self.bullet.compute(objIDs, dt, substeps)
 
         # Retrieve all collisions generated during the last step.
-        collisions = self.bullet.getLastContacts().data
+        collisions = [self.bullet.getContactData().data]
 
         # Retrieve all objects from Bullet and overwrite the state variables
         # that the user explicilty wanted to change (if any).
@@ -800,6 +1651,9 @@ class LeonardBullet(LeonardBase):
                     velocityRot=ret.data.vRot
                 )
 
+        # Log the number of used and saved sub-steps.
+        self.logSubsteps()
+
         # Synchronise the local object cache back to the database.
         self.syncObjects(collisions)
 
@@ -815,10 +1669,17 @@ class LeonardSweeping(LeonardBase):
     This class is single threaded and uses a single Bullet instance to
     sequentially update the physics for each collision set.
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bullet = None
+
     def setup(self):
         # Instantiate the Bullet engine with ID=1.
         self.bullet = azrael.bullet_api.PyBulletDynamicsWorld(1)
 
+    def getEngines(self):
+        return [] if self.bullet is None else [self.bullet]
+
     @typecheck
     def step(self, dt, maxsteps):
         """
@@ -834,10 +1695,20 @@ class LeonardSweeping(LeonardBase):
                              ``dt`` update.
         """
         self.processCommandQueue()
+        self.processSchedules(dt)
+
+        # Purge the removed objects from Bullet.
+        if len(self.removedLog) > 0:
+            self.bullet.removeRigidBody(self.removedLog[-1])
 
         # Update the constraint cache in our local Igor instance.
         self.igor.updateLocalCache()
 
+        # Remove the constraints of the previous step from the world. Every
+        # collision set applies its own constraints below (Bullet keeps them
+        # cached, which makes this cheap).
+        self.bullet.clearAllConstraints()
+
         # Compute all collision sets.
         with util.Timeit('CCS'):
             ret = self.igor.uniquePairs()
@@ -850,13 +1721,20 @@ class LeonardSweeping(LeonardBase):
             if not ret.ok:
                 return
             collSets = ret.data
-            del ret, uniquePairs
+            del ret
+
+            # Isolated bodies bypass Bullet.
+            isolated, collSets = self.splitCollisionSets(collSets, uniquePairs)
+            del uniquePairs
 
         # Log the number of created collision sets.
         util.logMetricQty('#CollSets', len(collSets))
 
-        # Create empty set of collisions. This is a precaution in case the
-        # for-loop below does not run (ie there are no bodies to simulate).
+        # Integrate all isolated bodies at once.
+        with util.Timeit('FastPath'):
+            self.integrateIsolated(isolated, dt, maxsteps)
+
+        # Collect the collisions of all sets.
         collisions = []
 
         # Process all subsets individually.
@@ -876,6 +1754,7 @@ class LeonardSweeping(LeonardBase):
             del ret, idPos
 
             # Iterate over all objects and update them.
+            forced = False
             for objID, body in coll_bodies.items():
                 # Copy the body from the DB to Bullet.
                 self.bullet.setRigidBodyData(objID, body)
@@ -885,6 +1764,7 @@ class LeonardSweeping(LeonardBase):
 
                 # Add the force defined on the 'force' grid.
                 force += gridForces[objID]
+                forced = forced or bool(np.any(force) or np.any(torque))
 
                 # Apply the final force to the object.
                 self.bullet.applyForceAndTorque(objID, force, torque)
@@ -901,17 +1781,20 @@ class LeonardSweeping(LeonardBase):
             ret = self.bullet.setConstraints(tmp)
             if not ret.ok:
                 self.logit.warning(ret.msg)
+            constraints = tmp
             del tmp
 
-            # Wait for Bullet to advance the simulation by one step.
+            # Wait for Bullet to advance the simulation by one step, using
+            # the quality profile and sub-steps of the collision set.
+            objIDs = list(coll_bodies.keys())
+            self.bullet.setQualityProfile(self.getQualityProfile(objIDs))
+            substeps = self.getSubsteps(
+                objIDs, dt, maxsteps, constraints, forced)
             with util.Timeit('compute'):
-                self.bullet.compute(list(coll_bodies.keys()), dt, maxsteps)
-
-            # Remove all constraints.
-            self.bullet.clearAllConstraints()
+                self.bullet.compute(objIDs, dt, substeps)
 
             # Retrieve all collisions generated during the last step.
-            collisions = self.bullet.getLastContacts().data
+            collisions.append(self.bullet.getContactData().data)
 
             # Retrieve all objects from Bullet.
             for objID, body in coll_bodies.items():
@@ -928,6 +1811,204 @@ class LeonardSweeping(LeonardBase):
                         velocityRot=ret.data.vRot
                     )
 
+        # Log the number of used and saved sub-steps.
+        self.logSubsteps()
+
+        # Synchronise the local object cache back to the database.
+        self.syncObjects(collisions)
+
+
+class LeonardThreaded(LeonardBase):
+    """
+    Compute physics on independent collision sets with a thread pool.
+
+    This class uses Sweeping to compile the collision sets, just like
+    ``LeonardSweeping``, but distributes them over ``numThreads`` threads.
+    Every thread owns its own Bullet instance and steps the collision sets
+    assigned to it sequentially. Bullet releases the GIL while it steps the
+    world, which is why the threads can run concurrently.
+
+    Unlike ``LeonardDistributedZeroMQ`` all engines live in the same process
+    and neither the bodies nor the results need to be serialised.
+
+    :param int numThreads: number of threads (and Bullet instances).
+    """
+    def __init__(self, *args, numThreads: int=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert numThreads > 0
+        self.numThreads = numThreads
+        self.engines = []
+        self.pool = None
+
+    def setup(self):
+        # One Bullet engine per thread.
+        self.engines = [azrael.bullet_api.PyBulletDynamicsWorld(_)
+                        for _ in range(self.numThreads)]
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.numThreads)
+
+    def getEngines(self):
+        return list(self.engines)
+
+    def shutdown(self):
+        """
+        Stop the thread pool.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    @staticmethod
+    def assignCollisionSets(collSets: list, numBins: int, size=len):
+        """
+        Distribute the ``collSets`` over ``numBins`` bins.
+
+        The bins will contain roughly the same number of bodies. This is
+        the classic greedy heuristic: assign the largest remaining set to the
+        bin with the fewest bodies.
+
+        The ``size`` function must return the number of bodies in a set.
+
+        :param list collSets: list of collision sets.
+        :param int numBins: number of bins.
+        :param callable size: returns the number of bodies in a set.
+        :return: list of ``numBins`` lists with collision sets.
+        """
+        bins = [[] for _ in range(numBins)]
+        heap = [(0, _) for _ in range(numBins)]
+        for subset in sorted(collSets, key=size, reverse=True):
+            load, idx = heapq.heappop(heap)
+            bins[idx].append(subset)
+            heapq.heappush(heap, (load + size(subset), idx))
+        return bins
+
+    @staticmethod
+    def _stepCollisionSets(engine, jobs: list, dt):
+        """
+        Step all collision sets in ``jobs`` with the Bullet ``engine``.
+
+        This method runs in a worker thread and must not access the state
+        of Leonard. Every element in ``jobs`` is a (objIDs, bodies, force,
+        torque, constraints, quality, substeps) tuple.
+
+        :param engine: Bullet instance (``PyBulletDynamicsWorld``).
+        :param list jobs: collision sets with all data to step them.
+        :param float dt: time step in seconds.
+        :return: list of (objIDs, state, ContactData) tuples.
+        """
+        out = []
+        for job in jobs:
+            objIDs, bodies, force, torque, constraints, quality, substeps = job
+            # Load the bodies, forces, constraints and the quality profile
+            # into Bullet.
+            engine.setRigidBodyDataBatch(objIDs, bodies)
+            engine.applyForceAndTorqueBatch(objIDs, force, torque)
+            engine.setConstraints(constraints)
+            engine.setQualityProfile(quality)
+
+            # Advance the simulation (Bullet releases the GIL).
+            engine.compute(objIDs, dt, substeps)
+
+            # Fetch the collisions and new body states.
+            collisions = engine.getContactData().data
+            ret = engine.getRigidBodyDataBatch(objIDs)
+            out.append((objIDs, ret.data if ret.ok else None, collisions))
+        return out
+
+    @typecheck
+    def step(self, dt, maxsteps):
+        """
+        Advance the simulation by ``dt`` using at most ``maxsteps``.
+
+        :param float dt: time step in seconds.
+        :param int maxsteps: maximum number of sub-steps to simulate for one
+                             ``dt`` update.
+        """
+        self.processCommandQueue()
+        self.processSchedules(dt)
+
+        # Purge the removed objects from all Bullet engines.
+        if len(self.removedLog) > 0:
+            for engine in self.engines:
+                engine.removeRigidBody(self.removedLog[-1])
+
+        # Update the constraint cache in our local Igor instance.
+        self.igor.updateLocalCache()
+
+        # Compute all collision sets.
+        with util.Timeit('CCS'):
+            ret = self.igor.uniquePairs()
+            if not ret.ok:
+                return
+            uniquePairs = ret.data
+
+            ret = getFinalCollisionSets(
+                uniquePairs, self.allBodies, self.allAABBs)
+            if not ret.ok:
+                return
+            collSets = [list(_) for _ in ret.data]
+            del ret
+
+            # Isolated bodies bypass Bullet.
+            isolated, collSets = self.splitCollisionSets(collSets, uniquePairs)
+            del uniquePairs
+
+        # Log the number of created collision sets.
+        util.logMetricQty('#CollSets', len(collSets))
+
+        # Integrate all isolated bodies at once.
+        with util.Timeit('FastPath'):
+            self.integrateIsolated(isolated, dt, maxsteps)
+
+        # Compile the data for all collision sets in this thread because it
+        # requires access to the local caches.
+        jobs = []
+        for subset in collSets:
+            bodies = [self.allBodies[_] for _ in subset]
+            pos = np.array([_.position for _ in bodies], np.float64)
+            rot = np.array([_.rotation for _ in bodies], np.float64)
+            force, torque = self.compileForces(subset, pos, rot)
+            constraints = self.igor.getConstraints(subset).data
+            quality = self.getQualityProfile(subset)
+            forced = bool(np.any(force) or np.any(torque))
+            substeps = self.getSubsteps(
+                subset, dt, maxsteps, constraints, forced)
+            jobs.append((subset, bodies, force, torque, constraints, quality,
+                         substeps))
+        del collSets
+
+        # Assign the collision sets to the threads and wait until they have
+        # stepped all of them.
+        bins = self.assignCollisionSets(
+            jobs, self.numThreads, size=lambda job: len(job[0]))
+        with util.Timeit('compute'):
+            futures = [
+                self.pool.submit(self._stepCollisionSets, engine, job, dt)
+                for engine, job in zip(self.engines, bins) if len(job) > 0
+            ]
+            results = [_.result() for _ in futures]
+        del bins, futures
+
+        # Copy the new body states back into the local cache and collect the
+        # collisions of all sets.
+        collisions = []
+        for result in results:
+            for objIDs, state, coll in result:
+                collisions.append(coll)
+                if state is None:
+                    self.logit.error('Unable to get all objects from Bullet')
+                    continue
+                pos, rot, vLin, vRot = state
+                for idx, objID in enumerate(objIDs):
+                    self.allBodies[objID] = self.allBodies[objID]._replace(
+                        position=pos[idx].tolist(),
+                        rotation=rot[idx].tolist(),
+                        velocityLin=vLin[idx].tolist(),
+                        velocityRot=vRot[idx].tolist()
+                    )
+
+        # Log the number of used and saved sub-steps.
+        self.logSubsteps()
+
         # Synchronise the local object cache back to the database.
         self.syncObjects(collisions)
 
@@ -1021,6 +2102,7 @@ class LeonardDistributedZeroMQ(LeonardBase):
         # Read queued commands and update the local object cache accordingly.
         with util.Timeit('Leonard:1.1  processCmdQueue'):
             self.processCommandQueue()
+            self.processSchedules(dt)
 
         # Update the constraint cache in our local Igor instance.
         self.igor.updateLocalCache()
@@ -1037,11 +2119,19 @@ class LeonardDistributedZeroMQ(LeonardBase):
             if not ret.ok:
                 return
             collSets = ret.data
-            del ret, uniquePairs
+            del ret
+
+            # Isolated bodies bypass the Workers.
+            isolated, collSets = self.splitCollisionSets(collSets, uniquePairs)
+            del uniquePairs
 
         # Log the number of created collision sets.
         util.logMetricQty('#CollSets', len(collSets))
 
+        # Integrate all isolated bodies locally.
+        with util.Timeit('Leonard:1.2a FastPath'):
+            self.integrateIsolated(isolated, dt, maxsteps)
+
         # Put each collision set into its own Work Package.
         with util.Timeit('Leonard:1.3  CreateWPs'):
             all_WPs = {}
@@ -1074,6 +2164,7 @@ class LeonardDistributedZeroMQ(LeonardBase):
                     # returned it).
                     if wpid in all_WPs:
                         self.updateLocalCache(msg['wpdata'], msg['collisions'])
+                        self.countSubsteps(msg['substeps'], maxsteps)
 
                         # Decrement the Work Package index if the wpIdx counter
                         # is already past that work package. This simply
@@ -1102,6 +2193,9 @@ class LeonardDistributedZeroMQ(LeonardBase):
                 # Send the Work Package to the Worker.
                 self.sock.send(pickle.dumps(wp))
 
+        # Log the number of used and saved sub-steps.
+        self.logSubsteps()
+
         # Synchronise the local cache back to the database.
         with util.Timeit('Leonard:1.5  syncObjects'):
             self.syncObjects(self.collisions)
@@ -1124,7 +2218,7 @@ class LeonardDistributedZeroMQ(LeonardBase):
 
         :param iterable objIDs: list of object IDs in the new work package.
         :param float dt: time step for this work package.
-        :param int maxsteps: number of sub-steps for the time step.
+        :param int maxsteps: maximum number of sub-steps for the time step.
         :return: Work package ID
         :rtype: int
         """
@@ -1145,11 +2239,27 @@ class LeonardDistributedZeroMQ(LeonardBase):
         # Query all constraints.
         constraints = self.igor.getConstraints(objIDs).data
 
+        # Tell the Worker about the recently removed objects. Workers do not
+        # receive every Work Package, which is why this covers the last few
+        # steps and not just the current one.
+        removed = [_ for ids in self.removedLog for _ in ids]
+
+        # The quality profile and number of sub-steps for this collision
+        # set. Leonard does not know the grid forces, which is why the Worker
+        # may still fall back to `maxsteps` (see `getSubsteps`). The Worker
+        # therefore reports the sub-steps it actually used for the metrics.
+        quality = tuple(self.getQualityProfile(objIDs))
+        forced = any(np.any(_.force) or np.any(_.torque) for _ in wpdata)
+        substeps = self.getSubsteps(
+            objIDs, dt, maxsteps, constraints, bool(forced), count=False)
+
         # Form the content of the Work Package as it will appear in the DB.
         data = {'wpid': self.wpid_counter,
-                'wpmeta': (self.wpid_counter, dt, maxsteps),
+                'wpmeta': (self.wpid_counter, dt, maxsteps, substeps),
                 'wpdata': wpdata,
                 'wpconstraints': constraints,
+                'wpquality': quality,
+                'wpremoved': removed,
                 'ts': None}
         self.wpid_counter += 1
         return RetVal(True, None, data)
@@ -1163,20 +2273,19 @@ class LeonardDistributedZeroMQ(LeonardBase):
         The implicit assumption of this method is that ``wpdata`` is the
         output of ``computePhysicsForWorkPackage`` from a Worker.
 
-        This method will also publish all `collisions`, the format of which is
-        determined entirely by `PyBulletDynamicsWorld.getLastContacts`.
+        This method will also publish the `collisions` (see `syncObjects`).
 
         :param list[Wp_data_ret] wp_data_ret: data returned by Minion.
-        :param list collisions: collisions to publish.
+        :param ContactData collisions: collisions to publish.
         """
         # Reset force and torque for all objects in the WP, and overwrite
         # the old Body States with the new one from the processed WP.
         for wp in wp_data_ret:
             self.allBodies[wp.aid] = _RigidBodyData(*wp.body)
 
-        # Extend the list of collision contacts if any were provided.
-        if (collisions is not None) and len(collisions) > 0:
-            self.collisions.extend(collisions)
+        # Add the collision contacts if any were provided.
+        if collisions is not None:
+            self.collisions.append(collisions)
 
 
 class LeonardWorkerZeroMQ(config.AzraelProcess):
@@ -1185,8 +2294,10 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
 
     :param int workerID: the ID of this worker.
     :param int stepsUntilQuit: Worker will restart after this many steps.
+    :param int maxBodies: maximum number of bodies to keep in Bullet
+        (defaults to ``config.worker_max_bodies``).
     """
-    def __init__(self, workerID, stepsUntilQuit: int):
+    def __init__(self, workerID, stepsUntilQuit: int, maxBodies: int=None):
         super().__init__()
         self.workerID = workerID
 
@@ -1199,6 +2310,44 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         engine = azrael.bullet_api.PyBulletDynamicsWorld
         self.bullet = engine(self.workerID)
 
+        # The bodies in the Bullet engine in least recently used order. The
+        # worker evicts the oldest ones once there are more than `maxBodies`.
+        if maxBodies is None:
+            maxBodies = config.worker_max_bodies
+        assert maxBodies > 0
+        self.maxBodies = maxBodies
+        self.bodyLRU = collections.OrderedDict()
+
+    @typecheck
+    def updateBodyCache(self, objIDs: (tuple, list), removed: (tuple, list)):
+        """
+        Purge ``removed`` and least recently used bodies from Bullet.
+
+        Mark the ``objIDs`` of the current Work Package as the most recently
+        used ones; they are never evicted. Then evict the least recently used
+        bodies until at most ``maxBodies`` remain (not counting the current
+        ones if there are more than that).
+
+        :param list objIDs: the objects in the current Work Package.
+        :param list removed: objects that Leonard has removed.
+        """
+        lru = self.bodyLRU
+
+        # Remove all objects Leonard has deleted.
+        removed = [_ for _ in removed if _ in lru]
+        for objID in removed:
+            del lru[objID]
+
+        # Mark the objects in the current Work Package as recently used.
+        for objID in objIDs:
+            lru[objID] = None
+            lru.move_to_end(objID)
+
+        # Evict the least recently used bodies.
+        num = min(len(lru) - self.maxBodies, len(lru) - len(objIDs))
+        evicted = [lru.popitem(last=False)[0] for _ in range(max(num, 0))]
+        self.bullet.removeRigidBody(removed + evicted)
+
     def getGridForces(self, idPos: dict):
         """
         Return dictionary of force values for every object in ``idPos``.
@@ -1235,11 +2384,15 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         Leonard itself.
 
         :param dict wp: Work Package content from ``createWorkPackage``.
-        :return dict: {'wpdata': list_of_bodies, 'wpid': wpid}
+        :return dict: {'wpdata': list_of_bodies, 'wpid': wpid,
+                       'collisions': contacts, 'substeps': used_substeps}
         """
         worklist, meta = wp['wpdata'], WPMeta(*wp['wpmeta'])
         constraints = wp['wpconstraints']
 
+        # Purge deleted and stale bodies from Bullet.
+        self.updateBodyCache([_[0] for _ in worklist], wp['wpremoved'])
+
         # Log the number of collision-sets in the current Work Package.
         util.logMetricQty('Engine_{}'.format(self.workerID), len(worklist))
 
@@ -1247,8 +2400,7 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         worklist = [WPDataOut(*_) for _ in worklist]
 
         # Convenience.
-        applyForceAndTorque = self.bullet.applyForceAndTorque
-        setRB = self.bullet.setRigidBodyData
+        IDs = [_.aid for _ in worklist]
 
         # Add every object to the Bullet engine and set the force/torque.
         with util.Timeit('Worker:1.1.0  applyforce'):
@@ -1265,16 +2417,20 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
                 del ret, idPos
 
             with util.Timeit('Worker:1.1.1   updateGeo'):
-                for obj in worklist:
-                    # Load all objects into Bullet.
-                    setRB(obj.aid, obj.rbs)
+                # Load all objects into Bullet with a single call.
+                self.bullet.setRigidBodyDataBatch(
+                    IDs, [_.rbs for _ in worklist])
 
             with util.Timeit('Worker:1.1.1   updateForce'):
-                for obj in worklist:
-                    # Tally up and apply the combined grid + user specified
-                    # force for each object.
-                    force = obj.force + gridForces[obj.aid]
-                    applyForceAndTorque(obj.aid, force, obj.torque)
+                # Tally up and apply the combined grid + user specified
+                # force for all objects.
+                num = len(worklist)
+                force = np.zeros((num, 3), np.float64)
+                torque = np.zeros((num, 3), np.float64)
+                for idx, obj in enumerate(worklist):
+                    force[idx] = obj.force + gridForces[obj.aid]
+                    torque[idx] = obj.torque
+                self.bullet.applyForceAndTorqueBatch(IDs, force, torque)
 
         # Apply all constraints. Log any errors but ignore them otherwise as
         # they are harmless (simply means no constraints were applied).
@@ -1282,39 +2438,46 @@ class LeonardWorkerZeroMQ(config.AzraelProcess):
         if not ret.ok:
             self.logit.warning(ret.msg)
 
+        # Apply the quality profile of the collision set.
+        self.bullet.setQualityProfile(QualityProfile(*wp['wpquality']))
+
+        # Use the number of sub-steps Leonard chose for this set, unless a
+        # grid force (which Leonard does not know about) acts on any body.
+        if np.any(force != 0):
+            substeps = meta.maxsteps
+        else:
+            substeps = meta.substeps
+
         # Tell Bullet to advance the simulation for all objects in the
         # current work list.
         with util.Timeit('Worker:1.2.0  compute'):
-            IDs = [_.aid for _ in worklist]
-            self.bullet.compute(IDs, meta.dt, meta.maxsteps)
-
-            # Remove all constraints.
-            self.bullet.clearAllConstraints()
+            self.bullet.compute(IDs, meta.dt, substeps)
 
         # Retrieve all collision contacts generated during the last step.
-        collisions = self.bullet.getLastContacts().data
+        collisions = self.bullet.getContactData().data
 
         with util.Timeit('Worker:1.3.0  fetchFromBullet'):
             # Compile the new state variables into a list. This list will be
             # sent back to the caller later on.
-            out = []
-            for obj in worklist:
-                ret = self.bullet.getRigidBodyData(obj.aid)
-                if ret.ok is True:
-                    body = obj.rbs._replace(
-                        position=ret.data.position,
-                        rotation=ret.data.rotation,
-                        velocityLin=ret.data.vLin,
-                        velocityRot=ret.data.vRot
-                    )
-                else:
-                    # Something went wrong. Reuse the old body.
-                    body = obj.rbs
-                    self.logit.error('Unable to get all objects from Bullet')
-                out.append(WPDataRet(obj.aid, body))
+            ret = self.bullet.getRigidBodyDataBatch(IDs)
+            if ret.ok:
+                pos, rot, vLin, vRot = ret.data
+                out = [
+                    WPDataRet(obj.aid, obj.rbs._replace(
+                        position=pos[idx].tolist(),
+                        rotation=rot[idx].tolist(),
+                        velocityLin=vLin[idx].tolist(),
+                        velocityRot=vRot[idx].tolist()))
+                    for idx, obj in enumerate(worklist)
+                ]
+            else:
+                # Something went wrong. Reuse the old bodies.
+                self.logit.error('Unable to get all objects from Bullet')
+                out = [WPDataRet(_.aid, _.rbs) for _ in worklist]
 
         # Return the updated WP data.
-        return {'wpid': meta.wpid, 'wpdata': out, 'collisions': collisions}
+        return {'wpid': meta.wpid, 'wpdata': out, 'collisions': collisions,
+                'substeps': substeps}
 
     def sighandler(self, signum, frame):
         """
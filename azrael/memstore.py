@@ -0,0 +1,655 @@
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory datastore that all Azrael processes on the same host share.
+
+`DatastoreServer` is a process that keeps all data stores in memory (one
+`DatastoreInMemory` instance per data store) and serves them over a Unix
+domain socket. `DatastoreShared` is the client side and implements the full
+`DatastoreBase` API. To use it instead of Mongo set
+`config.datastore_backend` to 'shared'.
+
+The server processes all requests in a single thread and every request is
+therefore atomic. Clients may pipeline their requests (see
+`DatastoreShared.pipeline`), ie. send several of them before they read the
+replies.
+
+Every message is a pickled Python object prefixed with its length (4 Bytes,
+big endian). The socket file is only accessible to its owner.
+
+If the server has a journal then it appends every write request to it before
+it processes the request, and replays the journal when it starts. At start up,
+and whenever it has grown by a certain number of requests, it compacts the
+journal to contain only the current content.
+"""
+import os
+import pickle
+import signal
+import socket
+import struct
+import selectors
+import threading
+import azrael.config as config
+import azrael.datastore as datastore
+
+from IPython import embed as ipshell
+from azrael.aztypes import typecheck, RetVal
+
+# The length prefix of every message.
+_HEADER = struct.Struct('>I')
+
+# The API methods clients may call, and those among them that modify data.
+_READ_METHODS = {'count', 'allKeys', 'getOne', 'getMulti', 'getAll',
+                 'query', 'getCounter'}
+_WRITE_METHODS = {'reset', 'put', 'replace', 'modify', 'remove', 'setCounter',
+                  'incrementCounter', 'removeCounter', 'createIndex'}
+
+
+def _encode(obj):
+    """
+    Return ``obj`` as a length prefixed message.
+    """
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(payload)) + payload
+
+
+def _decode(buf: bytearray):
+    """
+    Remove all complete messages from ``buf`` and return them in a list.
+    """
+    out, ofs = [], 0
+    while len(buf) - ofs >= _HEADER.size:
+        size, = _HEADER.unpack_from(buf, ofs)
+        if len(buf) - ofs - _HEADER.size < size:
+            break
+        ofs += _HEADER.size
+        out.append(pickle.loads(buf[ofs:ofs + size]))
+        ofs += size
+    del buf[:ofs]
+    return out
+
+
+def _recvMessage(sock):
+    """
+    Block until a complete message arrives on ``sock`` and return it.
+
+    Raise `ConnectionError` if the peer closed the connection.
+    """
+    buf = bytearray()
+    while len(buf) < _HEADER.size:
+        data = sock.recv(_HEADER.size - len(buf))
+        if len(data) == 0:
+            raise ConnectionError('Datastore server closed the connection')
+        buf += data
+    size, = _HEADER.unpack(buf)
+    buf = bytearray()
+    while len(buf) < size:
+        data = sock.recv(min(size - len(buf), 1 << 20))
+        if len(data) == 0:
+            raise ConnectionError('Datastore server closed the connection')
+        buf += data
+    return pickle.loads(buf)
+
+
+class _Connection:
+    """
+    Buffers and (optional) change feed of a single client connection.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.feed = None
+        self.closed = False
+
+
+class DatastoreServer(config.AzraelProcess):
+    """
+    Serve all data stores from memory via a Unix domain socket.
+
+    :param str address: path of the Unix domain socket.
+    :param str journal: path of the journal file (None disables it).
+    :param bool sync: call `fsync` on the journal before replying.
+    :param int compact: compact the journal after this many write requests
+        (zero disables it).
+    """
+    def __init__(self, address: str=None, journal: str=None,
+                 sync: bool=None, compact: int=None):
+        super().__init__()
+        self.address = config.datastore_socket if address is None else address
+        self.journal = config.datastore_journal if journal is None else journal
+        self.sync = config.datastore_journal_sync if sync is None else sync
+        if compact is None:
+            compact = config.datastore_journal_compact
+        self.compact = compact
+
+        self.stores = {}
+        self.fjournal = None
+        self.selector = None
+        self.running = False
+
+        # Whether the journal contains unflushed requests, and the number of
+        # requests since the last compaction.
+        self.dirty = False
+        self.numJournal = 0
+
+    def sighandler(self, signum, frame):
+        """
+        Stop the server loop.
+        """
+        self.logit.info('Intercepted signal {} - shutting down'.format(signum))
+        self.running = False
+
+    def getStore(self, name: tuple):
+        """
+        Return the `DatastoreInMemory` instance for ``name``.
+
+        Create it if it does not exist yet.
+        """
+        name = tuple(name)
+        if name not in self.stores:
+            self.stores[name] = datastore.DatastoreInMemory(name)
+        return self.stores[name]
+
+    def execute(self, request):
+        """
+        Execute the client ``request`` and return the result as a `RetVal`.
+
+        A request is a (name, method, args) tuple where `name` specifies the
+        data store, and `method` and `args` the API call.
+        """
+        try:
+            name, method, args = request
+            assert method in _READ_METHODS or method in _WRITE_METHODS
+            store = self.getStore(name)
+        except (TypeError, ValueError, AssertionError):
+            return RetVal(False, 'Invalid request', None)
+
+        # Log the request in the journal before executing it.
+        if method in _WRITE_METHODS and self.fjournal is not None:
+            self.fjournal.write(_encode(request))
+            self.dirty = True
+            self.numJournal += 1
+        try:
+            return RetVal(*getattr(store, method)(*args))
+        except (TypeError, AttributeError) as err:
+            return RetVal(False, 'Invalid request: {}'.format(err), None)
+
+    def replayJournal(self):
+        """
+        Replay the journal, then compact it.
+
+        A truncated message at the end of the journal (eg. because the server
+        crashed while writing it) is ignored.
+        """
+        if self.journal is None:
+            return
+
+        # Replay all requests in the journal.
+        if os.path.exists(self.journal):
+            with open(self.journal, 'rb') as fin:
+                buf = bytearray(fin.read())
+            requests = _decode(buf)
+            for request in requests:
+                self.execute(request)
+            msg = 'Replayed {} requests from <{}>'
+            self.logit.info(msg.format(len(requests), self.journal))
+        self.compactJournal()
+
+    def compactJournal(self):
+        """
+        Replace the journal with one that only contains the requests
+        necessary to restore the current content.
+        """
+        # Write the content of all stores into a new journal and replace the
+        # old one with it.
+        tmpname = '{}.{}.tmp'.format(self.journal, os.getpid())
+        with open(tmpname, 'wb') as fout:
+            for name, store in self.stores.items():
+                fout.write(_encode((name, 'reset', ())))
+                for key in store.indexes:
+                    fout.write(_encode((name, 'createIndex', (key, ))))
+                docs = {aid: {'data': doc}
+                        for aid, doc in store.content.items()}
+                fout.write(_encode((name, 'put', (docs, ))))
+                for counter, value in store.counters.items():
+                    fout.write(_encode((name, 'setCounter', (counter, value))))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmpname, self.journal)
+
+        # Append all further requests to the new journal.
+        if self.fjournal is not None:
+            self.fjournal.close()
+            self.fjournal = open(self.journal, 'ab')
+        self.numJournal = 0
+
+    def setup(self):
+        """
+        Replay the journal and open the socket.
+        """
+        self.replayJournal()
+        if self.journal is not None:
+            self.fjournal = open(self.journal, 'ab')
+
+        # Remove the socket file of a previous server.
+        try:
+            os.unlink(self.address)
+        except FileNotFoundError:
+            pass
+
+        # Create the socket and only allow the owner to connect.
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.address)
+        finally:
+            os.umask(umask)
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.logit.info('Listening on <{}>'.format(self.address))
+
+    def shutdown(self):
+        """
+        Close all connections, the socket, and the journal.
+        """
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.closeConnection(key.data)
+        self.selector.close()
+        self.sock.close()
+        try:
+            os.unlink(self.address)
+        except FileNotFoundError:
+            pass
+        if self.fjournal is not None:
+            self.fjournal.close()
+            self.fjournal = None
+
+    def run(self):
+        """
+        Serve client requests until the process receives SIGTERM.
+        """
+        # Call `run` method of `AzraelProcess` base class.
+        super().run()
+
+        # Install the signal handler to facilitate a clean shutdown.
+        signal.signal(signal.SIGTERM, self.sighandler)
+        signal.signal(signal.SIGINT, self.sighandler)
+
+        self.setup()
+        self.running = True
+        while self.running:
+            self.processEvents(timeout=0.5)
+        self.shutdown()
+
+    def processEvents(self, timeout: float):
+        """
+        Wait at most ``timeout`` seconds for socket activity and process it.
+        """
+        try:
+            events = self.selector.select(timeout)
+        except InterruptedError:
+            return
+
+        for key, mask in events:
+            conn = key.data
+            if conn is None:
+                # New client connection.
+                self.acceptConnection()
+                continue
+
+            # Only read the requests here. The replies are sent below, once
+            # the journal is on disk.
+            if mask & selectors.EVENT_READ:
+                self.readConnection(conn)
+
+        # Persist the journal before the clients learn about their writes.
+        if self.dirty:
+            self.fjournal.flush()
+            if self.sync:
+                os.fsync(self.fjournal.fileno())
+            self.dirty = False
+
+        # Compact the journal once it has grown too much.
+        if (self.compact > 0) and (self.numJournal >= self.compact):
+            self.compactJournal()
+
+        # Relay the new events to all subscribers and send all replies.
+        for key in list(self.selector.get_map().values()):
+            conn = key.data
+            if conn is None:
+                continue
+            if conn.feed is not None:
+                changes = conn.feed.poll()
+                if len(changes) > 0:
+                    conn.outbuf += _encode([tuple(_) for _ in changes])
+            if len(conn.outbuf) > 0:
+                self.flushConnection(conn)
+
+    def acceptConnection(self):
+        try:
+            sock, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        conn = _Connection(sock)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def closeConnection(self, conn):
+        if conn.feed is not None:
+            conn.feed.close()
+        conn.closed = True
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+    def readConnection(self, conn):
+        """
+        Read and execute all requests from ``conn``.
+
+        Queue the replies in the output buffer of ``conn`` but do not send
+        them yet.
+        """
+        try:
+            data = conn.sock.recv(1 << 20)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            data = b''
+        if len(data) == 0:
+            self.closeConnection(conn)
+            return
+
+        conn.inbuf += data
+        for request in _decode(conn.inbuf):
+            # A subscription turns the connection into a change feed.
+            if isinstance(request, tuple) and request[1:2] == ('subscribe', ):
+                conn.feed = self.getStore(request[0]).subscribe().data
+                conn.outbuf += _encode(tuple(RetVal(True, None, None)))
+                continue
+            conn.outbuf += _encode(tuple(self.execute(request)))
+
+    def flushConnection(self, conn):
+        """
+        Send as much of the output buffer of ``conn`` as possible.
+
+        Wait for the socket to become writable if the buffer does not fit.
+        """
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except ConnectionError:
+            self.closeConnection(conn)
+            return
+        del conn.outbuf[:sent]
+
+        mask = selectors.EVENT_READ
+        if len(conn.outbuf) > 0:
+            mask |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn.sock).events != mask:
+            self.selector.modify(conn.sock, mask, conn)
+
+
+class ChangeFeedShared(datastore.ChangeFeed):
+    """
+    Change feed of a data store in the `DatastoreServer`.
+
+    The feed uses a dedicated connection to the server, and a background
+    thread pushes the events from that connection into the queue.
+
+    :param str address: path of the Unix domain socket.
+    :param tuple name: name of the data store.
+    """
+    def __init__(self, address: str, name: tuple):
+        super().__init__()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.sock.sendall(_encode((tuple(name), 'subscribe', ())))
+        if not RetVal(*_recvMessage(self.sock)).ok:
+            self.sock.close()
+            raise ConnectionError('Datastore server rejected subscription')
+
+        self.thread = threading.Thread(target=self._tail, daemon=True)
+        self.thread.start()
+
+    def _tail(self):
+        while not self.closed:
+            try:
+                changes = _recvMessage(self.sock)
+            except (ConnectionError, OSError):
+                break
+            self.push([datastore.ChangeEvent(*_) for _ in changes])
+        self.sock.close()
+
+    def close(self):
+        """
+        See docu in ``ChangeFeed``.
+        """
+        super().close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class DatastoreShared(datastore.DatastoreBase):
+    """
+    Client for a data store in the `DatastoreServer`.
+
+    Raises IOError if it cannot connect to the server.
+
+    :param tuple[str, str] name: (db_name, collection_name)
+    :param str address: path of the Unix domain socket.
+    :param list indexes: key hierarchies to index (see `createIndex`).
+    """
+    @typecheck
+    def __init__(self, name: tuple, address: str=None,
+                 indexes: (tuple, list)=()):
+        super().__init__(name)
+        self.address = config.datastore_socket if address is None else address
+        self.lock = threading.Lock()
+        self.sock = self.pid = None
+        self.connect()
+
+        # Create the secondary indexes in the server.
+        for key in indexes:
+            if not self.createIndex(key).ok:
+                raise IOError('Could not create index <{}>'.format(key))
+
+    def connect(self):
+        """
+        Connect to the server.
+
+        Raises IOError if the connection failed.
+        """
+        if self.sock is not None:
+            self.sock.close()
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.address)
+        except OSError:
+            self.sock = None
+            raise IOError('Could not connect to datastore server')
+        self.pid = os.getpid()
+
+    def pipeline(self, calls: (tuple, list)):
+        """
+        Send all ``calls`` at once and return their results.
+
+        Each call is a (method, args) tuple, for instance ('getOne', ('1',
+        None)). The server processes the calls in order, but other clients
+        may interleave their own requests.
+
+        :param list calls: list of (method, args) tuples.
+        :return: list of `RetVal` tuples.
+        """
+        msg = b''.join([_encode((self.dbname, m, tuple(a))) for m, a in calls])
+        with self.lock:
+            try:
+                # Do not share the socket with a parent process, and reconnect
+                # if the previous call lost the connection.
+                if self.sock is None or self.pid != os.getpid():
+                    self.connect()
+
+                # Send all requests, then wait for their replies.
+                self.sock.sendall(msg)
+                return [RetVal(*_recvMessage(self.sock)) for _ in calls]
+            except (IOError, ConnectionError, OSError):
+                # Do not resend the requests since the server may already
+                # have processed some of them.
+                if self.sock is not None:
+                    self.sock.close()
+                self.sock = None
+        msg = 'Lost connection to datastore server'
+        self.logit.error(msg)
+        return [RetVal(False, msg, None)] * len(calls)
+
+    def _call(self, method: str, *args):
+        return self.pipeline([(method, args)])[0]
+
+    # -------------------------------------------------------------------------
+    #                             API methods.
+    # -------------------------------------------------------------------------
+    def reset(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('reset')
+
+    def count(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('count')
+
+    def allKeys(self):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('allKeys')
+
+    @typecheck
+    def getOne(self, aid: str, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('getOne', aid, prj)
+
+    @typecheck
+    def getMulti(self, aids: (list, tuple), prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('getMulti', aids, prj)
+
+    @typecheck
+    def getAll(self, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('getAll', prj)
+
+    @typecheck
+    def query(self, filter: dict, prj=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('query', filter, prj)
+
+    @typecheck
+    def createIndex(self, key_hierarchy: (tuple, list)):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        ret = self._call('createIndex', key_hierarchy)
+        if ret.ok and tuple(key_hierarchy) not in self.indexes:
+            self.indexes.append(tuple(key_hierarchy))
+        return ret
+
+    @typecheck
+    def put(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('put', ops)
+
+    @typecheck
+    def replace(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('replace', ops)
+
+    @typecheck
+    def modify(self, ops: dict):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('modify', ops)
+
+    @typecheck
+    def remove(self, aids: (tuple, list), match=None):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('remove', aids, match)
+
+    @typecheck
+    def setCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('setCounter', counter_name, value)
+
+    @typecheck
+    def getCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('getCounter', counter_name)
+
+    @typecheck
+    def incrementCounter(self, counter_name: str, value: int):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('incrementCounter', counter_name, value)
+
+    @typecheck
+    def removeCounter(self, counter_name: str):
+        """
+        See docu in ``DatastoreBase``.
+        """
+        return self._call('removeCounter', counter_name)
+
+    def subscribe(self):
+        """
+        See docu in ``DatastoreBase``.
+
+        The events arrive asynchronously (see ``ChangeFeedShared``).
+        """
+        try:
+            feed = ChangeFeedShared(self.address, self.dbname)
+        except OSError:
+            msg = 'Could not subscribe to datastore server'
+            return RetVal(False, msg, None)
+        return RetVal(True, None, feed)
@@ -303,6 +303,54 @@ def FromClerk_SetForce_Encode(dummyarg):
     return None
 
 
+# ---------------------------------------------------------------------------
+# SetSchedule
+# ---------------------------------------------------------------------------
+
+@typecheck
+def ToClerk_SetSchedule_Decode(payload: dict):
+    # Compile- and sanity check the scheduled commands.
+    C = aztypes.CmdSchedule
+    payload['schedule'] = [C(**_) for _ in payload['schedule']]
+    return payload
+
+
+@typecheck
+def FromClerk_SetSchedule_Encode(dummyarg):
+    return None
+
+
+# ---------------------------------------------------------------------------
+# GetScheduleStatus
+# ---------------------------------------------------------------------------
+
+@typecheck
+def ToClerk_GetScheduleStatus_Decode(payload: dict):
+    return payload
+
+
+@typecheck
+def FromClerk_GetScheduleStatus_Encode(payload):
+    return payload
+
+
+# ---------------------------------------------------------------------------
+# SetForceProfiles
+# ---------------------------------------------------------------------------
+
+@typecheck
+def ToClerk_SetForceProfiles_Decode(payload: dict):
+    # Compile- and sanity check the profiles.
+    P = aztypes.ForceProfile
+    payload['profiles'] = [P(**_) for _ in payload['profiles']]
+    return payload
+
+
+@typecheck
+def FromClerk_SetForceProfiles_Encode(dummyarg):
+    return None
+
+
 # ---------------------------------------------------------------------------
 # AddConstraints
 # ---------------------------------------------------------------------------
@@ -29,6 +29,7 @@ import azrael.clerk
 import azrael.config
 import azrael.dibbler
 import azrael.leonard
+import azrael.memstore
 import azrael.datastore
 import azrael.vectorgrid
 
@@ -95,20 +96,31 @@ class AzraelStack:
     """
     Convenience class to start and stop the necessary Azrael processes.
     """
-    def __init__(self, loglevel=1):
+    def __init__(self, loglevel=1, resume: bool=None):
         """
         Wait for support services and setup logging.
-        """
-        waitForDatabases(timeout=60)
-        waitForEventStore(timeout=60)
 
+        If ``resume`` is True then Leonard resumes the simulation from its
+        latest snapshot file and the datastores keep their content (see
+        ``config.snapshot_resume``, which is also the default).
+        """
         # List of processes started via this class.
         self.procs = []
+        if resume is None:
+            resume = azrael.config.snapshot_resume
+        self.resume = resume
 
         # Kill any pending processes.
         subprocess.run(['pkill', 'Azrael:'], check=False)
         time.sleep(0.2)
-        azrael.datastore.init(flush=True)
+
+        # Start the shared in-memory datastore, if so configured.
+        if azrael.config.datastore_backend == 'shared':
+            self.startProcess(azrael.memstore.DatastoreServer())
+
+        waitForDatabases(timeout=60)
+        waitForEventStore(timeout=60)
+        azrael.datastore.init(flush=not self.resume)
 
         # Reset the profiling database and enable logging.
         host, port = azrael.config.azService['database']
@@ -136,16 +148,17 @@ class AzraelStack:
         clerk = azrael.clerk.Clerk()
         web = azrael.web.WebServer()
 
-        # Flush the model database.
+        # Flush the model database, unless we resume the simulation.
         dibbler = azrael.dibbler.Dibbler()
-        dibbler.reset()
+        if not self.resume:
+            dibbler.reset()
 
         # Start the physics engine.
         # leo = azrael.leonard.LeonardBase()
         # leo = azrael.leonard.LeonardBullet()
         # leo = azrael.leonard.LeonardSweeping()
 
-        leo = azrael.leonard.LeonardDistributedZeroMQ()
+        leo = azrael.leonard.LeonardDistributedZeroMQ(resume=self.resume)
         wm = azrael.leonard.WorkerManager(
             numWorkers=3,
             minSteps=500,
@@ -17,11 +17,14 @@
 
 import pytest
 import azutils
+import azrael.config
 import azrael.bullet_api
 
 import numpy as np
+import unittest.mock as mock
 
 from IPython import embed as ipshell
+from azrael.aztypes import ContactData, QualityProfile, RetVal
 from azrael.test.test import getP2P, get6DofSpring2, getRigidBody
 from azrael.test.test import getCSEmpty, getCSBox, getCSSphere, getCSPlane
 
@@ -771,6 +774,123 @@ class TestBulletAPI:
         obj_new = getRigidBody(cshapes=csdefault, inertia=[1, 2, 3])
         assert sim.needNewCollisionShape(id_a, obj_new) is False
 
+    def test_shape_library(self):
+        """
+        Bodies with identical collision shapes must share the same compound
+        shape. The library must evict the shape once no body uses it anymore.
+        """
+        p, q = (0, 0, 0), (0, 0, 0, 1)
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+
+        def stats():
+            ret = sim.getShapeLibraryStats()
+            assert ret.ok
+            return ret.data
+
+        # Three bodies with the same shapes (but different shape names and
+        # body positions) must share a single compound shape.
+        id_a, id_b, id_c = '1', '2', '3'
+        obj_a = getRigidBody(position=[-5, 0, 0],
+                             cshapes={'foo': getCSSphere(p, q, radius=1)})
+        obj_b = getRigidBody(position=[0, 0, 0],
+                             cshapes={'bar': getCSSphere(p, q, radius=1)})
+        obj_c = getRigidBody(position=[5, 0, 0],
+                             cshapes={'foo': getCSSphere(p, q, radius=1)})
+        assert sim.setRigidBodyData(id_a, obj_a).ok
+        assert sim.setRigidBodyData(id_b, obj_b).ok
+        assert sim.setRigidBodyData(id_c, obj_c).ok
+        assert sim.shapeKey(obj_a) == sim.shapeKey(obj_b)
+        cs_a = sim.rigidBodies[id_a].getCollisionShape()
+        assert cs_a is sim.rigidBodies[id_b].getCollisionShape()
+        assert cs_a is sim.rigidBodies[id_c].getCollisionShape()
+        assert stats() == {'hits': 2, 'misses': 1, 'evictions': 0,
+                           'shapes': 1, 'children': 1, 'references': 3}
+
+        # Scale the last body: it must get its own shape.
+        obj_c = obj_c._replace(scale=2)
+        assert sim.setRigidBodyData(id_c, obj_c).ok
+        cs_c = sim.rigidBodies[id_c].getCollisionShape()
+        assert cs_c is not cs_a
+        assert cs_c.getChildShape(0).getRadius() == 2
+        tmp = stats()
+        assert (tmp['shapes'], tmp['references']) == (2, 3)
+
+        # Renaming a shape triggers 'needNewCollisionShape' but the library
+        # must still return the same compound.
+        obj_a = obj_a._replace(cshapes={'xyz': getCSSphere(p, q, radius=1)})
+        assert sim.setRigidBodyData(id_a, obj_a).ok
+        assert sim.rigidBodies[id_a].getCollisionShape() is cs_a
+        tmp = stats()
+        assert (tmp['shapes'], tmp['references']) == (2, 3)
+
+        # Step the simulation to ensure Bullet can cope with shared shapes.
+        sim.compute([id_a, id_b, id_c], 1.0, 60)
+
+        # Remove the bodies. The library must evict the shapes once their
+        # last body is gone.
+        assert sim.removeRigidBody([id_c]).data == 1
+        tmp = stats()
+        assert (tmp['shapes'], tmp['evictions']) == (1, 1)
+        assert sim.removeRigidBody([id_a, id_b]).data == 2
+        tmp = stats()
+        tmp = (tmp['shapes'], tmp['references'], tmp['evictions'])
+        assert tmp == (0, 0, 2)
+
+    def test_batch(self):
+        """
+        The batch functions must produce the same results as their single
+        body counterparts.
+        """
+        # Several bodies with different centre of mass, principal axes,
+        # factors, and one static body. They are far apart and do not
+        # collide.
+        bodies = [
+            getRigidBody(position=[0, 0, 0], velocityLin=[1, 2, 3]),
+            getRigidBody(position=[10, 0, 0], rotation=[0, 1, 0, 1],
+                         com=[0.5, 0, -0.3], paxis=[0.1, 0.4, 0.2, 0.8],
+                         inertia=[1, 2, 3], imass=0.5, velocityRot=[0, 1, 2],
+                         linFactor=[1, 0.5, 1], rotFactor=[1, 1, 0.3]),
+            getRigidBody(position=[0, 10, 0], imass=0),
+        ]
+        objIDs = ['1', '2', '3']
+        force = np.array([[1, 2, 3], [0, 1, 0], [1, 1, 1]], np.float64)
+        torque = np.array([[0, 0, 1], [1, 0, 0], [1, 1, 1]], np.float64)
+
+        # Simulate all bodies with the single-body methods...
+        sim_1 = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        for idx, (objID, body) in enumerate(zip(objIDs, bodies)):
+            assert sim_1.setRigidBodyData(objID, body).ok
+            assert sim_1.applyForceAndTorque(
+                objID, force[idx], torque[idx]).ok
+        sim_1.compute(objIDs, 0.5, 30)
+
+        # ... and the batch methods.
+        sim_2 = azrael.bullet_api.PyBulletDynamicsWorld(2)
+        assert sim_2.setRigidBodyDataBatch(objIDs, bodies).ok
+        assert sim_2.applyForceAndTorqueBatch(objIDs, force, torque).ok
+        sim_2.compute(objIDs, 0.5, 30)
+
+        # Compare the results.
+        ret = sim_2.getRigidBodyDataBatch(objIDs)
+        assert ret.ok
+        pos, rot, vLin, vRot = ret.data
+        for idx, objID in enumerate(objIDs):
+            ref = sim_1.getRigidBodyData(objID).data
+            assert np.allclose(ref.position, pos[idx])
+            assert np.allclose(ref.rotation, rot[idx])
+            assert np.allclose(ref.vLin, vLin[idx])
+            assert np.allclose(ref.vRot, vRot[idx])
+
+        # The static body must not have moved.
+        assert np.allclose(pos[2], [0, 10, 0])
+
+        # Invalid arguments.
+        assert not sim_2.getRigidBodyDataBatch(['1', '10']).ok
+        applyBatch = sim_2.applyForceAndTorqueBatch
+        assert not applyBatch(['10'], [[0] * 3], [[0] * 3]).ok
+        assert not applyBatch(['1'], [[0] * 2], [[0] * 3]).ok
+        assert not sim_2.setRigidBodyDataBatch(objIDs, bodies[:2]).ok
+
     def test_specify_P2P_constraint(self):
         """
         Use a P2P constraint to test the various methods to add- and remove
@@ -846,6 +966,70 @@ class TestBulletAPI:
         assert not np.allclose(ret_a.data.position, pos_a)
         assert np.allclose(ret_b.data.position, pos_b)
 
+    def test_constraint_cache(self):
+        """
+        The Bullet constraints must persist across calls to `setConstraints`
+        and only be rebuilt when necessary.
+        """
+        # Instantiate Bullet engine and load three spheres.
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        for objID in ('1', '2', '3'):
+            body = getRigidBody(cshapes={'cssphere': getCSSphere()})
+            assert sim.setRigidBodyData(objID, body).ok
+        world = sim.dynamicsWorld
+
+        # Link the bodies with a P2P and a 6DOF constraint.
+        p2p = getP2P(aid='c1', rb_a='1', rb_b='2')
+        dof = get6DofSpring2(aid='c2', rb_a='2', rb_b='3')
+        assert sim.setConstraints([p2p, dof]).ok
+        assert world.getNumConstraints() == 2
+        assert sim.activeConstraints == {'c1', 'c2'}
+        con_p2p = sim.constraintCache['c1'][1]
+        con_dof = sim.constraintCache['c2'][1]
+
+        # Apply the same constraints again: Bullet must re-use them.
+        assert sim.setConstraints([p2p, dof]).ok
+        assert world.getNumConstraints() == 2
+        assert sim.constraintCache['c1'][1] is con_p2p
+        assert sim.constraintCache['c2'][1] is con_dof
+
+        # Modify the pivot of the P2P constraint: it must be updated in place.
+        p2p = getP2P(aid='c1', rb_a='1', rb_b='2', pivot_a=(1, 2, 3))
+        assert sim.setConstraints([p2p, dof]).ok
+        assert sim.constraintCache['c1'][1] is con_p2p
+        assert np.allclose(con_p2p.getPivotInA().topy(), [1, 2, 3])
+        assert world.getNumConstraints() == 2
+
+        # Drop the P2P constraint. It must leave the world but not the cache.
+        assert sim.setConstraints([dof]).ok
+        assert world.getNumConstraints() == 1
+        assert sim.activeConstraints == {'c2'}
+        assert set(sim.constraintCache.keys()) == {'c1', 'c2'}
+
+        # Re-add it and move the 6DOF constraint to other bodies. This must
+        # create a new constraint.
+        dof = get6DofSpring2(aid='c2', rb_a='1', rb_b='3')
+        assert sim.setConstraints([p2p, dof]).ok
+        assert world.getNumConstraints() == 2
+        assert sim.constraintCache['c1'][1] is con_p2p
+        assert sim.constraintCache['c2'][1] is not con_dof
+
+        # Clearing the constraints removes them from the world only.
+        assert sim.clearAllConstraints().ok
+        assert world.getNumConstraints() == 0
+        assert sim.activeConstraints == set()
+        assert len(sim.constraintCache) == 2
+
+        # Removing a body must remove its constraints from the cache.
+        assert sim.setConstraints([p2p, dof]).ok
+        assert sim.removeRigidBody(['2']).ok
+        assert set(sim.constraintCache.keys()) == {'c2'}
+        assert world.getNumConstraints() == 1
+
+        # Invalid constraints must remove all constraints from the world.
+        assert not sim.setConstraints([p2p, dof]).ok
+        assert world.getNumConstraints() == 0
+
     def test_specify_6DofSpring2_constraint(self):
         """
         Create two objects and linke them with a 6DOF constraint. The
@@ -1118,3 +1302,341 @@ class TestBulletAPI:
         # terms of physics, but the contacts data must still be erased.
         assert sim.compute([], 1, num_sub_steps).ok
         assert sim.getLastContacts() == (True, None, [])
+
+    def test_get_contact_data(self):
+        """
+        Query the collision contacts as NumPy arrays, with and without
+        reduction.
+        """
+        # Two pairs of overlapping spheres, far apart from each other.
+        bodies = {
+            '1': getRigidBody(position=[0, 0, 0]),
+            '2': getRigidBody(position=[0, 1, 0]),
+            '3': getRigidBody(position=[10, 0, 0]),
+            '4': getRigidBody(position=[10, 0, 1.5]),
+        }
+
+        def getContacts(**kwargs):
+            sim = azrael.bullet_api.PyBulletDynamicsWorld(1, **kwargs)
+            for objID, body in bodies.items():
+                assert sim.setRigidBodyData(objID, body).ok
+            assert sim.compute(list(bodies.keys()), 1.0, 60).ok
+            ret = sim.getContactData()
+            assert ret.ok
+            return ret.data
+
+        # Without reduction there are many contacts per pair (one per sub-step
+        # at least).
+        c = getContacts(contactsMaxPoints=0, contactsAggregate=False)
+        num = len(c.impulse)
+        assert num > 2
+        assert c.point_a.shape == c.point_b.shape == c.normal.shape == (num, 3)
+        assert np.all(c.aid_a <= c.aid_b)
+        assert set(zip(c.aid_a.tolist(), c.aid_b.tolist())) == {(1, 2), (3, 4)}
+        assert np.all(c.impulse >= 0) and np.any(c.impulse > 0)
+
+        # The normals point from the second to the first body.
+        assert np.allclose(np.linalg.norm(c.normal, axis=1), 1)
+        pair = (c.aid_a == 1)
+        assert np.all(c.normal[pair, 1] < 0)
+        assert np.all(c.normal[~pair, 2] < 0)
+
+        # At most one contact per pair: the one with the largest impulse.
+        c1 = getContacts(contactsMaxPoints=1, contactsAggregate=False)
+        assert c1.aid_a.tolist() == [1, 3]
+        assert c1.aid_b.tolist() == [2, 4]
+        assert c1.impulse[0] == c.impulse[pair].max()
+        assert c1.impulse[1] == c.impulse[~pair].max()
+
+        # Aggregate all contacts of a pair.
+        c2 = getContacts(contactsAggregate=True)
+        assert c2.aid_a.tolist() == [1, 3]
+        assert np.allclose(c2.impulse, [c.impulse[pair].sum(),
+                                        c.impulse[~pair].sum()])
+        assert np.allclose(np.linalg.norm(c2.normal, axis=1), 1)
+
+    def test_reduce_contacts(self):
+        """
+        Reduce artificial contacts.
+        """
+        reduceContacts = azrael.bullet_api.reduceContacts
+
+        # Three contacts for pair (1, 2), one for pair (0, 5).
+        contacts = ContactData(
+            aid_a=np.array([1, 0, 1, 1]),
+            aid_b=np.array([2, 5, 2, 2]),
+            point_a=np.array(
+                [[1, 0, 0], [2, 0, 0], [3, 0, 0], [4, 0, 0]], float),
+            point_b=np.array(
+                [[0, 1, 0], [0, 2, 0], [0, 3, 0], [0, 4, 0]], float),
+            normal=np.array(
+                [[1, 0, 0], [0, 1, 0], [0, 1, 0], [1, 0, 0]], float),
+            impulse=np.array([1, 0, 3, 0], float),
+        )
+
+        # No reduction.
+        assert reduceContacts(contacts, 0, False) is contacts
+
+        # Keep the two strongest contacts of each pair, sorted by pair.
+        ret = reduceContacts(contacts, 2, False)
+        assert ret.aid_a.tolist() == [0, 1, 1]
+        assert ret.aid_b.tolist() == [5, 2, 2]
+        assert ret.impulse.tolist() == [0, 3, 1]
+        assert ret.point_a[:, 0].tolist() == [2, 3, 1]
+
+        # Aggregate: impulse weighted average for pair (1, 2) and the plain
+        # average for the pair without impulse.
+        ret = reduceContacts(contacts, 0, True)
+        assert ret.aid_a.tolist() == [0, 1]
+        assert ret.aid_b.tolist() == [5, 2]
+        assert ret.impulse.tolist() == [0, 4]
+        assert np.allclose(ret.point_a, [[2, 0, 0], [2.5, 0, 0]])
+        assert np.allclose(ret.point_b, [[0, 2, 0], [0, 2.5, 0]])
+        ref = np.array([0.25, 0.75, 0]) / np.linalg.norm([0.25, 0.75, 0])
+        assert np.allclose(ret.normal, [[0, 1, 0], ref])
+
+        # Empty contacts.
+        empty = ContactData(*[_[:0] for _ in contacts])
+        assert len(reduceContacts(empty, 1, True).impulse) == 0
+
+    def test_encode_contacts(self):
+        """
+        Encode the contacts of several engines for publishing.
+        """
+        encodeContacts = azrael.bullet_api.encodeContacts
+
+        def contacts(aid_a, aid_b, x):
+            num = len(aid_a)
+            point = np.zeros((num, 3), float)
+            point[:, 0] = x
+            return ContactData(np.array(aid_a), np.array(aid_b),
+                               point, -point, np.zeros((num, 3)),
+                               np.zeros(num))
+
+        # The contacts of all engines must be grouped by body pair.
+        c1 = contacts([3, 1], [4, 2], [1, 2])
+        c2 = contacts([1], [2], [3])
+        assert encodeContacts([c1, c2]) == [
+            ('1', '2', [(2, 0, 0), (-2, 0, 0), (3, 0, 0), (-3, 0, 0)]),
+            ('3', '4', [(1, 0, 0), (-1, 0, 0)]),
+        ]
+
+        # No contacts.
+        empty = contacts([], [], [])
+        assert encodeContacts([]) == encodeContacts([empty]) == []
+
+    def test_quality_profile(self):
+        """
+        Apply different quality profiles to the same world.
+        """
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        assert sim.quality == QualityProfile()
+
+        # The default profile must match the Bullet defaults.
+        ref = sim.dynamicsWorld.getSolverInfo()
+        default = QualityProfile()
+        assert ref[:3] == (default.solverIterations, default.splitImpulse,
+                           default.warmstarting)
+        assert np.allclose(ref[3:], (default.erp, default.cfm))
+
+        # Apply a custom profile.
+        profile = QualityProfile(
+            solverIterations=25, splitImpulse=False, warmstarting=0.5,
+            erp=0.4, cfm=0.01, contactThreshold=0.1, substepScale=2)
+        assert sim.setQualityProfile(profile).ok
+        assert sim.quality == profile
+        ret = sim.dynamicsWorld.getSolverInfo()
+        assert ret[:2] == (25, False)
+        assert np.allclose(ret[2:], (0.5, 0.4, 0.01))
+
+        # The contact threshold applies to all bodies in the next step.
+        assert sim.setRigidBodyData('1', getRigidBody()).ok
+        assert sim.compute(['1'], 1.0, 10).ok
+        threshold = sim.rigidBodies['1'].getContactProcessingThreshold()
+        assert threshold == 0.1
+
+        # Restore the default profile.
+        assert sim.setQualityProfile(QualityProfile()).ok
+        assert sim.dynamicsWorld.getSolverInfo() == ref
+        assert sim.compute(['1'], 1.0, 10).ok
+        threshold = sim.rigidBodies['1'].getContactProcessingThreshold()
+        assert threshold == 1E30
+
+        # Invalid profiles.
+        with pytest.raises(TypeError):
+            QualityProfile(solverIterations=0)
+        with pytest.raises(TypeError):
+            QualityProfile(erp=2)
+        with pytest.raises(TypeError):
+            QualityProfile(substepScale=0)
+
+    def test_ccd(self):
+        """
+        Bodies must derive their CCD parameters from their smallest collision
+        feature, and CCD must stop fast bodies from passing through thin ones.
+        """
+        ccdRadius = azrael.bullet_api.computeCcdRadius
+        box = getCSBox(dim=(1, 0.2, 3))
+        assert ccdRadius(getRigidBody()) == 1
+        assert ccdRadius(getRigidBody(cshapes={'box': box})) == 0.2
+        cshapes = {'box': box, 'sphere': getCSSphere(radius=0.1)}
+        assert ccdRadius(getRigidBody(scale=2, cshapes=cshapes)) == 0.2
+        assert ccdRadius(getRigidBody(cshapes={'p': getCSPlane()})) == 0
+        assert ccdRadius(getRigidBody(cshapes={'e': getCSEmpty()})) == 0
+
+        # Verify the CCD parameters of the Bullet body, also after its
+        # collision shape changed.
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        assert sim.setRigidBodyData('1', getRigidBody(cshapes={'b': box})).ok
+        body = sim.rigidBodies['1']
+        assert np.isclose(body.getCcdMotionThreshold(), 0.2)
+        assert np.isclose(body.getCcdSweptSphereRadius(), 0.1)
+        assert sim.setRigidBodyData('1', getRigidBody()).ok
+        assert body.getCcdMotionThreshold() == 1
+
+        # Fire a small sphere at a thin static wall with a single sub-step.
+        # It must bounce off the wall, unless CCD is disabled.
+        wall = getRigidBody(imass=0, cshapes={'b': getCSBox(dim=(0.05, 5, 5))})
+        ball = getRigidBody(position=(-2, 0, 0), velocityLin=(40, 0, 0),
+                            cshapes={'s': getCSSphere(radius=0.1)})
+        for ccd in (True, False):
+            with mock.patch.object(azrael.config, 'ccd_enabled', ccd):
+                sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+                assert sim.setRigidBodyData('1', wall).ok
+                assert sim.setRigidBodyData('2', ball).ok
+                assert sim.compute(['1', '2'], 0.1, 1).ok
+                pos = sim.getRigidBodyData('2').data.position
+                assert (pos[0] < 0) if ccd else (pos[0] > 1)
+
+    def test_snapshot(self):
+        """
+        Restoring a snapshot must reproduce the simulation exactly, both in
+        a new world and when rolling back an existing one.
+        """
+        def getState(sim, objIDs):
+            ret = sim.getRigidBodyDataBatch(objIDs)
+            assert ret.ok
+            return np.hstack(ret.data)
+
+        # Two spheres linked by a P2P constraint, an inactive 6DOF
+        # constraint, a custom quality profile, and gravity.
+        objIDs = ['1', '2', '3']
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        bodies = [
+            getRigidBody(position=(-1, 0, 0), velocityRot=(0, 1, 0),
+                         cshapes={'cssphere': getCSSphere()}),
+            getRigidBody(position=(1, 0, 0), com=(0.1, 0, 0),
+                         cshapes={'cssphere': getCSSphere()}),
+            getRigidBody(position=(0, -5, 0), imass=0,
+                         cshapes={'csbox': getCSBox(dim=(5, 1, 5))}),
+        ]
+        assert sim.setRigidBodyDataBatch(objIDs, bodies).ok
+        p2p = getP2P(aid='c1', rb_a='1', rb_b='2',
+                     pivot_a=(1, 0, 0), pivot_b=(-1, 0, 0))
+        dof = get6DofSpring2(aid='c2', rb_a='1', rb_b='3')
+        assert sim.setConstraints([p2p, dof]).ok
+        assert sim.setConstraints([p2p]).ok
+        profile = QualityProfile(solverIterations=20, substepScale=2)
+        assert sim.setQualityProfile(profile).ok
+        assert sim.setGravity((0, -9.81, 0)).ok
+
+        def advance(sim):
+            for ii in range(5):
+                sim.applyForceAndTorque('1', (-2, 0, 1), (0, 0, 1))
+                assert sim.compute(objIDs, 0.1, 10).ok
+
+        # Advance the simulation and take a snapshot.
+        advance(sim)
+        ret = sim.getSnapshot()
+        assert ret.ok and isinstance(ret.data, bytes)
+        blob = ret.data
+        state_snap = getState(sim, objIDs)
+
+        # Restore the snapshot in a new world.
+        sim_2 = azrael.bullet_api.PyBulletDynamicsWorld(2)
+        assert sim_2.restoreSnapshot(blob).ok
+        assert np.array_equal(getState(sim_2, objIDs), state_snap)
+        assert sim_2.quality == profile
+        assert set(sim_2.constraintCache.keys()) == {'c1', 'c2'}
+        assert sim_2.activeConstraints == {'c1'}
+        assert sim_2.dynamicsWorld.getNumConstraints() == 1
+        gravity = sim_2.dynamicsWorld.getGravity().topy()
+        assert np.allclose(gravity, (0, -9.81, 0))
+        assert len(sim_2.shapeLibrary) == 3
+
+        # Both worlds must now evolve identically.
+        advance(sim)
+        advance(sim_2)
+        state_end = getState(sim, objIDs)
+        assert np.array_equal(getState(sim_2, objIDs), state_end)
+        assert not np.array_equal(state_end, state_snap)
+
+        # Roll back the first world (after removing a body) and advance it
+        # again.
+        assert sim.removeRigidBody(['3']).ok
+        assert sim.restoreSnapshot(blob).ok
+        assert np.array_equal(getState(sim, objIDs), state_snap)
+        advance(sim)
+        assert np.array_equal(getState(sim, objIDs), state_end)
+        assert len(sim.shapeLibrary) == 3
+
+        # Snapshot of an empty world.
+        sim_3 = azrael.bullet_api.PyBulletDynamicsWorld(3)
+        ret = sim_3.getSnapshot()
+        assert ret.ok
+        assert sim_2.restoreSnapshot(ret.data).ok
+        assert len(sim_2.rigidBodies) == 0
+        assert sim_2.dynamicsWorld.getNumConstraints() == 0
+
+        # Invalid snapshots must not modify the world.
+        for invalid in (b'', b'foo', blob[:-8], blob[:40], blob + b'x'):
+            assert not sim.restoreSnapshot(invalid).ok
+        assert np.array_equal(getState(sim, objIDs), state_end)
+
+    def test_snapshot_failure(self):
+        """
+        A snapshot that cannot be restored must not modify the world.
+        """
+        def getState(sim, objIDs):
+            ret = sim.getRigidBodyDataBatch(objIDs)
+            assert ret.ok
+            return np.hstack(ret.data)
+
+        # Two spheres linked by a P2P constraint.
+        objIDs = ['1', '2']
+        sim = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        bodies = [
+            getRigidBody(position=(-1, 0, 0), velocityRot=(0, 1, 0),
+                         cshapes={'cssphere': getCSSphere()}),
+            getRigidBody(position=(1, 0, 0),
+                         cshapes={'cssphere': getCSSphere()}),
+        ]
+        assert sim.setRigidBodyDataBatch(objIDs, bodies).ok
+        p2p = getP2P(aid='c1', rb_a='1', rb_b='2',
+                     pivot_a=(1, 0, 0), pivot_b=(-1, 0, 0))
+        assert sim.setConstraints([p2p]).ok
+        blob = sim.getSnapshot().data
+
+        # Advance the world to make it differ from the snapshot.
+        assert sim.compute(objIDs, 0.1, 10).ok
+        state = getState(sim, objIDs)
+
+        # The constraint of this snapshot links a non-existing body.
+        invalid = blob.replace(b'"rb_b": "2"', b'"rb_b": "9"')
+        assert invalid != blob
+        assert not sim.restoreSnapshot(invalid).ok
+        assert np.array_equal(getState(sim, objIDs), state)
+
+        # Make the restoration fail half way through. The world must revert
+        # to its previous state.
+        setConstraints = sim.setConstraints
+        fail = [RetVal(False, 'error', None)]
+
+        def failOnce(constraints):
+            return fail.pop() if fail else setConstraints(constraints)
+
+        with mock.patch.object(sim, 'setConstraints', failOnce):
+            assert not sim.restoreSnapshot(blob).ok
+        assert np.array_equal(getState(sim, objIDs), state)
+        assert sim.activeConstraints == {'c1'}
+        assert sim.dynamicsWorld.getNumConstraints() == 1
@@ -781,6 +781,70 @@ class TestClerk:
         assert np.array_equal(tmp[0], tot_force)
         assert np.array_equal(tmp[1], tot_torque)
 
+    def test_setSchedule_Boosters_and_Forces(self):
+        """
+        Upload a schedule with booster- and force commands and verify that
+        Leonard applies them at the correct simulation steps.
+        """
+        # Reset the SV database and instantiate a Leonard.
+        leo = getLeonard()
+
+        # Parameters and constants for this test.
+        objID_1 = '1'
+        dt = 0.1
+        CmdSchedule = aztypes.CmdSchedule
+
+        # Convenience.
+        clerk = self.clerk
+
+        # Define a template with a booster and spawn it.
+        dir_0 = np.array([1, 0, 0], np.float64)
+        pos_0 = np.array([0, 1, 0], np.float64)
+        boosters = {
+            '0': aztypes.Booster(position=pos_0, direction=dir_0, force=0),
+        }
+        temp = getTemplate('t1', boosters=boosters)
+        assert clerk.addTemplates([temp]).data == {'t1': True}
+        ret = clerk.spawn([{'templateID': temp.aid}])
+        assert (ret.ok, ret.data) == (True, [objID_1])
+        del ret, temp
+
+        # Schedule must fail for non-existing objects and boosters.
+        cmd_b = {'0': aztypes.CmdBooster(force=2)}
+        sched = [CmdSchedule(time=0.25, cmd_boosters=cmd_b)]
+        assert not clerk.setSchedule('100', sched).ok
+        cmd_b_inv = {'10': aztypes.CmdBooster(force=2)}
+        tmp = [CmdSchedule(time=0.25, cmd_boosters=cmd_b_inv)]
+        assert not clerk.setSchedule(objID_1, tmp).ok
+
+        # Schedule a booster command and a direct force.
+        force, rpos = [0, 0, 3], [1, 0, 0]
+        sched.append(CmdSchedule(time=0.05, force=force, rpos=rpos))
+        assert clerk.setSchedule(objID_1, sched).ok
+        ret = clerk.getScheduleStatus([objID_1])
+        assert ret.ok and ret.data[objID_1]['state'] == 'queued'
+
+        # The direct force must apply in the first step...
+        leo.step(dt, 1)
+        tmp = leo.allForces[objID_1]
+        assert np.array_equal(tmp.forceDirect, force)
+        assert np.array_equal(tmp.torqueDirect, np.cross(rpos, force))
+        assert np.array_equal(tmp.forceBoost, [0, 0, 0])
+
+        # ... and the booster force in the third step.
+        leo.step(dt, 1)
+        assert np.array_equal(leo.allForces[objID_1].forceBoost, [0, 0, 0])
+        leo.step(dt, 1)
+        tmp = leo.allForces[objID_1]
+        assert np.array_equal(tmp.forceBoost, 2 * dir_0)
+        assert np.array_equal(tmp.torqueBoost, np.cross(pos_0, 2 * dir_0))
+
+        # The schedule must have completed.
+        ret = clerk.getScheduleStatus([objID_1, '100'])
+        assert ret.ok and ret.data['100'] is None
+        assert ret.data[objID_1] == {
+            'state': 'done', 'applied': 2, 'remaining': 0}
+
     def test_controlParts_Factories_notmoving(self):
         """
         Create a template with factories and let them spawn objects.
@@ -1706,6 +1770,28 @@ class TestClerk:
         # string.
         assert not clerk.spawn([{'templateID': 'tname', 'custom': [1]}]).ok
 
+    def test_spawn_with_quality(self):
+        """
+        Templates and spawn commands must only request known quality tiers.
+        """
+        clerk = self.clerk
+
+        # Templates with unknown quality tiers are invalid.
+        body = getRigidBody(cshapes={'cssphere': getCSSphere()})
+        template = getTemplate('tname', rbs=body)
+        assert not clerk.addTemplates([template._replace(quality='foo')]).ok
+        template = template._replace(quality='high')
+        assert clerk.addTemplates([template]) == (True, None, {'tname': True})
+
+        # Spawn commands with unknown quality tiers are invalid.
+        assert not clerk.spawn([{'templateID': 'tname', 'quality': 'foo'}]).ok
+        ret = clerk.spawn([
+            {'templateID': 'tname'},
+            {'templateID': 'tname', 'quality': 'low'},
+            {'templateID': 'tname', 'quality': ''},
+        ])
+        assert ret.ok and len(ret.data) == 3
+
 
 class TestModifyFragments:
     """
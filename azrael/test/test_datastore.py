@@ -15,8 +15,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Azrael. If not, see <http://www.gnu.org/licenses/>.
 import copy
+import time
 import pytest
+import pickle
+import pymongo
+import threading
+import bson.objectid
+import bson.timestamp
 import unittest.mock as mock
+import azrael.config as config
 import azrael.datastore as datastore
 
 from IPython import embed as ipshell
@@ -85,6 +92,53 @@ class TestAtomicCounter:
         # Run invalid queries.
         assert not datastore.getUniqueObjectIDs(-1).ok
 
+    @mock.patch.object(config, 'objid_block_size', 10)
+    def test_getUniqueObjectIDs_leases(self):
+        """
+        Every process must lease blocks of IDs and hand them out locally.
+        """
+        datastore.init(flush=True)
+        db = datastore.getDSHandle('Counters')
+        leases = datastore._objIDs
+
+        def getIDs(num):
+            ret = datastore.getUniqueObjectIDs(num)
+            assert ret.ok
+            return [int(_) for _ in ret.data]
+
+        # The first request leases a block of ten IDs. The subsequent ones
+        # need no round trip to the datastore.
+        assert getIDs(2) == [1, 2]
+        assert db.getCounter('objcnt').data == 10
+        with mock.patch.object(db, 'incrementCounter') as m_inc:
+            assert getIDs(5) == [3, 4, 5, 6, 7]
+            assert m_inc.call_count == 0
+
+        # Lease the next block in the background once fewer than a quarter of
+        # the current one remain.
+        assert getIDs(1) == [8]
+        leases.thread.join()
+        assert db.getCounter('objcnt').data == 20
+
+        # Requests may span several blocks, and large requests lease all IDs
+        # at once.
+        assert getIDs(4) == [9, 10, 11, 12]
+        assert getIDs(25) == list(range(13, 38))
+        leases.thread.join()
+        assert db.getCounter('objcnt').data == 47
+
+        # Other processes (including forked ones) must lease their own blocks.
+        leases.pid = None
+        assert getIDs(2) == [48, 49]
+        assert db.getCounter('objcnt').data == 57
+
+        # A counter value of zero returns the current counter value.
+        assert datastore.getUniqueObjectIDs(0).data == ['57']
+
+        # Resetting the datastores must discard the leases.
+        datastore.init(flush=True)
+        assert getIDs(1) == [1]
+
 
 class TestAllDatastoreBackends:
     """
@@ -94,6 +148,12 @@ class TestAllDatastoreBackends:
     all_engines = [
         datastore.DatastoreInMemory,
         datastore.DatastoreMongo,
+        lambda name: datastore.DatastoreCached(datastore.DatastoreMongo(name)),
+        lambda name: datastore.DatastorePacked(
+            datastore.DatastoreMongo(name), ('rbs', ), [('pos', 3)]),
+        lambda name: datastore.DatastorePartitioned(
+            [datastore.DatastoreMongo((name[0], name[1] + str(_)))
+             for _ in range(3)]),
     ]
 
     @classmethod
@@ -369,6 +429,36 @@ class TestAllDatastoreBackends:
         assert db.remove(['1', '4']) == (True, None, 1)
         assert db.count() == (True, None, 0)
 
+    @pytest.mark.parametrize('clsDatabase', all_engines)
+    def test_remove_match(self, clsDatabase):
+        """
+        Only delete those documents whose values match the conditions.
+        """
+        db = clsDatabase(name=('test1', 'test2'))
+        assert db.reset().ok and db.count().data == 0
+        ops = {
+            '1': {'data': {'a': {'b': 1}}},
+            '2': {'data': {'a': {'b': 2}}},
+            '3': {'data': {'a': {'b': 3}}},
+        }
+        assert db.put(ops).ok
+
+        # Neither document matches its condition.
+        match = {'1': {('a', 'b'): 2}, '2': {('a', 'c'): 2}}
+        assert db.remove(['1', '2'], match) == (True, None, 0)
+        assert db.count() == (True, None, 3)
+
+        # Document '1' matches, document '3' has no condition, and document
+        # '2' still does not match.
+        match = {'1': {('a', 'b'): 1}, '2': {('a', 'b'): 1}}
+        assert db.remove(['1', '2', '3'], match) == (True, None, 2)
+        assert db.allKeys() == (True, None, ['2'])
+
+        # Invalid conditions.
+        assert not db.remove(['2'], {'2': {('a.b', ): 2}}).ok
+        assert not db.remove(['2'], {'2': 2}).ok
+        assert db.count() == (True, None, 1)
+
     @pytest.mark.parametrize('clsDatabase', all_engines)
     def test_allKeys(self, clsDatabase):
         """
@@ -542,6 +632,634 @@ class TestAllDatastoreBackends:
         assert db.removeCounter('foo') == (True, None, None)
         assert db.getCounter('foo') == (True, None, None)
 
+    @pytest.mark.parametrize('clsDatabase', all_engines)
+    def test_query(self, clsDatabase):
+        """
+        Query documents by the values of their (indexed) fields.
+        """
+        db = clsDatabase(name=('test1', 'test2'))
+        assert db.reset().ok
+
+        # Index two key hierarchies. Indexing the same key twice is harmless.
+        assert db.createIndex(('tid', )).ok
+        assert db.createIndex(('a', 'b')).ok
+        assert db.createIndex(['tid']).ok
+        assert not db.createIndex(('a.b', )).ok
+
+        ops = {
+            '1': {'data': {'tid': 'foo', 'a': {'b': 1, 'c': 1}}},
+            '2': {'data': {'tid': 'foo', 'a': {'b': 2, 'c': 1}}},
+            '3': {'data': {'tid': 'bar', 'a': {'b': 2.0}}},
+            '4': {'data': {'a': 5}},
+        }
+        docs = {aid: op['data'] for aid, op in ops.items()}
+        assert db.put(ops).ok
+
+        def query(filter, prj=None):
+            ret = db.query(filter, prj)
+            assert ret.ok
+            return ret.data
+
+        # Indexed, non-indexed and mixed key hierarchies.
+        assert query({('tid', ): 'foo'}) == {'1': docs['1'], '2': docs['2']}
+        assert query({('tid', ): 'blah'}) == {}
+        assert query({('a', 'b'): 2}) == {'2': docs['2'], '3': docs['3']}
+        assert query({('a', 'c'): 1}) == {'1': docs['1'], '2': docs['2']}
+        assert query({('tid', ): 'foo', ('a', 'b'): 2}) == {'2': docs['2']}
+        assert query({('tid', ): 'bar', ('a', 'c'): 1}) == {}
+        assert query({}) == db.getAll().data
+
+        # Projections.
+        assert query({('tid', ): 'foo'}, [('a', 'b')]) == {
+            '1': {'a': {'b': 1}}, '2': {'a': {'b': 2}}}
+
+        # The indexes must reflect all write operations.
+        mod = {'inc': {}, 'set': {('tid', ): 'bar'}, 'unset': [], 'exists': {}}
+        assert db.modify({'1': mod}).ok
+        assert db.replace({'2': {'data': {'tid': 'bar'}}}).ok
+        assert db.remove(['3']).ok
+        assert set(query({('tid', ): 'bar'})) == {'1', '2'}
+        assert query({('tid', ): 'foo'}) == {}
+        assert set(query({('a', 'b'): 1})) == {'1'}
+        assert query({('a', 'b'): 2}) == {}
+
+        # The indexes must survive a reset.
+        assert db.reset().ok and query({('tid', ): 'bar'}) == {}
+        assert db.put(ops).ok
+        assert set(query({('tid', ): 'foo'})) == {'1', '2'}
+
+        # Invalid filters.
+        assert not db.query({('a.b', ): 1}).ok
+        assert not db.query({('a', ): [1]}).ok
+        assert not db.query({('a', ): None}).ok
+        assert not db.query({('a', ): 1}, [('a.b', )]).ok
+
+    def test_mongo_bulk_writes(self):
+        """
+        The bulk writes of the Mongo datastore must report the same per-AID
+        results as the reference implementation, irrespective of the batch
+        size.
+        """
+        db_ref = datastore.DatastoreInMemory(name=('test1', 'test2'))
+        db = datastore.DatastoreMongo(name=('test1', 'test2'), batchSize=3,
+                                      writeConcern={'w': 1})
+        assert db.batchSize == 3
+        assert db.reset().ok and db_ref.reset().ok
+
+        def both(method, ops):
+            ret = getattr(db, method)(ops)
+            ret_ref = getattr(db_ref, method)(ops)
+            assert ret == ret_ref
+            assert db.getAll() == db_ref.getAll()
+            return ret.data
+
+        # Insert 10 documents, then another 10 of which 5 already exist.
+        ops = {str(_): {'data': {'a': _, 'b': {'c': 1}}} for _ in range(10)}
+        assert all(both('put', ops).values())
+        ops = {str(_): {'data': {'x': _}} for _ in range(5, 15)}
+        assert sum(both('put', ops).values()) == 5
+
+        # The documents must not have changed.
+        data = {'x': 1}
+        assert db.put({'20': {'data': data}}).ok
+        assert db_ref.put({'20': {'data': data}}).ok
+        assert data == {'x': 1}
+
+        # Replace documents, some of which do not exist.
+        ops = {str(_): {'data': {'a': -_, 'b': {'c': 2}}}
+               for _ in range(8, 18)}
+        assert sum(both('replace', ops).values()) == 7
+
+        # Modify documents. Only those with an 'a' key qualify. The first
+        # modification cannot affect its own query, the second can.
+        ops = {
+            str(_): {
+                'inc': {('b', 'c'): 1}, 'set': {('y', ): _},
+                'unset': [('a', )] if _ % 2 else [],
+                'exists': {('a', ): True},
+            } for _ in range(16)
+        }
+        assert db._isQueryInvariant(ops['0'])
+        assert not db._isQueryInvariant(ops['1'])
+        assert sum(both('modify', ops).values()) == 15
+        assert sum(both('modify', ops).values()) == 8
+
+        # Remove documents in batches.
+        aids = [str(_) for _ in range(0, 30, 2)]
+        assert db.remove(aids) == db_ref.remove(aids) == (True, None, 9)
+        assert db.getAll() == db_ref.getAll()
+
+        # The bulk writes must use as many batches as necessary.
+        bulk_write = db.db.bulk_write
+        with mock.patch.object(db.db, 'bulk_write', wraps=bulk_write) as m_bw:
+            ops = {str(_): {'data': {}} for _ in range(100, 107)}
+            assert all(db.put(ops).data.values())
+            assert m_bw.call_count == 3
+
+    def test_mongo_bulk_writes_concurrent(self):
+        """
+        The Mongo datastore must report which documents a bulk update
+        matched, even if another client changes the documents afterwards.
+        """
+        db = datastore.DatastoreMongo(name=('test1', 'test2'), batchSize=10)
+        assert db.reset().ok
+        ops = {str(_): {'data': {'a': _} if _ % 2 else {}} for _ in range(6)}
+        assert all(db.put(ops).data.values())
+
+        # Another client gives all documents an 'a' key right after the bulk
+        # write, which must not affect the reported results.
+        bulk_write = db.db.bulk_write
+
+        def concurrent(*args, **kwargs):
+            ret = bulk_write(*args, **kwargs)
+            db.db.update_many({}, {'$set': {'a': -1}})
+            return ret
+
+        mod = {'inc': {}, 'set': {('b', ): 1}, 'unset': [],
+               'exists': {('a', ): True}}
+        with mock.patch.object(db.db, 'bulk_write', concurrent):
+            ret = db.modify({aid: mod for aid in ops})
+        assert ret.ok
+        assert ret.data == {str(_): bool(_ % 2) for _ in range(6)}
+
+        # The tokens must never appear in the documents.
+        assert all('_batch' not in _ for _ in db.getAll().data.values())
+        assert '_batch' not in db.getOne('1').data
+
+        # Write concern errors must surface as failures.
+        result = {'nMatched': 1, 'writeErrors': [], 'upserted': [],
+                  'writeConcernErrors': [{'errmsg': 'timeout'}]}
+        err = pymongo.errors.BulkWriteError(result)
+        with mock.patch.object(db.db, 'bulk_write', side_effect=err):
+            assert not db.modify({'1': mod}).ok
+            assert not db.replace({'1': {'data': {}}}).ok
+            assert not db.put({'10': {'data': {}}}).ok
+            assert not db.remove(['1'], {'1': {('a', ): -1}}).ok
+
+    def test_cached_datastore(self):
+        """
+        The read-through cache must serve repeated queries from memory and
+        invalidate exactly those entries that overlap modified keys.
+        """
+        backend = datastore.DatastoreInMemory(name=('test1', 'test2'))
+        db = datastore.DatastoreCached(backend, maxEntries=3,
+                                       volatile=[('a', 'v')])
+        assert db.reset().ok
+        ops = {str(_): {'data': {'a': {'v': _}, 'b': {'x': _, 'y': 0}}}
+               for _ in range(4)}
+        assert all(db.put(ops).data.values())
+        prj = [('b', )]
+
+        # The first query must fetch the document from the backend, the
+        # second one must come from the cache.
+        assert db.getOne('0', prj) == (True, None, {'b': {'x': 0, 'y': 0}})
+        assert db.getOne('0', prj) == (True, None, {'b': {'x': 0, 'y': 0}})
+        stats = db.getStats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+        assert stats['hitrate'] == 0.5
+
+        # The caller must not be able to alter the cached documents.
+        db.getOne('0', prj).data['b']['x'] = 10
+        assert db.getOne('0', prj).data == {'b': {'x': 0, 'y': 0}}
+
+        # Queries for volatile keys, including the full document, must always
+        # bypass the cache. Missing documents must never be cached.
+        assert db.getOne('0').data == ops['0']['data']
+        assert db.getMulti(['1'], [('a', )]).data == {'1': {'a': {'v': 1}}}
+        assert db.getOne('10', prj) == (False, None, None)
+        stats = db.getStats()
+        assert (stats['bypassed'], stats['entries']) == (2, 1)
+
+        # Modifying a key outside the projection must not invalidate the
+        # entry, but modifying a key inside it must.
+        mod = {'inc': {}, 'set': {('a', 'v'): -1}, 'unset': [], 'exists': {}}
+        assert db.modify({'0': mod}).ok
+        assert db.getStats()['invalidated'] == 0
+        mod = {'inc': {('b', 'x'): 5}, 'set': {}, 'unset': [], 'exists': {}}
+        assert db.modify({'0': mod}).ok
+        assert db.getStats()['invalidated'] == 1
+        assert db.getOne('0', prj).data == {'b': {'x': 5, 'y': 0}}
+
+        # Fill the cache beyond capacity. This must evict the least recently
+        # used entry ('0').
+        ret = db.getMulti(['1', '2', '3'], prj)
+        assert ret.data['3'] == {'b': {'x': 3, 'y': 0}}
+        stats = db.getStats()
+        assert (stats['entries'], stats['evicted']) == (3, 1)
+        assert ('0', (('b', ), )) not in db.cache
+
+        # Writes that bypass the cache must be relayed to `invalidate`.
+        assert backend.replace({'1': {'data': {'b': {'x': -1}}}}).ok
+        assert db.getOne('1', prj).data == {'b': {'x': 1, 'y': 0}}
+        db.invalidate(['1'], [('b', 'x')])
+        assert db.getOne('1', prj).data == {'b': {'x': -1}}
+
+        # Removed documents must disappear from the cache.
+        assert db.remove(['2']) == (True, None, 1)
+        assert db.getOne('2', prj) == (False, None, None)
+
+        # A document the backend fetched while a write happened must not be
+        # cached since it may already be stale.
+        backend_getMulti = backend.getMulti
+
+        def getMulti(aids, prj):
+            ret = backend_getMulti(aids, prj)
+            db.invalidate(aids)
+            return ret
+        db.invalidate(['3'])
+        with mock.patch.object(backend, 'getMulti', getMulti):
+            assert db.getOne('3', prj).data == {'b': {'x': 3, 'y': 0}}
+        assert ('3', (('b', ), )) not in db.cache
+
+
+    @pytest.mark.parametrize('clsDatabase', [datastore.DatastoreInMemory,
+                                             datastore.DatastoreMongo])
+    def test_packed_datastore(self, clsDatabase):
+        """
+        The packed datastore must store the fields of its layout in a blob,
+        yet present the original documents to the caller.
+        """
+        backend = clsDatabase(name=('test1', 'test2'))
+        layout = [('pos', 3), ('vel', 2)]
+        db = datastore.DatastorePacked(backend, ('a', 'rbs'), layout)
+        assert db.reset().ok
+
+        # Put three documents. Only the first one is complete.
+        rbs = {'pos': [1, 2, 3], 'vel': [4, 5], 'imass': 2}
+        docs = {
+            '1': {'a': {'rbs': rbs, 'b': 1}, 'c': 2},
+            '2': {'a': {'rbs': {'pos': [1, 2, 3], 'imass': 1}}},
+            '3': {'a': {'rbs': {'pos': [1, 2], 'vel': [4, 5]}}},
+        }
+        assert db.put({k: {'data': v} for k, v in docs.items()}).ok
+
+        # The backend must only contain the blob of the complete document,
+        # and the original documents must be intact.
+        raw = backend.getAll().data
+        assert set(raw['1']['a']['rbs']) == {'packed', 'imass'}
+        assert len(raw['1']['a']['rbs']['packed']) == 5 * 8
+        assert raw['2'] == docs['2'] and raw['3'] == docs['3']
+        assert rbs == {'pos': [1, 2, 3], 'vel': [4, 5], 'imass': 2}
+
+        # All queries must unpack the blob.
+        assert db.getOne('1') == (True, None, docs['1'])
+        assert db.getMulti(['1', '2', '4']).data == {
+            '1': docs['1'], '2': docs['2'], '4': None}
+        assert db.getAll().data == docs
+        assert db.query({('c', ): 2}).data == {'1': docs['1']}
+
+        # Projections.
+        assert db.getOne('1', [('a', 'rbs', 'vel')]).data == {
+            'a': {'rbs': {'vel': [4, 5]}}}
+        assert db.getOne('1', [('a', 'rbs', 'imass')]).data == {
+            'a': {'rbs': {'imass': 2}}}
+        assert db.getOne('1', [('a', 'rbs', 'pos'), ('a', 'rbs')]).data == {
+            'a': {'rbs': rbs}}
+        assert db.getOne('1', [('a', 'b'), ('c', )]).data == {
+            'a': {'b': 1}, 'c': 2}
+        assert db.getAll([('a', 'rbs', 'pos')]).data == {
+            '1': {'a': {'rbs': {'pos': [1, 2, 3]}}},
+            '2': {'a': {'rbs': {'pos': [1, 2, 3]}}},
+            '3': {'a': {'rbs': {'pos': [1, 2]}}},
+        }
+
+        # Overwrite an individual packed field. It must supersede the blob.
+        mod = {'inc': {}, 'set': {('a', 'rbs', 'vel'): [0, 0]},
+               'unset': [], 'exists': {('a', 'rbs', 'pos'): True}}
+        assert db.modify({'1': mod}) == (True, None, {'1': True})
+        rbs_new = dict(rbs, vel=[0, 0])
+        assert db.getOne('1').data['a']['rbs'] == rbs_new
+        assert db.getOne('1', [('a', 'rbs', 'vel')]).data == {
+            'a': {'rbs': {'vel': [0, 0]}}}
+
+        # Overwrite the entire sub-document. This must pack it again.
+        mod = {'inc': {}, 'set': {('a', 'rbs'): rbs}, 'unset': [],
+               'exists': {}}
+        assert db.modify({'1': mod, '2': mod}).ok
+        raw = backend.getAll().data
+        assert set(raw['1']['a']['rbs']) == {'packed', 'imass'}
+        assert set(raw['2']['a']['rbs']) == {'packed', 'imass'}
+        assert db.getOne('2').data == {'a': {'rbs': rbs}}
+
+        # Packed fields cannot be incremented, unset, queried or indexed.
+        mod = {'inc': {('a', 'rbs', 'pos'): 1}, 'set': {}, 'unset': [],
+               'exists': {}}
+        assert not db.modify({'1': mod}).ok
+        mod = {'inc': {}, 'set': {}, 'unset': [('a', 'rbs', 'vel')],
+               'exists': {}}
+        assert not db.modify({'1': mod}).ok
+        assert not db.query({('a', 'rbs', 'pos'): 1}).ok
+        assert not db.createIndex(('a', 'rbs', 'pos')).ok
+        assert db.getOne('1').data == docs['1']
+
+        # Remove documents.
+        assert db.remove(['1', '2']) == (True, None, 2)
+        assert db.allKeys().data == ['3']
+
+    def test_partitioned_datastore(self):
+        """
+        The partitioned datastore must distribute the documents over all
+        partitions, and merge the results of its queries.
+        """
+        backends = [datastore.DatastoreInMemory(('test1', str(_)))
+                    for _ in range(4)]
+        db = datastore.DatastorePartitioned(backends)
+        assert db.reset().ok
+
+        # Insert documents. They must end up in the partition their AID
+        # hashes to, and every partition must receive some of them.
+        aids = [str(_) for _ in range(100)]
+        ops = {aid: {'data': {'a': int(aid), 'b': int(aid) % 2}}
+               for aid in aids}
+        assert db.put(ops) == (True, None, {_: True for _ in aids})
+        for idx, backend in enumerate(backends):
+            assert 0 < backend.count().data < 100
+            for aid in backend.allKeys().data:
+                assert db._partition(aid) == idx
+        assert db.count().data == 100
+        assert sorted(db.allKeys().data) == sorted(aids)
+
+        # Queries must merge the results of all partitions.
+        docs = {aid: op['data'] for aid, op in ops.items()}
+        assert db.getOne('5') == (True, None, {'a': 5, 'b': 1})
+        assert db.getMulti(['5', '7', 'x'], [('a', )]).data == {
+            '5': {'a': 5}, '7': {'a': 7}, 'x': None}
+        assert db.getAll().data == docs
+        assert set(db.query({('b', ): 1}).data) == set(aids[1::2])
+
+        # Write operations.
+        mod = {'inc': {('a', ): 1}, 'set': {}, 'unset': [], 'exists': {}}
+        ret = db.modify({aid: mod for aid in aids[:10] + ['x']})
+        assert ret.ok
+        assert ret.data == dict({_: True for _ in aids[:10]}, x=False)
+        assert db.getOne('0').data == {'a': 1, 'b': 0}
+        assert db.replace({'1': {'data': {}}, 'x': {'data': {}}}).data == {
+            '1': True, 'x': False}
+        assert db.remove(aids[:50] + ['x']) == (True, None, 50)
+        assert db.count().data == 50
+
+        # Secondary indexes exist in all partitions.
+        assert db.createIndex(('b', )).ok
+        assert all(_.indexes == [('b', )] for _ in backends)
+        assert db.indexes == [('b', )]
+
+        # Counters live in the first partition.
+        assert db.incrementCounter('foo', 2) == (True, None, 2)
+        assert backends[0].getCounter('foo').data == 2
+        assert db.removeCounter('foo').ok
+
+        # The change feed must relay the events of all partitions.
+        feed = db.subscribe().data
+        assert db.remove(aids[50:60]).data == 10
+        events = []
+        for ii in range(20):
+            events += feed.poll(timeout=0.1)
+            if len(events) == 10:
+                break
+        assert sorted(_.aid for _ in events) == aids[50:60]
+        feed.close()
+        assert all(_.feeds == [] for _ in backends)
+
+        # Invalid arguments.
+        assert not db.put({'1': {}}).ok
+        assert not db.getMulti([1]).ok
+        assert not db.remove([1]).ok
+
+    def test_change_feed_merged(self):
+        """
+        The merged feed must stop relaying closed feeds, and close once all
+        of them are closed.
+        """
+        Event = datastore.ChangeEvent
+        feeds = [datastore.ChangeFeed(), datastore.ChangeFeed()]
+        merged = datastore.ChangeFeedMerged(feeds)
+
+        # Events that arrive right before a feed closes must not get lost.
+        feeds[0].push([Event('insert', '1', None, 1)])
+        feeds[0].close()
+        merged.threads[0].join(1)
+        assert not merged.threads[0].is_alive()
+        assert not merged.closed
+        feeds[1].push([Event('insert', '2', None, 1)])
+        events = []
+        for ii in range(20):
+            events += merged.poll(timeout=0.1)
+            if len(events) == 2:
+                break
+        assert sorted(_.aid for _ in events) == ['1', '2']
+
+        # Close the last feed.
+        feeds[1].close()
+        merged.threads[1].join(1)
+        assert not merged.threads[1].is_alive()
+        assert merged.closed
+
+    def test_change_feed_inmemory(self):
+        """
+        The in-memory datastore must publish every change to all its feeds.
+        """
+        db = datastore.DatastoreInMemory(name=('test1', 'test2'))
+        feed_1, feed_2 = db.subscribe().data, db.subscribe().data
+        assert feed_1.poll() == []
+
+        # Insert two documents, one of which already exists.
+        assert db.put({'1': {'data': {'a': 1}}}).ok
+        assert db.put({'1': {'data': {}}, '2': {'data': {'b': {'c': 1}}}}).ok
+        Event = datastore.ChangeEvent
+        ref = [Event('insert', '1', None, 1), Event('insert', '2', None, 2)]
+        assert feed_1.poll() == ref
+
+        # Modify- and replace documents. Unsuccessful operations must not
+        # produce an event.
+        mod = {'inc': {('b', 'c'): 1}, 'set': {('d', ): 2}, 'unset': [('e', )],
+               'exists': {('b', ): True}}
+        assert db.modify({'1': mod, '2': mod}).data == {'1': False, '2': True}
+        assert db.replace({'1': {'data': {}}, '3': {'data': {}}}).ok
+        ref += [Event('modify', '2', [('b', 'c'), ('d', ), ('e', )], 3),
+                Event('modify', '1', None, 4)]
+
+        # Remove documents and flush the datastore. Counters must not produce
+        # any events.
+        assert db.remove(['1', '5']).ok
+        assert db.incrementCounter('foo', 1).ok
+        assert db.reset().ok
+        ref += [Event('remove', '1', None, 5), Event('reset', None, None, 6)]
+        assert feed_1.poll() == ref[2:]
+        assert feed_2.poll() == ref
+
+        # A closed feed must not receive events anymore.
+        feed_1.close()
+        assert db.feeds == [feed_2]
+        assert db.put({'1': {'data': {}}}).ok
+        assert feed_1.poll() == []
+        assert list(feed_2.poll()) == [Event('insert', '1', None, 7)]
+
+        # Iterating over the feed must block until the events arrive, and stop
+        # once the feed closes.
+        def writer():
+            db.put({'8': {'data': {}}})
+            time.sleep(0.1)
+            feed_2.close()
+        threading.Thread(target=writer).start()
+        assert [_.aid for _ in feed_2] == ['8']
+
+    def test_change_feed_cached(self):
+        """
+        A cache that watches its backend must invalidate the entries that
+        other writers modify.
+        """
+        backend = datastore.DatastoreInMemory(name=('test1', 'test2'))
+        db = datastore.DatastoreCached(backend, maxEntries=10, watch=True)
+        assert backend.feeds == [db.feed]
+        assert db.put({'1': {'data': {'a': 1, 'b': 2}}}).ok
+
+        prj = [('a', )]
+        assert db.getOne('1', prj).data == {'a': 1}
+
+        # Modify- and remove the document via the backend.
+        mod = {'inc': {('a', ): 1}, 'set': {}, 'unset': [], 'exists': {}}
+        assert backend.modify({'1': mod}).ok
+        assert db.getOne('1', prj).data == {'a': 2}
+        assert backend.reset().ok
+        assert db.getOne('1', prj) == (False, None, None)
+
+        # The cache must resubscribe after a fork.
+        feed = db.feed
+        with mock.patch.object(datastore.os, 'getpid') as m_pid:
+            m_pid.return_value = db.feedPID + 1
+            assert db.getOne('1', prj) == (False, None, None)
+            assert db.feed is not feed and db.feedPID == m_pid.return_value
+
+        # The cache must disable itself if there is no change feed.
+        with mock.patch.object(backend, 'subscribe') as m_sub:
+            m_sub.return_value = datastore.RetVal(False, 'foo', None)
+            db = datastore.DatastoreCached(backend, watch=True)
+        assert db.feed is None and db.maxEntries == 0
+        db.getOne('1', prj)
+        assert db.getStats()['bypassed'] == 1
+
+    def test_change_feed_mongo(self):
+        """
+        The Mongo change feed must translate the change stream into
+        `ChangeEvent` tuples.
+        """
+        ts = bson.timestamp.Timestamp(10, 2)
+        version = (10 << 32) + 2
+        compile = datastore.ChangeFeedMongo.compileEvent
+        Event = datastore.ChangeEvent
+
+        # Compile the events for the possible operations.
+        doc = {'_id': 'token', 'clusterTime': ts,
+               'documentKey': {'_id': 'foo'}}
+        assert compile(dict(doc, operationType='insert')) == \
+            Event('insert', 'foo', None, version)
+        assert compile(dict(doc, operationType='replace')) == \
+            Event('modify', 'foo', None, version)
+        assert compile(dict(doc, operationType='delete')) == \
+            Event('remove', 'foo', None, version)
+        desc = {'updatedFields': {'a.b': 1, 'c': 2}, 'removedFields': ['d']}
+        update = dict(doc, operationType='update', updateDescription=desc)
+        assert compile(update) == \
+            Event('modify', 'foo', [('a', 'b'), ('c', ), ('d', )], version)
+        assert compile(dict(doc, operationType='drop')) == \
+            Event('reset', None, None, version)
+
+        # Counters have no AID and must thus not produce an event. This
+        # includes their updates after the feed learned about them.
+        oid = bson.objectid.ObjectId()
+        legacy = {}
+        doc['documentKey']['_id'] = oid
+        full = {'_id': oid, 'aid': 'cnt', 'value': 1}
+        assert compile(dict(doc, operationType='insert', fullDocument=full),
+                       legacy) is None
+        assert legacy == {oid: None}
+        update['documentKey'] = {'_id': oid}
+        assert compile(update, legacy) is None
+        assert compile(dict(doc, operationType='delete'), legacy) is None
+        assert legacy == {}
+
+        # Documents with an ObjectId that are not counters predate the
+        # AID as '_id' convention. The feed must resolve their AID.
+        full = {'_id': oid, 'aid': 'bar', 'template': 'foo'}
+        assert compile(dict(doc, operationType='replace', fullDocument=full),
+                       legacy) == Event('modify', 'bar', None, version)
+        assert compile(update, legacy) == \
+            Event('modify', 'bar', [('a', 'b'), ('c', ), ('d', )], version)
+        assert compile(dict(doc, operationType='delete'), legacy) == \
+            Event('remove', 'bar', None, version)
+        assert legacy == {}
+
+        # Unknown ObjectIds must make the subscribers reload everything.
+        assert compile(dict(doc, operationType='delete'), legacy) == \
+            Event('reset', None, None, version)
+
+        # Tail a mocked change stream. The collection already contains a
+        # counter and an old document with an ObjectId, and the feed must
+        # report the changes to the latter. It must also reopen the stream
+        # after the last event invalidated it.
+        cnt_id, old_id = bson.objectid.ObjectId(), bson.objectid.ObjectId()
+        col = mock.MagicMock()
+        col.find.return_value = [
+            {'_id': cnt_id, 'aid': 'cnt', 'value': 1},
+            {'_id': old_id, 'aid': 'old', 'template': 'foo'},
+        ]
+        doc['documentKey']['_id'] = 'foo'
+        stream = mock.MagicMock()
+        stream.alive = True
+        docs = [dict(doc, operationType='insert'),
+                dict(update, documentKey={'_id': cnt_id}),
+                dict(update, documentKey={'_id': old_id}),
+                dict(doc, operationType='invalidate', _id='last')]
+        stream.try_next.side_effect = lambda: docs.pop(0) if docs else None
+        col.watch.return_value = stream
+        feed = datastore.ChangeFeedMongo(col)
+        events = []
+        while len(events) < 3:
+            events += feed.poll(timeout=1)
+        assert [(_.op, _.aid) for _ in events] == [
+            ('insert', 'foo'), ('modify', 'old'), ('reset', None)]
+        stream.alive = False
+        for ii in range(100):
+            if col.watch.call_count > 1:
+                break
+            time.sleep(0.01)
+        assert col.watch.call_args[1]['start_after'] == 'last'
+        feed.close()
+        feed.thread.join(1)
+        assert not feed.thread.is_alive()
+
+        # The datastore must report if it does not support change feeds.
+        db = datastore.DatastoreMongo(name=('test1', 'test2'))
+        with mock.patch.object(db.db, 'watch') as m_watch:
+            m_watch.side_effect = datastore.pymongo.errors.OperationFailure('')
+            assert not db.subscribe().ok
+
+    def test_mongo_legacy_documents(self):
+        """
+        The Mongo datastore must support the documents of older versions,
+        whose '_id' is an ObjectId instead of their AID.
+        """
+        db = datastore.DatastoreMongo(name=('test1', 'test2'))
+        assert db.reset().ok
+        db.db.insert_one({'aid': '1', 'a': 1})
+        assert db.db.find_one({'aid': '1'})['_id'] != '1'
+
+        # Putting the document again must neither insert it again nor
+        # overwrite it.
+        ret = db.put({'1': {'data': {'a': 2}}, '2': {'data': {'a': 3}}})
+        assert ret == (True, None, {'1': False, '2': True})
+        assert db.getAll() == (True, None, {'1': {'a': 1}, '2': {'a': 3}})
+
+        # All other operations must work as usual.
+        ops = {'1': {'inc': {}, 'set': {('b', ): 2}, 'unset': [],
+                     'exists': {}}}
+        assert db.modify(ops) == (True, None, {'1': True})
+        assert db.replace({'1': {'data': {'c': 3}}}) == \
+            (True, None, {'1': True})
+        assert db.getOne('1') == (True, None, {'c': 3})
+        assert db.remove(['1']) == (True, None, 1)
+        assert db.getAll() == (True, None, {'2': {'a': 3}})
+
 
 class TestDatastoreInMemory:
     """
@@ -638,6 +1356,53 @@ class TestDatastoreInMemory:
         self.db.setKey(src, ['c', 'd', 'e'], -2)
         assert src == {'x': -1, 'a': {'b': -2}, 'c': {'d': {'e': -2}}, 'z': -1}
 
+    def test_read_only_documents(self):
+        """
+        The documents are read-only and shared with the callers instead of
+        copied. Modifications must only copy the sub-documents along the
+        modified keys and leave previously returned documents intact.
+        """
+        db = self.db
+        data = {'a': {'b': 1, 'c': [1, 2]}, 'd': {'e': {'f': 2}}}
+        assert db.put({'1': {'data': data}}).ok
+
+        # The data store must not keep a reference to the original data.
+        data['a']['b'] = 10
+        doc = db.getOne('1').data
+        assert doc == {'a': {'b': 1, 'c': [1, 2]}, 'd': {'e': {'f': 2}}}
+
+        # Queries return the same (read-only) document without copying it.
+        assert db.getAll().data['1'] is doc
+        assert db.getMulti(['1']).data['1'] is doc
+        assert db.getOne('1', [('d', )]).data['d'] is doc['d']
+        for fun, args in [(doc.__setitem__, ('x', 1)), (doc.pop, ('a', )),
+                          (doc.update, ({}, )), (doc['a'].clear, ()),
+                          (doc['a']['c'].append, (3, ))]:
+            with pytest.raises(TypeError):
+                fun(*args)
+        with pytest.raises(TypeError):
+            del doc['d']['e']
+
+        # Copies and pickled documents must be ordinary (mutable) containers.
+        for tmp in (copy.deepcopy(doc), pickle.loads(pickle.dumps(doc))):
+            assert type(tmp) is dict and type(tmp['a']['c']) is list
+            assert tmp == doc
+
+        # Modify the document. This must copy the path to the modified keys
+        # and share all other sub-documents with the previous version.
+        mod = {'inc': {('a', 'b'): 1}, 'set': {('x', 'y'): 2},
+               'unset': [], 'exists': {}}
+        assert db.modify({'1': mod}) == (True, None, {'1': True})
+        new = db.getOne('1').data
+        assert new == {'a': {'b': 2, 'c': [1, 2]}, 'd': {'e': {'f': 2}},
+                       'x': {'y': 2}}
+        assert doc == {'a': {'b': 1, 'c': [1, 2]}, 'd': {'e': {'f': 2}}}
+        assert new['a'] is not doc['a']
+        assert new['a']['c'] is doc['a']['c']
+        assert new['d'] is doc['d']
+        with pytest.raises(TypeError):
+            new['x']['y'] = 3
+
 
 class TestHelperFunctions:
     """
@@ -667,6 +1432,85 @@ class TestHelperFunctions:
         datastore.dbHandles = {}
         datastore.getDSHandle('ObjInstances')
 
+    def test_init_cached(self):
+        """
+        The 'init' function must wrap the datastores listed in
+        `config.datastore_cache` into read-through caches.
+        """
+        cache = {'ObjInstances': [('template', 'rbs')]}
+        with mock.patch.object(config, 'datastore_cache', cache):
+            assert datastore.init(flush=False).ok
+        db = datastore.getDSHandle('ObjInstances')
+        assert isinstance(db, datastore.DatastoreCached)
+        assert isinstance(db.backend, datastore.DatastoreMongo)
+        assert db.volatile == [('template', 'rbs')]
+        db = datastore.getDSHandle('Templates')
+        assert isinstance(db, datastore.DatastoreMongo)
+
+        # Restore the default handles.
+        assert datastore.init(flush=False).ok
+        db = datastore.getDSHandle('ObjInstances')
+        assert isinstance(db, datastore.DatastoreMongo)
+
+    def test_init_packed(self):
+        """
+        The 'init' function must wrap the object instances into a
+        `DatastorePacked` if `config.datastore_pack_rbs` is set.
+        """
+        cache = {'ObjInstances': []}
+        with mock.patch.object(config, 'datastore_pack_rbs', True), \
+                mock.patch.object(config, 'datastore_cache', cache):
+            assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('ObjInstances')
+        assert isinstance(db, datastore.DatastoreCached)
+        assert isinstance(db.backend, datastore.DatastorePacked)
+        assert db.backend.key == ('template', 'rbs')
+        assert db.indexes == [('templateID', )]
+
+        # Restore the default handles.
+        assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('ObjInstances')
+        assert isinstance(db, datastore.DatastoreMongo)
+
+    def test_init_partitions(self):
+        """
+        The 'init' function must partition the datastores listed in
+        `config.datastore_partitions`.
+        """
+        partitions = {'Constraints': 3}
+        with mock.patch.object(config, 'datastore_partitions', partitions):
+            assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('Constraints')
+        assert isinstance(db, datastore.DatastorePartitioned)
+        assert [_.name_col for _ in db.backends] == [
+            'Constraints_0', 'Constraints_1', 'Constraints_2']
+        assert all(_.indexes == [('rb_a', ), ('rb_b', )] for _ in db.backends)
+        db = datastore.getDSHandle('Counters')
+        assert isinstance(db, datastore.DatastoreMongo)
+
+        # Restore the default handles.
+        assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('Constraints')
+        assert isinstance(db, datastore.DatastoreMongo)
+
+    def test_init_indexes(self):
+        """
+        The 'init' function must create the secondary indexes listed in
+        `config.datastore_indexes`.
+        """
+        indexes = {'ObjInstances': [('template', 'rbs', 'imass')]}
+        with mock.patch.object(config, 'datastore_indexes', indexes):
+            assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('ObjInstances')
+        assert db.indexes == [('template', 'rbs', 'imass')]
+        assert datastore.getDSHandle('Templates').indexes == []
+        assert 'template.rbs.imass_1' in db.db.index_information()
+
+        # Restore the default handles.
+        assert datastore.init(flush=True).ok
+        db = datastore.getDSHandle('Constraints')
+        assert db.indexes == [('rb_a', ), ('rb_b', )]
+
     @mock.patch.object(datastore, 'init')
     def test_getDSHandle_invalid(self, m_init):
         """
@@ -691,6 +1535,92 @@ class TestHelperFunctions:
             datastore.getDSHandle('foo')
         assert m_init.call_count == 1
 
+    @mock.patch.object(config.pymongo, 'MongoClient')
+    def test_mongo_client_registry(self, m_client):
+        """
+        All Mongo datastores, Dibbler instances etc must share the same client
+        per process and timeout. A forked process must not inherit them.
+        """
+        config.resetMongoClients()
+        m_client.side_effect = lambda **kwargs: mock.MagicMock()
+
+        # The first call creates the client, all subsequent ones reuse it.
+        c1 = config.getMongoClient(timeout=1.0)
+        assert config.getMongoClient(timeout=1.0) is c1
+        assert config.getMongoClient(timeout=1.0) is c1
+        assert m_client.call_count == 1
+        kwargs = m_client.call_args[1]
+        assert kwargs['maxPoolSize'] == config.mongo_pool_max
+        assert kwargs['minPoolSize'] == config.mongo_pool_min
+
+        # A different timeout requires a different client.
+        c2 = config.getMongoClient(timeout=2.0)
+        assert c2 is not c1
+        stats = config.getMongoClientStats()
+        keys = ('created', 'reused', 'clients')
+        assert tuple(stats[_] for _ in keys) == (2, 2, 2)
+
+        # The datastores must use the shared client as well.
+        datastore.DatastoreMongo(('foo', 'bar'))
+        datastore.DatastoreMongo(('foo', 'baz'))
+        assert m_client.call_count == 2
+        assert config.getMongoClientStats()['reused'] == 4
+
+        # Pretend the process was forked. The registry must drop the clients
+        # without closing them since they still belong to the parent.
+        with mock.patch.object(config.os, 'getpid') as m_pid:
+            m_pid.return_value = stats['pid'] + 1
+            c3 = config.getMongoClient(timeout=1.0)
+            assert c3 is not c1
+            assert c1.close.call_count == c2.close.call_count == 0
+            stats = config.getMongoClientStats()
+            assert tuple(stats[_] for _ in keys) == (1, 0, 1)
+            assert stats['pid'] == m_pid.return_value
+
+            # Resetting the registry in the same process closes the clients.
+            config.resetMongoClients()
+            assert c3.close.call_count == 1
+        config.resetMongoClients()
+        assert config.getMongoClientStats()['clients'] == 0
+
+    @mock.patch.object(config.pymongo, 'MongoClient')
+    def test_mongo_client_registry_concurrent(self, m_client):
+        """
+        Threads that request the same client at the same time must all
+        receive the one client created for them.
+        """
+        config.resetMongoClients()
+
+        # Make the client creation slow enough to provoke a race.
+        def newClient(**kwargs):
+            time.sleep(0.01)
+            return mock.MagicMock()
+        m_client.side_effect = newClient
+
+        # Let all threads request the client for one of two timeouts at once.
+        num_threads = 16
+        barrier = threading.Barrier(num_threads)
+        clients = [None] * num_threads
+
+        def request(idx):
+            barrier.wait()
+            clients[idx] = config.getMongoClient(timeout=1.0 + idx % 2)
+
+        threads = [threading.Thread(target=request, args=(_, ))
+                   for _ in range(num_threads)]
+        [_.start() for _ in threads]
+        [_.join() for _ in threads]
+
+        # Exactly one client per timeout.
+        assert m_client.call_count == 2
+        assert len({id(_) for _ in clients[0::2]}) == 1
+        assert len({id(_) for _ in clients[1::2]}) == 1
+        assert clients[0] is not clients[1]
+        stats = config.getMongoClientStats()
+        keys = ('created', 'reused', 'clients')
+        assert tuple(stats[_] for _ in keys) == (2, num_threads - 2, 2)
+        config.resetMongoClients()
+
     def test_datastore_validJsonKey(self):
         """
         Verify that 'DatastoreBase.validJsonKey' only admits valid JSON
@@ -746,6 +1676,31 @@ class TestHelperFunctions:
         # Projection contains a string with a dot.
         assert datastore._checkGetAll([['a', 'b.c']]) is False
 
+    def test_invalid_args_query(self):
+        """
+        Create invalid arguments for 'query'.
+        """
+        # Valid.
+        assert datastore._checkQuery({}, None) is True
+        query = {('a', 'b'): 'x', ('c', ): 1.5}
+        assert datastore._checkQuery(query, None) is True
+        assert datastore._checkQuery({('a', ): 1}, [('x', 'y')]) is True
+
+        # Filter is not a dictionary.
+        assert datastore._checkQuery([('a', 1)], None) is False
+
+        # Invalid key hierarchies.
+        assert datastore._checkQuery({'a': 1}, None) is False
+        assert datastore._checkQuery({('a.b', ): 1}, None) is False
+        assert datastore._checkQuery({('a', 2): 1}, None) is False
+
+        # Values must be strings or numbers.
+        for value in (None, True, [1], {'a': 1}):
+            assert datastore._checkQuery({('a', ): value}, None) is False
+
+        # Invalid projection.
+        assert datastore._checkQuery({('a', ): 1}, [['a', 'b.c']]) is False
+
     def test_invalid_args_put(self):
         """
         Create invalid arguments for 'put'.
@@ -777,6 +1732,13 @@ class TestHelperFunctions:
         assert datastore._checkRemove([['blah']]) is False
         assert datastore._checkRemove(['blah', 1]) is False
 
+        # Invalid match conditions.
+        assert datastore._checkRemove(['blah'], ['blah']) is False
+        assert datastore._checkRemove(['blah'], {'blah': 1}) is False
+        assert datastore._checkRemove(['blah'], {'blah': {'a': 1}}) is False
+        assert datastore._checkRemove(['blah'], {1: {('a', ): 1}}) is False
+        assert datastore._checkRemove(['blah'], {'blah': {('a', ): 1}})
+
     def test_invalid_args_mod(self):
         """
         Create invalid arguments for 'mod'.
@@ -0,0 +1,96 @@
+# Copyright 2015, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Test the analytic force profiles.
+"""
+import pytest
+import numpy as np
+import azrael.force_profiles
+
+from IPython import embed as ipshell
+from azrael.aztypes import ForceProfile
+from azrael.test.test import getRigidBody
+
+
+class TestForceProfiles:
+    def test_invalid(self):
+        """
+        Invalid profiles must not compile.
+        """
+        with pytest.raises(TypeError):
+            ForceProfile('foo', 'force', {})
+        with pytest.raises(TypeError):
+            ForceProfile('sine', 'bar', {'amplitude': [1, 2, 3],
+                                         'frequency': 1})
+        with pytest.raises(TypeError):
+            ForceProfile('ramp', 'force', {'start': [0, 0, 0],
+                                           'stop': [1, 1, 1],
+                                           't0': 2, 't1': 1})
+        with pytest.raises(TypeError):
+            ForceProfile('piecewise', 'force', {'times': [1, 0],
+                                                'values': [[0, 0, 0]] * 2})
+        with pytest.raises(TypeError):
+            ForceProfile('spring', 'torque', {'position': [0, 0, 0],
+                                              'stiffness': 1})
+
+        # The profiles container must reject them as well.
+        fp = azrael.force_profiles.ForceProfiles()
+        assert not fp.setProfiles('1', 0, [('foo', 'force', {})]).ok
+
+    def test_evaluate(self):
+        """
+        Evaluate every profile type and verify the result.
+        """
+        fp = azrael.force_profiles.ForceProfiles()
+        assert fp.evaluate(0, {}) == {}
+
+        # Object 1: a sine force and a ramp torque.
+        sine = ForceProfile('sine', 'force', {
+            'amplitude': [1, 2, 0], 'frequency': 0.25, 'offset': [0, 0, 1]})
+        ramp = ForceProfile('ramp', 'torque', {
+            'start': [0, 0, 0], 'stop': [4, 0, 0], 't0': 1, 't1': 3})
+        assert fp.setProfiles('1', 0, [sine, ramp]).ok
+
+        # Object 2: two piecewise tables and a spring (installed at t=1).
+        pw = ForceProfile('piecewise', 'force', {
+            'times': [0, 2], 'values': [[0, 0, 0], [2, 4, 6]]})
+        spring = ForceProfile('spring', 'force', {
+            'position': [1, 1, 1], 'stiffness': 2, 'damping': 0.5})
+        assert fp.setProfiles('2', 1, [pw, pw._asdict(), spring]).ok
+
+        # Evaluate the profiles at t=2.
+        bodies = {
+            '1': getRigidBody(),
+            '2': getRigidBody(position=[1, 0, 1], velocityLin=[0, 0, 2]),
+        }
+        ret = fp.evaluate(2, bodies)
+        assert set(ret.keys()) == {'1', '2'}
+
+        # Object 1: sin(2 * pi * 0.25 * 2) = 0 and half way up the ramp.
+        assert np.allclose(ret['1'][0], [0, 0, 1])
+        assert np.allclose(ret['1'][1], [2, 0, 0])
+
+        # Object 2: twice the interpolated table at t=1, plus the spring.
+        assert np.allclose(ret['2'][0], [2 + 0, 4 + 2, 6 - 1])
+        assert np.allclose(ret['2'][1], [0, 0, 0])
+
+        # Remove the profiles of the first object.
+        assert fp.removeProfiles('1').ok
+        assert set(fp.evaluate(2, bodies).keys()) == {'2'}
+        assert fp.setProfiles('2', 0, []).ok
+        assert fp.evaluate(2, bodies) == {}
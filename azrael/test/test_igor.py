@@ -20,6 +20,8 @@ Test the Igor module.
 """
 import pytest
 import azrael.igor
+import azrael.datastore
+import unittest.mock as mock
 
 from IPython import embed as ipshell
 from azrael.test.test import killAzrael, getP2P, get6DofSpring2
@@ -300,3 +302,52 @@ class TestClerk:
         # Body 2 features in two constraints whereas body 10 features in none.
         ret = igor.getConstraints(['2', '10'])
         assert sorted(ret.data) == sorted((c1, c2))
+
+    @pytest.mark.parametrize('getCon', _AllConstraintGetters)
+    def test_change_feed(self, getCon):
+        """
+        If the datastore has a change feed then 'updateLocalCache' must only
+        download all constraints once, and afterwards only fetch the changed
+        ones, including those changed by other Igor instances.
+        """
+        # Two Igor instances that share an in-memory datastore.
+        db = azrael.datastore.DatastoreInMemory(('azrael', 'Constraints'))
+        igor_1, igor_2 = azrael.igor.Igor(), azrael.igor.Igor()
+        igor_1.db = igor_2.db = db
+
+        c1 = getCon('foo', '1', '2')
+        c2 = getCon('foo', '2', '3')
+        c3 = getCon('bar', '3', '4')
+        getAll, getMulti = db.getAll, db.getMulti
+        with mock.patch.object(db, 'getAll', wraps=getAll) as m_all, \
+                mock.patch.object(db, 'getMulti', wraps=getMulti) as m_multi:
+            # The first update must download everything.
+            assert igor_1.addConstraints([c1]) == (True, None, [True])
+            assert igor_1.updateLocalCache() == (True, None, 1)
+            assert (m_all.call_count, m_multi.call_count) == (1, 0)
+
+            # Without changes there is nothing to fetch.
+            assert igor_1.updateLocalCache() == (True, None, 1)
+            assert (m_all.call_count, m_multi.call_count) == (1, 0)
+
+            # Add constraints with both instances. Igor 1 must only fetch the
+            # new ones.
+            assert igor_1.addConstraints([c2]) == (True, None, [True])
+            assert igor_2.addConstraints([c3]) == (True, None, [True])
+            assert igor_1.updateLocalCache() == (True, None, 3)
+            assert (m_all.call_count, m_multi.call_count) == (1, 1)
+            ret = igor_1.getConstraints(None).data
+            assert sorted(ret) == sorted([c1, c2, c3])
+
+            # Remove a constraint with the other instance.
+            assert igor_2.removeConstraints([c1]) == (True, None, 1)
+            assert igor_1.updateLocalCache() == (True, None, 2)
+            assert (m_all.call_count, m_multi.call_count) == (1, 2)
+            assert sorted(igor_1.getConstraints(None).data) == sorted([c2, c3])
+            assert igor_1.getConstraints(['1']).data == tuple()
+
+            # A reset must trigger a full download.
+            assert igor_2.reset().ok
+            assert igor_1.updateLocalCache() == (True, None, 0)
+            assert (m_all.call_count, m_multi.call_count) == (2, 2)
+        assert len(db.feeds) == 1
@@ -0,0 +1,112 @@
+# Copyright 2015, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Test the vectorised integrator for isolated bodies.
+"""
+import numpy as np
+import azrael.integrator
+import azrael.bullet_api
+
+from IPython import embed as ipshell
+from azrael.test.test import getRigidBody
+
+
+class TestIntegrator:
+    def test_quaternions(self):
+        """
+        Verify the basic quaternion operations.
+        """
+        integ = azrael.integrator
+
+        # 90 degree rotation around the z-axis.
+        c = np.cos(np.pi / 4)
+        q = np.array([[0, 0, c, c]], np.float64)
+        vec = np.array([[1, 0, 0]], np.float64)
+        assert np.allclose(integ.quatRotate(q, vec), [[0, 1, 0]])
+
+        # Rotating twice by 90 degrees flips the vector.
+        q2 = integ.quatMult(q, q)
+        assert np.allclose(integ.quatRotate(q2, vec), [[-1, 0, 0]])
+
+        # The conjugate must undo the rotation.
+        q_id = integ.quatMult(q, integ.quatConj(q))
+        assert np.allclose(q_id, [[0, 0, 0, 1]])
+
+        # Rotate with 0.5 rad/s for 1s around the z-axis.
+        q = np.array([[0, 0, 0, 1]], np.float64)
+        vRot = np.array([[0, 0, 0.5]], np.float64)
+        q = integ.integrateRotation(q, vRot, 1)
+        assert np.allclose(q, [[0, 0, np.sin(0.25), np.cos(0.25)]])
+
+    def test_compare_with_bullet(self):
+        """
+        The integrator must produce the same result as Bullet.
+        """
+        # Several bodies with different mass, inertia, principal axes, and
+        # linear/angular factors. They are far apart and cannot collide.
+        bodies = [
+            getRigidBody(velocityLin=[1, -1, 0.5]),
+            getRigidBody(position=[10, 2, 3], rotation=[0.2, 0.1, 0.3, 0.9],
+                         com=[0.5, -0.2, 0.1], paxis=[0.1, 0.4, 0.2, 0.8],
+                         inertia=[1, 2, 3], imass=0.5,
+                         velocityLin=[1, -1, 0.5], velocityRot=[0.3, 0.2, -1],
+                         linFactor=[1, 0.5, 1], rotFactor=[1, 1, 0.3]),
+            getRigidBody(position=[-10, 0, 0], imass=2, inertia=[0.5, 0.5, 4],
+                         velocityRot=[20, 0, 1]),
+        ]
+        bodies = [_._replace(rotation=tuple(np.array(_.rotation) /
+                                            np.linalg.norm(_.rotation)))
+                  for _ in bodies]
+        force = np.array([[1, 2, 3], [0, 0, 0], [-1, 0, 2]], np.float64)
+        torque = np.array([[0.5, -0.3, 0.2], [1, 1, 0], [0, 0, 0]], np.float64)
+        dt, substeps = 0.05, 10
+
+        # Let Bullet simulate each body for several steps.
+        world = azrael.bullet_api.PyBulletDynamicsWorld(1)
+        for idx, body in enumerate(bodies):
+            world.setRigidBodyData(str(idx), body)
+        objIDs = [str(_) for _ in range(len(bodies))]
+        for ii in range(3):
+            for idx, objID in enumerate(objIDs):
+                world.applyForceAndTorque(
+                    objID, force[idx].tolist(), torque[idx].tolist())
+            world.compute(objIDs, dt, substeps)
+
+        # Do the same with the integrator.
+        integ = azrael.integrator
+        for ii in range(3):
+            pos, rot, vLin, vRot = integ.integrateBodies(
+                bodies, force, torque, dt, substeps)
+            bodies = [
+                body._replace(position=tuple(pos[idx]),
+                              rotation=tuple(rot[idx]),
+                              velocityLin=tuple(vLin[idx]),
+                              velocityRot=tuple(vRot[idx]))
+                for idx, body in enumerate(bodies)
+            ]
+
+        # Compare the results.
+        for idx, objID in enumerate(objIDs):
+            ret = world.getRigidBodyData(objID)
+            assert ret.ok
+            assert np.allclose(ret.data.position, pos[idx])
+            assert np.allclose(ret.data.vLin, vLin[idx])
+            assert np.allclose(ret.data.vRot, vRot[idx])
+
+            # Quaternions q and -q describe the same rotation.
+            assert np.allclose(np.abs(np.dot(ret.data.rotation, rot[idx])), 1)
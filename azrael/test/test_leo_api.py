@@ -16,6 +16,7 @@
 # along with Azrael. If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
+import unittest.mock as mock
 
 import azrael.datastore
 import azrael.leo_api as leoAPI
@@ -248,6 +249,102 @@ class TestLeonardAPI:
         assert len(ret.data['direct_force']) == 2
         assert len(ret.data['booster_force']) == 2
 
+    def test_commandQueue_coalesce(self):
+        """
+        Newer update commands for the same object must supersede still pending
+        ones, and partial body state updates must be merged.
+        """
+        id_1 = '1'
+
+        # Queue two direct- and booster forces each. Only the last one must
+        # survive.
+        for val in ([1, 2, 3], [4, 5, 6]):
+            assert leoAPI.addCmdDirectForce(id_1, val, val).ok
+            assert leoAPI.addCmdBoosterForce(id_1, val, val).ok
+
+        # Queue two partial body state updates that overlap in one field.
+        assert leoAPI.addCmdModifyBodyState(id_1, {'imass': 2}).ok
+        body = {'imass': 3, 'position': [1, 2, 3]}
+        assert leoAPI.addCmdModifyBodyState(id_1, body).ok
+        assert leoAPI.addCmdModifyBodyState(id_1, {'scale': 4}).ok
+
+        # De-queue the commands and verify that each was coalesced into a
+        # single command.
+        ret = leoAPI.dequeueCommands()
+        assert ret.ok
+        for cmd in ('direct_force', 'booster_force'):
+            assert len(ret.data[cmd]) == 1
+            assert ret.data[cmd][0]['force'] == [4, 5, 6]
+            assert ret.data[cmd][0]['torque'] == [4, 5, 6]
+        assert len(ret.data['modify']) == 1
+        rbs = ret.data['modify'][0]['rbs']
+        assert rbs == {'imass': 3, 'position': [1, 2, 3], 'scale': 4}
+
+    def test_commandQueue_concurrent_update(self):
+        """
+        Commands that are updated while Leonard de-queues them must not be
+        lost.
+        """
+        id_1 = '1'
+        db = azrael.datastore.getDSHandle('Commands')
+        assert leoAPI.addCmdModifyBodyState(id_1, {'imass': 2}).ok
+        assert leoAPI.addCmdDirectForce(id_1, [1, 2, 3], [1, 2, 3]).ok
+
+        # Update both commands right after `dequeueCommands` fetched them.
+        getAll = db.getAll
+
+        def getAllAndUpdate(*args, **kwargs):
+            ret = getAll(*args, **kwargs)
+            assert leoAPI.addCmdModifyBodyState(id_1, {'scale': 4}).ok
+            assert leoAPI.addCmdDirectForce(id_1, [4, 5, 6], [4, 5, 6]).ok
+            return ret
+
+        with mock.patch.object(db, 'getAll', getAllAndUpdate):
+            ret = leoAPI.dequeueCommands()
+        assert ret.ok
+
+        # The de-queued commands must contain the updates.
+        assert len(ret.data['modify']) == 1
+        assert ret.data['modify'][0]['rbs'] == {'imass': 2, 'scale': 4}
+        assert len(ret.data['direct_force']) == 1
+        assert ret.data['direct_force'][0]['force'] == [4, 5, 6]
+
+        # The queue must now be empty.
+        ret = leoAPI.dequeueCommands()
+        assert ret.ok
+        assert ret.data['modify'] == ret.data['direct_force'] == []
+
+    def test_commandQueue_readonly_documents(self):
+        """
+        De-queue commands from a datastore with read-only documents.
+        """
+        # Replace the command queue with an in-memory datastore because its
+        # documents are read-only.
+        db = azrael.datastore.DatastoreInMemory(('azrael', 'Commands'))
+        handles = azrael.datastore.dbHandles
+        handles['Commands'], db = db, handles['Commands']
+        try:
+            id_1, id_2 = '1', '2'
+            assert leoAPI.addCmdSpawn([(id_1, getRigidBody())]).ok
+            assert leoAPI.addCmdModifyBodyState(id_2, {'imass': 2}).ok
+
+            # De-queue the commands.
+            ret = leoAPI.dequeueCommands()
+            assert ret.ok
+            assert [_['objID'] for _ in ret.data['spawn']] == [id_1]
+            modify = ret.data['modify']
+            assert len(modify) == 1
+            assert modify[0]['objID'] == id_2
+            assert modify[0]['cmd'] == 'modify'
+            assert modify[0]['rbs'] == {'imass': 2}
+
+            # The queue must now be empty.
+            ret = leoAPI.dequeueCommands()
+            assert ret.ok
+            assert ret.data['spawn'] == ret.data['modify'] == []
+        finally:
+            handles['Commands'] = db
+
     def test_setRigidBody(self):
         """
         Set and retrieve object attributes like position, velocity,
@@ -1,6 +1,8 @@
+import os
 import json
 import pytest
 import time
+import tempfile
 import azrael.igor
 import azrael.aztypes
 import azrael.leonard
@@ -11,11 +13,13 @@ import azrael.eventstore
 import numpy as np
 import unittest.mock as mock
 import azrael.leo_api as leoAPI
+import azrael.config as config
 
 from azrael.aztypes import RetVal
 from IPython import embed as ipshell
 from azrael.test.test import getCSBox, getCSSphere, getCSEmpty
 from azrael.test.test import getP2P, getLeonard, getRigidBody
+from azrael.test.test import get6DofSpring2
 
 
 # List all available engines. This simplifies the parameterisation of those
@@ -24,6 +28,7 @@ allEngines = [
     azrael.leonard.LeonardBase,
     azrael.leonard.LeonardBullet,
     azrael.leonard.LeonardSweeping,
+    azrael.leonard.LeonardThreaded,
     azrael.leonard.LeonardDistributedZeroMQ,
 ]
 
@@ -340,6 +345,32 @@ class TestLeonardAllEngines:
             assert len(colldata) == 2
             assert len(colldata[0]) == len(colldata[1]) == 3
 
+    @pytest.mark.parametrize('clsLeonard', allEngines[1:])
+    def test_collision_contacts_all_sets(self, clsLeonard):
+        """
+        Leonard must publish the collision contacts of all collision sets in
+        a single message.
+        """
+        leo = getLeonard(clsLeonard)
+        leo.events = mock.create_autospec(azrael.eventstore.EventStore)
+        leo.events.publish.return_value = RetVal(True, None, None)
+
+        # Spawn two pairs of touching bodies, far apart from each other.
+        bodies = [
+            ('1', getRigidBody(position=[0, 0, 0])),
+            ('2', getRigidBody(position=[0, 0, 0])),
+            ('3', getRigidBody(position=[20, 0, 0])),
+            ('4', getRigidBody(position=[20, 0, 0])),
+        ]
+        assert leoAPI.addCmdSpawn(bodies).ok
+        leo.step(1, 1)
+
+        # One message must contain the contacts of both pairs.
+        assert leo.events.publish.call_count == 1
+        _, kwargs = leo.events.publish.call_args
+        msg = json.loads(kwargs['msg'].decode('utf8'))
+        assert sorted((_[0], _[1]) for _ in msg) == [('1', '2'), ('3', '4')]
+
     @pytest.mark.parametrize('clsLeonard', allEngines)
     def test_collision_contacts_eventstore(self, clsLeonard):
         """
@@ -581,6 +612,7 @@ class TestLeonardOther:
         data = [WPDataOut(*_) for _ in ret.data['wpdata']]
         meta = WPMeta(*ret.data['wpmeta'])
         assert (meta.dt, meta.maxsteps) == (dt, maxsteps)
+        assert meta.substeps == 1
         assert (ret.ok, len(data)) == (True, 2)
         assert (data[0].aid, data[1].aid) == (id_1, id_2)
         assert getRigidBody(*data[0].rbs) == body_1
@@ -588,6 +620,83 @@ class TestLeonardOther:
         assert np.array_equal(data[0].force, [0, 0, 0])
         assert np.array_equal(data[1].force, [0, 0, 0])
 
+    def test_workerBodyCache(self):
+        """
+        Workers must purge removed objects and evict the least recently used
+        bodies once their cache exceeds the budget.
+        """
+        # The budget defaults to the config value.
+        worker = azrael.leonard.LeonardWorkerZeroMQ(0, 100)
+        assert worker.maxBodies == config.worker_max_bodies
+        with mock.patch.object(config, 'worker_max_bodies', 2):
+            worker = azrael.leonard.LeonardWorkerZeroMQ(0, 100)
+        assert worker.maxBodies == 2
+
+        # Get a Leonard instance and a Worker with room for two bodies.
+        leo = getLeonard(azrael.leonard.LeonardDistributedZeroMQ)
+        id_1, id_2, id_3 = '1', '2', '3'
+
+        # Spawn three bodies far apart.
+        tmp = [(id_1, getRigidBody(position=[0, 0, 0])),
+               (id_2, getRigidBody(position=[10, 0, 0])),
+               (id_3, getRigidBody(position=[20, 0, 0]))]
+        assert leoAPI.addCmdSpawn(tmp).ok
+        leo.processCommandsAndSync()
+
+        def process(objIDs):
+            wp = leo.createWorkPackage(objIDs, 0.1, 1).data
+            worker.computePhysicsForWorkPackage(wp)
+            return set(worker.bullet.rigidBodies.keys())
+
+        # Process one Work Package per body: the worker must evict the least
+        # recently used one.
+        assert process([id_1]) == {id_1}
+        assert process([id_2]) == {id_1, id_2}
+        assert process([id_3]) == {id_2, id_3}
+        assert process([id_2]) == {id_2, id_3}
+        assert process([id_1]) == {id_1, id_2}
+
+        # The bodies of the current Work Package are never evicted, even if
+        # they exceed the budget.
+        assert process([id_1, id_2, id_3]) == {id_1, id_2, id_3}
+        assert process([id_3]) == {id_2, id_3}
+
+        # Remove a body: the next Work Package must tell the worker about it.
+        assert leoAPI.addCmdRemoveObject(id_2).ok
+        leo.processCommandQueue()
+        assert list(leo.removedLog)[-1] == [id_2]
+        wp = leo.createWorkPackage([id_3], 0.1, 1).data
+        assert wp['wpremoved'] == [id_2]
+        worker.computePhysicsForWorkPackage(wp)
+        assert set(worker.bullet.rigidBodies.keys()) == {id_3}
+        assert list(worker.bodyLRU.keys()) == [id_3]
+
+    def test_workerSubsteps(self):
+        """
+        Workers must report the sub-steps they actually used, including the
+        fall back to `maxsteps` because of grid forces.
+        """
+        vg = azrael.vectorgrid
+        leo = getLeonard(azrael.leonard.LeonardDistributedZeroMQ)
+        worker = azrael.leonard.LeonardWorkerZeroMQ(0, 100)
+        assert leoAPI.addCmdSpawn([('1', getRigidBody())]).ok
+        leo.processCommandsAndSync()
+
+        # Without forces one sub-step suffices, and creating the Work Package
+        # must not count it.
+        wp = leo.createWorkPackage(['1'], 1.0, 60).data
+        assert azrael.aztypes.WPMeta(*wp['wpmeta']).substeps == 1
+        assert set(leo.substepsStep.values()) == {0}
+        assert worker.computePhysicsForWorkPackage(wp)['substeps'] == 1
+
+        # A grid force at the body position forces `maxsteps`.
+        assert vg.defineGrid(name='force', vecDim=3, granularity=1).ok
+        pos = np.zeros(3, np.float64)
+        assert vg.setValues('force', [(pos, np.ones(3, np.float64))]).ok
+        wp = leo.createWorkPackage(['1'], 1.0, 60).data
+        assert azrael.aztypes.WPMeta(*wp['wpmeta']).substeps == 1
+        assert worker.computePhysicsForWorkPackage(wp)['substeps'] == 60
+
     def test_updateLocalCache(self):
         """
         Update the local object cache in Leonard based on a Work Package.
@@ -736,6 +845,668 @@ class TestLeonardOther:
             assert tmp.forceBoost == [-3, -2, -1]
             assert tmp.torqueBoost == [-6, -5, -4]
 
+    def test_processCommandQueue_backlog(self):
+        """
+        Leonard must spawn at most ``maxIngest`` objects per call and carry
+        the remaining spawn commands (and their pending updates) over to the
+        next call.
+        """
+        # Get a Leonard instance and limit its ingestion rate.
+        leo = getLeonard(azrael.leonard.LeonardBase)
+        leo.maxIngest = 2
+
+        # Use a command queue with read-only documents.
+        db = azrael.datastore.DatastoreInMemory(('azrael', 'Commands'))
+        handles = azrael.datastore.dbHandles
+        with mock.patch.dict(handles, {'Commands': db}):
+            # Spawn five objects.
+            objIDs = ['1', '2', '3', '4', '10']
+            tmp = [(_, getRigidBody(imass=1)) for _ in objIDs]
+            assert leoAPI.addCmdSpawn(tmp).ok
+
+            # Update the state of an object that is still in the backlog and
+            # remove another one before it was ever spawned.
+            assert leoAPI.addCmdModifyBodyState('10', {'imass': 5}).ok
+            assert leoAPI.addCmdRemoveObject('4').ok
+
+            # Leonard must spawn the objects in the order they were created.
+            leo.processCommandsAndSync()
+            assert set(leo.allBodies) == {'1', '2'}
+
+            # Update the object in the backlog once more.
+            assert leoAPI.addCmdModifyBodyState('10', {'scale': 2}).ok
+            leo.processCommandsAndSync()
+            assert set(leo.allBodies) == {'1', '2', '3', '10'}
+            assert len(leo.cmdBacklog) == 0
+
+        # Leonard must have applied both updates once the object existed.
+        assert leo.allBodies['10'].imass == 5
+        assert leo.allBodies['10'].scale == 2
+        assert all([len(_) == 0 for _ in leo.cmdPending.values()])
+
+        # Leonard must discard updates for objects it does not know.
+        assert leoAPI.addCmdDirectForce('4', [1, 2, 3], [4, 5, 6]).ok
+        leo.processCommandsAndSync()
+        assert '4' not in leo.allBodies
+        assert all([len(_) == 0 for _ in leo.cmdPending.values()])
+
+    def test_processSchedules(self):
+        """
+        Leonard must apply scheduled commands at the matching simulation
+        steps, and a new schedule must replace the current one.
+        """
+        # Get a Leonard instance and spawn an object.
+        leo = getLeonard(azrael.leonard.LeonardBase)
+        objID, dt = '1', 0.1
+        assert leoAPI.addCmdSpawn([(objID, getRigidBody(imass=1))]).ok
+
+        # Schedule three commands. The ones at 0.15s must apply in the second
+        # step, the one at 0.35s in the fourth.
+        entries = [
+            (0.35, 'direct_force', [0, 0, 1], [0, 0, 0]),
+            (0.15, 'direct_force', [1, 0, 0], [0, 1, 0]),
+            (0.15, 'booster_force', [2, 0, 0], [0, 2, 0]),
+        ]
+        assert leoAPI.addCmdSchedule(objID, entries).ok
+        assert not leoAPI.addCmdSchedule(objID, [(-1, 'foo', [], [])]).ok
+
+        leo.step(dt, 1)
+        assert leo.allForces[objID].forceDirect == [0, 0, 0]
+        assert leo.schedStatus[objID]['state'] == 'active'
+
+        leo.step(dt, 1)
+        tmp = leo.allForces[objID]
+        assert tmp.forceDirect == [1, 0, 0] and tmp.torqueDirect == [0, 1, 0]
+        assert tmp.forceBoost == [2, 0, 0] and tmp.torqueBoost == [0, 2, 0]
+        assert leo.schedStatus[objID] == {
+            'state': 'active', 'applied': 2, 'remaining': 1}
+
+        # Cancel the schedule. The last command must thus never apply.
+        assert leoAPI.addCmdSchedule(objID, []).ok
+        for ii in range(3):
+            leo.step(dt, 1)
+        assert leo.allForces[objID].forceDirect == [1, 0, 0]
+        assert leo.schedStatus[objID]['state'] == 'cancelled'
+        assert abs(leo.simTime - 5 * dt) < 1E-9
+
+        # Schedules must disappear with their object.
+        assert leoAPI.addCmdSchedule(objID, entries).ok
+        leo.step(dt, 1)
+        assert leoAPI.addCmdRemoveObject(objID).ok
+        leo.step(dt, 1)
+        assert objID not in leo.schedStatus
+        for ii in range(5):
+            leo.step(dt, 1)
+
+    def test_forceProfiles(self):
+        """
+        Leonard must add the value of the force profiles to the total force
+        and torque in every step.
+        """
+        # Get a Leonard instance and spawn an object.
+        leo = getLeonard(azrael.leonard.LeonardBase)
+        objID, dt = '1', 0.5
+        assert leoAPI.addCmdSpawn([(objID, getRigidBody(imass=1))]).ok
+
+        # Install a ramp for the force and apply a direct torque.
+        ramp = azrael.aztypes.ForceProfile('ramp', 'force', {
+            'start': [0, 0, 0], 'stop': [2, 0, 0], 't0': 0, 't1': 1})
+        assert leoAPI.addCmdForceProfiles(objID, [ramp]).ok
+        assert not leoAPI.addCmdForceProfiles(objID, [('foo', 'bar', {})]).ok
+        assert leoAPI.addCmdDirectForce(objID, [0, 1, 0], [0, 0, 1]).ok
+
+        # The ramp must start at zero and grow in every step.
+        for force_x in (0, 1, 2, 2):
+            leo.step(dt, 1)
+            force, torque = leo.totalForceAndTorque(objID)
+            assert np.allclose(force, [force_x, 1, 0])
+            assert np.allclose(torque, [0, 0, 1])
+
+        # Remove the profile.
+        assert leoAPI.addCmdForceProfiles(objID, []).ok
+        leo.step(dt, 1)
+        force, torque = leo.totalForceAndTorque(objID)
+        assert np.allclose(force, [0, 1, 0])
+
+    def test_fastPath(self):
+        """
+        Isolated bodies must bypass Bullet yet move exactly as if Bullet had
+        simulated them.
+        """
+        # Get a Leonard instance and mock its EventStore (the overlapping
+        # bodies will collide).
+        leo = getLeonard(azrael.leonard.LeonardSweeping)
+        mock_es = mock.create_autospec(azrael.eventstore.EventStore)
+        mock_es.publish.return_value = RetVal(True, None, None)
+        leo.events = mock_es
+
+        # Spawn three bodies. The first two are far apart and isolated, the
+        # third one overlaps with the second.
+        id_0, id_1, id_2 = '0', '1', '2'
+        body_0 = getRigidBody(position=[0, 0, 0], velocityLin=[1, 0, 0],
+                              velocityRot=[0, 1, 0], inertia=[1, 2, 3])
+        body_1 = getRigidBody(position=[10, 0, 0], velocityRot=[0, 0, 1])
+        body_2 = getRigidBody(position=[10, 0.5, 0], imass=0.5)
+        tmp = [(id_0, body_0), (id_1, body_1), (id_2, body_2)]
+        assert leoAPI.addCmdSpawn(tmp).ok
+        assert leoAPI.addCmdDirectForce(id_0, [1, 2, 3], [0.1, 0.2, 0.3]).ok
+        leo.processCommandQueue()
+
+        # Only the first body is isolated.
+        collSets = [{id_0}, {id_1, id_2}]
+        isolated, remaining = leo.splitCollisionSets(collSets, [])
+        assert isolated == [id_0]
+        assert remaining == [{id_1, id_2}]
+
+        # Constraints disqualify a body.
+        isolated, remaining = leo.splitCollisionSets(collSets, [(id_0, id_2)])
+        assert isolated == []
+        assert remaining == collSets
+
+        # Advance the simulation with- and without the fast path.
+        bodies = dict(leo.allBodies)
+        leo.step(1.0, 60)
+        ret_fast = dict(leo.allBodies)
+
+        leo.allBodies = bodies
+        leo.fastPath = False
+        leo.step(1.0, 60)
+        ret_bullet = dict(leo.allBodies)
+
+        # Both must yield the same result.
+        for objID in (id_0, id_1, id_2):
+            b_fast, b_bullet = ret_fast[objID], ret_bullet[objID]
+            assert np.allclose(b_fast.position, b_bullet.position)
+            assert np.allclose(b_fast.rotation, b_bullet.rotation)
+            assert np.allclose(b_fast.velocityLin, b_bullet.velocityLin)
+            assert np.allclose(b_fast.velocityRot, b_bullet.velocityRot)
+        assert ret_fast[id_0].position[0] > 1
+
+    def test_threaded(self):
+        """
+        The threaded Leonard must distribute the collision sets over its
+        engines and produce the same result as ``LeonardSweeping``.
+        """
+        # Distribute the collision sets evenly (by number of bodies).
+        assign = azrael.leonard.LeonardThreaded.assignCollisionSets
+        bins = assign([[1, 2, 3], [4], [5, 6], [7]], 2)
+        assert bins == [[[1, 2, 3], [7]], [[5, 6], [4]]]
+        assert assign([], 3) == [[], [], []]
+
+        # Spawn four pairs of overlapping bodies. The pairs are far apart and
+        # form four independent collision sets.
+        bodies = []
+        for ii in range(4):
+            pos = [20 * ii, 0, 0]
+            bodies.append((str(2 * ii + 1), getRigidBody(
+                position=pos, velocityLin=[1, 0, 0], velocityRot=[0, 0, 1])))
+            pos = [20 * ii, 0.5, 0]
+            bodies.append((str(2 * ii + 2), getRigidBody(position=pos)))
+
+        # Step the simulation with both Leonard instances.
+        results = []
+        for clsLeonard in (azrael.leonard.LeonardSweeping,
+                           azrael.leonard.LeonardThreaded):
+            azrael.datastore.init(flush=True)
+            leo = getLeonard(clsLeonard)
+            mock_es = mock.create_autospec(azrael.eventstore.EventStore)
+            mock_es.publish.return_value = RetVal(True, None, None)
+            leo.events = mock_es
+
+            assert leoAPI.addCmdSpawn(bodies).ok
+            assert leoAPI.addCmdDirectForce('3', [1, 2, 3], [0, 0, 1]).ok
+            leo.step(1.0, 60)
+            results.append(dict(leo.allBodies))
+
+        # The threaded Leonard must have used all engines.
+        assert all(len(_.rigidBodies) == 2 for _ in leo.engines)
+
+        # Both must yield the same result.
+        ret_sweep, ret_thread = results
+        for objID, _ in bodies:
+            b_sweep, b_thread = ret_sweep[objID], ret_thread[objID]
+            assert np.allclose(b_sweep.position, b_thread.position)
+            assert np.allclose(b_sweep.rotation, b_thread.rotation)
+            assert np.allclose(b_sweep.velocityLin, b_thread.velocityLin)
+            assert np.allclose(b_sweep.velocityRot, b_thread.velocityRot)
+
+        # The threaded Leonard must report the collisions of all sets.
+        args = leo.events.publish.call_args_list
+        assert len(args) > 0
+
+    def test_threaded_balance(self):
+        """
+        The threaded Leonard must balance its engines by the number of bodies
+        in the collision sets, not by the number of fields in the jobs.
+        """
+        # Spawn one collision set with four bodies and two with two each.
+        bodies = []
+        for ii, num in enumerate((4, 2, 2)):
+            for jj in range(num):
+                pos = [20 * ii, 0.5 * jj, 0]
+                bodies.append((str(len(bodies) + 1), getRigidBody(
+                    position=pos, velocityLin=[1, 0, 0])))
+        assert leoAPI.addCmdSpawn(bodies).ok
+
+        # Intercept the bins that Leonard assigns to its two engines.
+        leo = azrael.leonard.LeonardThreaded(numThreads=2)
+        leo.setup()
+        mock_es = mock.create_autospec(azrael.eventstore.EventStore)
+        mock_es.publish.return_value = RetVal(True, None, None)
+        leo.events = mock_es
+        assign = leo.assignCollisionSets
+        with mock.patch.object(leo, 'assignCollisionSets',
+                               mock.Mock(wraps=assign)) as m_assign:
+            leo.step(1.0, 60)
+        leo.shutdown()
+
+        # Re-run the assignment with the arguments Leonard used.
+        jobs, numBins = m_assign.call_args[0]
+        bins = assign(jobs, numBins, **m_assign.call_args[1])
+
+        # Every job holds all the data to step one collision set. The four
+        # body set must have an engine to itself.
+        assert len(jobs) == 3 and all(len(_) == 7 for _ in jobs)
+        loads = sorted(sum(len(job[0]) for job in _) for _ in bins)
+        assert loads == [4, 4]
+
+    def test_quality_tiers(self):
+        """
+        Leonard must track the quality tier of every object and use the best
+        tier of each collision set.
+        """
+        leo = getLeonard(azrael.leonard.LeonardBase)
+        profiles = leo.qualityProfiles
+        assert set(profiles.keys()) == set(config.quality_tiers)
+
+        # Invalid quality argument.
+        body = getRigidBody()
+        assert not leoAPI.addCmdSpawn([('1', body, 1)]).ok
+        assert not leoAPI.addCmdSpawn([('1', body, 'low', 'foo')]).ok
+
+        # Spawn objects with different quality tiers.
+        objs = [('1', body), ('2', body, 'low'), ('3', body, 'high'),
+                ('4', body, 'foo'), ('5', body, config.quality_default)]
+        assert leoAPI.addCmdSpawn(objs).ok
+        leo.processCommandQueue()
+        assert leo.allQuality == {'2': 'low', '3': 'high', '4': 'foo'}
+
+        # The best tier of all members determines the profile. Unknown tiers
+        # count as the default tier.
+        get = leo.getQualityProfile
+        assert get([]) == profiles['default']
+        assert get(['1']) == profiles['default']
+        assert get(['2']) == profiles['low']
+        assert get(['1', '2']) == profiles['default']
+        assert get(['2', '3']) == profiles['high']
+        assert get(['4']) == get(['2', '4']) == profiles['default']
+
+        # Isolated objects of every tier use the fast path, unless their
+        # tier must go through Bullet.
+        collSets = [['1'], ['2'], ['3'], ['5']]
+        isolated, rest = leo.splitCollisionSets(collSets, [])
+        assert isolated == ['1', '2', '3', '5']
+        assert rest == []
+        with mock.patch.object(config, 'quality_bullet', ('high', )):
+            isolated, rest = leo.splitCollisionSets(collSets, [])
+        assert isolated == ['1', '2', '5']
+        assert rest == [['3']]
+
+        # Removing an object must also remove its tier.
+        assert leoAPI.addCmdRemoveObject('3').ok
+        leo.processCommandQueue()
+        assert '3' not in leo.allQuality
+
+    def test_quality_tiers_fastPath(self):
+        """
+        Isolated bodies with a non-default quality tier must bypass Bullet
+        yet move exactly as if Bullet had simulated them.
+        """
+        leo = getLeonard(azrael.leonard.LeonardSweeping)
+
+        # Spawn a fast spinning body for every tier. They are all isolated.
+        objs = []
+        for ii, tier in enumerate(config.quality_tiers):
+            body = getRigidBody(position=[10 * ii, 0, 0], inertia=[1, 2, 3],
+                                velocityLin=[4, 0, 0], velocityRot=[1, 2, 3])
+            objs.append((str(ii + 1), body, tier))
+        assert leoAPI.addCmdSpawn(objs).ok
+        leo.processCommandQueue()
+
+        # Advance the simulation with- and without the fast path.
+        bodies = dict(leo.allBodies)
+        leo.step(1.0, 60)
+        ret_fast = dict(leo.allBodies)
+
+        leo.allBodies = bodies
+        leo.fastPath = False
+        leo.step(1.0, 60)
+        ret_bullet = dict(leo.allBodies)
+
+        # Both must yield the same result.
+        for objID, _, _ in objs:
+            b_fast, b_bullet = ret_fast[objID], ret_bullet[objID]
+            assert np.allclose(b_fast.position, b_bullet.position)
+            assert np.allclose(b_fast.rotation, b_bullet.rotation)
+            assert np.allclose(b_fast.velocityLin, b_bullet.velocityLin)
+            assert np.allclose(b_fast.velocityRot, b_bullet.velocityRot)
+
+    def test_getSubsteps(self):
+        """
+        Leonard must select the number of sub-steps of a collision set from
+        the speed of its fastest body, its smallest AABB, the angular
+        velocities, and the stiffness of its constraints.
+        """
+        leo = getLeonard(azrael.leonard.LeonardBase)
+        box = getCSBox(dim=(0.2, 0.2, 0.2))
+        objs = [
+            ('1', getRigidBody()),
+            ('2', getRigidBody(velocityLin=(3, 0, 4))),
+            ('3', getRigidBody(velocityLin=(0, 1, 0), cshapes={'b': box})),
+            ('4', getRigidBody(velocityLin=(5, 0, 0), cshapes={})),
+        ]
+        assert leoAPI.addCmdSpawn(objs).ok
+        leo.processCommandQueue()
+
+        # Bodies at rest and bodies without collision shapes need only one
+        # sub-step.
+        get = leo.getSubsteps
+        assert get([], 1, 60) == 1
+        assert get(['1'], 1, 60) == get(['4'], 1, 60) == 1
+
+        # Body 2 moves 5m in 1s and has a radius of 1m. The AABB of body 3 is
+        # sqrt(3.1) * 0.2m.
+        assert get(['2'], 1, 60) == 5
+        assert get(['2'], 0.1, 60) == 1
+        assert get(['1', '2'], 1, 3) == 3
+        size = np.sqrt(3.1) * 0.2
+        assert get(['2', '3'], 1, 60) == int(np.ceil(5 / size))
+
+        # Body 5 spins with 1rad/s. Its surface moves with 1m/s and it rotates
+        # by 1rad per second.
+        assert leoAPI.addCmdSpawn(
+            [('5', getRigidBody(velocityRot=(0, 0, 1)))]).ok
+        leo.processCommandQueue()
+        assert get(['5'], 1, 60) == int(np.ceil(1 / config.substeps_angle))
+        assert get(['5'], 0.1, 60) == 1
+
+        # Rigid constraints, forces, and disabled adaptive sub-steps always
+        # require the maximum number of sub-steps.
+        p2p = getP2P(rb_a='1', rb_b='2')
+        assert get(['1'], 1, 60, constraints=[p2p]) == 60
+        assert get(['1'], 1, 60, forced=True) == 60
+
+        # Springs require sub-steps according to their natural frequency
+        # (the linear spring of 'get6DofSpring2' has a stiffness of 1 and the
+        # bodies have unit mass).
+        dof = get6DofSpring2(rb_a='1', rb_b='2')
+        ref = int(np.ceil(config.substeps_spring))
+        assert get(['1'], 1, 60, constraints=[dof]) == ref
+
+        # Locked axes are rigid.
+        tmp = dof.condata._replace(linLimitLo=(0, 0, 0), linLimitHi=(0, 0, 0))
+        dof = dof._replace(condata=tmp)
+        assert get(['1'], 1, 60, constraints=[dof]) == 60
+
+        # Leonard must tally the used and saved sub-steps.
+        leo.logSubsteps()
+        total = dict(leo.substepStats)
+        assert set(leo.substepsStep.values()) == {0}
+        get(['1'], 1, 60)
+        get(['2'], 1, 60)
+        assert leo.substepsStep == {'sets': 2, 'substeps': 6, 'saved': 114}
+        leo.logSubsteps()
+        assert leo.substepStats['sets'] == total['sets'] + 2
+        assert leo.substepStats['saved'] == total['saved'] + 114
+
+        # Sub-steps that are not counted must not change the tally.
+        get(['1'], 1, 60, count=False)
+        assert set(leo.substepsStep.values()) == {0}
+
+        leo.adaptiveSubsteps = False
+        assert get(['1'], 1, 60) == 60
+
+        # Isolated bodies bypass Bullet and must not count.
+        leo = getLeonard(azrael.leonard.LeonardSweeping)
+        assert leoAPI.addCmdSpawn([('1', getRigidBody())]).ok
+        leo.step(1, 60)
+        assert leo.substepStats['sets'] == 0
+
+    def test_stepBatch(self):
+        """
+        A batch of steps must produce the same result as individual steps and
+        only synchronise the bodies with the datastore at the end.
+        """
+        # Get a Leonard instance.
+        leo = getLeonard(azrael.leonard.LeonardBase)
+
+        # Spawn a spinning body, a body with a booster force, and a static
+        # body.
+        id_0, id_1, id_2 = '0', '1', '2'
+        body_0 = getRigidBody(velocityLin=[1, 0, 0], velocityRot=[0, 0, 1])
+        body_1 = getRigidBody(position=[0, 5, 0], inertia=[1, 2, 3])
+        body_2 = getRigidBody(position=[0, 0, 5], imass=0,
+                              velocityLin=[1, 0, 0])
+        tmp = [(id_0, body_0), (id_1, body_1), (id_2, body_2)]
+        assert leoAPI.addCmdSpawn(tmp).ok
+        assert leoAPI.addCmdBoosterForce(id_1, [1, 0, 0], [0, 1, 0]).ok
+        leo.processCommandsAndSync()
+        bodies = dict(leo.allBodies)
+
+        # Advance the simulation in five individual steps.
+        for ii in range(5):
+            leo.step(0.1, 10)
+        ret_single = dict(leo.allBodies)
+
+        # Reset the bodies and advance the simulation in a single batch.
+        leo.allBodies = dict(bodies)
+        leo.processCommandsAndSync()
+        with mock.patch.object(leo, 'syncObjects') as m_sync:
+            leo.stepBatch(0.1, 10, 5)
+            assert m_sync.call_count == 1
+        ret_batch = dict(leo.allBodies)
+
+        # Both must yield the same result.
+        for objID in (id_0, id_1, id_2):
+            b_single, b_batch = ret_single[objID], ret_batch[objID]
+            assert np.allclose(b_single.position, b_batch.position)
+            assert np.allclose(b_single.rotation, b_batch.rotation)
+            assert np.allclose(b_single.velocityLin, b_batch.velocityLin)
+            assert np.allclose(b_single.velocityRot, b_batch.velocityRot)
+
+        # The first body moved and rotated about the z-axis, the static body
+        # did not move at all.
+        b_0 = ret_batch[id_0]
+        assert 0.45 < b_0.position[0] < 0.5
+        assert b_0.rotation[0] == b_0.rotation[1] == 0
+        assert b_0.rotation[2] > 0.2
+        assert ret_batch[id_2] == bodies[id_2]
+
+        # The booster force rotates with the body.
+        assert ret_batch[id_1].velocityLin[0] > 0.4
+        assert ret_batch[id_1].velocityRot[1] > 0
+
+        # Only LeonardBase supports batch mode, and the number of steps and
+        # sub-steps must be positive.
+        with pytest.raises(ValueError):
+            azrael.leonard.LeonardSweeping(batchSteps=2)
+        with pytest.raises(ValueError):
+            azrael.leonard.LeonardBase(batchSteps=0)
+        with pytest.raises(ValueError):
+            azrael.leonard.LeonardBase(maxsteps=0)
+
+        # `run` uses the configured number of sub-steps.
+        assert azrael.leonard.LeonardBase().maxsteps == config.leonard_maxsteps
+        with mock.patch.object(config, 'leonard_maxsteps', 3):
+            assert azrael.leonard.LeonardBase().maxsteps == 3
+        assert azrael.leonard.LeonardBase(maxsteps=5).maxsteps == 5
+        for batchSteps in (1, 2):
+            leo = azrael.leonard.LeonardBase(maxsteps=5, batchSteps=batchSteps)
+            leo.step = mock.MagicMock(side_effect=KeyboardInterrupt)
+            leo.stepBatch = mock.MagicMock(side_effect=KeyboardInterrupt)
+            leo.run()
+            if batchSteps == 1:
+                assert leo.step.call_args[1]['maxsteps'] == 5
+            else:
+                assert leo.stepBatch.call_args[0][1:] == (5, 2)
+
+    @pytest.mark.parametrize('clsLeonard', allEngines[:4])
+    def test_snapshot(self, clsLeonard):
+        """
+        Roll back the simulation to a snapshot and resume it from a snapshot
+        file in a new Leonard instance. Both must reproduce the original
+        simulation exactly.
+        """
+        def getLeo():
+            leo = getLeonard(clsLeonard)
+            mock_es = mock.create_autospec(azrael.eventstore.EventStore)
+            mock_es.publish.return_value = RetVal(True, None, None)
+            leo.events = mock_es
+            return leo
+
+        def advance(leo):
+            for ii in range(3):
+                leo.step(0.1, 10)
+            return dict(leo.allBodies)
+
+        # Spawn two colliding bodies and an isolated spinning one. Push the
+        # first body and give the third a force profile.
+        leo = getLeo()
+        bodies = [
+            ('1', getRigidBody(velocityLin=[1, 0, 0])),
+            ('2', getRigidBody(position=[0, 1.5, 0])),
+            ('3', getRigidBody(position=[20, 0, 0], velocityRot=[0, 0, 1])),
+        ]
+        assert leoAPI.addCmdSpawn(bodies).ok
+        assert leoAPI.addCmdDirectForce('1', [0, 2, 0], [0, 0, 1]).ok
+        ramp = {'ptype': 'ramp', 'target': 'force', 'params': {
+            'start': [0, 0, 0], 'stop': [1, 0, 0], 't0': 0, 't1': 1}}
+        assert leoAPI.addCmdForceProfiles('3', [ramp]).ok
+        leo.step(0.1, 10)
+
+        with tempfile.TemporaryDirectory() as dirname:
+            fname = os.path.join(dirname, 'leonard.snapshot')
+
+            # Take a snapshot, advance the simulation, and roll it back.
+            assert leo.takeSnapshot(fname).ok
+            t_snap = leo.simTime
+            ref = advance(leo)
+            assert leo.rollback(t_snap + 0.05) == (True, None, t_snap)
+            assert advance(leo) == ref
+
+            # Resume the simulation from the snapshot file in a new instance.
+            leo_2 = getLeo()
+            assert leo_2.resumeSnapshot(fname).ok
+            assert leo_2.simTime == t_snap
+            assert advance(leo_2) == ref
+
+            # Invalid snapshots.
+            with open(fname, 'wb') as fd:
+                fd.write(b'foo')
+            assert not leo_2.resumeSnapshot(fname).ok
+            assert not leo_2.resumeSnapshot(fname + 'x').ok
+            assert not leo_2.restoreSnapshot(b'foo').ok
+
+        # There is no snapshot before the first one.
+        assert not leo.rollback(0).ok
+        assert len(leo.snapshots) == 0
+
+    def test_snapshot_file_private(self):
+        """
+        Leonard must only use snapshot files that nobody but the current
+        user could have written.
+        """
+        with tempfile.TemporaryDirectory() as dirname:
+            # Leonard must create the snapshot directory.
+            snapdir = os.path.join(dirname, 'snapshots')
+            with mock.patch.object(config, 'snapshot_dir', snapdir):
+                ret = azrael.leonard.getSnapshotFile('foo')
+                fname = os.path.join(snapdir, 'foo.snapshot')
+                assert ret == (True, None, fname)
+                assert os.stat(snapdir).st_mode & 0o777 == 0o700
+
+                # Write a snapshot file.
+                assert azrael.leonard.writeSnapshotFile(fname, b'bar').ok
+                assert os.stat(fname).st_mode & 0o777 == 0o600
+                assert azrael.leonard.readSnapshotFile(fname).data == b'bar'
+
+                # Leonard must not read the file if others could modify it.
+                os.chmod(fname, 0o664)
+                assert not azrael.leonard.readSnapshotFile(fname).ok
+                os.chmod(fname, 0o600)
+
+                # Neither must it read (or write) files in a directory others
+                # could modify.
+                os.chmod(snapdir, 0o777)
+                assert not azrael.leonard.readSnapshotFile(fname).ok
+                assert not azrael.leonard.getSnapshotFile('foo').ok
+                os.chmod(snapdir, 0o700)
+                assert azrael.leonard.readSnapshotFile(fname).ok
+
+                # Symbolic links are not acceptable either.
+                os.symlink(fname, fname + '.link')
+                assert not azrael.leonard.readSnapshotFile(fname + '.link').ok
+
+    def test_snapshot_keep_commands(self):
+        """
+        Leonard must only remove the commands it applied from the queue once
+        a snapshot file covers them, and must apply them again after it
+        resumed from an older snapshot file.
+        """
+        def getLeo():
+            leo = getLeonard(azrael.leonard.LeonardBase)
+            leo.keepCommands = True
+            return leo
+
+        def numCommands():
+            return azrael.datastore.getDSHandle('Commands').count().data
+
+        leo = getLeo()
+        assert leoAPI.addCmdSpawn([('1', getRigidBody(imass=1))]).ok
+        leo.processCommandQueue()
+        assert '1' in leo.allBodies
+
+        # The spawn command must remain in the queue, yet Leonard must not
+        # apply it again.
+        assert numCommands() == 1
+        leo.processCommandQueue()
+        assert set(leo.allBodies) == {'1'}
+
+        with tempfile.TemporaryDirectory() as dirname:
+            fname = os.path.join(dirname, 'leonard.snapshot')
+
+            # The snapshot covers the spawn command.
+            assert leo.takeSnapshot(fname).ok
+            assert numCommands() == 0
+
+            # Apply a new command after the snapshot.
+            assert leoAPI.addCmdModifyBodyState('1', {'imass': 5}).ok
+            leo.processCommandQueue()
+            assert leo.allBodies['1'].imass == 5
+            assert numCommands() == 1
+
+            # A new instance that resumes from the snapshot file must apply
+            # the command again.
+            leo_2 = getLeo()
+            assert leo_2.resumeSnapshot(fname).ok
+            assert leo_2.allBodies['1'].imass == 1
+            leo_2.processCommandQueue()
+            assert leo_2.allBodies['1'].imass == 5
+
+            # The next snapshot covers it.
+            assert leo_2.takeSnapshot(fname).ok
+            assert numCommands() == 0
+
+    def test_resume_default(self):
+        """
+        Leonard must resume from a snapshot if the configuration says so.
+        """
+        assert getLeonard(azrael.leonard.LeonardBase).resume is False
+        with mock.patch.object(config, 'snapshot_resume', True):
+            assert getLeonard(azrael.leonard.LeonardBase).resume is True
+            leo = azrael.leonard.LeonardBase(resume=False)
+            assert leo.resume is False
+
     def test_totalForceAndTorque_no_rotation(self):
         """
         Verify that 'totalForceAndTorque' correctly adds up the direct-
@@ -892,9 +1663,35 @@ class TestLeonardOther:
         assert igor.addConstraints([getP2P(rb_a='3', rb_b='4')]).ok
         _verify(s, [['1', '2', '3', '6', '4', '5']])
 
+    def test_constraint_sweeping_stale(self):
+        """
+        LeonardSweeping must not keep the constraints of earlier steps in its
+        Bullet world.
+        """
+        leo = getLeonard(azrael.leonard.LeonardSweeping)
+        world = leo.bullet.dynamicsWorld
+
+        # Link two bodies and step them.
+        id_a, id_b = '1', '2'
+        con = getP2P(rb_a=id_a, rb_b=id_b, pivot_a=(2, 0, 0),
+                     pivot_b=(-2, 0, 0))
+        assert self.igor.addConstraints([con]).ok
+        assert leoAPI.addCmdSpawn([
+            (id_a, getRigidBody(position=(-2, 0, 0))),
+            (id_b, getRigidBody(position=(2, 0, 0)))]).ok
+        leo.step(1.0, 60)
+        assert world.getNumConstraints() == 1
+
+        # Remove the constraint. The bodies are now isolated and never reach
+        # Bullet, but the constraint must still disappear from the world.
+        assert self.igor.removeConstraints([con]).ok
+        leo.step(1.0, 60)
+        assert world.getNumConstraints() == 0
+
     @pytest.mark.parametrize('clsLeonard', [
         azrael.leonard.LeonardBullet,
         azrael.leonard.LeonardSweeping,
+        azrael.leonard.LeonardThreaded,
         azrael.leonard.LeonardDistributedZeroMQ])
     def test_constraint_p2p(self, clsLeonard):
         """
@@ -0,0 +1,299 @@
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+"""
+Test the shared in-memory datastore.
+"""
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+import unittest.mock as mock
+import azrael.config as config
+import azrael.memstore as memstore
+import azrael.datastore as datastore
+
+from IPython import embed as ipshell
+
+
+def startServer(address, journal=None, compact=0):
+    """
+    Start a `DatastoreServer` and return once it accepts connections.
+    """
+    server = memstore.DatastoreServer(
+        address, journal, sync=True, compact=compact)
+    server.daemon = True
+    server.start()
+    for ii in range(100):
+        try:
+            memstore.DatastoreShared(('test1', 'test2'), address)
+            return server
+        except IOError:
+            time.sleep(0.05)
+    server.terminate()
+    assert False, 'Datastore server did not start'
+
+
+def stopServer(server):
+    server.terminate()
+    server.join()
+
+
+class TestMemStore:
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'datastore.sock')
+        self.journal = os.path.join(self.tmpdir, 'datastore.journal')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_api(self):
+        """
+        The shared datastore must behave exactly like the in-memory reference
+        implementation.
+        """
+        server = startServer(self.address)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        db_ref = datastore.DatastoreInMemory(('test1', 'test2'))
+        assert db.reset().ok
+
+        def both(method, *args):
+            ret = getattr(db, method)(*args)
+            assert ret == getattr(db_ref, method)(*args)
+            return ret
+
+        # Insert, replace and modify documents.
+        ops = {str(_): {'data': {'a': _, 'b': {'c': _, 'd': [1, 2]}}}
+               for _ in range(5)}
+        assert all(both('put', ops).data.values())
+        assert not any(both('put', ops).data.values())
+        assert both('replace', {'1': {'data': {'x': 1}}, '9': {'data': {}}}).ok
+        mod = {'inc': {('b', 'c'): 2}, 'set': {('b', 'e'): 'foo'},
+               'unset': [('a', )], 'exists': {('b', ): True}}
+        assert both('modify', {str(_): mod for _ in range(5)}).ok
+
+        # Query the documents, with and without projection.
+        both('getOne', '2', None)
+        both('getOne', '2', [('b', 'c')])
+        both('getOne', '9', None)
+        both('getMulti', ['0', '1', '9'], [('b', )])
+        both('getAll', None)
+        assert both('createIndex', ('b', 'c')).ok
+        assert both('query', {('b', 'c'): 4}, [('b', )]).data != {}
+        both('query', {('b', 'e'): 'foo'}, None)
+        assert db.indexes == [('b', 'c')]
+        assert both('count').data == 5
+        assert sorted(db.allKeys().data) == sorted(db_ref.allKeys().data)
+
+        # Counters.
+        assert both('incrementCounter', 'foo', 2).data == 2
+        assert both('setCounter', 'foo', 5).data == 5
+        assert both('getCounter', 'foo').data == 5
+        assert both('removeCounter', 'foo').ok
+
+        # Remove documents.
+        assert both('remove', ['0', '1', '9']).data == 2
+
+        # Invalid arguments must produce an error, not crash the server.
+        assert not db.getOne('0', [('a.b', )]).ok
+        assert not db.pipeline([('foo', ())])[0].ok
+        assert not db.pipeline([('getOne', (1, 2, 3, 4))])[0].ok
+        assert db.count().data == 3
+
+        # Other data stores must be independent.
+        db2 = memstore.DatastoreShared(('test1', 'test3'), self.address)
+        assert db2.count().data == 0
+
+        # The client must report a lost connection and reconnect afterwards.
+        stopServer(server)
+        assert not db.count().ok
+        server = startServer(self.address)
+        assert db.count() == (True, None, 0)
+        stopServer(server)
+
+    def test_pipeline_and_processes(self):
+        """
+        Pipelined requests must return their results in order, and all
+        processes must see the same data.
+        """
+        server = startServer(self.address)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db.reset().ok
+
+        calls = [('put', ({'1': {'data': {'a': 1}}}, ))]
+        calls += [('incrementCounter', ('foo', 1))] * 100
+        calls += [('getOne', ('1', None))]
+        ret = db.pipeline(calls)
+        assert len(ret) == 102
+        assert [_.data for _ in ret[1:-1]] == list(range(1, 101))
+        assert ret[-1] == (True, None, {'a': 1})
+
+        # Several processes increment the same counter. The final value must
+        # account for all increments. The client handle must reconnect in
+        # every process.
+        def work():
+            for ii in range(50):
+                assert db.incrementCounter('foo', 1).ok
+        procs = [multiprocessing.Process(target=work) for _ in range(4)]
+        [_.start() for _ in procs]
+        [_.join() for _ in procs]
+        assert [_.exitcode for _ in procs] == [0] * 4
+        assert db.getCounter('foo').data == 300
+        stopServer(server)
+
+    def test_change_feed(self):
+        """
+        Subscribers must receive the changes of all clients.
+        """
+        server = startServer(self.address)
+        db_1 = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        db_2 = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db_1.reset().ok
+
+        feed = db_1.subscribe().data
+        assert db_2.put({'1': {'data': {'a': 1}}}).ok
+        mod = {'inc': {('a', ): 1}, 'set': {}, 'unset': [], 'exists': {}}
+        assert db_2.modify({'1': mod}).ok
+        assert db_2.remove(['1']).ok
+
+        events = []
+        for ii in range(10):
+            events += feed.poll(timeout=0.5)
+            if len(events) >= 3:
+                break
+        assert [(_.op, _.aid, _.keys) for _ in events] == [
+            ('insert', '1', None),
+            ('modify', '1', [('a', )]),
+            ('remove', '1', None)]
+        assert events[0].version < events[1].version < events[2].version
+
+        # Closing the feed must end its thread.
+        feed.close()
+        feed.thread.join(1)
+        assert not feed.thread.is_alive()
+        stopServer(server)
+
+        # Subscribing must fail without a server.
+        assert not db_1.subscribe().ok
+
+    def test_journal(self):
+        """
+        A restarted server must restore the content from its journal.
+        """
+        server = startServer(self.address, self.journal)
+        db = memstore.DatastoreShared(
+            ('test1', 'test2'), self.address, indexes=[('a', )])
+        assert db.reset().ok
+        assert db.put({'1': {'data': {'a': 0}}, '2': {'data': {}}}).ok
+        mod = {'inc': {('a', ): 1}, 'set': {}, 'unset': [], 'exists': {}}
+        for ii in range(100):
+            assert db.modify({'1': mod}).ok
+        assert db.remove(['2']).data == 1
+        assert db.setCounter('foo', 5).ok
+        size = os.path.getsize(self.journal)
+        stopServer(server)
+
+        # Restart the server. The content must be intact and the journal
+        # compacted.
+        server = startServer(self.address, self.journal)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db.getAll() == (True, None, {'1': {'a': 100}})
+        assert db.query({('a', ): 100}) == (True, None, {'1': {'a': 100}})
+        assert db.getCounter('foo').data == 5
+        assert os.path.getsize(self.journal) < size
+        stopServer(server)
+
+        # A truncated request at the end of the journal must be ignored.
+        with open(self.journal, 'ab') as fout:
+            fout.write(memstore._encode(('x', 'put', ()))[:-3])
+        server = startServer(self.address, self.journal)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db.getAll() == (True, None, {'1': {'a': 100}})
+        stopServer(server)
+
+    def test_journal_compact(self):
+        """
+        The server must compact its journal once it has grown by the
+        specified number of write requests.
+        """
+        server = startServer(self.address, self.journal, compact=10)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db.reset().ok
+        assert db.put({'1': {'data': {'a': 0}}}).ok
+        size = os.path.getsize(self.journal)
+
+        # The journal must not grow with the number of requests.
+        mod = {'inc': {('a', ): 1}, 'set': {}, 'unset': [], 'exists': {}}
+        for ii in range(100):
+            assert db.modify({'1': mod}).ok
+        assert os.path.getsize(self.journal) < 5 * size
+        stopServer(server)
+
+        # The compacted journal must restore the content.
+        server = startServer(self.address, self.journal)
+        db = memstore.DatastoreShared(('test1', 'test2'), self.address)
+        assert db.getAll() == (True, None, {'1': {'a': 100}})
+        stopServer(server)
+
+    def test_reply_after_journal(self):
+        """
+        The server must only send replies once the journal is on disk.
+        """
+        server = memstore.DatastoreServer(self.address, self.journal)
+        order = []
+        server.fjournal = mock.MagicMock()
+        server.fjournal.flush.side_effect = lambda: order.append('journal')
+        server.dirty = True
+        conn = mock.MagicMock()
+        conn.closed = False
+        conn.feed = None
+        conn.outbuf = b'reply'
+        key = mock.MagicMock()
+        key.data = conn
+        mask = memstore.selectors.EVENT_READ | memstore.selectors.EVENT_WRITE
+        server.selector = mock.MagicMock()
+        server.selector.select.return_value = [(key, mask)]
+        server.selector.get_map.return_value = {1: key}
+        server.readConnection = mock.MagicMock()
+        server.flushConnection = lambda _: order.append('reply')
+        server.processEvents(0.1)
+        assert order == ['journal', 'reply']
+
+    def test_init(self):
+        """
+        The 'init' function must use the shared datastore if so configured.
+        """
+        server = startServer(self.address)
+        with mock.patch.object(config, 'datastore_backend', 'shared'), \
+                mock.patch.object(config, 'datastore_socket', self.address):
+            assert datastore.init(flush=True).ok
+            db = datastore.getDSHandle('Commands')
+            assert isinstance(db, memstore.DatastoreShared)
+            assert datastore.getUniqueObjectIDs(2) == (True, None, ['1', '2'])
+        stopServer(server)
+
+        # Restore the default datastores.
+        assert datastore.init(flush=True).ok
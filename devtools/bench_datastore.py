@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+# Copyright 2014, Oliver Nagy <olitheolix@gmail.com>
+#
+# This file is part of Azrael (https://github.com/olitheolix/azrael)
+#
+# Azrael is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Azrael is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Azrael. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark the write operations of the Mongo datastore.
+
+Compare one round trip per document (the original implementation) with the
+bulk writes of ``DatastoreMongo`` for various batch sizes.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Augment the Python path so that we can include the main project.
+p = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(p, '..'))
+del p
+
+import azrael.datastore
+
+from IPython import embed as ipshell
+
+
+def parseCommandLine():
+    """
+    Parse program arguments.
+    """
+    # Create the parser.
+    parser = argparse.ArgumentParser(
+        description=('Benchmark the Mongo datastore'),
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    # Shorthand.
+    padd = parser.add_argument
+
+    # Add the command line options.
+    padd('--num', metavar='N', type=int, default=5000,
+         help='Number of documents')
+    padd('--batch', metavar='N', type=int, nargs='+',
+         default=[1, 10, 100, 1000, 10000],
+         help='Batch sizes to test')
+    padd('--w', metavar='N', type=int, default=1,
+         help='Write concern')
+
+    # Run the parser.
+    return parser.parse_args()
+
+
+def compileOps(num: int):
+    """
+    Return the put-, replace- and modify operations for ``num`` documents.
+
+    The documents resemble the object instances Leonard synchronises.
+    """
+    def doc(ii):
+        return {'template': {'rbs': {'position': [ii, 0, 0],
+                                     'velocityLin': [0, 1, 0]}},
+                'version': 0}
+
+    aids = [str(_) for _ in range(num)]
+    put = {aid: {'data': doc(ii)} for ii, aid in enumerate(aids)}
+    rep = {aid: {'data': doc(-ii)} for ii, aid in enumerate(aids)}
+    mod = {
+        aid: {
+            'inc': {('version', ): 1},
+            'set': {('template', 'rbs', 'position'): [ii, 1, 0]},
+            'unset': [],
+            'exists': {('template', 'rbs'): True},
+        } for ii, aid in enumerate(aids)
+    }
+    return aids, put, rep, mod
+
+
+def loopWrites(db, put, rep, mod):
+    """
+    Issue all operations with one round trip per document, like the original
+    ``DatastoreMongo`` implementation did.
+    """
+    col = db.db
+    for aid, op in put.items():
+        data = dict(op['data'], aid=aid)
+        col.update_one({'aid': aid}, {'$setOnInsert': data}, upsert=True)
+    for aid, op in rep.items():
+        col.replace_one({'aid': aid}, dict(op['data'], aid=aid), upsert=False)
+    for aid, op in mod.items():
+        query = {'.'.join(k): {'$exists': v} for k, v in op['exists'].items()}
+        query['aid'] = aid
+        update = {
+            '$inc': {'.'.join(k): v for k, v in op['inc'].items()},
+            '$set': {'.'.join(k): v for k, v in op['set'].items()},
+        }
+        col.update_one(query, update, upsert=False)
+
+
+def timeit(fun, *args):
+    t0 = time.time()
+    fun(*args)
+    return time.time() - t0
+
+
+def main():
+    param = parseCommandLine()
+    aids, put, rep, mod = compileOps(param.num)
+    name = ('azrael_bench', 'Datastore')
+    wc = {'w': param.w}
+
+    # Header.
+    print('Documents: {}, write concern: {}'.format(param.num, wc))
+    print('{:>10s}{:>10s}{:>10s}{:>10s}{:>10s}'.format(
+        'Batch', 'Put', 'Replace', 'Modify', 'Remove'))
+    fmt = '{:>10s}{:10.3f}{:10.3f}{:10.3f}{:10.3f}'
+
+    # Baseline: one round trip per document.
+    db = azrael.datastore.DatastoreMongo(name, writeConcern=wc)
+    db.reset()
+    t0 = time.time()
+    loopWrites(db, put, {}, {})
+    t_put = time.time() - t0
+    t_rep = timeit(loopWrites, db, {}, rep, {})
+    t_mod = timeit(loopWrites, db, {}, {}, mod)
+    t_rm = timeit(lambda: [db.db.delete_one({'aid': _}) for _ in aids])
+    print(fmt.format('loop', t_put, t_rep, t_mod, t_rm))
+
+    # Bulk writes.
+    for batchSize in param.batch:
+        db = azrael.datastore.DatastoreMongo(
+            name, batchSize=batchSize, writeConcern=wc)
+        db.reset()
+        t_put = timeit(db.put, put)
+        t_rep = timeit(db.replace, rep)
+        t_mod = timeit(db.modify, mod)
+        t_rm = timeit(db.remove, aids)
+        print(fmt.format(str(batchSize), t_put, t_rep, t_mod, t_rm))
+    db.db.drop()
+
+
+if __name__ == '__main__':
+    main()
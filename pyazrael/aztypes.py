@@ -43,7 +43,8 @@ logit = logging.getLogger('azrael.' + __name__)
 RetVal = namedtuple('RetVal', 'ok msg data')
 
 # Object Template.
-_Template = namedtuple('_Template', 'aid rbs fragments boosters factories custom')
+_Template = namedtuple('_Template',
+                       'aid rbs fragments boosters factories custom quality')
 
 # Fragments.
 _FragMeta = namedtuple('_FragMeta', 'fragtype scale position rotation files')
@@ -51,7 +52,7 @@ _FragMeta = namedtuple('_FragMeta', 'fragtype scale position rotation files')
 # Work package related.
 WPDataOut = namedtuple('WPDataOut', 'aid rbs force torque')
 WPDataRet = namedtuple('WPDataRet', 'aid body')
-WPMeta = namedtuple('WPAdmin', 'wpid dt maxsteps')
+WPMeta = namedtuple('WPAdmin', 'wpid dt maxsteps substeps')
 Forces = namedtuple('Forces',
                     'forceDirect forceBoost torqueDirect torqueBoost')
 
@@ -64,6 +65,10 @@ _RigidBodyData = namedtuple('_RigidBodyData',
 # Return value of 'bullet_api.getRigidBody'.
 RbStateUpdate = namedtuple('RbStateUpdate', 'position rotation vLin vRot')
 
+# Return value of 'bullet_api.getContactData'.
+ContactData = namedtuple('ContactData',
+                         'aid_a aid_b point_a point_b normal impulse')
+
 # Collision shapes.
 _CollShapeMeta = namedtuple('_CollShapeMeta', 'cstype position rotation csdata')
 _CollShapeBox = namedtuple('_CollShapeBox', 'x y z')
@@ -85,6 +90,11 @@ _Booster = namedtuple('Booster', 'position direction force ')
 _Factory = namedtuple('Factory', 'position direction templateID exit_speed')
 _CmdBooster = namedtuple('CmdBooster', 'force')
 _CmdFactory = namedtuple('CmdFactory', 'exit_speed')
+_CmdSchedule = namedtuple('CmdSchedule', 'time cmd_boosters force rpos')
+_ForceProfile = namedtuple('ForceProfile', 'ptype target params')
+_QualityProfile = namedtuple(
+    'QualityProfile', 'solverIterations splitImpulse warmstarting erp cfm '
+                      'contactThreshold substepScale')
 
 
 def toVec(num_el, v):
@@ -755,6 +765,178 @@ class CmdFactory(_CmdFactory):
         return OrderedDict(zip(self._fields, self))
 
 
+class CmdSchedule(_CmdSchedule):
+    """
+    Return a scheduled command wrapped into a ``CmdSchedule`` instance.
+
+    Leonard will apply the command ``time`` seconds after it received the
+    schedule. The command may contain ``cmd_boosters`` (a dictionary with
+    ``CmdBooster`` instances), a ``force`` that applies at position ``rpos``
+    relative to the centre of mass, or both. A ``force`` of *None* means the
+    command does not change the current force.
+
+    :param float time: time (relative to receipt of schedule) in seconds.
+    :param dict cmd_boosters: booster commands.
+    :param vec3 force: force vector (or *None*).
+    :param vec3 rpos: force position relative to centre of mass.
+    :return CmdSchedule: compiled description of scheduled command.
+    """
+    @typecheck
+    def __new__(cls, time: (int, float, np.float64),
+                cmd_boosters: dict={},
+                force: (tuple, list, np.ndarray)=None,
+                rpos: (tuple, list, np.ndarray)=(0, 0, 0)):
+        try:
+            # Verify the inputs.
+            time = float(time)
+            assert time >= 0
+            cmd_boosters = {
+                k: CmdBooster(**v) if isinstance(v, dict) else CmdBooster(*v)
+                for (k, v) in cmd_boosters.items()}
+            if force is not None:
+                force = toVec(3, force)
+            rpos = toVec(3, rpos)
+        except (TypeError, AssertionError):
+            msg = 'Cannot construct <{}>'.format(cls.__name__)
+            logit.warning(msg)
+            raise TypeError
+
+        # Return constructed data type.
+        return super().__new__(cls, time, cmd_boosters, force, rpos)
+
+    def _asdict(self):
+        cmd_boosters = {k: v._asdict() for (k, v) in self.cmd_boosters.items()}
+        return OrderedDict([
+            ('time', self.time),
+            ('cmd_boosters', cmd_boosters),
+            ('force', self.force),
+            ('rpos', self.rpos),
+        ])
+
+
+class ForceProfile(_ForceProfile):
+    """
+    Return an analytic force- or torque profile.
+
+    Leonard evaluates the profile in every physics step and adds the result
+    to the force (or torque) of the object. The time ``t`` is relative to
+    the moment Leonard received the profile. The supported profile types
+    ``ptype`` and their ``params`` are:
+
+    * 'sine': offset + amplitude * sin(2 * pi * frequency * t + phase)
+      with the keys 'amplitude' (vec3), 'frequency' (Hz), 'phase' (rad,
+      optional) and 'offset' (vec3, optional).
+    * 'ramp': linear transition from 'start' (vec3) to 'stop' (vec3)
+      between the times 't0' and 't1'.
+    * 'piecewise': linear interpolation of the vec3 'values' at the
+      ascending 'times'. The first/last value holds before/after the table.
+    * 'spring': stiffness * (position - body.position) - damping *
+      body.velocityLin with the keys 'position' (vec3), 'stiffness', and
+      'damping' (optional). Only valid for forces.
+
+    All vectors are in world coordinates.
+
+    :param str ptype: profile type ('sine', 'ramp', 'piecewise', 'spring').
+    :param str target: either 'force' or 'torque'.
+    :param dict params: profile parameters (see above).
+    :return ForceProfile: compiled profile description.
+    """
+    @typecheck
+    def __new__(cls, ptype: str, target: str='force', params: dict={}):
+        try:
+            assert target in ('force', 'torque')
+
+            def vec(v):
+                return [float(_) for _ in toVec(3, v)]
+
+            if ptype == 'sine':
+                params = {
+                    'amplitude': vec(params['amplitude']),
+                    'frequency': float(params['frequency']),
+                    'phase': float(params.get('phase', 0)),
+                    'offset': vec(params.get('offset', (0, 0, 0))),
+                }
+            elif ptype == 'ramp':
+                params = {
+                    'start': vec(params['start']),
+                    'stop': vec(params['stop']),
+                    't0': float(params['t0']),
+                    't1': float(params['t1']),
+                }
+                assert 0 <= params['t0'] < params['t1']
+            elif ptype == 'piecewise':
+                times = [float(_) for _ in toVec(0, params['times'])]
+                values = [vec(_) for _ in params['values']]
+                assert 0 < len(times) == len(values)
+                assert np.all(np.diff(times) > 0)
+                params = {'times': times, 'values': values}
+            elif ptype == 'spring':
+                assert target == 'force'
+                params = {
+                    'position': vec(params['position']),
+                    'stiffness': float(params['stiffness']),
+                    'damping': float(params.get('damping', 0)),
+                }
+                assert params['stiffness'] >= 0 and params['damping'] >= 0
+            else:
+                assert False
+        except (TypeError, ValueError, KeyError, AssertionError):
+            msg = 'Cannot construct <{}>'.format(cls.__name__)
+            logit.warning(msg)
+            raise TypeError
+
+        # Return constructed data type.
+        return super().__new__(cls, ptype, target, params)
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+
+class QualityProfile(_QualityProfile):
+    """
+    Return the solver settings for one physics quality tier.
+
+    Leonard applies the profile to every collision set. This makes it
+    possible to simulate eg. debris with a cheap profile and docking
+    manoeuvres with an accurate one.
+
+    :param int solverIterations: number of constraint solver iterations.
+    :param bool splitImpulse: use split impulses for penetration recovery.
+    :param float warmstarting: warm starting factor in [0, 1].
+    :param float erp: error reduction parameter in [0, 1].
+    :param float cfm: constraint force mixing (non-negative).
+    :param float contactThreshold: contacts further apart than this are not
+        processed by the solver (non-negative).
+    :param float substepScale: scale factor for the number of sub-steps.
+    :return QualityProfile: compiled profile description.
+    """
+    @typecheck
+    def __new__(cls, solverIterations: int=10, splitImpulse: bool=True,
+                warmstarting: (int, float)=0.85, erp: (int, float)=0.2,
+                cfm: (int, float)=0, contactThreshold: (int, float)=1E30,
+                substepScale: (int, float)=1):
+        try:
+            assert solverIterations > 0
+            assert 0 <= warmstarting <= 1
+            assert 0 <= erp <= 1
+            assert cfm >= 0
+            assert contactThreshold >= 0
+            assert substepScale > 0
+        except AssertionError:
+            msg = 'Cannot construct <{}>'.format(cls.__name__)
+            logit.warning(msg)
+            raise TypeError
+
+        # Return constructed data type.
+        return super().__new__(
+            cls, solverIterations, splitImpulse, float(warmstarting),
+            float(erp), float(cfm), float(contactThreshold),
+            float(substepScale))
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self))
+
+
 class RigidBodyData(_RigidBodyData):
     """
     Return a valid Rigid Body object.
@@ -899,6 +1081,9 @@ class Template(_Template):
     :param list[FragMeta] fragments: geometry fragments.
     :param list[Booster] boosters: booster data
     :param list[Factory] factories: factory data
+    :param str custom: custom data.
+    :param str quality: name of the physics quality tier (empty string for
+        the default tier).
     :return: compiled ``_Template`` instance.
     :raises: TypeError if the input does not compile to the data type.
     """
@@ -909,7 +1094,8 @@ class Template(_Template):
                 fragments: dict,
                 boosters: dict,
                 factories: dict,
-                custom: str=''):
+                custom: str='',
+                quality: str=''):
         try:
             # Sanity check the AID of the template, boosters, and factories.
             assert isValidAIDString(aid)
@@ -956,7 +1142,7 @@ class Template(_Template):
 
         # Return constructed data type.
         return super().__new__(
-            cls, aid, rbs, fragments, boosters, factories, custom)
+            cls, aid, rbs, fragments, boosters, factories, custom, quality)
 
     def _asdict(self):
         fragments = {k: v._asdict() for (k, v) in self.fragments.items()}
@@ -968,5 +1154,6 @@ class Template(_Template):
                         fragments=fragments,
                         boosters=boosters,
                         factories=factories,
-                        custom=self.custom)
+                        custom=self.custom,
+                        quality=self.quality)
         return OrderedDict(zip(tmp._fields, tmp))
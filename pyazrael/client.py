@@ -528,6 +528,73 @@ class Client():
 
         return self.serialiseAndSend('set_force', payload)
 
+    @typecheck
+    def setSchedule(self, objID: str, schedule: (tuple, list)):
+        """
+        Install a ``schedule`` of booster- and force commands for ``objID``.
+
+        Each element in ``schedule`` must be a ``CmdSchedule`` instance.
+        Leonard applies every command at the simulation step that matches its
+        time stamp (relative to the moment Leonard receives the schedule).
+        A new schedule replaces the current one.
+
+        :param str objID: object ID.
+        :param list[CmdSchedule] schedule: the scheduled commands.
+        :return: Success
+        """
+        # Sanity checks.
+        for cmd in schedule:
+            assert isinstance(cmd, aztypes.CmdSchedule)
+
+        payload = {
+            'objID': objID,
+            'schedule': [_._asdict() for _ in schedule]
+        }
+        return self.serialiseAndSend('set_schedule', payload)
+
+    @typecheck
+    def cancelSchedule(self, objID: str):
+        """
+        Cancel the command schedule of ``objID``.
+
+        :param str objID: object ID.
+        :return: Success
+        """
+        return self.setSchedule(objID, [])
+
+    @typecheck
+    def getScheduleStatus(self, objIDs: (tuple, list)):
+        """
+        Return the status of the command schedules for all ``objIDs``.
+
+        :param list[str] objIDs: object IDs.
+        :return: dictionary of schedule status (see ``Clerk``).
+        """
+        return self.serialiseAndSend('get_schedule_status', {'objIDs': objIDs})
+
+    @typecheck
+    def setForceProfiles(self, objID: str, profiles: (tuple, list)):
+        """
+        Replace the analytic force- and torque profiles of ``objID``.
+
+        Each element in ``profiles`` must be a ``ForceProfile`` instance.
+        Leonard evaluates them in every physics step and adds the result to
+        the other forces on the object. An empty list removes all profiles.
+
+        :param str objID: object ID.
+        :param list[ForceProfile] profiles: the new profiles.
+        :return: Success
+        """
+        # Sanity checks.
+        for prof in profiles:
+            assert isinstance(prof, aztypes.ForceProfile)
+
+        payload = {
+            'objID': objID,
+            'profiles': [_._asdict() for _ in profiles]
+        }
+        return self.serialiseAndSend('set_force_profiles', payload)
+
     @typecheck
     def addConstraints(self, constraints: (tuple, list)):
         """